@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+"""
+Normalizes an expression matrix generated by XICRA and tests differential
+expression between groups of samples (see XICRA.scripts.diff_expression).
+"""
+## import useful modules
+import os
+import time
+import csv
+import pandas as pd
+from termcolor import colored
+
+## import my modules
+from HCGB import functions
+from XICRA.scripts import diff_expression, expression_matrix
+
+##############################################
+def run_DE(options):
+    """Main function of the module, organizes the differential expression analysis.
+
+    Reads the expression matrix and the sample sheet, estimates size factors and
+    dispersions, fits the model and tests all contrasts. Results are stored in the
+    output folder: size_factors.csv, normalized_counts.csv, dispersions.csv and a
+    table for each contrast (e.g. DE_condition_case_vs_control.csv).
+
+    :param options: input parameters introduced by the user. See XICRA DE -h.
+
+    :returns: None
+    """
+    ## init time
+    start_time_total = time.time()
+
+    ## debugging messages
+    global Debug
+    if (options.debug):
+        Debug = True
+    else:
+        Debug = False
+
+    functions.aesthetics_functions.pipeline_header('XICRA')
+    functions.aesthetics_functions.boxymcboxface("Differential expression analysis")
+    print ("--------- Starting Process ---------")
+    functions.time_functions.print_time()
+
+    ## absolute path for in & out
+    input_file = os.path.abspath(options.input)
+    outdir = os.path.abspath(options.output_folder)
+    functions.files_functions.create_folder(outdir)
+
+    ## read data
+    print ("+ Reading expression matrix: ", input_file)
+    counts_df = expression_matrix.read_matrix_file(input_file)
+
+    print ("+ Reading sample sheet: ", options.sample_sheet)
+    sample_sheet = pd.read_csv(os.path.abspath(options.sample_sheet), sep=None, engine='python', index_col=0)
+    sample_sheet.index = sample_sheet.index.astype(str)
+
+    ## reference levels: factor,level
+    reference = dict([ item.split(',', 1) for item in (options.reference or []) ])
+
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: counts_df **", 'yellow'))
+        print (counts_df)
+        print (colored("**DEBUG: sample_sheet **", 'yellow'))
+        print (sample_sheet)
+
+    print ("+ Design: ~ " + " + ".join(options.design))
+    print ("+ Normalization: ", options.normalization)
+    print ("+ Test: ", options.test)
+
+    try:
+        results = diff_expression.DE_analysis(counts_df, sample_sheet, options.design, contrasts=options.contrast,
+                                              method=options.normalization, test=options.test, reference=reference,
+                                              min_counts=options.min_counts, Debug=Debug)
+    except (KeyError, ValueError) as exc:
+        print (colored("** ERROR: Differential expression analysis failed: %s" %exc, 'red'))
+        exit()
+
+    ## dump results
+    print ("+ Saving results in folder: ", outdir)
+    results['size_factors'].to_csv(os.path.join(outdir, 'size_factors.csv'), quoting=csv.QUOTE_NONNUMERIC)
+    results['normalized'].to_csv(os.path.join(outdir, 'normalized_counts.csv'), quoting=csv.QUOTE_NONNUMERIC)
+    results['dispersions'].to_csv(os.path.join(outdir, 'dispersions.csv'), quoting=csv.QUOTE_NONNUMERIC)
+    for name, table in results['results'].items():
+        table.to_csv(os.path.join(outdir, 'DE_' + name + '.csv'), quoting=csv.QUOTE_NONNUMERIC)
+        print ("\t+ %s: %s features with padj < 0.05" %(name, (table['padj'] < 0.05).sum()))
+
+    print ("\n*************** Finish *******************")
+    functions.time_functions.timestamp(start_time_total)
+    print ("\n+ Exiting DE module.")
+    return()
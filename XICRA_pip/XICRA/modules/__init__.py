@@ -3,6 +3,7 @@ __all__ = [
 	'config',
 	'citation',
 	'database',
+	'DE',
 	'help_XICRA',
 	'join',
 	'miRNA',
@@ -11,7 +12,8 @@ __all__ = [
 	'trim',
 	'tRNA',
 	'piRNA',
-	'map'
+	'map',
+	'pipeline'
 	
 ]
 
@@ -21,6 +21,7 @@ from termcolor import colored
 from XICRA.config import set_config
 from XICRA.modules import help_XICRA, map
 from XICRA.scripts import RNAbiotype, multiQC_report, get_length_distribution
+from XICRA.scripts import resource_manager, step_cache
 from XICRA.other_tools import tools
 
 from HCGB import sampleParser
@@ -34,10 +35,12 @@ def run_biotype(options):
 
     First, checks if the files needed to do the mapping (and posterior
     classification of the reads) have been provided by the user:
-    fasta sequence + annotation or STAR index directory. 
+    fasta sequence + annotation, STAR index directory or bowtie index. 
 
-    First, it executes the maping calling map XICRA module.
-    Then, it calls RNAbiotype_module_call() to execute featureCounts.
+    First, it executes the maping calling map XICRA module, unless all samples 
+    were previously mapped (e.g. XICRA map).
+    Then, it calls RNAbiotype_module_call() to execute featureCounts for each 
+    sample or for all samples at once (--cohort_counts).
     
     Finally, generate the MultiQC featureCounts report of all samples.
     
@@ -70,6 +73,9 @@ def run_biotype(options):
         Debug = True
     else:
         Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
         
     ### set as default paired_end mode
     if (options.single_end):
@@ -139,10 +145,9 @@ def run_biotype(options):
     # time stamp
     start_time_partial = time_functions.timestamp(start_time_total)
 
-    ## optimize threads
+    ## optimize threads: CPUs and memory required for featureCounts (mapping is planned by map module)
     name_list = set(pd_samples_retrieved["new_name"].tolist())
-    threads_job = main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
+    (threads_job, max_workers_int) = resource_manager.plan_jobs('featureCounts', options.threads, len(name_list), Debug=options.debug)
     
     ## debug message
     if (Debug):
@@ -153,8 +158,14 @@ def run_biotype(options):
     ##############################################
     ## map Reads
     ##############################################
-    (start_time_partial, mapping_results) = map.mapReads_module_STAR(options, pd_samples_retrieved, mapping_outdir_dict, 
-                    options.debug, max_workers_int, threads_job, start_time_partial, outdir)
+    ## use BAM files of a previous mapping (e.g. XICRA map) if available for all samples
+    mapping_results = map.mapped_samples(options, input_dir, name_list) if options.project else None
+    if mapping_results:
+        print ("+ Mapping available for all samples: BAM files generated previously are used.")
+    else:
+        map.check_aligner(options)
+        (start_time_partial, mapping_results) = map.mapReads_module(options, pd_samples_retrieved, mapping_outdir_dict, 
+                        options.debug, start_time_partial, outdir)
 
     ## debug message
     if (Debug):
@@ -182,9 +193,15 @@ def run_biotype(options):
     ## feature counts
     ##############################################
 
+    ## count all samples in one or a few featureCounts calls using all threads available
+    cohort_folder = None
+    if options.cohort_counts:
+        cohort_folder = files_functions.create_subfolder("featureCounts", files_functions.create_subfolder("biotype", files_functions.create_subfolder("report", outdir)))
+        (threads_job, max_workers_int) = (options.threads, 1)
+
     ## get RNAbiotype information
     RNAbiotype.RNAbiotype_module_call(mapping_results, biotype_outdir_dict, options.annotation, 
-                                      options.debug, max_workers_int, threads_job, multimapping, options.stranded)
+                                      options.debug, max_workers_int, threads_job, multimapping, options.stranded, cohort_folder)
 
     # time stamp
     start_time_partial = time_functions.timestamp(start_time_partial)
@@ -230,7 +247,7 @@ def run_biotype(options):
                 shutil.copy(pdf_plot[0], single_files_biotype)
         
         ## collapse all information
-        all_data = RNAbiotype.generate_matrix(dict_files)
+        all_data = RNAbiotype.generate_matrix(dict_files, options.threads)
     
         ## print into excel/csv
         print ('+ Table contains: ', len(all_data), ' entries\n')
@@ -49,9 +49,8 @@ def miRNA_db(options):
     list_files = functions.main_functions.get_fullpath_list(options.miRNA_db, options.debug)
     
     ## Check for files from miRBase:
-    miRBase_files = ["hsa.gff3", "hairpin.fa", "mature.fa", "miRNA.str"]
+    miRBase_files = [options.species + ".gff3", "hairpin.fa", "mature.fa", "miRNA.str"]
     miRBase_files_dict = {}
-    download_data=False
     
     ## get file names
     list_names = list(map(os.path.basename, list_files))
@@ -65,7 +64,6 @@ def miRNA_db(options):
             aesthetics_functions.debug_message("file_req: " + file_req)
             
         if file_req not in list_names:
-            download_data=True
             miRBase_files_dict[file_req] = ""
         else:
             file_retrieved = functions.main_functions.retrieve_matching_files(options.miRNA_db, file_req, options.debug, starts=False)
@@ -83,84 +81,48 @@ def miRNA_db(options):
     ftp_site = "https://www.mirbase.org/ftp/CURRENT/"
     
     ## -------------------------------
-    ## miRNA_gff: can be set as automatic to download from miRBase
+    ## files provided are used; otherwise, available in database or downloaded from miRBase
     ## -------------------------------
-    if not miRBase_files_dict['hsa.gff3']:
-        print ("+ File miRNA gff3 annotation")
-        if Debug:
-            print (colored("\t** ATTENTION: No miRNA gff file provided", 'yellow'))     
-        print (colored("\t** Download it form miRBase", 'green'))
-        file_name = options.species + ".gff3"
-        ftp_site1 = "https://www.mirbase.org/ftp/CURRENT/genomes/" 
-        options.miRNA_gff = functions.main_functions.urllib_request(options.miRNA_db, ftp_site1, file_name, Debug)
-        
-    else:
-        if (options.miRNA_gff):
-            print ("\t+ miRNA gff file provided")
-            options.miRNA_gff = os.path.abspath(options.miRNA_gff)
-        else:
-            print ("\t+ miRNA gff file available")
-            options.miRNA_gff = miRBase_files_dict['hsa.gff3']
-
-    ## -------------------------------
-    ## hairpin: can be set as automatic to download from miRBase
-    ## -------------------------------
-    if not miRBase_files_dict['hairpin.fa']:
-        print ("+ File hairpin fasta")
-        if Debug:
-            print (colored("\t** ATTENTION: No hairpin fasta file provided", 'yellow'))        
-        print (colored("\t** Download it form miRBase", 'green'))
-        options.hairpinFasta = functions.main_functions.urllib_request(options.miRNA_db, ftp_site, "hairpin.fa.gz", Debug)
-        
-    else:
-        if (options.hairpinFasta):
-            print ("\t+ hairpin fasta file provided")
-            options.hairpinFasta = os.path.abspath(options.hairpinFasta)
-        else:
-            print ("\t+ hairpin fasta file available")
-            options.miRNA_gff = miRBase_files_dict['hairpin.fa']
-            
-   
-    ## -------------------------------
-    ## mature: can be set as automatic to download from miRBase
-    ## -------------------------------
-    if not miRBase_files_dict['mature.fa']:
-        print ("+ File mature fasta")
-        if Debug:
-            print (colored("\t** ATTENTION: No mature miRNA fasta file provided", 'yellow'))        
-        print (colored("\t** Download it form miRBase", 'green'))
-        options.matureFasta = functions.main_functions.urllib_request(options.miRNA_db, ftp_site, "mature.fa.gz", Debug)
-
-    else:
-        if (options.matureFasta):
-            print ("\t+ mature fasta file provided")
-            options.matureFasta = os.path.abspath(options.matureFasta)
-        else:
-            print ("\t+ miRNA gff file available")
-            options.matureFasta = miRBase_files_dict['mature.fa']
-        
-    ## -------------------------------
-    ## miRBase str: can be set as automatic to download from miRBase
-    ## -------------------------------
-    if not miRBase_files_dict['miRNA.str']:
-        print ("+ File miRBase str annotation")
-        if Debug:
-            print (colored("\t** ATTENTION: No miRBase_str file provided", 'yellow'))        
-        print (colored("\t** Download it form miRBase", 'green'))
-        options.miRBase_str = functions.main_functions.urllib_request(options.miRNA_db, ftp_site, "miRNA.str.gz", Debug)
-        ## extract
-        
-    else:
-        if (options.miRBase_str):
-            print ("\t+ miRBase_str file provided")
-            options.miRBase_str = os.path.abspath(options.miRBase_str)
-        else:
-            print ("\t+ miRBase str file available")
-            options.miRBase_str = miRBase_files_dict['miRNA.str']
+    options.miRNA_gff = miRBase_file(options.miRNA_gff, miRBase_files_dict[options.species + '.gff3'], options.miRNA_db, 
+                                     ftp_site + "genomes/", options.species + ".gff3", "miRNA gff3 annotation", Debug)
+    options.hairpinFasta = miRBase_file(options.hairpinFasta, miRBase_files_dict['hairpin.fa'], options.miRNA_db, 
+                                        ftp_site, "hairpin.fa.gz", "hairpin fasta", Debug)
+    options.matureFasta = miRBase_file(options.matureFasta, miRBase_files_dict['mature.fa'], options.miRNA_db, 
+                                       ftp_site, "mature.fa.gz", "mature fasta", Debug)
+    options.miRBase_str = miRBase_file(options.miRBase_str, miRBase_files_dict['miRNA.str'], options.miRNA_db, 
+                                       ftp_site, "miRNA.str.gz", "miRBase str annotation", Debug)
         
     ## -------------------------------
     return (options)    
 
+##############################################
+def miRBase_file(file_provided, file_available, folder, ftp_site, file_name, label, Debug):
+    """Returns the miRBase file to use: provided by the user, available in the database folder or downloaded.
+
+    :param file_provided: File provided by the user or None.
+    :param file_available: File available in the database folder or empty.
+    :param folder: Database folder to store files downloaded.
+    :param ftp_site: miRBase site to download the file.
+    :param file_name: Name of the file to download.
+    :param label: Description of the file for messages.
+    :param Debug: show extra information of the process.
+    
+    :returns: Absolute path to the file.
+    """
+    if file_provided:
+        print ("\t+ %s file provided" %label)
+        return (os.path.abspath(file_provided))
+    
+    if file_available:
+        print ("\t+ %s file available" %label)
+        return (file_available)
+    
+    print ("+ File " + label)
+    if Debug:
+        print (colored("\t** ATTENTION: No %s file provided" %label, 'yellow'))
+    print (colored("\t** Download it form miRBase", 'green'))
+    return (functions.main_functions.urllib_request(folder, ftp_site, file_name, Debug))
+
 ##############################################
 def tRNA_db(database, tRNA_db, debug):
     
@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from XICRA.modules import help_XICRA
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, resource_manager, exec_trace
 from HCGB import functions
 from HCGB import sampleParser
 
@@ -49,6 +50,9 @@ def run_join(options):
         Debug = True
     else:
         Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
         
     ### set as default paired_end mode
     if (options.single_end):
@@ -100,10 +104,9 @@ def run_join(options):
     ## for samples
     outdir_dict = functions.files_functions.outdir_project(outdir, options.project, pd_samples_retrieved, "join", options.debug)
     
-    ## optimize threads
+    ## optimize threads: CPUs and memory required
     name_list = set(pd_samples_retrieved["new_name"].tolist())
-    threads_job = functions.main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
+    (threads_job, max_workers_int) = resource_manager.plan_jobs('fastqjoin', options.threads, len(name_list), Debug=options.debug)
 
     ## debug message
     if (Debug):
@@ -114,7 +117,7 @@ def run_join(options):
     print ("+ Joining paired-end sequencing reads for each sample retrieved...")    
     
     # Group dataframe by sample name
-    sample_frame = pd_samples_retrieved.groupby(["new_name"])
+    sample_frame = pd_samples_retrieved.groupby("new_name")
     
     ## send for each sample
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
@@ -143,19 +146,25 @@ def run_join(options):
 
 #############################################
 def fastqjoin_caller(list_reads, sample_folder, name, threads, perc_diff, Debug):
-    ## check if previously joined and succeeded
-    filename_stamp = sample_folder + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'fastqjoin'), 'yellow'))
-    else:
+    ## output files
+    outputs = [ os.path.join(sample_folder, name + f) for f in ('_trim_joined.fastq', '_trimmed_unjoin_R1.fastq', 
+                                                                 '_trimmed_unjoin_R2.fastq', '.fastqjoin.log') ]
+
+    ## check if previously joined and succeeded with same inputs and parameters
+    (cached, step_info) = step_cache.check_step(sample_folder, 'fastqjoin', name, list_reads, "-p %s" %perc_diff, 
+                                                prog='fastqjoin', legacy_stamp=sample_folder + '/.success', Debug=Debug, 
+                                                outputs=outputs)
+    if not cached:
         # Call fastqjoin
         fastqjoin_exe = set_config.get_exe('fastqjoin')
         code_returned = fastqjoin(fastqjoin_exe, list_reads, sample_folder, name, threads, perc_diff, Debug)
         if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info, outputs)
         else:
             print ('** Sample %s failed...' %name)
+            return (False)
+    
+    return (True)
 
 #############################################
 def fastqjoin (fastqjoin_exe, reads, path, sample_name, num_threads, perc_diff, Debug):
@@ -190,5 +199,5 @@ def fastqjoin (fastqjoin_exe, reads, path, sample_name, num_threads, perc_diff,
         print ('** Wrong number of files provided for sample: %s...' %sample_name)
         return(False)
 
-    return(functions.system_call_functions.system_call(cmd))
+    return(exec_trace.system_call(cmd, 'fastqjoin', sample_name, inputs=reads, outputs=[path]))
     
\ No newline at end of file
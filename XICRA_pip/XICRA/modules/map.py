@@ -4,41 +4,226 @@
 ## Copyright (C) 2019-2020 Lauro Sumoy Lab, IGTP, Spain   ##
 ############################################################
 """
-Create RNA biotype analysis using STAR and featureCounts
+Maps reads of each sample against the reference genome (STAR or bowtie) and
+summarizes mapping statistics for all samples. BAM files generated are used
+by downstream modules (biotype, piRNA) without mapping again.
 """
 ## import useful modules
 import os
-import sys
-import re
 import time
-from io import open
-import shutil
 import concurrent.futures
-import pandas as pd
 from termcolor import colored
 
 ## import my modules
 from XICRA.config import set_config
 from XICRA.modules import help_XICRA
-from XICRA.scripts import RNAbiotype, STAR_caller, multiQC_report, get_length_distribution
-from XICRA.other_tools import tools
+from XICRA.scripts import STAR_caller, bowtie_caller, multiQC_report
+from XICRA.scripts import step_cache, reduced_reference
 
 from HCGB import sampleParser
-from HCGB.functions import fasta_functions, time_functions
-from HCGB.functions import aesthetics_functions, system_call_functions
-from HCGB.functions import files_functions, main_functions
+from HCGB.functions import time_functions
+from HCGB.functions import aesthetics_functions
+from HCGB.functions import files_functions
 
 ## set to use as a module
-## allow multiple software to map
-## e.g. bowtie
+## allow multiple software to map: each aligner generates the same results
+## (BAM file and Log.final.out), see mapReads_module()
+
+## folder for reference files and MultiQC module for each aligner
+aligner_info = { 'STAR':   { 'folder': 'STAR_files',   'report': 'STAR' },
+                 'bowtie': { 'folder': 'bowtie_files', 'report': 'bowtie' } }
 
 #########################################
 def run_mapping(options):
-    print("TODO: Implement this module")
+    """Main function of the module, organizes the mapping of the reads.
+
+    Reads of each sample (joined reads if paired-end data) are mapped using the 
+    aligner selected (see mapReads_module). BAM files and mapping statistics are 
+    stored in the map folder of each sample and summarized for all samples in 
+    report/map/mapping_statistics.csv (see mapping_report).
+
+    :param options: input parameters introduced by the user. See XICRA map -h.
+
+    :returns: None
+    """
+    ## init time
+    start_time_total = time.time()
+
+    ##################################
+    ### show help messages if desired    
+    ##################################
+    if (options.help_format):
+        ## help_format option
+        help_XICRA.help_fastq_format()
+    elif (options.help_project):
+        ## information for project
+        help_XICRA.project_help()
+        exit()
+
+    ## debugging messages
+    global Debug
+    if (options.debug):
+        Debug = True
+    else:
+        Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
+
+    ### set as default paired_end mode
+    if (options.single_end):
+        options.pair = False
+    else:
+        options.pair = True
+
+    aesthetics_functions.pipeline_header('XICRA')
+    aesthetics_functions.boxymcboxface("Mapping")
+    print ("--------- Starting Process ---------")
+    time_functions.print_time()
+
+    ## check reference
+    if not (options.fasta or options.genomeDir or options.bowtie_index):
+        print (colored("** ERROR: mapping requires --fasta, --genomeDir or --bowtie_index", 'red'))
+        exit()
+    if options.reduced_reference and not options.annotation:
+        print (colored("** WARNING: --reduced_reference requires --annotation. Reads will be mapped against the genome.", 'yellow'))
+        options.reduced_reference = False
+    check_aligner(options)
+
+    ## absolute path for in & out
+    input_dir = os.path.abspath(options.input)
+    outdir=""
+
+    ## set mode: project/detached
+    if (options.detached):
+        outdir = os.path.abspath(options.output_folder)
+        options.project = False
+    else:
+        options.project = True
+        outdir = input_dir        
+
+    ## get files
+    print ('+ Getting files from input folder... ')
+
+    ## get files: use joined reads if paired-end data
+    if options.pair:
+        options.pair = False ## set paired-end to false for further prepocessing
+        if options.noTrim:
+            print ('+ Mode: fastq.\n+ Extension: ')
+            print ("[ fastq, fq, fastq.gz, fq.gz ]\n")
+            pd_samples_retrieved = sampleParser.files.get_files(options, input_dir, "fastq", ["fastq", "fq", "fastq.gz", "fq.gz"], options.debug)
+        else:
+            print ('+ Mode: join.\n+ Extension: ')
+            print ("[_joined.fastq]\n")
+            pd_samples_retrieved = sampleParser.files.get_files(options, input_dir, "join", ['_joined.fastq'], options.debug)
+    else:
+        if options.noTrim:
+            print ('+ Mode: fastq.\n+ Extension: ')
+            print ("[ fastq, fq, fastq.gz, fq.gz ]\n")
+            pd_samples_retrieved = sampleParser.files.get_files(options, input_dir, "fastq", ["fastq", "fq", "fastq.gz", "fq.gz"], options.debug)
+        else:
+            print ('+ Mode: join.\n+ Extension: ')
+            print ("[_joined.fastq]\n")
+            pd_samples_retrieved = sampleParser.files.get_files(options, input_dir, "trim", ['_trim'], options.debug)
+
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: pd_samples_retrieve **", 'yellow'))
+        print (pd_samples_retrieved)
+
+    ## generate output folder, if necessary
+    print ("\n+ Create output folder(s):")
+    if not options.project:
+        files_functions.create_folder(outdir)
+
+    ## for samples
+    mapping_outdir_dict = files_functions.outdir_project(outdir, options.project, pd_samples_retrieved, "map", options.debug)
+
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: mapping_outdir_dict **", 'yellow'))
+        print (mapping_outdir_dict)
+
+    # time stamp
+    start_time_partial = time_functions.timestamp(start_time_total)
+
+    ##############################################
+    ## map Reads
+    ##############################################
+    (start_time_partial, mapping_results) = mapReads_module(options, pd_samples_retrieved, mapping_outdir_dict, 
+                                                            Debug, start_time_partial, outdir)
+
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: mapping_results **", 'yellow'))
+        print (mapping_results)
+
+    print ("\n*************** Finish *******************")
+    start_time_partial = time_functions.timestamp(start_time_total)
+    print ("\n+ Exiting map module.")
+    return()
+
+#########################################
+def mapped_samples(options, input_dir, name_list):
+    """Returns the BAM files of the samples provided if all of them were mapped previously (e.g. XICRA map).
+
+    A sample is mapped if its BAM file and mapping statistics (Log.final.out) are available.
+
+    :param options: input parameters introduced by the user.
+    :param input_dir: input folder of the project.
+    :param name_list: names of the samples to analyze.
+
+    :returns: Dictionary with the BAM file of each sample or None if any sample is not mapped.
+    """
+    results_SampleParser = get_mapping_files(options, input_dir)
+    mapping_results = dict(zip(results_SampleParser['name'], results_SampleParser['sample']))
+    for name in name_list:
+        if name not in mapping_results:
+            return (None)
+        if not files_functions.is_non_zero_file(os.path.join(os.path.dirname(mapping_results[name]), 'Log.final.out')):
+            return (None)
+    return (dict([ (name, mapping_results[name]) for name in name_list ]))
+
+#########################################
+def mapReads_module(options, pd_samples_retrieved, outdir_dict, Debug, start_time_partial, outdir):
+    """Organizes the mapping of the samples using the aligner selected (--aligner).
+
+    Any aligner generates a BAM file (see STAR_caller.mapping_bam) and mapping statistics 
+    in Log.final.out format for each sample, so downstream analysis does not depend on it.
+
+    :param options: input parameters introduced by the user. See XICRA biotype -h.
+    :param pd_samples_retrieved: data frame with the information of the samples
+    :param outdir_dict: dictionary with the names of the samples and their files
+    :param Debug: show extra information of the process
+    :param start_time_partial: time of the beggining of the process
+    :param outdir: directory to store the results
+
+    :returns: (start_time_partial, mapping_results)
+    """
+    if (options.aligner == 'STAR'):
+        return (mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug, start_time_partial, outdir))
+
+    elif (options.aligner == 'bowtie'):
+        return (mapReads_module_bowtie(options, pd_samples_retrieved, outdir_dict, Debug, start_time_partial, outdir))
+
+    print (colored("** ERROR: Aligner %s not available for mapping" %options.aligner, 'red'))
+    exit()
+
+#########################################
+def check_aligner(options):
+    """Checks the reference provided is available for the aligner selected: --fasta, --genomeDir (STAR) or --bowtie_index (bowtie)."""
+    if options.bowtie_index:
+        options.aligner = 'bowtie'
+    if options.genomeDir and options.aligner != 'STAR':
+        print (colored("** ERROR: --genomeDir is only available for STAR, provide --fasta or --bowtie_index for %s" %options.aligner, 'red'))
+        exit()
+    if options.reduced_reference and options.aligner != 'STAR':
+        print (colored("** WARNING: --reduced_reference is only available for STAR. Reads will be mapped against the genome.", 'yellow'))
+        options.reduced_reference = False
 
 #########################################
 def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug, 
-                    max_workers_int, threads_job, start_time_partial, outdir):
+                    start_time_partial, outdir):
     
     """Organizes the mapping of the samples, executed in parallel.
 
@@ -46,7 +231,10 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
     classification of the reads) have been provided by the user:
     fasta sequence + annotation or STAR index directory. 
 
-    Then, sends the mapping in parallel for each sample calling mapReads_caller().    
+    Then, sends the mapping in parallel for each sample calling mapReads_caller().
+    Threads, samples mapped at the same time and RAM for sorting are set according
+    to CPUs and memory available (see STAR_caller.plan_mapping). BAM files are 
+    unsorted unless sorted BAM files are requested (--sorted_bam).
     
     Finally, generate the MultiQC report  of the mapping for each sample.
     
@@ -54,14 +242,10 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
     :param pd_samples_retrieved: data frame with the information of the samples
     :param outdir_dict: dictionary with the names of the samples and their files
     :param Debug: show extra information of the process
-    :param max_workers_int: number of workers for each thread
-    :param threads_job: number of threads to do the computation
     :param start_time_partial: time of the beggining of the process
     :param outdir: directory to store the results
 
     :type Debug: boolean
-    :type max_workers_int: int
-    :type threads_job: int 
     :type start_time_partial: int
     :type outdir: string
 
@@ -70,40 +254,111 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
     """
 
     # Group dataframe by sample name
-    sample_frame = pd_samples_retrieved.groupby(["new_name"])
+    sample_frame = pd_samples_retrieved.groupby("new_name")
     
     ## options
     STAR_exe = set_config.get_exe("STAR", Debug=Debug)
     cwd_folder = os.path.abspath("./")
     folder=files_functions.create_subfolder('STAR_files', cwd_folder)
 
-    ## For many samples it will have to load genome index in memory every time.
-    ## For a unique sample it will not matter. Take care genome might stay in memory.
-    ## Use before loop option LoadAndExit and then:
-        ## in loop
-        ## Use option LoadAndKeep, set shared memory > 30 Gb
-    ## when finished loop Remove memory        
-    
     ## check reference
     if (options.fasta):
         print ("+ Genome fasta file provided")
-        print ("+ Create genomeDir for later usage...")
+        print ("+ Create genomeDir for later usage or reuse a compatible one...")
         options.fasta = os.path.abspath(options.fasta)
         
-        ## create genomeDir
-        options.genomeDir = STAR_caller.create_genomeDir(folder, STAR_exe, options.threads, options.fasta, options.limitRAM)
+        ## create genomeDir: shared across projects (see STAR_caller.index_cache_dir)
+        options.genomeDir = STAR_caller.create_genomeDir(folder, STAR_exe, options.threads, options.fasta, options.limitRAM,
+                                                         genomeSAindexNbases=options.genomeSAindexNbases, 
+                                                         cache_dir=options.index_cache, Debug=Debug)
         
     elif (options.genomeDir):
         print ("+ genomeDir provided.")
         options.genomeDir = os.path.abspath(options.genomeDir)
         
-    ## remove previous reference genome from memory
-    print ("+ Remove genome in memory from previous call... (if any)")
-    #STAR_caller.remove_Genome(STAR_exe, options.genomeDir, folder, options.threads)
+    ## reduced reference of small RNA loci: mapped first
+    reducedDir = None
+    if (options.reduced_reference):
+        reducedDir = reduced_genomeDir(options, folder, STAR_exe, Debug)
+
+    ## load reference genome once in shared memory for all samples (or reuse the
+    ## copy loaded by another job); it is released when finished, even on errors
+    print ("+ Load genome in shared memory for all samples...")
+    name_list = set(pd_samples_retrieved["new_name"].tolist())
+    with STAR_caller.shared_genome(folder, STAR_exe, options.genomeDir, options.threads, Debug) as genomeLoad:
+
+        ## optimize threads: CPUs and memory required
+        (threads_job, max_workers_int, limitRAM_job, memory_job, memory_genome) = STAR_caller.plan_mapping(options.threads, len(name_list), 
+                                                                                                          options.genomeDir, options.limitRAM, Debug,
+                                                                                                          shared=(genomeLoad == 'LoadAndKeep'),
+                                                                                                          sorted_bam=options.sorted_bam)
+
+        ## functions.time_functions.timestamp
+        start_time_partial = time_functions.timestamp(start_time_partial)
+        
+        print ("+ Mapping sequencing reads for each sample retrieved...")
+
+        ## send for each sample
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
+            commandsSent = { executor.submit(mapReads_caller_STAR, sorted(cluster["sample"].tolist()), 
+                                             outdir_dict[name], name, threads_job, STAR_exe, 
+                                             options.genomeDir, limitRAM_job, Debug, genomeLoad, reducedDir,
+                                             options.collapsed_mapping, options.sorted_bam): name for name, cluster in sample_frame }
+
+            for cmd2 in concurrent.futures.as_completed(commandsSent):
+                details = commandsSent[cmd2]
+                try:
+                    cmd2.result()
+                except Exception as exc:
+                    print ('***ERROR:')
+                    print (cmd2)
+                    print('%r generated an exception: %s' % (details, exc))
+
+        print ("\n\n+ Mapping reads has finished...")
+        
+        ## functions.time_functions.timestamp
+        start_time_partial = time_functions.timestamp(start_time_partial)
+
+    ## reference genome removed from memory if no other job is using it
     
-    ## load reference genome
-    #STAR_caller.load_Genome(folder, STAR_exe, options.genomeDir, options.threads)
+    ## functions.time_functions.timestamp
+    start_time_partial = time_functions.timestamp(start_time_partial)
 
+    mapping_results = mapping_report(options, outdir_dict, outdir, 'STAR', Debug)
+    return(start_time_partial, mapping_results)
+
+#################################
+def mapReads_module_bowtie(options, pd_samples_retrieved, outdir_dict, Debug, start_time_partial, outdir):
+    """Organizes the mapping of the samples using bowtie, executed in parallel.
+
+    As mapReads_module_STAR(), but the index requires much less memory (~3 Gb for the
+    human genome) and it is memory mapped by all jobs, so more samples could be 
+    mapped at the same time (see bowtie_caller.plan_mapping). The index is generated 
+    from the fasta provided or an index previously generated is used (--bowtie_index).
+
+    :param options: input parameters introduced by the user. See XICRA biotype -h.
+    :param pd_samples_retrieved: data frame with the information of the samples
+    :param outdir_dict: dictionary with the names of the samples and their files
+    :param Debug: show extra information of the process
+    :param start_time_partial: time of the beggining of the process
+    :param outdir: directory to store the results
+
+    :returns: (start_time_partial, mapping_results)
+    """
+    # Group dataframe by sample name
+    sample_frame = pd_samples_retrieved.groupby("new_name")
+
+    ## options
+    bowtie_exe = set_config.get_exe("bowtie", Debug=Debug)
+    folder = files_functions.create_subfolder(aligner_info['bowtie']['folder'], os.path.abspath("./"))
+    options.bowtie_index = bowtie_index(options, folder, Debug)
+    
+    ## optimize threads: CPUs and memory required
+    name_list = set(pd_samples_retrieved["new_name"].tolist())
+    (threads_job, max_workers_int, limitRAM_job, memory_job, memory_index) = bowtie_caller.plan_mapping(options.threads, len(name_list), 
+                                                                                                       options.bowtie_index, options.limitRAM, 
+                                                                                                       Debug, sorted_bam=options.sorted_bam)
+    
     ## functions.time_functions.timestamp
     start_time_partial = time_functions.timestamp(start_time_partial)
     
@@ -111,14 +366,14 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
 
     ## send for each sample
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        commandsSent = { executor.submit(mapReads_caller_STAR, sorted(cluster["sample"].tolist()), 
-                                         outdir_dict[name], name, threads_job, STAR_exe, 
-                                         options.genomeDir, options.limitRAM, Debug): name for name, cluster in sample_frame }
+        commandsSent = { executor.submit(mapReads_caller_bowtie, sorted(cluster["sample"].tolist()), 
+                                         outdir_dict[name], name, threads_job, bowtie_exe, options.bowtie_index, 
+                                         limitRAM_job, Debug, options.collapsed_mapping, options.sorted_bam): name for name, cluster in sample_frame }
 
         for cmd2 in concurrent.futures.as_completed(commandsSent):
             details = commandsSent[cmd2]
             try:
-                data = cmd2.result()
+                cmd2.result()
             except Exception as exc:
                 print ('***ERROR:')
                 print (cmd2)
@@ -129,15 +384,42 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
     ## functions.time_functions.timestamp
     start_time_partial = time_functions.timestamp(start_time_partial)
 
-    ## remove reference genome from memory
-    #STAR_caller.remove_Genome(STAR_exe, options.genomeDir, folder, options.threads)
-    
-    ## functions.time_functions.timestamp
-    start_time_partial = time_functions.timestamp(start_time_partial)
+    mapping_results = mapping_report(options, outdir_dict, outdir, 'bowtie', Debug)
+    return(start_time_partial, mapping_results)
+
+#################################
+def bowtie_index(options, folder, Debug):
+    """Returns the bowtie index provided (--bowtie_index) or generates it from the fasta provided (--fasta)."""
+    if (options.bowtie_index):
+        print ("+ bowtie index provided.")
+        return (os.path.abspath(options.bowtie_index))
+
+    print ("+ Genome fasta file provided")
+    print ("+ Create bowtie index for later usage or reuse a compatible one...")
+    options.fasta = os.path.abspath(options.fasta)
+    bowtie_build_exe = set_config.get_exe("bowtie-build", Debug=Debug)
+    return (bowtie_caller.create_index(folder, bowtie_build_exe, options.threads, options.fasta, 
+                                       cache_dir=options.index_cache, Debug=Debug))
+
+#################################
+def mapping_report(options, outdir_dict, outdir, aligner, Debug):
+    """Retrieves the BAM files generated for each sample and generates the report of the mapping.
+
+    Mapping statistics (Log.final.out) of all samples are summarized in a table: 
+    report/map/mapping_statistics.csv (see STAR_caller.mapping_stats). A MultiQC 
+    report is also generated, unless --skip_report.
+
+    :param options: input parameters introduced by the user. See XICRA biotype -h.
+    :param outdir_dict: dictionary with the names of the samples and their files
+    :param outdir: directory to store the results
+    :param aligner: aligner employed: STAR or bowtie (see aligner_info)
+    :param Debug: show extra information of the process
 
+    :returns: Dictionary with the BAM file of each sample.
+    """
     ## retrieve mapping files
     input_dir = os.path.abspath(options.input)
-    results_SampleParser = sampleParser.files.get_files(options, input_dir, "map", ["Aligned.sortedByCoord.out.bam"], options.debug, bam=True)
+    results_SampleParser = get_mapping_files(options, input_dir)
     del results_SampleParser['dirname']
     del results_SampleParser['ext']
     del results_SampleParser['tag']
@@ -146,6 +428,15 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
     results_SampleParser = results_SampleParser.set_index('name')
     mapping_results = results_SampleParser.to_dict()['sample']
 
+    ## mapping statistics of all samples
+    log_files = dict([ (name, os.path.join(os.path.dirname(bam_file), 'Log.final.out')) for name, bam_file in mapping_results.items() ])
+    log_files = dict([ (name, f) for name, f in log_files.items() if files_functions.is_non_zero_file(f) ])
+    if log_files:
+        stats_folder = files_functions.create_subfolder("map", files_functions.create_subfolder("report", outdir))
+        stats_file = os.path.join(stats_folder, 'mapping_statistics.csv')
+        STAR_caller.mapping_stats(log_files).to_csv(stats_file)
+        print ('+ Mapping statistics of all samples available in: %s' %stats_file)
+
     ## Create mapping report    
     if (options.skip_report):
         print ("+ No report generation...")
@@ -167,14 +458,64 @@ def mapReads_module_STAR(options, pd_samples_retrieved, outdir_dict, Debug,
             print (my_outdir_list)
             print ("\n")
         
-        map_report = files_functions.create_subfolder("STAR", outdir_report)
-        multiQC_report.multiQC_module_call(my_outdir_list, "STAR", map_report,"-dd 2")
+        map_report = files_functions.create_subfolder(aligner_info[aligner]['report'], outdir_report)
+        multiQC_report.multiQC_module_call(my_outdir_list, aligner_info[aligner]['report'], map_report,"-dd 2")
         print ('\n+ A summary HTML report of each sample is generated in folder: %s' %map_report)
 
-    return(start_time_partial, mapping_results)
+    return(mapping_results)
+
+#################################
+def get_mapping_files(options, input_dir):
+    """Retrieves the BAM files generated by the mapping for each sample.
+
+    BAM files could be unsorted (Aligned.out.bam) or sorted by coordinate 
+    (Aligned.sortedByCoord.out.bam). If both are available, the sorted one is used.
+
+    :param options: input parameters introduced by the user.
+    :param input_dir: input folder of the project.
+
+    :returns: Pandas dataframe with sample and file information, see sampleParser.files.get_files.
+    """
+    results_SampleParser = sampleParser.files.get_files(options, input_dir, "map", [STAR_caller.bam_sorted, STAR_caller.bam_unsorted], 
+                                                        options.debug, bam=True)
+    results_SampleParser['sorted'] = results_SampleParser['sample'].str.endswith(STAR_caller.bam_sorted)
+    results_SampleParser = results_SampleParser.sort_values('sorted', ascending=False).drop_duplicates('name')
+    del results_SampleParser['sorted']
+    return (results_SampleParser)
+
+#################################
+def reduced_genomeDir(options, folder, STAR_exe, Debug):
+    """Creates the genomeDir of the reduced reference with the small RNA loci of the genome.
+
+    Loci are retrieved from the annotation (--annotation) and additional loci provided 
+    (--reduced_loci), see XICRA.scripts.reduced_reference. The genome sequence is the 
+    fasta provided or the one used to generate the genomeDir, if generated by XICRA.
+
+    :param options: input parameters introduced by the user. See XICRA biotype -h.
+    :param folder: folder to store the reduced reference
+    :param STAR_exe: STAR executable
+    :param Debug: show extra information of the process
+
+    :returns: genomeDir of the reduced reference or None if not available.
+    """
+    print ("+ Create reduced reference of small RNA loci...")
+    fasta_file = options.fasta if options.fasta else STAR_caller.index_fasta(options.genomeDir)
+    if not fasta_file:
+        print (colored("** WARNING: Genome fasta file is required for the reduced reference. Reads will be mapped against the genome.", 'yellow'))
+        return (None)
+
+    reduced_folder = files_functions.create_subfolder('reduced_reference', folder)
+    reduced_fasta = reduced_reference.build_reduced_fasta(fasta_file, os.path.abspath(options.annotation), reduced_folder,
+                                                          flank=options.reduced_flank, bed_file=options.reduced_loci, Debug=Debug)
+    if not reduced_fasta:
+        return (None)
+
+    return (STAR_caller.create_genomeDir(reduced_folder, STAR_exe, options.threads, reduced_fasta, options.limitRAM,
+                                         cache_dir=options.index_cache, Debug=Debug))
 
 #################################
-def mapReads_caller_STAR(files, folder, name, threads, STAR_exe, genomeDir, limitRAM_option, Debug):
+def mapReads_caller_STAR(files, folder, name, threads, STAR_exe, genomeDir, limitRAM_option, Debug, genomeLoad='NoSharedMemory', reducedDir=None,
+                         collapsed=False, sorted_bam=False):
     """Mapping of a given sample with STAR
 
     First, checks if the trimmed unjoined files exist for the sample and also
@@ -190,6 +531,10 @@ def mapReads_caller_STAR(files, folder, name, threads, STAR_exe, genomeDir, limi
     :param genomeDir: path to the genome directory to do the mappig
     :param limitRAM_option: limit RAM bytes to be used in the computation
     :param Debug: show extra information of the process
+    :param genomeLoad: LoadAndKeep to use the genome loaded in shared memory (see STAR_caller.shared_genome) or NoSharedMemory
+    :param reducedDir: path to the genome directory of the reduced reference, mapped first (see STAR_caller.mapReads_reduced)
+    :param collapsed: map each unique sequence once and weight alignments by its count (see STAR_caller.mapReads)
+    :param sorted_bam: sort and index the BAM file by coordinate (see STAR_caller.sort_bam)
 
 
     :type folder: string
@@ -199,16 +544,25 @@ def mapReads_caller_STAR(files, folder, name, threads, STAR_exe, genomeDir, limi
     :type genomeDir: string
     :type limitRAM_option: int
     :type Debug: boolean
+    :type genomeLoad: string
+    :type reducedDir: string
+    :type collapsed: boolean
+    :type sorted_bam: boolean
 
-    :returns: None
+    :returns: True/False
     """
 
-    ## check if previously joined and succeeded
-    filename_stamp = folder + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'STAR'), 'yellow'))
-    else:
+    ## check if previously mapped and succeeded with same reads and reference
+    ## genome index is identified by its parameters file: avoid hashing the whole index
+    genome_params = [ os.path.join(genomeDir, 'genomeParameters.txt') ]
+    if reducedDir:
+        genome_params.append(os.path.join(reducedDir, 'genomeParameters.txt'))
+    params = "reduced: %s collapsed: %s" %(bool(reducedDir), collapsed) if (reducedDir or collapsed) else ""
+    params = params + " bam: %s" %(STAR_caller.bam_sorted if sorted_bam else STAR_caller.bam_unsorted)
+    (cached, step_info) = step_cache.check_step(folder, 'STAR', name, files + genome_params, params, 
+                                                prog='STAR', legacy_stamp=folder + '/.success', Debug=Debug, 
+                                                outputs=STAR_caller.mapping_outputs(folder))
+    if not cached:
         ##
         if Debug:
             print ("\n** DEBUG: mapReads_caller options **\n")
@@ -218,17 +572,87 @@ def mapReads_caller_STAR(files, folder, name, threads, STAR_exe, genomeDir, limi
             print ("STAR_exe: " + STAR_exe) 
             print ("genomeDir: " + genomeDir) 
             print ("limitRAM_option: " + str(limitRAM_option))
+            print ("genomeLoad: " + genomeLoad)
+            print ("reducedDir: " + str(reducedDir))
+            print ("collapsed: " + str(collapsed))
+            print ("sorted_bam: " + str(sorted_bam))
             print ("files: ")
             print (files)
             
         # Call STAR
-        code_returned = STAR_caller.mapReads("LoadAndKeep", files, folder, name, STAR_exe, genomeDir, limitRAM_option, threads, Debug)
+        if reducedDir:
+            code_returned = STAR_caller.mapReads_reduced(genomeLoad, files, folder, name, STAR_exe, genomeDir, reducedDir, 
+                                                         limitRAM_option, threads, Debug, collapsed, sorted_bam)
+        else:
+            code_returned = STAR_caller.mapReads(genomeLoad, files, folder, name, STAR_exe, genomeDir, limitRAM_option, threads, 
+                                                 Debug, collapsed, sorted_bam)
         
         if (code_returned):
-            time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info, STAR_caller.mapping_outputs(folder))
         else:
             print ("+ Mapping sample %s failed..." %name)
+            return (False)
     
     ## return results
-    return()
+    return (True)
+    
+
+#################################
+def mapReads_caller_bowtie(files, folder, name, threads, bowtie_exe, index, limitRAM_option, Debug, collapsed=False, sorted_bam=False):
+    """Mapping of a given sample with bowtie
+
+    As mapReads_caller_STAR(): checks if the calculation has not been done previously
+    and executes bowtie to generate the BAM file of the sample (see bowtie_caller.mapReads).
+
+    :param files: unjoined trimmed files of the sample
+    :param folder: sample folder to store the results
+    :param name: sample name
+    :param threads: number of threads to do the computation
+    :param bowtie_exe: bowtie executable
+    :param index: bowtie index (prefix of the index files)
+    :param limitRAM_option: maximum RAM (bytes) for sorting the alignments, if sorted_bam
+    :param Debug: show extra information of the process
+    :param collapsed: map each unique sequence once and weight alignments by its count
+    :param sorted_bam: sort and index the BAM file by coordinate (see STAR_caller.sort_bam)
+
+    :type folder: string
+    :type name: string
+    :type threads: int 
+    :type bowtie_exe: string
+    :type index: string
+    :type limitRAM_option: int
+    :type Debug: boolean
+    :type collapsed: boolean
+    :type sorted_bam: boolean
+
+    :returns: True/False
+    """
+    ## check if previously mapped and succeeded with same reads and reference
+    ## index is identified by its first file: avoid hashing the whole index
+    params = "collapsed: %s bam: %s" %(collapsed, STAR_caller.bam_sorted if sorted_bam else STAR_caller.bam_unsorted)
+    (cached, step_info) = step_cache.check_step(folder, 'bowtie', name, files + bowtie_caller.index_files(index)[:1], params, 
+                                                prog='bowtie', Debug=Debug)
+    if not cached:
+        ##
+        if Debug:
+            print ("\n** DEBUG: mapReads_caller_bowtie options **\n")
+            print ("folder: " + folder) 
+            print ("name: " + name)
+            print ("threads: " + str(threads))
+            print ("bowtie_exe: " + bowtie_exe) 
+            print ("index: " + index) 
+            print ("collapsed: " + str(collapsed))
+            print ("sorted_bam: " + str(sorted_bam))
+            print ("files: ")
+            print (files)
+
+        code_returned = bowtie_caller.mapReads(files, folder, name, bowtie_exe, index, limitRAM_option, threads, Debug, 
+                                               collapsed, sorted_bam)
+        if (code_returned):
+            step_cache.save_step(step_info, STAR_caller.mapping_outputs(folder))
+        else:
+            print ("+ Mapping sample %s failed..." %name)
+            return (False)
     
+    ## return results
+    return (True)
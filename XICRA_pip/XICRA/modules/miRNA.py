@@ -15,7 +15,6 @@ import re
 import time
 from io import open
 import shutil
-import concurrent.futures
 import pandas as pd
 from termcolor import colored
 
@@ -32,6 +31,8 @@ from XICRA.scripts import mirtop_caller
 from XICRA.scripts import sRNAbench_caller
 from XICRA.scripts import optimir_caller
 from XICRA.scripts import miraligner_caller
+from XICRA.scripts import isomiR_annotator
+from XICRA.scripts import resource_manager, task_graph, step_cache
 
 
 ##############################################
@@ -44,7 +45,7 @@ def run_miRNA(options):
     If some is missing it will be downloaded from miRBase. 
 
     Then, it calls miRNA_analysis() for each sample in parallel.
-    Gets user software selection: sRNAbench, optimiR, miraligner.
+    Gets user software selection: sRNAbench, optimiR, miraligner, native.
     Standarize results using miRTop.
     Finally, build final matrix comparing all samples.
     
@@ -77,6 +78,9 @@ def run_miRNA(options):
         Debug = True
     else:
         Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
         
     ### set as default paired_end mode
     if (options.single_end):
@@ -152,8 +156,6 @@ def run_miRNA(options):
     ## call database module and return options updated
     options = database.miRNA_db(options)    
     
-    exit()
-    
     ##############################################################
     ## Start the analysis
     ##############################################################
@@ -165,41 +167,33 @@ def run_miRNA(options):
     ## for samples
     outdir_dict = functions.files_functions.outdir_project(outdir, options.project, pd_samples_retrieved, "miRNA", options.debug)
     
-    ## optimize threads
+    ## optimize threads: CPUs and memory required by each software
     name_list = set(pd_samples_retrieved["new_name"].tolist())
-    threads_job = functions.main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
+    resources = plan_miRNA(options.soft_name, options.threads, len(name_list), Debug=options.debug)
 
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
+        print (colored("**DEBUG: resources " +  str(resources) + " **", 'yellow'))
 
     print ("+ Create a miRNA analysis for each sample retrieved...")    
     
     ## call miRNA_analysis: 
     ## Get user software selection: sRNAbench, optimir, ...
     ## Standarize using miRTop
+    ## Each software and sample is sent as an independent task
     
     # Group dataframe by sample name
-    sample_frame = pd_samples_retrieved.groupby(["new_name"])
+    sample_frame = pd_samples_retrieved.groupby("new_name")
     
-    ## send for each sample
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        commandsSent = { executor.submit(miRNA_analysis, sorted(cluster["sample"].tolist()), 
-                                         outdir_dict[name], name, threads_job, options.miRNA_gff,
-                                         options.soft_name, options.matureFasta, options.hairpinFasta, 
-                                         options.miRBase_str, options.species, options.database, Debug): name for name, cluster in sample_frame }
-
-        for cmd2 in concurrent.futures.as_completed(commandsSent):
-            details = commandsSent[cmd2]
-            try:
-                data = cmd2.result()
-            except Exception as exc:
-                print ('***ERROR:')
-                print (cmd2)
-                print('%r generated an exception: %s' % (details, exc))
+    graph = {}
+    for name, cluster in sample_frame:
+        add_miRNA_tasks(graph, sorted(cluster["sample"].tolist()), outdir_dict[name], name, options.soft_name, resources, 
+                        options.miRNA_gff, options.matureFasta, options.hairpinFasta, options.species, options.database, Debug)
+    
+    ## send all tasks
+    status = task_graph.run_graph(graph, options.threads, Debug, threads=options.threads, memory=resource_manager.available_memory())
+    task_graph.summary_graph(graph, status)
 
     print ("\n\n+ miRNA analysis is finished...")
     print ("+ Let's summarize all results...")
@@ -208,14 +202,8 @@ def run_miRNA(options):
     outdir_report = functions.files_functions.create_subfolder("report", outdir)
     expression_folder = functions.files_functions.create_subfolder("miRNA", outdir_report)
 
-    ## Get results files generated
-    
-    ## dictionary results
-    results_SampleParser = sampleParser.files.get_files(options, input_dir, "miRNA", ["mirtop.tsv"], options.debug)
-    results_df = pd.DataFrame(columns=("name", "soft", "filename"))
-    results_df['name'] = results_SampleParser['name']
-    results_df['soft'] = results_SampleParser['ext']
-    results_df['filename'] = results_SampleParser['sample']
+    ## Get results files generated: project or detached mode
+    results_df = miRNA_results(outdir_dict, options.soft_name)
 
     ## debugging messages
     if options.debug:
@@ -223,13 +211,22 @@ def run_miRNA(options):
     
     ## merge all parse gtf files created
     print ("+ Summarize miRNA analysis for all samples...")
-    generate_DE.generate_DE(results_df, options.debug, expression_folder)
+    generate_DE.generate_DE(results_df, options.debug, expression_folder, out_format=options.matrix_format, memory_budget=options.memory_budget,
+                            incremental=options.incremental, threads=options.threads,
+                            rollup=options.rollup)
 
     print ("\n*************** Finish *******************")
     start_time_partial = functions.time_functions.timestamp(start_time_total)
     print ("\n+ Exiting miRNA module.")
     return()
 
+###############
+## output folder and miRTop format for each software
+soft_info = { 'sRNAbench':  { 'folder': 'sRNAbench',  'format': 'sRNAbench' },
+              'optimir':    { 'folder': 'OptimiR',    'format': 'optimir' },
+              'miraligner': { 'folder': 'miraligner', 'format': 'seqbuster' },
+              'native':     { 'folder': 'native',     'format': 'seqbuster' } }
+
 ###############
 def miRNA_analysis(reads, folder, name, threads, miRNA_gff, soft_list, 
                    matureFasta, hairpinFasta, miRBase_str, species, database, Debug):
@@ -257,37 +254,122 @@ def miRNA_analysis(reads, folder, name, threads, miRNA_gff, soft_list,
     """
     
     for soft in soft_list:
-        if (soft == "sRNAbench"):
-            ## create sRNAbench
-            sRNAbench_folder = functions.files_functions.create_subfolder('sRNAbench', folder)
-            code_success = sRNAbench_caller.sRNAbench_caller(reads, sRNAbench_folder, name, threads, species, Debug) ## Any additional sRNAbench parameter?
-                
-            if not code_success:
-                print ('** miRTop would not be executed for sample %s...' %name)
-                return ()
-            
-            ## create folder for sRNAbench results
-            miRTop_folder = functions.files_functions.create_subfolder("sRNAbench_miRTop", folder)
-            mirtop_caller.miRTop_caller(sRNAbench_folder, miRTop_folder, name, threads, miRNA_gff, hairpinFasta, 'sRNAbench', species, Debug)
-            
-        ###
-        if (soft == "optimir"):
-            ## create OptimiR analysis
-            optimir_folder = functions.files_functions.create_subfolder('OptimiR', folder)
-            code_success = optimir_caller.optimir_caller(reads, optimir_folder, name, threads, matureFasta, hairpinFasta, miRNA_gff, species, Debug) ## Any additional sRNAbench parameter?
-            
-            ## create folder for Optimir results
-            miRTop_folder = functions.files_functions.create_subfolder("OptimiR_miRTop", folder)
-            mirtop_caller.miRTop_caller(optimir_folder, miRTop_folder, name, threads, miRNA_gff, hairpinFasta, 'optimir', species, Debug)
-            
-        ###
-        if (soft == "miraligner"):
-            
-            ## create OptimiR analysis
-            miraligner_folder = functions.files_functions.create_subfolder('miraligner', folder)
-            code_success = miraligner_caller.miraligner_caller(reads, miraligner_folder, name, threads, database, species, Debug) 
-            
-            ## create folder for Optimir results
-            miRTop_folder = functions.files_functions.create_subfolder("miraligner_miRTop", folder)
-            mirtop_caller.miRTop_caller(miraligner_folder, miRTop_folder, name, threads, miRNA_gff, hairpinFasta, 'seqbuster', species, Debug)
-            
+        code_success = soft_analysis(soft, reads, folder, name, threads, miRNA_gff, matureFasta, hairpinFasta, species, database, Debug)
+        if not code_success:
+            print ('** miRTop would not be executed for sample %s...' %name)
+            continue
+        
+        soft_miRTop(soft, folder, name, threads, miRNA_gff, hairpinFasta, species, Debug)
+
+###############
+def soft_analysis(soft, reads, folder, name, threads, miRNA_gff, matureFasta, hairpinFasta, species, database, Debug):
+    """Analyzes the sample with the software provided. Results are stored in a subfolder named as the software.
+
+    :param soft: software: sRNAbench, optimir, miraligner or native
+    :param reads: file with sample reads
+    :param folder: output folder
+    :param name: sample name
+    :param threads: selected threads (by defoult 2)
+    :param miRNA_gff: miRNA gff3 annotation file
+    :param matureFasta: mature fasta file 
+    :param hairpinFasta: hairpin fasta file
+    :param species: species tag ID. Default: hsa (Homo sapiens)
+    :param database: path to store miRNA annotation files downloaded
+    :param Debug: display complete log.
+
+    :returns: True/False
+    """
+    soft_folder = functions.files_functions.create_subfolder(soft_info[soft]['folder'], folder)
+    
+    if (soft == "sRNAbench"):
+        return (sRNAbench_caller.sRNAbench_caller(reads, soft_folder, name, threads, species, Debug)) ## Any additional sRNAbench parameter?
+    
+    elif (soft == "optimir"):
+        return (optimir_caller.optimir_caller(reads, soft_folder, name, threads, matureFasta, hairpinFasta, miRNA_gff, species, Debug))
+    
+    elif (soft == "miraligner"):
+        return (miraligner_caller.miraligner_caller(reads, soft_folder, name, threads, database, species, Debug))
+    
+    elif (soft == "native"):
+        ## native isomiR annotation: results in miraligner format
+        return (isomiR_annotator.isomiR_annotator_caller(reads, soft_folder, name, threads, miRNA_gff, hairpinFasta, species, Debug))
+
+    print (colored("** ERROR: Software %s not available for miRNA analysis" %soft, 'red'))
+    return (False)
+
+###############
+def soft_miRTop(soft, folder, name, threads, miRNA_gff, hairpinFasta, species, Debug):
+    """Standardizes the results of the software provided using miRTop. See soft_analysis()
+
+    :returns: True/False
+    """
+    soft_folder = os.path.join(folder, soft_info[soft]['folder'])
+    
+    ## create folder for miRTop results
+    miRTop_folder = functions.files_functions.create_subfolder(soft_info[soft]['folder'] + "_miRTop", folder)
+    return (mirtop_caller.miRTop_caller(soft_folder, miRTop_folder, name, threads, miRNA_gff, hairpinFasta, 
+                                        soft_info[soft]['format'], species, Debug))
+
+###############
+def miRNA_results(outdir_dict, soft_list):
+    """Returns the miRTop counts generated by each software for each sample.
+
+    :param outdir_dict: dictionary with the output folder of each sample.
+    :param soft_list: list with the selected softwares 
+
+    :returns: dataframe with name, soft and filename columns, as required by generate_DE.
+    """
+    results = []
+    for name, folder in sorted(outdir_dict.items()):
+        for soft in soft_list:
+            counts_file = os.path.join(folder, soft_info[soft]['folder'] + "_miRTop", "counts", "mirtop.tsv")
+            if os.path.isfile(counts_file):
+                results.append([name, soft, counts_file])
+    return (pd.DataFrame(results, columns=("name", "soft", "filename")))
+
+###############
+def plan_miRNA(soft_list, threads, n_samples, Debug):
+    """Sets threads and memory for the tasks of each software and miRTop.
+
+    Each software and sample is an independent task, so all of them share the
+    CPUs available.
+
+    :param soft_list: list with the selected softwares 
+    :param threads: total number of CPUs available
+    :param n_samples: number of samples
+    :param Debug: display complete log.
+
+    :returns: dictionary with threads and memory for each software and miRTop.
+    """
+    resources = {}
+    for soft in soft_list + ['miRTop']:
+        (threads_job, max_workers) = resource_manager.plan_jobs(soft, threads, n_samples * len(soft_list), Debug=Debug)
+        resources[soft] = { 'threads': threads_job, 'memory': resource_manager.get_profile(soft)['memory'] }
+    return (resources)
+
+###############
+def add_miRNA_tasks(graph, reads, folder, name, soft_list, resources, miRNA_gff, matureFasta, hairpinFasta, 
+                    species, database, Debug, depends=()):
+    """Adds a task for each software and its miRTop standardization into the graph of tasks.
+
+    miRTop for each software starts as soon as the software finishes, independently
+    of the rest. See XICRA.scripts.task_graph.
+
+    :param graph: Dictionary containing tasks. See XICRA.scripts.task_graph.add_task()
+    :param resources: Dictionary with threads and memory for each software. See plan_miRNA()
+    :param depends: List of tasks to finish before starting, e.g. join reads.
+
+    Rest of parameters as miRNA_analysis().
+    """
+    for soft in soft_list:
+        task_soft = name + "_" + soft
+        task_graph.add_task(graph, task_soft, soft_analysis,
+                            [soft, reads, folder, name, resources[soft]['threads'], miRNA_gff, 
+                             matureFasta, hairpinFasta, species, database, Debug],
+                            depends=depends, sample=name, step=soft, 
+                            threads=resources[soft]['threads'], memory=resources[soft]['memory'])
+        
+        task_graph.add_task(graph, task_soft + "_miRTop", soft_miRTop,
+                            [soft, folder, name, resources['miRTop']['threads'], miRNA_gff, hairpinFasta, species, Debug],
+                            depends=[task_soft], sample=name, step="miRTop", 
+                            threads=resources['miRTop']['threads'], memory=resources['miRTop']['memory'])
@@ -22,10 +22,13 @@ from termcolor import colored
 ## import my modules
 from HCGB import sampleParser
 from HCGB import functions
+from HCGB.functions import files_functions, time_functions
+import HCGB.functions.aesthetics_functions as HCGB_aes
 from XICRA.config import set_config
-from XICRA.modules import help_XICRA
+from XICRA.modules import help_XICRA, map, database
 from XICRA.scripts import generate_DE, bedtools_caller
-from XICRA.scripts import MINTMap_caller
+from XICRA.scripts import resource_manager, step_cache
+from XICRA.scripts import MINTMap_caller, pilfer_caller
 from XICRA.scripts import get_length_distribution
 
 ##############################################
@@ -59,6 +62,9 @@ def run_piRNA(options):
         Debug = True
     else:
         Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
         
     ### set as default paired_end mode
     if (options.single_end):
@@ -92,7 +98,7 @@ def run_piRNA(options):
     print ('+ Check if previously mapping was generated...')
     
     ## retrieve mapping files
-    results_SampleParser = sampleParser.files.get_files(options, input_dir, "map", ["Aligned.sortedByCoord.out.bam"], options.debug, bam=True)
+    results_SampleParser = map.get_mapping_files(options, input_dir)
     pd_samples_retrieved = results_SampleParser
     del results_SampleParser['dirname']
     del results_SampleParser['ext']
@@ -147,10 +153,9 @@ def run_piRNA(options):
         # time stamp
         start_time_partial = time_functions.timestamp(start_time_total)
     
-        ## optimize threads
+        ## optimize threads: CPUs and memory required
         name_list = set(pd_samples_retrieved["new_name"].tolist())
-        threads_job = main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-        max_workers_int = int(options.threads/threads_job)
+        (threads_job, max_workers_int) = resource_manager.plan_jobs('bedtools', options.threads, len(name_list), Debug=options.debug)
         
         ## debug message
         if (Debug):
@@ -161,8 +166,9 @@ def run_piRNA(options):
         ##############################################
         ## map Reads
         ##############################################
-        (start_time_partial, mapping_results) = map.mapReads_module_STAR(options, pd_samples_retrieved, mapping_outdir_dict, 
-                        options.debug, max_workers_int, threads_job, start_time_partial, outdir)
+        map.check_aligner(options)
+        (start_time_partial, mapping_results) = map.mapReads_module(options, pd_samples_retrieved, mapping_outdir_dict, 
+                        options.debug, start_time_partial, outdir)
     
         ## debug message
         if (Debug):
@@ -184,8 +190,8 @@ def run_piRNA(options):
     print ("+ Create folder to store results: ", options.database)
     functions.files_functions.create_folder(options.database)
     
-    ## call database module and return options updated
-    options = database.piRNA_db(options)    
+    ## call database module
+    database.piRNA_db(options.database, None, options.debug)
 
     ##############################################################
     ## Start the analysis
@@ -218,7 +224,7 @@ def run_piRNA(options):
     (bed_files, gtf_files) = get_length_distribution.convert_GTF2bed(options.GTF_info, folder_GTF, debug=options.debug)
 
     ## debugging messages
-    if debug:
+    if options.debug:
         HCGB_aes.debug_message("bed_files", color="yellow")
         print(bed_files)        
         print()
@@ -231,7 +237,7 @@ def run_piRNA(options):
     print("+ Intersecting GTF annotation file and mapping BED file...")
     
     # Group dataframe by sample name
-    sample_frame = pd_samples_retrieved.groupby(["new_name"])
+    sample_frame = pd_samples_retrieved.groupby("new_name")
     
     ## send for each sample
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
@@ -244,7 +250,7 @@ def run_piRNA(options):
         for cmd2 in concurrent.futures.as_completed(commandsSent):
             details = commandsSent[cmd2]
             try:
-                data = cmd2.result()
+                cmd2.result()
             except Exception as exc:
                 print ('***ERROR:')
                 print (cmd2)
@@ -272,7 +278,8 @@ def run_piRNA(options):
         print (results_df)
     
     print ("\n\n+ Parsing piRNA analysis for all samples...")
-    generate_DE.generate_DE(results_df, options.debug, expression_folder,  type_analysis="piRNA")
+    generate_DE.generate_DE(results_df, options.debug, expression_folder,  type_analysis="piRNA", out_format=options.matrix_format, memory_budget=options.memory_budget,
+                            incremental=options.incremental, threads=options.threads)
 
     print ("\n*************** Finish *******************")
     start_time_partial = functions.time_functions.timestamp(start_time_total)
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy             ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Runs the complete analysis (prep, trim, join, miRNA/tRNA/biotype) for a set of
+samples as a graph of per-sample tasks.
+
+Instead of finishing each module for all samples before starting the next one,
+each sample advances through the steps on its own: as soon as a sample is
+trimmed, it is joined, and as soon as it is joined, it is quantified. Cohort
+summaries are generated once all samples are finished.
+"""
+## import useful modules
+import os
+import time
+import contextlib
+import pandas as pd
+from termcolor import colored
+
+## import my modules
+from HCGB import sampleParser
+from HCGB import functions
+
+from XICRA.config import set_config
+from XICRA.modules import help_XICRA
+from XICRA.modules import database
+from XICRA.modules import prep, join, miRNA, map
+from XICRA.scripts import task_graph, step_cache, resource_manager, exec_trace, collapse_reads
+from XICRA.scripts import cutadapt_caller, STAR_caller, bowtie_caller
+from XICRA.scripts import MINTMap_caller, RNAbiotype
+from XICRA.scripts import generate_DE, expression_rollup
+
+##############################################
+def run_pipeline(options):
+    """Main function of the module, organizes the complete analysis.
+
+    First, it prepares the samples into a project folder using the prep module.
+
+    Then, it creates a graph with a task per sample and step: trim, join and any
+    of the analysis selected (miRNA, tRNA, biotype). Each task depends only on
+    the previous step of the same sample, so samples are processed in a pipelined
+    fashion using all the threads available.
+
+    Finally, summarizes all the results for all the samples.
+
+    :param options: input parameters introduced by the user. See XICRA pipeline -h.
+
+    :returns: None
+    """
+
+    ## init time
+    start_time_total = time.time()
+
+    ##################################
+    ### show help messages if desired
+    ##################################
+    if (options.help_format):
+        ## help_format option
+        help_XICRA.help_fastq_format()
+        exit()
+    elif (options.help_project):
+        ## information for project
+        help_XICRA.project_help()
+        exit()
+
+    ## debugging messages
+    global Debug
+    if (options.debug):
+        Debug = True
+    else:
+        Debug = False
+
+    ## no analysis selected
+    if not options.analysis:
+        print (colored("** ERROR: No analysis selected. Provide any of: miRNA, tRNA, biotype", 'red'))
+        exit()
+
+    ## no adapters provided
+    if not options.noTrim:
+        if (not options.adapters_a and not options.adapters_A and not options.extra):
+            print (colored("** ERROR: No adapter trimming options provided...", 'red'))
+            print ("Please provide any option or --noTrim")
+            exit()
+
+    ## cache of results for each step
+    step_cache.set_cache(options.cache_dir, options.content_hash)
+
+    ## check reference for biotype analysis
+    if 'biotype' in options.analysis:
+        if not options.annotation or not (options.fasta or options.genomeDir or options.bowtie_index):
+            print (colored("** ERROR: biotype analysis requires --annotation and --fasta, --genomeDir or --bowtie_index", 'red'))
+            exit()
+        map.check_aligner(options)
+
+    ## check software for miRNA analysis
+    if 'miRNA' in options.analysis and not options.soft_name:
+        print (colored("** ERROR: miRNA analysis requires --miRNA_software", 'red'))
+        exit()
+
+    ##############################################
+    ## prepare samples: project folder
+    ##############################################
+    ## prep module: do not merge reads
+    options.merge_Reads = False
+    options.detached = False
+    prep.run_prep(options)
+
+    functions.aesthetics_functions.boxymcboxface("XICRA pipeline")
+    print ("--------- Starting Process ---------")
+    functions.time_functions.print_time()
+
+    ## project folder is the input from now on
+    outdir = os.path.abspath(options.output_folder)
+    options.input = outdir
+    options.project = True
+    options.batch = False
+
+    ## trace of each software call
+    trace_file = exec_trace.set_trace(os.path.join(outdir, "report", "trace", 
+                                                   "trace_" + time.strftime("%Y%m%d_%H%M%S") + ".jsonl"))
+
+    ### set as default paired_end mode
+    if (options.single_end):
+        options.pair = False
+    else:
+        options.pair = True
+
+    ## get files
+    print ('+ Getting files from project folder... ')
+    pd_samples_retrieved = sampleParser.files.get_files(options, outdir, "fastq", ["fastq", "fq", "fastq.gz", "fq.gz"], options.debug)
+
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: pd_samples_retrieve **", 'yellow'))
+        print (pd_samples_retrieved)
+
+    ## output folders for each step and sample
+    print ("\n+ Create output folder(s):")
+    outdir_dict = {}
+    steps = [ step for step in options.analysis if step != 'biotype' ]
+    if 'biotype' in options.analysis:
+        steps.extend(["map", "biotype"])
+    if options.pair:
+        steps.insert(0, "join")
+    if not options.noTrim:
+        steps.insert(0, "trimm")
+    for step in steps:
+        outdir_dict[step] = functions.files_functions.outdir_project(outdir, options.project, pd_samples_retrieved, step, options.debug)
+
+    ##############################################
+    ## databases and references
+    ##############################################
+    if not (options.database):
+        install_path =  os.path.dirname(os.path.realpath(__file__))
+        options.database = os.path.join(install_path, "db_files")
+    else:
+        options.database = os.path.abspath(options.database)
+    functions.files_functions.create_folder(options.database)
+
+    if 'miRNA' in options.analysis:
+        options = database.miRNA_db(options)
+
+    STAR_exe = ""
+    map_exe = ""
+    featureCount_exe = ""
+    options.reducedDir = None
+    if 'biotype' in options.analysis and options.aligner == 'bowtie':
+        map_exe = set_config.get_exe("bowtie", Debug=Debug)
+        featureCount_exe = set_config.get_exe('featureCounts', Debug=Debug)
+        options.annotation = os.path.abspath(options.annotation)
+        folder = functions.files_functions.create_subfolder(map.aligner_info['bowtie']['folder'], outdir)
+        options.bowtie_index = map.bowtie_index(options, folder, Debug)
+
+    elif 'biotype' in options.analysis:
+        STAR_exe = set_config.get_exe("STAR", Debug=Debug)
+        map_exe = STAR_exe
+        featureCount_exe = set_config.get_exe('featureCounts', Debug=Debug)
+        options.annotation = os.path.abspath(options.annotation)
+        if (options.fasta):
+            print ("+ Genome fasta file provided")
+            print ("+ Create genomeDir for later usage or reuse a compatible one...")
+            folder = functions.files_functions.create_subfolder('STAR_files', outdir)
+            options.genomeDir = STAR_caller.create_genomeDir(folder, STAR_exe, options.threads, os.path.abspath(options.fasta), options.limitRAM,
+                                                             genomeSAindexNbases=options.genomeSAindexNbases, 
+                                                             cache_dir=options.index_cache, Debug=Debug)
+        else:
+            options.genomeDir = os.path.abspath(options.genomeDir)
+
+        ## reduced reference of small RNA loci: mapped first
+        if options.reduced_reference:
+            folder = functions.files_functions.create_subfolder('STAR_files', outdir)
+            options.reducedDir = map.reduced_genomeDir(options, folder, STAR_exe, Debug)
+
+    ## adapters
+    adapters_dict = {}
+    if (options.adapters_a):
+        adapters_dict['adapter_a'] = options.adapters_a
+    if (options.adapters_A):
+        adapters_dict['adapter_A'] = options.adapters_A
+
+    if not options.perc_diff:
+        options.perc_diff = 0
+
+    ## mapping: genome loaded once in shared memory for all mapping tasks and
+    ## released when finished, even on errors (see STAR_caller.shared_genome)
+    genome_context = contextlib.nullcontext('NoSharedMemory')
+    if 'biotype' in options.analysis and options.aligner == 'STAR':
+        STAR_folder = functions.files_functions.create_subfolder('STAR_files', outdir)
+        genome_context = STAR_caller.shared_genome(STAR_folder, STAR_exe, options.genomeDir, options.threads, Debug)
+
+    with genome_context as genomeLoad:
+        options.genomeLoad = genomeLoad
+
+        ## optimize threads: CPUs and memory required by each step
+        name_list = set(pd_samples_retrieved["new_name"].tolist())
+        (resources, memory_shared, memory_loaded) = plan_steps(options, len(name_list), Debug)
+        memory_total = resource_manager.available_memory(memory_loaded) - memory_shared
+
+        ## debug message
+        if (Debug):
+            print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
+            print (colored("**DEBUG: memory available " +  str(memory_total) + " **", 'yellow'))
+            print (colored("**DEBUG: resources " +  str(resources) + " **", 'yellow'))
+
+        ##############################################
+        ## create graph of tasks
+        ##############################################
+        start_time_partial = functions.time_functions.timestamp(start_time_total)
+        print ("+ Create the graph of tasks for each sample retrieved...")
+        graph = create_graph(options, pd_samples_retrieved, outdir_dict, resources, adapters_dict,
+                             map_exe, featureCount_exe, Debug)
+
+        print ("+ Sending %s tasks for %s samples..." %(len(graph), len(name_list)))
+        status = task_graph.run_graph(graph, options.threads, Debug, threads=options.threads, memory=memory_total)
+
+        print ("\n\n+ Analysis for each sample is finished...")
+        task_graph.summary_graph(graph, status)
+
+    start_time_partial = functions.time_functions.timestamp(start_time_partial)
+
+    ##############################################
+    ## summarize results
+    ##############################################
+    print ("+ Let's summarize all results...")
+    outdir_report = functions.files_functions.create_subfolder("report", outdir)
+
+    samples_done = lambda step: [ task['sample'] for task_id, task in graph.items()
+                                        if task['step'] == step and status.get(task_id) == 'done' ]
+
+    if 'miRNA' in options.analysis:
+        summary_miRNA(options, outdir, outdir_report)
+
+    if 'tRNA' in options.analysis:
+        summary_tRNA(samples_done('tRNA'), outdir_dict['tRNA'], outdir_report, Debug,
+                     options.matrix_format, options.memory_budget, options.incremental, options.threads, options.rollup)
+
+    if 'biotype' in options.analysis:
+        summary_biotype(samples_done('biotype'), outdir_dict['biotype'], outdir_report, Debug, options.threads)
+
+    ## execution trace
+    if os.path.isfile(trace_file):
+        print ("\n+ Time and resources used by each step:")
+        exec_trace.summary_trace(trace_file)
+        chrome_trace = exec_trace.export_chrome_trace(trace_file, trace_file.replace(".jsonl", ".json"))
+        print ("+ Timeline available in: %s (open with https://ui.perfetto.dev or chrome://tracing)" %chrome_trace)
+
+    print ("\n*************** Finish *******************")
+    start_time_partial = functions.time_functions.timestamp(start_time_total)
+    print ("\n+ Exiting pipeline module.")
+    return()
+
+##############################################
+def plan_steps(options, n_samples, Debug):
+    """Sets threads and memory for the tasks of each step, according to the software employed.
+
+    :param options: input parameters introduced by the user. See XICRA pipeline -h.
+    :param n_samples: number of samples
+    :param Debug: show extra information of the process
+
+    :returns: (resources, memory_shared, memory_loaded): dictionary with threads, memory (and limitRAM for mapping) 
+              for each step, memory shared by all tasks (bowtie index) and memory shared by all tasks already 
+              loaded (STAR genome index, see resource_manager.available_memory).
+    """
+    tools = { 'trim': ['cutadapt'], 'join': ['fastqjoin'], 'tRNA': ['MINTmap'], 'biotype': ['featureCounts'] }
+
+    resources = {}
+    for step, tools_step in tools.items():
+        (threads_job, max_workers) = resource_manager.plan_jobs(tools_step, options.threads, n_samples, Debug=Debug)
+        memory_job = max([ resource_manager.get_profile(t)['memory'] for t in tools_step ])
+        resources[step] = { 'threads': threads_job, 'memory': memory_job }
+
+    ## miRNA: a task for each software and its miRTop standardization
+    if options.soft_name:
+        resources['miRNA'] = miRNA.plan_miRNA(options.soft_name, options.threads, n_samples, Debug)
+
+    ## mapping: genome index loaded once and RAM for sorting per job
+    (memory_shared, memory_loaded) = (0, 0)
+    if 'biotype' in options.analysis and options.aligner == 'bowtie':
+        (threads_job, max_workers, limitRAM_job, memory_job, memory_shared) = bowtie_caller.plan_mapping(options.threads, n_samples, 
+                                                                                                        options.bowtie_index, options.limitRAM, Debug,
+                                                                                                        sorted_bam=options.sorted_bam)
+        resources['map'] = { 'threads': threads_job, 'memory': memory_job, 'limitRAM': limitRAM_job }
+
+    elif 'biotype' in options.analysis:
+        (threads_job, max_workers, limitRAM_job, memory_job, memory_loaded) = STAR_caller.plan_mapping(options.threads, n_samples, 
+                                                                                                      options.genomeDir, options.limitRAM, Debug,
+                                                                                                      shared=(options.genomeLoad == 'LoadAndKeep'),
+                                                                                                      sorted_bam=options.sorted_bam)
+        resources['map'] = { 'threads': threads_job, 'memory': memory_job, 'limitRAM': limitRAM_job }
+
+    return (resources, memory_shared, memory_loaded)
+
+##############################################
+def create_graph(options, pd_samples_retrieved, outdir_dict, resources, adapters_dict, map_exe, featureCount_exe, Debug):
+    """Creates the graph of tasks for each sample and step.
+
+    :param options: input parameters introduced by the user. See XICRA pipeline -h.
+    :param pd_samples_retrieved: data frame with the information of the samples
+    :param outdir_dict: dictionary containing for each step, a dictionary of sample names and folders
+    :param resources: dictionary containing threads and memory for the tasks of each step. See plan_steps()
+    :param adapters_dict: dictionary with adapters to trim
+    :param map_exe: executable of the aligner selected (STAR or bowtie), if biotype analysis
+    :param featureCount_exe: featureCounts executable, if biotype analysis
+    :param Debug: show extra information of the process
+
+    :returns: Dictionary with the graph of tasks. See XICRA.scripts.task_graph
+    """
+    graph = {}
+
+    # Group dataframe by sample name
+    sample_frame = pd_samples_retrieved.groupby("new_name")
+
+    for name, cluster in sample_frame:
+        reads = sorted(cluster["sample"].tolist())
+        last_task = []
+
+        ## trim reads
+        if not options.noTrim:
+            trim_folder = outdir_dict["trimm"][name]
+            task_graph.add_task(graph, name + "_trim", cutadapt_caller.caller,
+                                [reads, trim_folder, name, resources['trim']['threads'], options.min_read_len,
+                                 Debug, adapters_dict, options.extra],
+                                sample=name, step="trim", **task_resources(resources, 'trim'))
+            last_task = [name + "_trim"]
+
+            if options.pair:
+                reads = [ os.path.join(trim_folder, name + "_trim_R1.fastq"),
+                          os.path.join(trim_folder, name + "_trim_R2.fastq") ]
+            else:
+                reads = [ os.path.join(trim_folder, name + "_trim.fastq") ]
+
+        ## join reads
+        if options.pair:
+            join_folder = outdir_dict["join"][name]
+            task_graph.add_task(graph, name + "_join", join.fastqjoin_caller,
+                                [reads, join_folder, name, resources['join']['threads'], options.perc_diff, Debug],
+                                depends=last_task, sample=name, step="join", **task_resources(resources, 'join'))
+            last_task = [name + "_join"]
+            reads = [ os.path.join(join_folder, name + "_trim_joined.fastq") ]
+
+        ## collapse reads: shared by all quantifiers
+        if len(reads) == 1:
+            profile = resource_manager.get_profile('collapse')
+            task_graph.add_task(graph, name + "_collapse", collapse_reads.collapse_caller,
+                                [reads, os.path.dirname(os.path.abspath(reads[0])), name, Debug],
+                                depends=last_task, sample=name, step="collapse", threads=1, memory=profile['memory'])
+            last_task = [name + "_collapse"]
+
+        ## miRNA analysis
+        if 'miRNA' in options.analysis:
+            miRNA.add_miRNA_tasks(graph, reads, outdir_dict["miRNA"][name], name, options.soft_name, resources['miRNA'],
+                                  options.miRNA_gff, options.matureFasta, options.hairpinFasta, options.species,
+                                  options.database, Debug, depends=last_task)
+
+        ## tRNA analysis
+        if 'tRNA' in options.analysis:
+            MINTmap_folder = functions.files_functions.create_subfolder('mintmap', outdir_dict["tRNA"][name])
+            task_graph.add_task(graph, name + "_tRNA", MINTMap_caller.MINTmap_caller,
+                                [MINTmap_folder, reads, name, resources['tRNA']['threads'], options.species,
+                                 options.database, Debug],
+                                depends=last_task, sample=name, step="tRNA", **task_resources(resources, 'tRNA'))
+
+        ## biotype analysis: mapping & featureCounts
+        if 'biotype' in options.analysis:
+            map_folder = outdir_dict["map"][name]
+            if options.aligner == 'bowtie':
+                task_graph.add_task(graph, name + "_map", map.mapReads_caller_bowtie,
+                                    [reads, map_folder, name, resources['map']['threads'], map_exe,
+                                     options.bowtie_index, resources['map']['limitRAM'], Debug, 
+                                     options.collapsed_mapping, options.sorted_bam],
+                                    depends=last_task, sample=name, step="map", **task_resources(resources, 'map'))
+            else:
+                task_graph.add_task(graph, name + "_map", map.mapReads_caller_STAR,
+                                    [reads, map_folder, name, resources['map']['threads'], map_exe,
+                                     options.genomeDir, resources['map']['limitRAM'], Debug, options.genomeLoad,
+                                     options.reducedDir, options.collapsed_mapping, options.sorted_bam],
+                                    depends=last_task, sample=name, step="map", **task_resources(resources, 'map'))
+
+            bam_file = os.path.join(map_folder, STAR_caller.bam_sorted if options.sorted_bam else STAR_caller.bam_unsorted)
+            task_graph.add_task(graph, name + "_biotype", RNAbiotype.biotype_all,
+                                [featureCount_exe, outdir_dict["biotype"][name], options.annotation,
+                                 bam_file, name, resources['biotype']['threads'], Debug, not options.no_multiMapping,
+                                 options.stranded],
+                                depends=[name + "_map"], sample=name, step="biotype", **task_resources(resources, 'biotype'))
+
+    return (graph)
+
+##############################################
+def task_resources(resources, step):
+    """Returns threads and memory for a task of the step provided, as required by task_graph.add_task()."""
+    return ({ 'threads': resources[step]['threads'], 'memory': resources[step]['memory'] })
+
+##############################################
+def summary_miRNA(options, outdir, outdir_report):
+    """Generates the miRNA expression matrix for all samples."""
+    expression_folder = functions.files_functions.create_subfolder("miRNA", outdir_report)
+
+    ## dictionary results
+    options.pair = False
+    results_SampleParser = sampleParser.files.get_files(options, outdir, "miRNA", ["mirtop.tsv"], options.debug)
+    results_df = pd.DataFrame(columns=("name", "soft", "filename"))
+    results_df['name'] = results_SampleParser['name']
+    results_df['soft'] = results_SampleParser['ext']
+    results_df['filename'] = results_SampleParser['sample']
+
+    ## debugging messages
+    if options.debug:
+        print (results_df)
+
+    print ("+ Summarize miRNA analysis for all samples...")
+    generate_DE.generate_DE(results_df, options.debug, expression_folder, out_format=options.matrix_format,
+                            memory_budget=options.memory_budget, incremental=options.incremental,
+                            threads=options.threads, rollup=rollup_levels(options.rollup, 'miRNA'))
+
+##############################################
+def summary_tRNA(samples, outdir_dict, outdir_report, Debug, out_format='csv', memory_budget=None, incremental=False, threads=1, rollup=None):
+    """Generates the tRF expression matrices for all samples."""
+    expression_folder = functions.files_functions.create_subfolder("tRNA", outdir_report)
+
+    results_df = pd.DataFrame(columns=("name", "soft", "type", "filename"))
+    for name in samples:
+        parse_folder = os.path.join(outdir_dict[name], 'mintmap', 'mintmap_parse')
+        results_df.loc[len(results_df)] = name, "mintmap", "amb", os.path.join(parse_folder, name + '_amb.tsv')
+        results_df.loc[len(results_df)] = name, "mintmap", "exc", os.path.join(parse_folder, name + '_exc.tsv')
+
+    ## debugging messages
+    if Debug:
+        print (results_df)
+
+    results_df = results_df.set_index('type')
+
+    print ("\n\n+ Parsing ambiguous tRNA analysis for all samples...")
+    generate_DE.generate_DE(results_df.filter(like="amb", axis=0).set_index('name'),
+                            Debug, expression_folder, type_analysis="tRF-amb", out_format=out_format,
+                            memory_budget=memory_budget, incremental=incremental, threads=threads,
+                            rollup=rollup_levels(rollup, 'tRNA'))
+
+    print ("\n\n+ Parsing exclusive tRNA analysis for all samples...")
+    generate_DE.generate_DE(results_df.filter(like="exc", axis=0).set_index('name'),
+                            Debug, expression_folder, type_analysis="tRF-exc", out_format=out_format,
+                            memory_budget=memory_budget, incremental=incremental, threads=threads,
+                            rollup=rollup_levels(rollup, 'tRNA'))
+
+##############################################
+def rollup_levels(levels, type_analysis):
+    """Returns the levels to roll up available for the type of analysis. See expression_rollup."""
+    return ([ level for level in (levels or []) if level in expression_rollup.analysis_levels(type_analysis) ])
+
+##############################################
+def summary_biotype(samples, outdir_dict, outdir_report, Debug, threads=1):
+    """Generates the RNA biotype summary for all samples."""
+    biotype_report = functions.files_functions.create_subfolder("biotype", outdir_report)
+
+    ## plot & results
+    dict_files = {}
+    for name in samples:
+        RNAbiotypes_stats_file = os.path.join(outdir_dict[name], name + '_RNAbiotype.tsv')
+        if functions.files_functions.is_non_zero_file(RNAbiotypes_stats_file):
+            RNAbiotype.pie_plot_results(RNAbiotypes_stats_file, name, outdir_dict[name], Debug)
+
+        featurecount_file = os.path.join(outdir_dict[name], 'featureCount.out.tsv')
+        if functions.files_functions.is_non_zero_file(featurecount_file):
+            dict_files[name] = featurecount_file
+
+    ## collapse all information
+    all_data = RNAbiotype.generate_matrix(dict_files, threads)
+    print ('+ Table contains: ', len(all_data), ' entries\n')
+
+    ## debugging messages
+    if Debug:
+        print ("** DEBUG: all_data")
+        print (all_data)
+
+    abs_csv_outfile = os.path.join(biotype_report, "summary.csv")
+    all_data.to_csv(abs_csv_outfile)
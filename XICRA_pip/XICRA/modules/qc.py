@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from XICRA.scripts import multiQC_report
 from XICRA.scripts import fastqc_caller
+from XICRA.scripts import resource_manager, step_cache
 from XICRA.config import set_config
 from XICRA.modules import help_XICRA
 from HCGB import sampleParser
@@ -52,6 +53,9 @@ def run_QC(options):
         Debug = True
     else:
         Debug = False    
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
     
     ### set as default paired_end mode
     if (options.single_end):
@@ -142,10 +146,9 @@ def fastqc(pd_samples_retrieved, outdir, options, name_analysis, time_stamp, Deb
     # Group dataframe by sample name
     sample_frame = pd_samples_retrieved.groupby(["name"])
 
-    ## optimize threads
+    ## optimize threads: CPUs and memory required
     name_list = set(pd_samples_retrieved["name"].tolist())
-    threads_job = functions.main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
+    (threads_job, max_workers_int) = resource_manager.plan_jobs('fastqc', options.threads, len(name_list), Debug=options.debug)
 
     ## debug message
     if (Debug):
@@ -27,6 +27,7 @@ from XICRA.config import set_config
 from XICRA.modules import help_XICRA
 from XICRA.scripts import generate_DE
 from XICRA.scripts import MINTMap_caller
+from XICRA.scripts import resource_manager, step_cache
 
 ##############################################
 def run_tRNA(options):
@@ -57,6 +58,9 @@ def run_tRNA(options):
         Debug = True
     else:
         Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
         
     ### set as default paired_end mode
     if (options.single_end):
@@ -142,13 +146,9 @@ def run_tRNA(options):
     ## for samples
     outdir_dict = functions.files_functions.outdir_project(outdir, options.project, pd_samples_retrieved, "tRNA", options.debug)
     
-    ## optimize threads
+    ## optimize threads: CPUs and memory required
     name_list = set(pd_samples_retrieved["new_name"].tolist())
-    threads_job = functions.main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
-    ## to FIX: MINTmap requires to chdir to folder to create results
-    max_workers_int = 1
+    (threads_job, max_workers_int) = resource_manager.plan_jobs('MINTmap', options.threads, len(name_list), Debug=options.debug)
 
     ## debug message
     if (Debug):
@@ -166,7 +166,7 @@ def run_tRNA(options):
     results_df = pd.DataFrame(columns=("name", "soft", "type", "filename"))
     
     # Group dataframe by sample name
-    sample_frame = pd_samples_retrieved.groupby(["new_name"])
+    sample_frame = pd_samples_retrieved.groupby("new_name")
     
     ## send for each sample
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
@@ -202,17 +202,20 @@ def run_tRNA(options):
     if 'mintmap' in options.soft_name:
         results_df = results_df.set_index('type')
         
-        ## exclusive tRFs
-        print ("\n\n+ Parsing exclusive tRNA analysis for all samples...")
+        ## ambiguous tRFs
+        print ("\n\n+ Parsing ambiguous tRNA analysis for all samples...")
         generate_DE.generate_DE(results_df.filter(like="amb", axis=0).set_index('name'), 
-                                options.debug, expression_folder,  type_analysis="tRF-amb")
+                                options.debug, expression_folder,  type_analysis="tRF-amb", out_format=options.matrix_format, memory_budget=options.memory_budget,
+                                incremental=options.incremental, threads=options.threads, rollup=options.rollup)
         
-        ## amb tRFs
-        print ("\n\n+ Parsing ambiguous tRNA analysis for all samples...")
+        ## exclusive tRFs
+        print ("\n\n+ Parsing exclusive tRNA analysis for all samples...")
         generate_DE.generate_DE(results_df.filter(like="exc", axis=0).set_index('name'), 
-                                options.debug, expression_folder,  type_analysis="tRF-exc")
+                                options.debug, expression_folder,  type_analysis="tRF-exc", out_format=options.matrix_format, memory_budget=options.memory_budget,
+                                incremental=options.incremental, threads=options.threads, rollup=options.rollup)
     else:
-        generate_DE.generate_DE(results_df, options.debug, expression_folder,  type_analysis="tRNA")
+        generate_DE.generate_DE(results_df, options.debug, expression_folder,  type_analysis="tRNA", out_format=options.matrix_format, memory_budget=options.memory_budget,
+                                incremental=options.incremental, threads=options.threads, rollup=options.rollup)
 
     print ("\n*************** Finish *******************")
     start_time_partial = functions.time_functions.timestamp(start_time_total)
@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from XICRA.scripts import multiQC_report
 from XICRA.scripts import cutadapt_caller
+from XICRA.scripts import resource_manager, step_cache
 from XICRA.config import set_config
 from XICRA.modules import help_XICRA
 from XICRA.modules import qc
@@ -68,6 +69,9 @@ def run_trim(options):
         Debug = True
     else:
         Debug = False
+
+    ## shared cache of results across projects (see step_cache)
+    step_cache.set_cache(options.cache_dir, options.content_hash)
         
     ### set as default paired_end mode
     if (options.single_end):
@@ -138,10 +142,9 @@ def run_trim(options):
     ## for samples
     outdir_dict = functions.files_functions.outdir_project(outdir, options.project, pd_samples_retrieved, "trimm", options.debug)
     
-    ## optimize threads
+    ## optimize threads: CPUs and memory required
     name_list = set(pd_samples_retrieved["new_name"].tolist())
-    threads_job = functions.main_functions.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
+    (threads_job, max_workers_int) = resource_manager.plan_jobs('cutadapt', options.threads, len(name_list), Debug=options.debug)
 
     ## debug message
     if (Debug):
@@ -152,7 +155,7 @@ def run_trim(options):
     print ("+ Trimming adapters for each sample retrieved...")    
     
     # Group dataframe by sample name
-    sample_frame = pd_samples_retrieved.groupby(["new_name"])
+    sample_frame = pd_samples_retrieved.groupby("new_name")
     
     ## send for each sample
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
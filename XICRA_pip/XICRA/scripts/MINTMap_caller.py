@@ -20,6 +20,7 @@ from termcolor import colored
 from HCGB import functions
 from XICRA.config import set_config
 from XICRA.modules import database
+from XICRA.scripts import step_cache, exec_trace, collapse_reads
 import HCGB.functions.aesthetics_functions as HCGB_aes
 
 ############################
@@ -33,22 +34,13 @@ def download_MINTmap_db(database_folder, tRNA_db, debug):
 
 ############################
 def MINTmap_caller(MINTmap_folder, reads, name, num_threads, species, database, Debug):
-    # check if previously generated and succeeded
-    filename_stamp = MINTmap_folder + '/.success_all'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'MINTmap'), 'yellow'))
+    # Call MINTMap_analysis: each step is only executed if inputs or parameters changed
+    code_returned = MINTMap_analysis(MINTmap_folder, reads, name, num_threads, species, database, Debug)
+    if code_returned:
         return True
-
     else:
-        # Call MINTMap_analysis
-        code_returned = MINTMap_analysis(MINTmap_folder, reads, name, num_threads, species, database, Debug)
-        if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
-            return True
-        else:
-            print ('** Sample %s failed...' %name)
-            return(False)
+        print ('** Sample %s failed...' %name)
+        return(False)
 
 ############################
 def MINTMap_analysis(path_folder, reads, name, num_threads, species, database, Debug):
@@ -66,32 +58,25 @@ def MINTMap_analysis(path_folder, reads, name, num_threads, species, database, D
         HCGB_aes.debug_message("species: " + species, "yellow")
         HCGB_aes.debug_message("species_code: " + species_code, "yellow")
     
-    ## ATTENTION: MINTmap needs to chdir to output folder
-    path_here = os.getcwd()
-    
-    ## debug messages 
-    if Debug:    
-        HCGB_aes.debug_message("path_here: " + path_here, "yellow")
-            
-    filename_stamp = path_folder + '/.success_mintmap'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'MINTmap call'), 'yellow'))
-    else:
+    (cached, step_info) = step_cache.check_step(path_folder, 'MINTmap', name, reads, "bundle: %s" %species_code, prog='MINTmap', 
+                                                legacy_stamp=path_folder + '/.success_mintmap', Debug=Debug, by_name=True)
+    if not cached:
         # Call MINTMap_analysis
         codeReturn = MINTmap(reads, path_folder, name, num_threads, species_code, database, Debug)
-        os.chdir(path_here)
         
         if not codeReturn:
             print ('** Sample %s failed...' %name)
             return False
 
-        ## create time stamp        
-        functions.time_functions.print_time_stamp(filename_stamp)
+        ## save MINTmap results generated
+        step_cache.save_step(step_info, [ os.path.join(path_folder, f) for f in os.listdir(path_folder) 
+                                          if os.path.isfile(os.path.join(path_folder, f)) and not f.startswith('.') ])
 
     ## Get MINTmap matrix
     MINTmap_matrix_folder = functions.files_functions.create_subfolder("mintmap_parse", path_folder)
 
+    amb_file = ""
+    exc_file = ""
     files = os.listdir(path_folder)
     for item in files:
         abs_path_file = os.path.abspath(os.path.join(path_folder, item))
@@ -116,9 +101,8 @@ def MINTMap_analysis(path_folder, reads, name, num_threads, species, database, D
         HCGB_aes.debug_message("amb_file: " + amb_file, "yellow")
         
     
-    if functions.files_functions.is_non_zero_file(amb_file) and functions.files_functions.is_non_zero_file(exc_file):
-        filename_stamp = path_folder + '/.success_all'
-        functions.time_functions.print_time_stamp(filename_stamp)
+    if not functions.files_functions.is_non_zero_file(amb_file) or not functions.files_functions.is_non_zero_file(exc_file):
+        return(False)
     
     return(True)
 
@@ -128,12 +112,9 @@ def parse_tRF(pathFile, sample_name, matrix_folder, ident, Debug):
     ## tsv file name
     tsv_file = os.path.join(matrix_folder, sample_name + "_" + ident + '.tsv')
     
-    ## time stamp
-    filename_stamp = matrix_folder + '/.success_parse'
-    if os.path.isfile(filename_stamp) and functions.files_functions.is_non_zero_file(tsv_file):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, sample_name, 'MINTmap - parse'), 'yellow'))
-    else:
+    ## check if previously parsed
+    (cached, step_info) = step_cache.check_step(matrix_folder, 'MINTmap_parse_' + ident, sample_name, [pathFile], "", Debug=Debug)
+    if not cached:
         ## Open file
         fil = open(tsv_file, 'w')
         string2write = 'UID\tRead\ttRNA\tvariant\tident\texpression\tsoft\n'
@@ -180,8 +161,9 @@ def parse_tRF(pathFile, sample_name, matrix_folder, ident, Debug):
                     fil.write(string2write)
 
         fil.close()
+        step_cache.save_step(step_info, [tsv_file])
 
-        return(tsv_file)
+    return(tsv_file)
 
 ##############
 def MINTmap(reads, outpath, name, num_threads, species_code, database, Debug):
@@ -189,9 +171,6 @@ def MINTmap(reads, outpath, name, num_threads, species_code, database, Debug):
     outpath = os.path.abspath(outpath)
     functions.files_functions.create_folder(outpath)
     
-    ## change path where the results are required
-    os.chdir(outpath)
-    
     mintmap_exe = set_config.get_exe("MINTmap", Debug=Debug)
     logfile = os.path.join(outpath, 'MINTmap.log')
     
@@ -205,13 +184,19 @@ def MINTmap(reads, outpath, name, num_threads, species_code, database, Debug):
     ## TODO
     ## use -m option with database provided
     
-    ## species bundle
-    if species_code == "default": 
-        ## create command: use default mapping bundle provided with MINTmap 
-        cmd = '%s -p %s %s 2> %s' %(mintmap_exe, name, reads[0], logfile)
-    else:
-        ## create command: use specific mapping bundle path 
-        cmd = '%s -p %s -m %s %s 2> %s' %(mintmap_exe, name, species_code, reads[0], logfile)
-    
-    return(functions.system_call_functions.system_call(cmd))
+    ## MINTmap creates results in the working directory: change it only for the command,
+    ## so several samples could be analyzed at the same time
+    ## use collapsed reads of the sample, expanded on the fly: create it in a subfolder,
+    ## as all files in outpath are considered MINTmap results
+    tmp_folder = functions.files_functions.create_subfolder('tmp', outpath)
+    with collapse_reads.fastq_input(reads, tmp_folder, name, Debug) as fastq:
+        ## species bundle
+        if species_code == "default": 
+            ## create command: use default mapping bundle provided with MINTmap 
+            cmd = 'cd %s && %s -p %s %s 2> %s' %(outpath, mintmap_exe, name, os.path.abspath(fastq[0]), logfile)
+        else:
+            ## create command: use specific mapping bundle path 
+            cmd = 'cd %s && %s -p %s -m %s %s 2> %s' %(outpath, mintmap_exe, name, species_code, os.path.abspath(fastq[0]), logfile)
+        
+        return(exec_trace.system_call(cmd, 'MINTmap', name, threads=num_threads, inputs=reads, outputs=[outpath]))
  
\ No newline at end of file
@@ -16,6 +16,7 @@ import concurrent.futures
 
 ## import my modules
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace, table_loader, collapse_reads
 
 ## import HCGB
 from HCGB.functions import system_call_functions, main_functions, time_functions
@@ -24,12 +25,15 @@ from HCGB.functions import files_functions, math_functions
 ## plots
 import pandas as pd
 import matplotlib
-from build.lib.HCGB.functions.aesthetics_functions import debug_message
+from HCGB.functions.aesthetics_functions import debug_message
 
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 from pandas.plotting import table
 
+## maximum number of BAM files counted in the same featureCounts call (see biotype_cohort)
+cohort_batch_size = 100
+
 #####################
 def help_info():
 	'''Provide information on RNA biotype analysis'''
@@ -46,60 +50,297 @@ def biotype_all(featureCount_exe, path, gtf_file, bam_file, name, threads, Debug
 	out_file = os.path.join(path, 'featureCount.out')
 	logfile = os.path.join(path, name + '_RNAbiotype.log')
 
-	filename_stamp_all = path + '/.success_all'
-	if os.path.isfile(filename_stamp_all):
-		stamp = time_functions.read_time_stamp(filename_stamp_all)
-		print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'RNAbiotype'), 'yellow'))
-		return()
+	## alignments of unique sequences: weighted by the reads represented (see collapse_reads)
+	weighted = collapse_reads.is_weighted(bam_file)
+
+	## check if previously generated with same BAM, annotation and parameters
+	(cached, step_info) = step_cache.check_step(path, 'featureCounts', name, [bam_file, gtf_file], 
+											featureCount_params(stranded, allow_multimap, weighted), prog='featureCounts', 
+											legacy_stamp=path + '/.success_featureCounts', Debug=Debug, by_name=True)
+	if not cached:
+		## debugging messages
+		if Debug:
+			print ("** DEBUG:")
+			print ("featureCounts system call for sample: " + name)
+			print ("out_file: " + out_file)
+			print ("logfile: " + logfile)
+	
+		## send command for feature count
+		## assignment of each read: weighted afterwards
+		cmd_featureCount = featureCount_cmd(featureCount_exe, gtf_file, [bam_file], out_file, logfile, threads, 
+										allow_multimap, stranded, path if weighted else None)
+			
+		## system call
+		cmd_featureCount_code = exec_trace.system_call(cmd_featureCount, 'featureCounts', name, threads=threads, inputs=[bam_file], outputs=[out_file])
+		if not cmd_featureCount_code:
+			print("** ERROR: featureCount failed for sample " + name)
+			exit()
+		
+		if weighted:
+			core_file = os.path.join(path, os.path.basename(bam_file) + '.featureCounts')
+			weight_featureCount(out_file, core_file)
+			os.remove(core_file)
+			
+		## save results generated
+		step_cache.save_step(step_info, [out_file, out_file + '.summary', logfile])
+	
+	## parse results
+	(extended_Stats_file, RNAbiotypes_stats_file) = parse_featureCount(out_file, path, name, bam_file, Debug)
+	
+	## debugging messages
+	if Debug:
+		print ("** DEBUG:")
+		print ("extended_Stats: " + extended_Stats_file)
+		print (main_functions.get_data(extended_Stats_file, '\t', 'header=None'))
+		print ("RNAbiotypes_stats: " + RNAbiotypes_stats_file)
+		print (main_functions.get_data(RNAbiotypes_stats_file, '\t', 'header=None'))
 
+	return ()
+
+#######################################################################
+def featureCount_params(stranded, allow_multimap, weighted):
+	"""Returns the parameters of the featureCounts analysis of a sample, used to check previous results (see step_cache)."""
+	params = "-s %s multimapping: %s" %(stranded, allow_multimap)
+	if weighted:
+		params = params + " weighted: True"
+	return (params)
+
+#######################################################################
+def featureCount_cmd(featureCount_exe, gtf_file, bam_files, out_file, logfile, threads, allow_multimap, stranded, Rpath=None):
+	"""
+	Returns the featureCounts command to count reads of the BAM files provided for each RNA biotype.
+	
+	Several BAM files are counted in the same call, with a column of counts for each one, 
+	so the annotation is only loaded once.
+	
+	:param featureCount_exe: featureCounts executable.
+	:param gtf_file: Gene annotation file for the reference genome used.
+	:param bam_files: List of BAM files.
+	:param out_file: Name provided to featureCount for output results.
+	:param logfile: File to store featureCounts messages.
+	:param threads: Number of threads to use.
+	:param allow_multimap: Count multimapping reads.
+	:param stranded: Stranded [1], reverse stranded [2] or non-stranded [0] reads.
+	:param Rpath: Folder to store the assignment of each read (-R CORE), if required.
+	"""
+	## Allow multimapping
+	if allow_multimap:
+		multimap_option = "-M -O"
 	else:
-		filename_stamp_featureCounts = path + '/.success_featureCounts'
-		if os.path.isfile(filename_stamp_featureCounts):
-			stamp = time_functions.read_time_stamp(filename_stamp_featureCounts)
-			print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'featureCounts'), 'yellow'))
-		else:
-            
-			## debugging messages
-			if Debug:
-				print ("** DEBUG:")
-				print ("featureCounts system call for sample: " + name)
-				print ("out_file: " + out_file)
-				print ("logfile: " + logfile)
+		multimap_option = "--largestOverlap"
+	
+	cmd_featureCount = ('%s -s %s %s -T %s -p -t exon -g transcript_biotype' %(featureCount_exe, stranded, multimap_option, threads))
+	if Rpath:
+		cmd_featureCount = cmd_featureCount + ' -R CORE --Rpath %s' %Rpath
+	
+	cmd_featureCount = cmd_featureCount + ' -a %s -o %s %s 2> %s' %(gtf_file, out_file, " ".join(bam_files), logfile)
+	return (cmd_featureCount)
+
+#######################################################################
+def split_featureCount(out_file, columns, Debug):
+	"""
+	Splits featureCounts results of several BAM files into the results of each one.
+	
+	Files generated (out_file and out_file.summary of each sample) are the same as 
+	featureCounts generates for a single BAM file.
+	
+	:param out_file: Name provided to featureCount for output results of all BAM files.
+	:param columns: Dictionary containing output file names as keys and a tuple with the 
+	  column (BAM file provided to featureCounts) and BAM file to report as values.
+	:param Debug: True/False for debugging messages
+	"""
+	## command line in first line
+	with open(out_file) as fh:
+		program_line = fh.readline()
+
+	counts = pd.read_csv(out_file, sep='\t', skiprows=1, dtype=str)
+	summary = pd.read_csv(out_file + '.summary', sep='\t', dtype=str)
+	annotation_cols = [ col for col in counts.columns if col not in summary.columns ]
+	
+	for sample_out_file, (column, bam_file) in columns.items():
+		if Debug:
+			print ("** DEBUG:")
+			print ("Split featureCounts results: %s -> %s" %(column, sample_out_file))
 		
-			## send command for feature count
-			## Allow multimapping
-			if allow_multimap:
-				cmd_featureCount = ('%s -s %s -M -O -T %s -p -t exon -g transcript_biotype -a %s -o %s %s 2> %s' %(
-					featureCount_exe, stranded, threads, gtf_file, out_file, bam_file, logfile)
-				)
-			else:
-				cmd_featureCount = ('%s -s %s --largestOverlap -T %s -p -t exon -g transcript_biotype -a %s -o %s %s 2> %s' %(
-					featureCount_exe, stranded, threads, gtf_file, out_file, bam_file, logfile)
-				)
-				
-				
-			## system call
-			cmd_featureCount_code = system_call_functions.system_call(cmd_featureCount, False, True)
-			if not cmd_featureCount_code:
-				print("** ERROR: featureCount failed for sample " + name)
-				exit()
-				
-			## print time stamp
-			time_functions.print_time_stamp(filename_stamp_featureCounts)
+		with open(sample_out_file, 'w') as fh:
+			fh.write(program_line)
+			counts[annotation_cols + [column]].rename(columns={column: bam_file}).to_csv(fh, sep='\t', index=False)
 		
-		## parse results
-		(extended_Stats_file, RNAbiotypes_stats_file) = parse_featureCount(out_file, path, name, bam_file, Debug)
+		summary[['Status', column]].rename(columns={column: bam_file}).to_csv(sample_out_file + '.summary', sep='\t', index=False)
+
+#######################################################################
+def biotype_cohort(featureCount_exe, samples_dict, output_dict, gtf_file, cohort_folder, threads, Debug, allow_multimap, stranded):
+	"""
+	Creates the featureCounts analysis of all samples in one or a few featureCounts calls.
+	
+	BAM files are counted in batches of up to cohort_batch_size files in the same featureCounts 
+	call, so the annotation is loaded once per batch instead of once per sample. Results 
+	are split into the results of each sample (see split_featureCount), the same as 
+	generated by biotype_all(), and parsed for each sample.
+	
+	BAM files are linked in the cohort folder with the name of the sample: the column of counts
+	and the assignment of each read (-R CORE) of weighted BAM files are named after the sample.
+	
+	:param featureCount_exe: featureCounts executable.
+	:param samples_dict: Dictionary containing sample IDs as keys and bam files as values
+	:param output_dict: Dictionary containing sample IDs as keys and output folder as values
+	:param gtf_file: Gene annotation file for the reference genome used.
+	:param cohort_folder: Folder to store featureCounts results of all samples.
+	:param threads: Number of threads to use, shared by all batches.
+	:param Debug: True/False for debugging messages
+	:param allow_multimap: Count multimapping reads.
+	:param stranded: Stranded [1], reverse stranded [2] or non-stranded [0] reads.
+	"""
+	## samples to count: skip samples previously counted with same BAM, annotation and parameters
+	batches = { True: [], False: [] }
+	steps = {}
+	for name, bam_file in samples_dict.items():
+		path = output_dict[name]
+		if not os.path.isdir(path):
+			files_functions.create_folder(path)
 		
-		## debugging messages
-		if Debug:
-			print ("** DEBUG:")
-			print ("extended_Stats: " + extended_Stats_file)
-			print (main_functions.get_data(extended_Stats_file, '\t', 'header=None'))
-			print ("RNAbiotypes_stats: " + RNAbiotypes_stats_file)
-			print (main_functions.get_data(RNAbiotypes_stats_file, '\t', 'header=None'))
+		if not files_functions.is_non_zero_file(bam_file):
+			print (colored("** ERROR: BAM file not available for sample " + name, 'red'))
+			continue
+		
+		## alignments of unique sequences: weighted by the reads represented (see collapse_reads)
+		weighted = collapse_reads.is_weighted(bam_file)
+		(cached, step_info) = step_cache.check_step(path, 'featureCounts', name, [bam_file, gtf_file], 
+												featureCount_params(stranded, allow_multimap, weighted), prog='featureCounts', 
+												legacy_stamp=path + '/.success_featureCounts', Debug=Debug, by_name=True)
+		if not cached:
+			batches[weighted].append(name)
+			steps[name] = step_info
 
+	## weighted BAM files require the assignment of each read: counted in separate batches
+	batch_list = []
+	for weighted, names in batches.items():
+		for i in range(0, len(names), cohort_batch_size):
+			batch_list.append((weighted, names[i:i + cohort_batch_size]))
+	
+	if batch_list:
+		files_functions.create_folder(cohort_folder)
+		print ("+ featureCounts analysis of %s samples in %s call(s)" %(len(steps), len(batch_list)))
+	
+	## threads shared by all batches
+	threads_batch = max(1, int(threads) // max(1, len(batch_list)))
+	
+	## send each batch
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(batch_list))) as executor:
+		commandsSent = { executor.submit(biotype_batch, featureCount_exe, samples_dict, output_dict, gtf_file, 
+										cohort_folder, 'batch' + str(i + 1), names, weighted, threads_batch, 
+										Debug, allow_multimap, stranded): names for i, (weighted, names) in enumerate(batch_list) }
+		
+		for cmd2 in concurrent.futures.as_completed(commandsSent):
+			details = commandsSent[cmd2]
+			try:
+				data = cmd2.result()
+			except Exception as exc:
+				print ('***ERROR:')
+				print (cmd2)
+				print('%r generated an exception: %s' % (details, exc))
+				continue
+			
+			## save results generated
+			for name in details:
+				out_file = os.path.join(output_dict[name], 'featureCount.out')
+				step_cache.save_step(steps[name], [out_file, out_file + '.summary'])
+	
+	## parse results
+	for name, bam_file in samples_dict.items():
+		out_file = os.path.join(output_dict[name], 'featureCount.out')
+		if files_functions.is_non_zero_file(out_file):
+			parse_featureCount(out_file, output_dict[name], name, bam_file, Debug)
+
+	return ()
+
+#######################################################################
+def biotype_batch(featureCount_exe, samples_dict, output_dict, gtf_file, cohort_folder, batch_name, names, weighted, threads, Debug, allow_multimap, stranded):
+	"""
+	Counts reads of the samples provided in one featureCounts call and splits results for each sample.
+	
+	See biotype_cohort() for details.
+	"""
+	out_file = os.path.join(cohort_folder, 'featureCount_' + batch_name + '.out')
+	logfile = os.path.join(cohort_folder, 'featureCount_' + batch_name + '.log')
+
+	## link BAM files with the name of the sample
+	bam_links = {}
+	for name in names:
+		bam_links[name] = os.path.join(cohort_folder, name + '.bam')
+		if os.path.lexists(bam_links[name]):
+			os.remove(bam_links[name])
+		os.symlink(os.path.abspath(samples_dict[name]), bam_links[name])
+
+	## debugging messages
+	if Debug:
+		print ("** DEBUG:")
+		print ("featureCounts system call for %s: %s" %(batch_name, ", ".join(names)))
+		print ("out_file: " + out_file)
+		print ("logfile: " + logfile)
+
+	## send command for feature count
+	## assignment of each read: weighted afterwards
+	cmd_featureCount = featureCount_cmd(featureCount_exe, gtf_file, list(bam_links.values()), out_file, logfile, threads, 
+									allow_multimap, stranded, cohort_folder if weighted else None)
+	cmd_featureCount_code = exec_trace.system_call(cmd_featureCount, 'featureCounts', batch_name, threads=threads, 
+												inputs=list(samples_dict[name] for name in names), outputs=[out_file])
+	if not cmd_featureCount_code:
+		print("** ERROR: featureCount failed for samples: " + ", ".join(names))
+		exit()
+
+	## results for each sample
+	split_featureCount(out_file, dict([ (os.path.join(output_dict[name], 'featureCount.out'), (bam_links[name], samples_dict[name])) 
+										for name in names ]), Debug)
+
+	for name in names:
+		if weighted:
+			core_file = bam_links[name] + '.featureCounts'
+			weight_featureCount(os.path.join(output_dict[name], 'featureCount.out'), core_file)
+			os.remove(core_file)
+		os.remove(bam_links[name])
+
+	## remove tmp files
+	os.remove(out_file)
+	os.remove(out_file + '.summary')
+	
 	return ()
 
+#######################################################################
+def weight_featureCount(out_file, core_file):
+	"""
+	Replaces counts of featureCounts results by the reads represented by each alignment.
+	
+	Alignments of unique sequences are weighted by the count in the read name (see 
+	collapse_reads.read_weight). Unmapped sequences are included in the BAM file
+	but reported from the mapping statistics, so they are not counted here.
+	
+	:param out_file: Name provided to featureCount for output results.
+	:param core_file: Assignment of each read generated by featureCounts (-R CORE).
+	"""
+	## read assignments
+	reads = pd.read_csv(core_file, sep='\t', header=None, usecols=[0, 1, 3], names=['read', 'status', 'targets'], dtype=str)
+	reads['weight'] = reads['read'].str.extract(collapse_reads.weight_regex.pattern, expand=False).fillna(1).astype('int64')
+	status = reads.groupby('status')['weight'].sum()
+	status['Unassigned_Unmapped'] = 0
+
+	## a read could be assigned to several features (-M -O)
+	assigned = reads[reads['status'] == 'Assigned']
+	targets = assigned.assign(targets=assigned['targets'].str.split(',')).explode('targets')
+	counts = targets.groupby('targets')['weight'].sum()
+
+	## replace last column of results and summary
+	for file_name, values, skip in ((out_file, counts, ('#', 'Geneid')), (out_file + '.summary', status, ('Status',))):
+		with open(file_name) as fh:
+			lines = fh.read().splitlines()
+		with open(file_name, 'w') as fh:
+			for line in lines:
+				if not line.startswith(skip):
+					fields = line.split('\t')
+					fields[-1] = str(int(values.get(fields[0], 0)))
+					line = '\t'.join(fields)
+				fh.write(line + '\n')
+
 #######################################################################
 def parse_featureCount(out_file, path, name, bam_file, Debug):
 	"""
@@ -116,12 +357,14 @@ def parse_featureCount(out_file, path, name, bam_file, Debug):
 	out_tsv_file_name = out_file + '.tsv'
 	RNA_biotypes_file_name = os.path.join(path, name + '_RNAbiotype.tsv')
 
-	##
-	filename_stamp_parse = path + '/.success_parse'
-	if os.path.isfile(filename_stamp_parse):
-		stamp = time_functions.read_time_stamp(filename_stamp_parse)
-		print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'parse results'), 'yellow'))
-	else:
+	## check if previously parsed with same featureCounts results and mapping statistics
+	mapping_folder = os.path.dirname(bam_file)
+	(cached, step_info) = step_cache.check_step(path, 'parse_featureCount', name, 
+											[out_file, out_file + '.summary', 
+											os.path.join(mapping_folder, 'Log.final.out'), 
+											os.path.join(mapping_folder, 'align_summary.txt')], 
+											"", legacy_stamp=path + '/.success_parse', Debug=Debug)
+	if not cached:
 	
 		## debugging messages
 		if Debug:
@@ -295,40 +538,49 @@ def parse_featureCount(out_file, path, name, bam_file, Debug):
 		summary_count_file.close()
 		mapping_stats_file.close()
 		count_file.close()
-		## print timestamp
-		time_functions.print_time_stamp(filename_stamp_parse)
+		## save results generated
+		step_cache.save_step(step_info, [out_tsv_file_name, RNA_biotypes_file_name])
 
 	return(out_tsv_file_name, RNA_biotypes_file_name)
 
 #######################################################################
-def RNAbiotype_module_call(samples_dict, output_dict, gtf_file, Debug, max_workers_int, threads_job, multimapping, stranded):
+def RNAbiotype_module_call(samples_dict, output_dict, gtf_file, Debug, max_workers_int, threads_job, multimapping, stranded, cohort_folder=None):
 	"""
 	Create RNAbiotype analysis for each sample and create summary plots
 	
+	If cohort_folder is provided, all samples are counted in one or a few featureCounts calls 
+	using all threads available (see biotype_cohort). Otherwise, a featureCounts call is sent for each sample.
+	
 	:param samples_dict: Dictionary containing sample IDs as keys and bam files as values
 	:param output_dict: Dictionary containing sample IDs as keys and output folder as values
 	:param gtf_file: Gene annotation file for the reference genome used.
 	:param threads: Number of threads to use.
 	:param Debug: True/False for debugging messages
+	:param cohort_folder: Folder to store featureCounts results of all samples, if counted together.
 	"""
 	
 	## get bin
 	featureCount_exe = set_config.get_exe('featureCounts')
 
-	## send for each sample
-	with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-		commandsSent = { executor.submit(biotype_all, featureCount_exe, 
-										output_dict[sample], gtf_file, bam_files, 
-										sample, threads_job, Debug, multimapping, stranded): sample for sample, bam_files in samples_dict.items() }
-	
-		for cmd2 in concurrent.futures.as_completed(commandsSent):
-			details = commandsSent[cmd2]
-			try:
-				data = cmd2.result()
-			except Exception as exc:
-				print ('***ERROR:')
-				print (cmd2)
-				print('%r generated an exception: %s' % (details, exc))
+	if cohort_folder:
+		## all samples at once
+		biotype_cohort(featureCount_exe, samples_dict, output_dict, gtf_file, cohort_folder, 
+					max_workers_int * threads_job, Debug, multimapping, stranded)
+	else:
+		## send for each sample
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
+			commandsSent = { executor.submit(biotype_all, featureCount_exe, 
+											output_dict[sample], gtf_file, bam_files, 
+											sample, threads_job, Debug, multimapping, stranded): sample for sample, bam_files in samples_dict.items() }
+		
+			for cmd2 in concurrent.futures.as_completed(commandsSent):
+				details = commandsSent[cmd2]
+				try:
+					data = cmd2.result()
+				except Exception as exc:
+					print ('***ERROR:')
+					print (cmd2)
+					print('%r generated an exception: %s' % (details, exc))
 
 	##
 	## plot results
@@ -340,40 +592,45 @@ def RNAbiotype_module_call(samples_dict, output_dict, gtf_file, Debug, max_worke
 	return()
 
 ############################################################
-def generate_matrix(dict_files):
-	######################################################
-	### For a dictionary containing names as keys and files as values, 
-	###	generates a count matrix with the classification from featurecounts
-	###		
-	### It returns a dataframe containing for each index generated
-	### count values for each sample (sample_name) in columns
-	###
-	#########################################################
-	all_data = pd.DataFrame()
-	for key,values in dict_files.items():
-		print ('+ Reading information from sample: ', key)	
-		data = pd.read_csv(values, sep='\t', header=None, names=['RNAbiotypes', key])
-		
-		## skip if file is empty
-		if data.empty:
-			continue
-
-		## get info, generate unique name and merge for samples
-		data = data.set_index('RNAbiotypes')
-		all_data = pd.concat([all_data, data], axis=1, sort=True)
+def generate_matrix(dict_files, threads=1):
+	"""Generates a count matrix with the classification from featureCounts for all samples.
 	
-	return (all_data)
-	##
+	Samples are read in parallel (see table_loader) and merged at once.
+	
+	:param dict_files: Dictionary containing names as keys and files as values.
+	:param threads: Number of processes to read samples.
+	
+	:returns: Dataframe containing for each RNA biotype count values for each sample (sample_name) in columns.
+	"""
+	args_list = [ (values, key) for key, values in dict_files.items() ]
+	sample_counts = [ data for data in table_loader.parallel_map(read_biotype_counts, args_list, threads) if data is not None ]
+	
+	## merge all samples at once
+	if not sample_counts:
+		return (pd.DataFrame())
+	return (pd.concat(sample_counts, axis=1, sort=True))
+
+############################################################
+def read_biotype_counts(featurecount_file, name):
+	"""Returns the counts of each RNA biotype of the sample as a series or None if empty."""
+	print ('+ Reading information from sample: ', name)	
+	data = table_loader.read_table(featurecount_file, header=None, names=['RNAbiotypes', name])
+	
+	## skip if file is empty
+	if data.empty:
+		return (None)
+	
+	## biotype as index: categories not needed
+	data['RNAbiotypes'] = data['RNAbiotypes'].astype(str)
+	return (data.set_index('RNAbiotypes')[name])
 
 #######################################################################
 def pie_plot_results(RNAbiotypes_stats_file, name, folder, Debug):
 	
-	##
-	filename_stamp_plot = folder + '/.success_plot'
-	if os.path.isfile(filename_stamp_plot):
-		stamp = time_functions.read_time_stamp(filename_stamp_plot)
-		print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'plot results'), 'yellow'))
-	else:
+	## check if previously plotted with same results
+	(cached, step_info) = step_cache.check_step(folder, 'plot_RNAbiotype', name, [RNAbiotypes_stats_file], "", 
+											legacy_stamp=folder + '/.success_plot', Debug=Debug, by_name=True)
+	if not cached:
 		
 		# PLOT and SHOW results
 		RNAbiotypes_stats = main_functions.get_data(RNAbiotypes_stats_file, '\t', 'header=None')
@@ -430,10 +687,8 @@ def pie_plot_results(RNAbiotypes_stats_file, name, folder, Debug):
 		plt.close(name_figure)
 		plt.close()
 		
-		## print time stamps
-		time_functions.print_time_stamp(filename_stamp_plot)
-		filename_stamp_all = folder + '/.success_all'
-		time_functions.print_time_stamp(filename_stamp_all)
+		## save results generated
+		step_cache.save_step(step_info, [name_figure])
 		
 #######################################################################
 def main():
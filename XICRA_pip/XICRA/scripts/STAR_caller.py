@@ -10,45 +10,195 @@ import os
 import re
 import sys
 from sys import argv
+import json
+import math
+import fcntl
+import shutil
+import signal
+import atexit
+import hashlib
+import tempfile
+import threading
+import contextlib
 import subprocess
 import traceback
+from termcolor import colored
 
 from HCGB.functions import system_call_functions
 from HCGB.functions import files_functions
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+from XICRA.config import set_config
+from XICRA.scripts import resource_manager, exec_trace, collapse_reads, step_cache, reduced_reference
+
+## minimum RAM (bytes) for sorting BAM files and additional memory per job
+min_BAMsortRAM = 2*resource_manager.GB
+overhead_job = 1*resource_manager.GB
+
+## BAM files generated: unsorted by default, sorted by coordinate on request (see sort_bam)
+bam_unsorted = 'Aligned.out.bam'
+bam_sorted = 'Aligned.sortedByCoord.out.bam'
+
+## mapping statistics in Log.final.out: number of reads and percentage
+log_counts = [ ('Uniquely mapped reads number', 'Uniquely mapped reads %'),
+               ('Number of reads mapped to multiple loci', '% of reads mapped to multiple loci'),
+               ('Number of reads mapped to too many loci', '% of reads mapped to too many loci'),
+               ('Number of reads unmapped: too many mismatches', '% of reads unmapped: too many mismatches'),
+               ('Number of reads unmapped: too short', '% of reads unmapped: too short'),
+               ('Number of reads unmapped: other', '% of reads unmapped: other') ]
+
+## reason of unmapped reads (tag uT) in STAR alignments
+unmapped_reasons = { '0': 'Number of reads unmapped: other', 
+                     '1': 'Number of reads unmapped: too short',
+                     '2': 'Number of reads unmapped: too many mismatches', 
+                     '3': 'Number of reads mapped to too many loci',
+                     '4': 'Number of reads unmapped: other' }
+
+## genomes loaded in shared memory held by this process: released at exit
+_held = {}
+_held_lock = threading.Lock()
+
+############################################################
+def index_cache_dir(cache_dir=None):
+    """Returns the folder storing the genome indexes (STAR genomeDirs, bowtie indexes) shared across projects.
+
+    In order: folder provided, XICRA_INDEX_CACHE, STAR_index in the shared cache
+    (XICRA_CACHE_DIR) or ~/.XICRA/STAR_index.
+    """
+    if cache_dir:
+        return (os.path.abspath(cache_dir))
+    if os.environ.get('XICRA_INDEX_CACHE'):
+        return (os.path.abspath(os.environ['XICRA_INDEX_CACHE']))
+    if step_cache.cache_settings['cache_dir']:
+        return (os.path.join(step_cache.cache_settings['cache_dir'], 'STAR_index'))
+    return (os.path.join(os.path.expanduser("~"), ".XICRA", "STAR_index"))
 
 ############################################################
-def create_genomeDir(folder, STAR_exe, num_threads, fasta_file, limitGenomeGenerateRAM):
-    """Create the STAR_index genome dir 
+def SAindexNbases(fasta_file):
+    """Returns genomeSAindexNbases for the genome provided: min(14, log2(GenomeLength)/2 - 1), as recommended 
+    by STAR for small genomes. Genome length is approximated by the size of the file."""
+    length = max(os.path.getsize(fasta_file), 4)
+    return (max(1, min(14, int(math.log2(length)/2 - 1))))
+
+############################################################
+def index_key(STAR_exe, fasta_file, genomeSAindexNbases, sjdbGTFfile=None, sjdbOverhang=None, Debug=False):
+    """Returns the key identifying a STAR genome index and the information used to build it.
+
+    The key is the hash of the content of the fasta (and GTF) file, the STAR version and
+    the parameters of the index, so it does not depend on the location of the files.
+    """
+    info = { 'fasta': step_cache.file_hash(fasta_file),
+             'STAR': step_cache.tool_version('STAR', Debug=Debug),
+             'genomeSAindexNbases': int(genomeSAindexNbases) }
+    if sjdbGTFfile:
+        info['sjdbGTFfile'] = step_cache.file_hash(sjdbGTFfile)
+        info['sjdbOverhang'] = int(sjdbOverhang) if sjdbOverhang else 100
+
+    key = hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest()[:24]
+    return (key, info)
+
+############################################################
+def create_genomeDir(folder, STAR_exe, num_threads, fasta_file, limitGenomeGenerateRAM, genomeSAindexNbases=None,
+                     sjdbGTFfile=None, sjdbOverhang=None, cache_dir=None, Debug=False):
+    """Create the STAR_index genome dir or reuse a compatible index built previously.
+
+    Indexes are stored in a folder shared across projects (see index_cache_dir) and
+    identified by the content of the fasta file, the STAR version and the parameters
+    (see index_key). The index is built in a temporary folder and renamed when
+    finished, so other processes never use a partial index. Processes building the
+    same index wait for the first one and reuse it.
     
-    :param folder: folder to store the results
+    :param folder: folder to store the logs of the genomeDir generation
     :param STAR_exe: Executable path for STAR binary
     :param num_threads: number of threads to do the computation
-    :param fasta_file: path to the genome directory
+    :param fasta_file: path to the genome fasta file
     :param limitGenomeGenerateRAM: limit RAM bytes to be used in the computation
+    :param genomeSAindexNbases: length (bases) of the SA pre-indexing string. Default: set according to the genome length (see SAindexNbases)
+    :param sjdbGTFfile: GTF file with annotated transcripts for the splice junctions database
+    :param sjdbOverhang: length of the donor/acceptor sequence on each side of the junctions
+    :param cache_dir: folder to store the STAR genome indexes. See index_cache_dir.
+    :param Debug: show extra information of the process
 
     :type folder: string
     :type num_threads: int 
     :type STAR_exe: string
     :type fasta_file: string
     :type limitGenomeGenerateRAM: int
+    :type genomeSAindexNbases: int
+    :type sjdbGTFfile: string
+    :type sjdbOverhang: int
+    :type cache_dir: string
+    :type Debug: boolean
 
     :returns: genomeDir
     """
     ##
-    genomeDir = files_functions.create_subfolder("STAR_index", folder)
-    
-    cmd_create = "%s --runMode genomeGenerate --limitGenomeGenerateRAM %s --runThreadN %s --genomeDir %s --genomeFastaFiles %s" %(
-        STAR_exe, limitGenomeGenerateRAM, num_threads, genomeDir, fasta_file)
+    if not genomeSAindexNbases:
+        genomeSAindexNbases = SAindexNbases(fasta_file)
+    (key, info) = index_key(STAR_exe, fasta_file, genomeSAindexNbases, sjdbGTFfile, sjdbOverhang, Debug)
 
-    print ('\t+ genomeDir generation for STAR mapping')
-    create_code = system_call_functions.system_call(cmd_create, False, True)
-    
-    if not create_code:
-        print ("** ERROR: Some error occurred during genomeDir creation... **")
-        exit()
-    
+    cache_folder = index_cache_dir(cache_dir)
+    os.makedirs(cache_folder, exist_ok=True)
+    genomeDir = os.path.join(cache_folder, key)
+    info_file = os.path.join(genomeDir, 'XICRA_index.json')
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("STAR index key: %s" %key, "yellow")
+        HCGB_aes.debug_message("STAR index information: %s" %info, "yellow")
+
+    ## only a process builds each index: others wait and reuse it
+    with open(os.path.join(cache_folder, key + '.lock'), 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(info_file):
+                print ('\t+ Reusing genomeDir available: %s' %genomeDir)
+                return (genomeDir)
+
+            tmp_genomeDir = os.path.join(cache_folder, '.' + key + '.tmp' + str(os.getpid()))
+            shutil.rmtree(tmp_genomeDir, ignore_errors=True)
+            os.makedirs(tmp_genomeDir)
+            
+            cmd_create = "%s --runMode genomeGenerate --limitGenomeGenerateRAM %s --runThreadN %s --genomeDir %s --genomeFastaFiles %s" %(
+                STAR_exe, limitGenomeGenerateRAM, num_threads, tmp_genomeDir, fasta_file)
+            cmd_create = cmd_create + " --genomeSAindexNbases %s --outFileNamePrefix %s" %(genomeSAindexNbases, os.path.join(folder, 'STAR_index_'))
+            if sjdbGTFfile:
+                cmd_create = cmd_create + " --sjdbGTFfile %s --sjdbOverhang %s" %(sjdbGTFfile, info['sjdbOverhang'])
+
+            print ('\t+ genomeDir generation for STAR mapping')
+            create_code = exec_trace.system_call(cmd_create, 'STAR_index', step='STAR_genomeGenerate', threads=num_threads, 
+                                                 inputs=[fasta_file], outputs=[tmp_genomeDir])
+            
+            if not create_code:
+                shutil.rmtree(tmp_genomeDir, ignore_errors=True)
+                print ("** ERROR: Some error occurred during genomeDir creation... **")
+                exit()
+
+            ## information of the index: written last, marks it as complete
+            info['fasta_file'] = os.path.abspath(fasta_file)
+            info['date'] = time.strftime("%Y-%m-%d %H:%M:%S")
+            with open(os.path.join(tmp_genomeDir, 'XICRA_index.json'), 'w') as fh:
+                json.dump(info, fh, indent=1)
+            shutil.rmtree(genomeDir, ignore_errors=True)
+            os.rename(tmp_genomeDir, genomeDir)
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    print ('\t+ genomeDir available for later usage: %s' %genomeDir)
     return (genomeDir)
 
+############################################################
+def index_fasta(genomeDir):
+    """Returns the fasta file used to generate the genomeDir, if generated by XICRA (see create_genomeDir)."""
+    info_file = os.path.join(genomeDir, 'XICRA_index.json')
+    if not os.path.isfile(info_file):
+        return (None)
+    with open(info_file) as fh:
+        fasta_file = json.load(fh).get('fasta_file')
+    if fasta_file and os.path.isfile(fasta_file):
+        return (fasta_file)
+    return (None)
+
 ############################################################
 def load_Genome(folder, STAR_exe, genomeDir, num_threads):
     """Load the genome stored in STAR_index  
@@ -101,21 +251,424 @@ def remove_Genome(STAR_exe, genomeDir, folder, num_threads):
     return (remove_code)
 
 ############################################################
-def mapReads(option, reads, folder, name, STAR_exe, genomeDir, limitRAM_option, num_threads, Debug):
+def genome_state_file(genomeDir):
+    """Returns the file with the processes using the genome index loaded in shared memory.
+
+    Shared memory belongs to the host, so the file is stored in the temporary folder
+    (TMPDIR) and identified by the absolute path of the genome index.
+    """
+    key = hashlib.sha1(os.path.abspath(genomeDir).encode()).hexdigest()[:16]
+    return (os.path.join(tempfile.gettempdir(), 'XICRA_STAR_shm_' + key + '.json'))
+
+############################################################
+def _alive(pid):
+    """Returns True if the process is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return (False)
+    except PermissionError:
+        return (True)
+    return (True)
+
+############################################################
+def _update_holders(genomeDir, change):
+    """Updates the processes holding the genome loaded, under an exclusive lock.
+
+    Processes no longer running (e.g. killed) are discarded, so a crash of any of
+    them does not keep the genome in memory forever.
+
+    :param genomeDir: path to the genome directory
+    :param change: function receiving the list of holders (pids, one entry per reference) and returning it updated
+
+    :returns: (holders before, holders after)
+    """
+    state_file = genome_state_file(genomeDir)
+    with open(state_file + '.lock', 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            holders = []
+            if os.path.isfile(state_file):
+                try:
+                    with open(state_file) as fh:
+                        holders = json.load(fh).get('holders', [])
+                except ValueError:
+                    holders = []
+            holders = [ pid for pid in holders if _alive(pid) ]
+            updated = change(list(holders))
+
+            if updated:
+                tmp_file = state_file + '.tmp' + str(os.getpid())
+                with open(tmp_file, 'w') as fh:
+                    json.dump({ 'genomeDir': os.path.abspath(genomeDir), 'holders': updated }, fh)
+                os.replace(tmp_file, state_file)
+            elif os.path.isfile(state_file):
+                os.remove(state_file)
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    return (holders, updated)
+
+############################################################
+def acquire_Genome(folder, STAR_exe, genomeDir, num_threads, Debug=False):
+    """Loads the genome index in shared memory, or reuses the copy loaded by another job.
+
+    A reference for this process is added. The genome is loaded (LoadAndExit) only by
+    the first process requiring it, so concurrent jobs share a single copy.
+
+    :param folder: folder to store the loading logs
+    :param STAR_exe: Executable path for STAR binary
+    :param genomeDir: path to the genome directory
+    :param num_threads: number of threads to do the computation
+    :param Debug: show extra information of the process
+
+    :returns: True if the genome is available in shared memory, False otherwise.
+    """
+    pid = os.getpid()
+    status = {}
+
+    def add_reference(holders):
+        ## first holder: load genome while holding the lock so other jobs wait for it
+        if not holders:
+            status['loaded'] = load_Genome(folder, STAR_exe, genomeDir, num_threads)
+            if not status['loaded']:
+                return (holders)
+        else:
+            status['loaded'] = True
+        return (holders + [pid])
+
+    (before, after) = _update_holders(genomeDir, add_reference)
+
+    if not status['loaded']:
+        print (colored("** WARNING: Genome could not be loaded in shared memory. Each job will load its own copy.", 'yellow'))
+        return (False)
+
+    with _held_lock:
+        _held.setdefault(os.path.abspath(genomeDir), []).append((STAR_exe, folder, num_threads))
+
+    if Debug:
+        HCGB_aes.debug_message("STAR genome in shared memory: %s (references: %s)" %(genomeDir, len(after)), "yellow")
+    if before:
+        print ('\t+ Using genome loaded in memory by another job')
+    return (True)
+
+############################################################
+def release_Genome(STAR_exe, genomeDir, folder, num_threads, Debug=False):
+    """Removes a reference of this process to the genome in shared memory.
+
+    The genome is removed from memory when no other process is using it.
+
+    :param STAR_exe: Executable path for STAR binary
+    :param genomeDir: path to the genome directory
+    :param folder: folder to store the removing logs
+    :param num_threads: number of threads to do the computation
+    :param Debug: show extra information of the process
+
+    :returns: True if the genome was removed from memory.
+    """
+    pid = os.getpid()
+    status = { 'removed': False }
+
+    with _held_lock:
+        held = _held.get(os.path.abspath(genomeDir), [])
+        if held:
+            held.pop()
+
+    def remove_reference(holders):
+        if pid in holders:
+            holders.remove(pid)
+        if not holders:
+            status['removed'] = remove_Genome(STAR_exe, genomeDir, folder, num_threads)
+        return (holders)
+
+    (before, after) = _update_holders(genomeDir, remove_reference)
+
+    if Debug:
+        HCGB_aes.debug_message("STAR genome in shared memory: %s (references: %s)" %(genomeDir, len(after)), "yellow")
+    return (status['removed'])
+
+############################################################
+def _release_all():
+    """Releases the genomes still held by this process, e.g. on exit or after an error."""
+    with _held_lock:
+        held = [ (genomeDir, args) for genomeDir, calls in _held.items() for args in calls ]
+
+    for (genomeDir, (STAR_exe, folder, num_threads)) in held:
+        try:
+            release_Genome(STAR_exe, genomeDir, folder, num_threads)
+        except Exception as exc:
+            print (colored("** WARNING: Genome %s could not be released: %s" %(genomeDir, exc), 'yellow'))
+
+atexit.register(_release_all)
+
+############################################################
+def _terminate(signum, frame):
+    """Converts a termination signal into a normal exit, so genomes held are released."""
+    sys.exit(128 + signum)
+
+############################################################
+@contextlib.contextmanager
+def shared_genome(folder, STAR_exe, genomeDir, num_threads, Debug=False):
+    """Keeps the genome index in shared memory while mapping all samples.
+
+    Usage:
+        with STAR_caller.shared_genome(folder, STAR_exe, genomeDir, threads) as genomeLoad:
+            mapReads(genomeLoad, ...)
+
+    The genome is loaded once (or reused if another job loaded it) and released at
+    the end, even if an error occurs or the process is terminated (SIGTERM). If it
+    can not be loaded (e.g. shared memory limits: kernel.shmmax), each job loads
+    its own copy (NoSharedMemory).
+
+    :param folder: folder to store the loading and removing logs
+    :param STAR_exe: Executable path for STAR binary
+    :param genomeDir: path to the genome directory
+    :param num_threads: number of threads to do the computation
+    :param Debug: show extra information of the process
+
+    :returns: genomeLoad option for mapReads: LoadAndKeep or NoSharedMemory
+    """
+    ## handlers only available in main thread
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        previous = signal.getsignal(signal.SIGTERM)
+        if previous in (signal.SIG_DFL, None):
+            signal.signal(signal.SIGTERM, _terminate)
+        else:
+            previous = None
+
+    loaded = acquire_Genome(folder, STAR_exe, genomeDir, num_threads, Debug)
+    try:
+        yield ('LoadAndKeep' if loaded else 'NoSharedMemory')
+    finally:
+        if loaded:
+            release_Genome(STAR_exe, genomeDir, folder, num_threads, Debug)
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
+
+############################################################
+def genome_memory(genomeDir):
+    """Returns the memory (bytes) required to load the genome index: size of Genome, SA and SAindex files."""
+    size = 0
+    for f in ('Genome', 'SA', 'SAindex'):
+        file_index = os.path.join(genomeDir, f)
+        if os.path.isfile(file_index):
+            size += os.path.getsize(file_index)
+    return (size)
+
+############################################################
+def plan_mapping(threads, n_samples, genomeDir, limitRAM_option, Debug=False, shared=True, sorted_bam=False):
+    """Sets threads, number of samples to map at the same time and RAM for sorting BAM files.
+
+    The genome index is loaded once in shared memory (LoadAndKeep, see shared_genome) 
+    before planning: it is not included in the memory available anymore, so it is not subtracted again.
+    BAM files are unsorted by default, so no additional memory is required for sorting.
+    If sorted BAM files are requested, each job requires additional memory for sorting 
+    (see sort_bam). If memory available is not enough to use all CPUs, it is reduced
+    for each job (not below 2 Gb) instead of leaving CPUs idle. If the genome could
+    not be shared (NoSharedMemory), each job requires its own copy.
+
+    :param threads: Total number of CPUs available.
+    :param n_samples: Number of samples to map.
+    :param genomeDir: path to the genome directory
+    :param limitRAM_option: maximum RAM (bytes) for sorting BAM files per job, as provided by the user.
+    :param Debug: Show additional information.
+    :param shared: Genome index already loaded in shared memory for all jobs.
+    :param sorted_bam: BAM files sorted by coordinate are requested.
+
+    :returns: (threads_job, max_workers, limitRAM_job, memory_job, memory_genome): memory_genome is the 
+      memory of the genome index already loaded in shared memory (see resource_manager.available_memory).
+    """
+    memory_genome = genome_memory(genomeDir)
+    memory_copy = 0
+    if not shared:
+        (memory_copy, memory_genome) = (memory_genome, 0)
+    memory_free = resource_manager.available_memory(memory_genome)
+
+    ## jobs required to use all CPUs
+    (threads_job, workers_cpu) = resource_manager.plan_jobs('STAR', threads, n_samples, memory_job=1, Debug=False)
+
+    ## reduce RAM for sorting if not enough memory
+    limitRAM_job = int(limitRAM_option) if sorted_bam else 0
+    if sorted_bam and memory_free // (limitRAM_job + overhead_job + memory_copy) < workers_cpu:
+        limitRAM_job = max(min_BAMsortRAM, int(memory_free // workers_cpu) - overhead_job - memory_copy)
+        limitRAM_job = min(limitRAM_job, int(limitRAM_option))
+
+    memory_job = limitRAM_job + overhead_job + memory_copy
+    (threads_job, max_workers) = resource_manager.plan_jobs('STAR', threads, n_samples, memory_job=memory_job,
+                                                            memory_loaded=memory_genome, Debug=Debug)
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("genome index: %.1f Gb" %(memory_genome/resource_manager.GB), "yellow")
+        HCGB_aes.debug_message("RAM for sorting BAM per job: %s" %limitRAM_job, "yellow")
+
+    return (threads_job, max_workers, limitRAM_job, memory_job, memory_genome)
+
+############################################################
+def smallRNA_options():
+    """Returns the STAR options set for small RNA Seq, according to ENCODE Project directives for small RNAs."""
+    cmd = "--alignSJDBoverhangMin 1000 --outFilterMultimapNmax 1 --outFilterMismatchNoverLmax 0.03 "
+    cmd = cmd + "--outFilterScoreMinOverLread 0 --outFilterMatchNminOverLread 0 --outFilterMatchNmin 16 "
+    cmd = cmd + "--alignIntronMax 1 "
+    return (cmd)
+
+############################################################
+def read_log(log_file):
+    """Returns the values of the mapping statistics (Log.final.out) as a dictionary: label and value (string)."""
+    values = {}
+    with open(log_file) as fh:
+        for line in fh:
+            if '|' in line:
+                (label, value) = line.split('|', 1)
+                values[label.strip()] = value.strip()
+    return (values)
+
+############################################################
+def mapping_stats(log_files):
+    """Returns the mapping statistics (Log.final.out) of all samples as a table: a row for each sample and column for each statistic.
+
+    All files are concatenated and parsed at once: values are converted into numbers 
+    (percentages without %) and statistics not numeric (e.g. dates) discarded.
+
+    :param log_files: Dictionary with sample names and their Log.final.out file.
+
+    :returns: Pandas dataframe
+    """
+    import pandas as pd
+
+    frames = [ pd.read_csv(log_file, sep='|', header=None, names=['stat', 'value'], dtype=str, skip_blank_lines=True)
+               for log_file in log_files.values() ]
+    if not frames:
+        return (pd.DataFrame())
+
+    stats = pd.concat(frames, keys=list(log_files.keys()), names=['sample', 'line']).dropna(subset=['value'])
+    stats['stat'] = stats['stat'].str.strip()
+    stats['value'] = pd.to_numeric(stats['value'].str.strip().str.rstrip('%'), errors='coerce')
+    stats = stats.dropna(subset=['value']).reset_index(level='sample')
+
+    table = stats.pivot_table(index='sample', columns='stat', values='value', aggfunc='first')
+    table = table.reindex(index=[ name for name in log_files if name in table.index ], columns=stats['stat'].unique())
+    table.columns.name = None
+
+    ## number of reads as integers
+    integer = table.columns[ table.notna().all() & (table % 1 == 0).all() & ~table.columns.str.contains('%') ]
+    table[integer] = table[integer].astype('int64')
+    return (table)
+
+############################################################
+def write_log(template_file, counts, out_file):
+    """Writes mapping statistics (Log.final.out) using the template provided and the counts updated.
+
+    :param template_file: Log.final.out generated by STAR.
+    :param counts: Dictionary with the number of reads for any label of log_counts and Number of input reads.
+    :param out_file: Output file. It could be the template.
+    """
+    percentages = { label_perc: label for label, label_perc in log_counts }
+    total = counts.get('Number of input reads', 0)
+
+    lines = []
+    with open(template_file) as fh:
+        for line in fh:
+            if '|' in line:
+                label = line.split('|', 1)[0]
+                if label.strip() in counts:
+                    line = "%s|\t%s\n" %(label, counts[label.strip()])
+                elif label.strip() in percentages and percentages[label.strip()] in counts:
+                    value = 100.0 * counts[percentages[label.strip()]] / total if total else 0
+                    line = "%s|\t%.2f%%\n" %(label, value)
+            lines.append(line)
+
+    with open(out_file, 'w') as fh:
+        fh.writelines(lines)
+
+############################################################
+def merge_logs(reduced_log, genome_log, out_file, resent=0):
+    """Writes mapping statistics of reads mapped against the reduced reference and the genome afterwards.
+
+    Reads not mapped against the reduced reference are the input of the genome, so 
+    reads unmapped are those of the genome. Reads mapped uniquely but not exactly against
+    the reduced reference (resent) are also the input of the genome, so they are only counted once.
+    """
+    reduced = read_log(reduced_log)
+    genome = read_log(genome_log)
+    counts = { 'Number of input reads': int(reduced['Number of input reads']) }
+    for label in ('Uniquely mapped reads number', 'Number of reads mapped to multiple loci'):
+        counts[label] = int(reduced.get(label, 0)) + int(genome.get(label, 0))
+    counts['Uniquely mapped reads number'] -= resent
+    for label, label_perc in log_counts[2:]:
+        counts[label] = int(genome.get(label, 0))
+
+    write_log(genome_log, counts, out_file)
+
+############################################################
+def weighted_stats(bam_file, samtools_exe):
+    """Returns mapping statistics for the BAM file generated using unique sequences, weighted by their counts.
+
+    Unmapped reads must be included in the BAM file (--outSAMunmapped Within), and
+    the reason is retrieved from tag uT.
+
+    :returns: Dictionary with the number of reads for each label of log_counts and Number of input reads.
+    """
+    counts = dict([ (label, 0) for label, label_perc in log_counts ])
+    total = 0
+    process = subprocess.Popen([samtools_exe, 'view', bam_file], stdout=subprocess.PIPE, universal_newlines=True)
+    for line in process.stdout:
+        fields = line.split('\t', 11)
+        flag = int(fields[1])
+        ## secondary or supplementary alignments
+        if flag & 0x900:
+            continue
+
+        weight = collapse_reads.read_weight(fields[0])
+        total += weight
+        tags = fields[11] if len(fields) > 11 else ''
+        if flag & 0x4:
+            reason = re.search(r'uT:A:(\d)', tags)
+            ## other aligners (bowtie): alignments suppressed due to multiple loci (XM:i > 0)
+            if not reason and re.search(r'XM:i:[1-9]', tags):
+                counts['Number of reads mapped to too many loci'] += weight
+                continue
+            counts[unmapped_reasons.get(reason.group(1) if reason else '0', 'Number of reads unmapped: other')] += weight
+        else:
+            NH = re.search(r'NH:i:(\d+)', tags)
+            if NH and int(NH.group(1)) > 1:
+                counts['Number of reads mapped to multiple loci'] += weight
+            else:
+                counts['Uniquely mapped reads number'] += weight
+    process.wait()
+
+    counts['Number of input reads'] = total
+    return (counts)
+
+############################################################
+def mapReads(option, reads, folder, name, STAR_exe, genomeDir, limitRAM_option, num_threads, Debug, collapsed=False, sorted_bam=False):
     """
     Map reads using STAR software. Some parameters are set for small RNA Seq.
 
     Parameters set according to ENCODE Project directives for small RNAs
     https://www.encodeproject.org/rna-seq/small-rnas/
+
+    If collapsed, each unique sequence of the sample is mapped once, named with its count
+    (see XICRA.scripts.collapse_reads). Unmapped sequences are kept in the BAM file, 
+    statistics in Log.final.out are weighted by the counts (statistics of the unique 
+    sequences in Log.final.unique.out) and the BAM file is flagged as weighted.
+
+    Alignments are provided unsorted (Aligned.out.bam): featureCounts and bedtools do not
+    require coordinate order and STAR does not reserve memory for sorting. If sorted_bam,
+    the BAM file is sorted and indexed afterwards (Aligned.sortedByCoord.out.bam, see sort_bam).
     
-    :param option: If multiple files to map, use loaded genome (LoadAndKeep) if only one map, anything else.
+    :param option: Use the genome loaded in shared memory (LoadAndKeep, see shared_genome) or anything else to load its own copy (NoSharedMemory).
     :param reads: List containing absolute path to reads (SE or PE)
     :param folder: Path for output results
     :param name: Sample name
     :param STAR_exe: Executable path for STAR binary
     :param genomeDir: path to the genome directory
-    :param limitRAM_option: maximum available RAM (bytes) for map reads process. Default: 40000000000
+    :param limitRAM_option: maximum available RAM (bytes) for sorting the alignments, if sorted_bam.
     :param num_threads: number of threads to do the computation
+    :param Debug: show extra information of the process
+    :param collapsed: map each unique sequence once
+    :param sorted_bam: sort and index the BAM file by coordinate
     
     :type option: string
     :type reads: list
@@ -125,6 +678,9 @@ def mapReads(option, reads, folder, name, STAR_exe, genomeDir, limitRAM_option,
     :type genomeDir: string 
     :type limitRAM_option: int
     :type num_threads: int
+    :type Debug: boolean
+    :type collapsed: boolean
+    :type sorted_bam: boolean
     
     :returns: mapping_code
     """
@@ -134,19 +690,15 @@ def mapReads(option, reads, folder, name, STAR_exe, genomeDir, limitRAM_option,
     if not os.path.isdir(folder):
         folder = files_functions.create_folder(folder)
     ##
-    bam_file_name = os.path.join(folder, 'Aligned.sortedByCoord.out.bam')
+    bam_file_name = os.path.join(folder, bam_unsorted)
         
-    ## read is a list with 1 or 2 read fastq files
-    jread = " ".join(reads)
-
     ## prepare command
     cmd = "%s --genomeDir %s --runThreadN %s " %(STAR_exe, genomeDir, num_threads)
-    cmd = cmd + "--limitBAMsortRAM %s --outFileNamePrefix %s " %(limitRAM_option, folder + '/')
+    cmd = cmd + "--outFileNamePrefix %s " %(folder + '/')
 
     ## some common options
-    cmd = cmd + "--alignSJDBoverhangMin 1000 --outFilterMultimapNmax 1 --outFilterMismatchNoverLmax 0.03 "
-    cmd = cmd + "--outFilterScoreMinOverLread 0 --outFilterMatchNminOverLread 0 --outFilterMatchNmin 16 "
-    cmd = cmd + "--alignIntronMax 1 --outSAMheaderHD @HD VN:1.4 SO:coordinate --outSAMtype BAM SortedByCoordinate "
+    cmd = cmd + smallRNA_options()
+    cmd = cmd + "--outSAMtype BAM Unsorted "
     
     ## Multiple samples or just one?
     if option == 'LoadAndKeep':
@@ -154,18 +706,284 @@ def mapReads(option, reads, folder, name, STAR_exe, genomeDir, limitRAM_option,
     else:
         cmd = cmd + "--genomeLoad NoSharedMemory"
     
-    ## ReadFiles
-    cmd = cmd + " --readFilesIn %s " %jread
+    ## unique sequences: only if reads could be collapsed (single-end)
+    collapsed_file = collapse_reads.get_collapsed(reads, name, Debug, folder=folder) if collapsed else None
+    if collapsed_file:
+        cmd = cmd + " --outSAMunmapped Within"
 
     ## logfile & errfile
     logfile = os.path.join(folder, 'STAR.log')
     errfile = os.path.join(folder, 'STAR.err')
-    cmd = cmd + ' > ' + logfile + ' 2> ' + errfile
     
-    ## sent command
-    mapping_code = system_call_functions.system_call(cmd, False, True)
+    ## read is a list with 1 or 2 read fastq files
+    ## single-end reads: use collapsed reads of the sample, expanded on the fly
+    with collapse_reads.fastq_input(reads, folder, name, Debug, unique=bool(collapsed_file)) as fastq:
+        ## ReadFiles
+        jread = " ".join(fastq)
+        cmd = cmd + " --readFilesIn %s " %jread
+        cmd = cmd + ' > ' + logfile + ' 2> ' + errfile
+        
+        ## sent command
+        mapping_code = exec_trace.system_call(cmd, 'STAR', name, threads=num_threads, inputs=reads, outputs=[folder])
+    
+    ## sort on request: unsorted BAM file is not kept
+    if mapping_code and sorted_bam:
+        sorted_file = sort_bam(bam_file_name, name, num_threads, limitRAM_option, Debug)
+        if sorted_file:
+            os.remove(bam_file_name)
+            bam_file_name = sorted_file
+        else:
+            mapping_code = False
+
+    if mapping_code:
+        clean_bam(folder, bam_file_name)
+        weight_mapping(folder, bam_file_name, collapsed_file, Debug)
     return (mapping_code)
 
+############################################################
+def mapping_bam(folder):
+    """Returns the BAM file generated in the mapping folder: sorted by coordinate if available, unsorted otherwise."""
+    sorted_file = os.path.join(folder, bam_sorted)
+    if os.path.isfile(sorted_file):
+        return (sorted_file)
+    return (os.path.join(folder, bam_unsorted))
+
+############################################################
+def mapping_outputs(folder):
+    """Returns the outputs of the mapping folder: BAM file, its index and weighting flag, if any, and mapping statistics.
+
+    Other files of the folder (e.g. collapsed reads or temporary files) are not part of the results.
+    """
+    bam_file = mapping_bam(folder)
+    outputs = [ bam_file, os.path.join(folder, 'Log.final.out') ]
+    for f in (bam_file + '.bai', collapse_reads.weighted_file(bam_file), os.path.join(folder, 'Log.final.unique.out')):
+        if os.path.isfile(f):
+            outputs.append(f)
+    return (outputs)
+
+############################################################
+def clean_bam(folder, bam_file):
+    """Removes BAM files of previous mappings of the folder other than the one provided, sorted or not."""
+    for f in (bam_unsorted, bam_sorted, bam_sorted + '.bai'):
+        old_file = os.path.join(folder, f)
+        if os.path.isfile(old_file) and not old_file.startswith(bam_file):
+            os.remove(old_file)
+            collapse_reads.set_weighted(old_file)
+
+############################################################
+def sort_memory(limitRAM_option, num_threads):
+    """Returns the memory per thread (bytes) for samtools sort: RAM available divided by threads, not below 512 Mb."""
+    return (max(min_BAMsortRAM // 4, int(limitRAM_option) // max(1, int(num_threads))))
+
+############################################################
+def sort_bam(bam_file, name, num_threads, limitRAM_option, Debug, sam_input=None):
+    """Sorts by coordinate and indexes the BAM file provided using samtools, only when requested.
+
+    Results are stored as Aligned.sortedByCoord.out.bam (and .bai index) in the folder
+    of the BAM file and reused if the input did not change.
+
+    :param bam_file: BAM file with alignments, e.g. Aligned.out.bam. If already sorted, it is only indexed.
+    :param name: Sample name
+    :param num_threads: number of threads to do the computation
+    :param limitRAM_option: maximum RAM (bytes) for sorting.
+    :param Debug: show extra information of the process
+    :param sam_input: SAM file to sort instead of the BAM file, e.g. alignments merged.
+
+    :returns: Sorted BAM file or None if failed.
+    """
+    folder = os.path.dirname(bam_file)
+    sorted_file = os.path.join(folder, bam_sorted)
+    input_file = sam_input if sam_input else bam_file
+    
+    ## check if previously sorted with same alignments
+    (cached, step_info) = step_cache.check_step(folder, 'samtools_sort', name, [input_file], "", prog='samtools', Debug=Debug)
+    if cached and os.path.isfile(sorted_file + '.bai'):
+        return (sorted_file)
+
+    samtools_exe = set_config.get_exe('samtools', Debug=Debug)
+    code = True
+    if input_file != sorted_file:
+        cmd_sort = "%s sort -@ %s -m %s -T %s -o %s %s" %(samtools_exe, num_threads, sort_memory(limitRAM_option, num_threads), 
+                                                          os.path.join(folder, 'sort_tmp'), sorted_file, input_file)
+        code = exec_trace.system_call(cmd_sort, 'samtools', name, step='samtools_sort', threads=num_threads,
+                                      inputs=[input_file], outputs=[sorted_file])
+    if code:
+        cmd_index = "%s index -@ %s %s" %(samtools_exe, num_threads, sorted_file)
+        code = exec_trace.system_call(cmd_index, 'samtools', name, step='samtools_index', threads=num_threads,
+                                      inputs=[sorted_file], outputs=[sorted_file + '.bai'])
+    if not code:
+        print (colored("** ERROR: Sorting BAM file failed for sample %s" %name, 'red'))
+        return (None)
+
+    ## inputs removed afterwards are not cached
+    step_cache.save_step(step_info, [sorted_file, sorted_file + '.bai'], store=False)
+    return (sorted_file)
+
+############################################################
+def weight_mapping(folder, bam_file, collapsed_file, Debug):
+    """Flags the BAM file as weighted if generated using unique sequences and weights its mapping statistics.
+
+    :param folder: Folder containing mapping statistics (Log.final.out).
+    :param bam_file: BAM file generated.
+    :param collapsed_file: Collapsed file of the sample, if unique sequences were mapped. None otherwise.
+    :param Debug: show extra information of the process
+    """
+    collapse_reads.set_weighted(bam_file, collapsed_file)
+    if not collapsed_file:
+        return ()
+
+    log_file = os.path.join(folder, 'Log.final.out')
+    unique_log = os.path.join(folder, 'Log.final.unique.out')
+    os.replace(log_file, unique_log)
+    counts = weighted_stats(bam_file, set_config.get_exe('samtools', Debug=Debug))
+    write_log(unique_log, counts, log_file)
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("Weighted mapping statistics: %s" %counts, "yellow")
+
+############################################################
+def mapReads_reduced(option, reads, folder, name, STAR_exe, genomeDir, reducedDir, limitRAM_option, num_threads, Debug, collapsed=False,
+                     sorted_bam=False):
+    """
+    Map reads against the reduced reference of small RNA loci and then reads not mapped against the whole genome.
+
+    Most reads are mapped against the reduced reference (see XICRA.scripts.reduced_reference),
+    so only a few are mapped against the whole genome. Alignments of both are merged in genome 
+    coordinates and converted using samtools into Aligned.out.bam (or sorted into 
+    Aligned.sortedByCoord.out.bam if sorted_bam), as generated by mapReads().
+    Logs of each pass are available in folders reduced and genome, and merged into Log.final.out.
+    Unique sequences are mapped if collapsed, see mapReads().
+
+    Only reads mapped uniquely and exactly (end-to-end without mismatches) against the reduced 
+    reference are not mapped against the whole genome: no alignment in the genome could have 
+    a better score. Reads aligned with mismatches, indels or soft-clipped bases are mapped 
+    against the genome, as reads not mapped, and their alignment in the genome is reported. 
+    Exact reads that also match exactly outside the small RNA loci, discarded when mapping 
+    against the genome only (--outFilterMultimapNmax 1), are still reported as unique alignments.
+
+    :param option: Use the genome loaded in shared memory (LoadAndKeep, see shared_genome) or anything else to load its own copy (NoSharedMemory).
+    :param reads: List containing absolute path to reads (SE or PE)
+    :param folder: Path for output results
+    :param name: Sample name
+    :param STAR_exe: Executable path for STAR binary
+    :param genomeDir: path to the genome directory
+    :param reducedDir: path to the genome directory of the reduced reference
+    :param limitRAM_option: maximum available RAM (bytes) for sorting the alignments, if sorted_bam.
+    :param num_threads: number of threads to do the computation
+    :param Debug: show extra information of the process
+    :param collapsed: map each unique sequence once
+    :param sorted_bam: sort and index the BAM file by coordinate
+
+    :type option: string
+    :type reads: list
+    :type folder: string 
+    :type name: string 
+    :type STAR_exe: string
+    :type genomeDir: string 
+    :type reducedDir: string 
+    :type limitRAM_option: int
+    :type num_threads: int
+    :type Debug: boolean
+    :type collapsed: boolean
+    :type sorted_bam: boolean
+
+    :returns: mapping_code
+    """
+    print("\t+ Mapping sample %s using STAR: small RNA reduced reference & genome" %name)
+    
+    if not os.path.isdir(folder):
+        folder = files_functions.create_folder(folder)
+    reduced_folder = files_functions.create_subfolder('reduced', folder)
+    genome_folder = files_functions.create_subfolder('genome', folder)
+
+    ## 1st: reduced reference, small enough to be loaded by each job
+    cmd = "%s --genomeDir %s --runThreadN %s --outFileNamePrefix %s " %(STAR_exe, reducedDir, num_threads, reduced_folder + '/')
+    cmd = cmd + smallRNA_options() + "--outSAMtype SAM --outReadsUnmapped Fastx --genomeLoad NoSharedMemory "
+    collapsed_file = collapse_reads.get_collapsed(reads, name, Debug, folder=folder) if collapsed else None
+    with collapse_reads.fastq_input(reads, folder, name, Debug, unique=bool(collapsed_file)) as fastq:
+        n_files = len(fastq)
+        cmd = cmd + "--readFilesIn %s " %" ".join(fastq)
+        cmd = cmd + ' > ' + os.path.join(reduced_folder, 'STAR.log') + ' 2> ' + os.path.join(reduced_folder, 'STAR.err')
+        mapping_code = exec_trace.system_call(cmd, 'STAR', name, step='STAR_reduced', threads=num_threads, inputs=reads, outputs=[reduced_folder])
+    
+    if not mapping_code:
+        return (False)
+
+    ## exact alignments are kept in genome coordinates; reads aligned with mismatches, 
+    ## indels or clipped are added to the reads not mapped
+    reduced_sam = os.path.join(reduced_folder, 'Aligned.out.sam')
+    lifted_sam = os.path.join(reduced_folder, 'Aligned.lifted.sam')
+    unmapped = [ os.path.join(reduced_folder, 'Unmapped.out.mate%s' %(i+1)) for i in range(n_files) ]
+    with open(lifted_sam, 'w') as out_fh:
+        mate_fhs = [ open(f, 'a') for f in unmapped ]
+        try:
+            (n_reduced, n_resent) = reduced_reference.lift_sam(reduced_sam, out_fh, mate_fhs)
+        finally:
+            for fh in mate_fhs:
+                fh.close()
+
+    ## 2nd: reads not mapped exactly against the whole genome
+    cmd = "%s --genomeDir %s --runThreadN %s --outFileNamePrefix %s " %(STAR_exe, genomeDir, num_threads, genome_folder + '/')
+    cmd = cmd + smallRNA_options() + "--outSAMtype SAM "
+    if collapsed_file:
+        cmd = cmd + "--outSAMunmapped Within "
+    if option == 'LoadAndKeep':
+        cmd = cmd + "--genomeLoad LoadAndKeep "
+    else:
+        cmd = cmd + "--genomeLoad NoSharedMemory "
+    cmd = cmd + "--readFilesIn %s " %" ".join(unmapped)
+    cmd = cmd + ' > ' + os.path.join(genome_folder, 'STAR.log') + ' 2> ' + os.path.join(genome_folder, 'STAR.err')
+    mapping_code = exec_trace.system_call(cmd, 'STAR', name, step='STAR_genome', threads=num_threads, inputs=unmapped, outputs=[genome_folder])
+
+    if not mapping_code:
+        return (False)
+
+    ## merge alignments in genome coordinates: header of the whole genome
+    genome_sam = os.path.join(genome_folder, 'Aligned.out.sam')
+    merged_sam = os.path.join(folder, 'Aligned.merged.sam')
+    with open(merged_sam, 'w') as out_fh:
+        with open(genome_sam) as in_fh:
+            for line in in_fh:
+                if line.startswith('@'):
+                    out_fh.write(line)
+
+        with open(lifted_sam) as in_fh:
+            shutil.copyfileobj(in_fh, out_fh)
+        with open(genome_sam) as in_fh:
+            for line in in_fh:
+                if not line.startswith('@'):
+                    out_fh.write(line)
+
+    if Debug:
+        HCGB_aes.debug_message("Alignments in reduced reference: %s" %n_reduced, "yellow")
+        HCGB_aes.debug_message("Reads mapped against the genome after alignment in reduced reference: %s" %n_resent, "yellow")
+
+    ## convert into BAM or sort on request
+    bam_file_name = os.path.join(folder, bam_unsorted)
+    if sorted_bam:
+        bam_file_name = sort_bam(bam_file_name, name, num_threads, limitRAM_option, Debug, sam_input=merged_sam)
+        sort_code = bool(bam_file_name)
+    else:
+        samtools_exe = set_config.get_exe('samtools', Debug=Debug)
+        cmd_view = "%s view -b -@ %s -o %s %s" %(samtools_exe, num_threads, bam_file_name, merged_sam)
+        sort_code = exec_trace.system_call(cmd_view, 'samtools', name, step='samtools_view', threads=num_threads,
+                                           inputs=[merged_sam], outputs=[bam_file_name])
+
+    ## intermediate files
+    for f in [reduced_sam, lifted_sam, genome_sam, merged_sam] + unmapped:
+        if os.path.isfile(f):
+            os.remove(f)
+
+    ## mapping statistics of both
+    if sort_code:
+        clean_bam(folder, bam_file_name)
+        merge_logs(os.path.join(reduced_folder, 'Log.final.out'), os.path.join(genome_folder, 'Log.final.out'), 
+                   os.path.join(folder, 'Log.final.out'), resent=n_resent)
+        weight_mapping(folder, bam_file_name, collapsed_file, Debug)
+    
+    return (sort_code)
+
 ###############
 
 ###########
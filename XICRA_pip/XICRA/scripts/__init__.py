@@ -1,16 +1,28 @@
 __all__ = [
     'bedtools_caller',
+    'bowtie_caller',
+    'collapse_reads',
     'cutadapt_caller',
+    'diff_expression',
+    'exec_trace',
+    'expression_matrix',
+    'expression_rollup',
     'fastqc_caller',
     'generate_DE',
+    'isomiR_annotator',
     'miraligner_caller',
     'MINTMap_caller',
     'multiQC_report',
     'mirtop_caller',
     'optimir_caller',
     'pilfer_caller',
+    'reduced_reference',
+    'resource_manager',
     'RNAbiotype',
-    'STAR_caller'
+    'STAR_caller',
+    'step_cache',
+    'table_loader',
+    'task_graph'
 ]
 
 from XICRA.scripts import *
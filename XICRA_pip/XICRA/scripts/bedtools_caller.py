@@ -15,6 +15,7 @@ import argparse
 from termcolor import colored
 
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace, collapse_reads
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.system_call_functions as HCGB_sys
@@ -32,31 +33,30 @@ def intersect_coordinates(file1, file2, path_given, name, options, debug):
     bed_file = os.path.join(path_given, name + ".bed") 
     #bed_file_tmp = bed_file + '_tmp' 
     
-    ## check if previously done
-    filename_stamp = path_given + '/.' + name + '_intersect_success'
-    if os.path.isfile(filename_stamp):
-        if HCGB_files.is_non_zero_file(bed_file):
-            stamp = HCGB_time.read_time_stamp(filename_stamp)
-            print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'intersect bed annotations'), 'yellow'))
-            return (bed_file)
-    
     ###
     string_options = " -wa -wb "
     if options:
         string_options = string_options + options
     
+    ## check if previously done with same files and options
+    (cached, step_info) = step_cache.check_step(path_given, 'intersect_' + name, name, [file1, file2], string_options, 
+                                                prog='bedtools', legacy_stamp=path_given + '/.' + name + '_intersect_success', 
+                                                Debug=debug)
+    if cached:
+        return (bed_file)
+    
     ## Create call for bedtools intersect
     bedtools_exe = set_config.get_exe("bedtools", debug)
     cmd_bedtools = "%s intersect -a %s -b %s %s > %s" %(bedtools_exe, file1, file2, string_options, bed_file) 
     
-    bed_code = HCGB_sys.system_call(cmd_bedtools, False, True)
+    bed_code = exec_trace.system_call(cmd_bedtools, 'bedtools', name, 'bedtools_intersect', inputs=[file1, file2], outputs=[bed_file])
 
     if not bed_code:
         print(colored("** ERROR: Something happen while calling bedtools intersect for job: " + name, "red"))
         exit()
         
-    ## print time stamp
-    HCGB_time.print_time_stamp(filename_stamp)
+    ## save results generated
+    step_cache.save_step(step_info, [bed_file])
 
     return (bed_file)    
 
@@ -71,27 +71,36 @@ def convert_bam2bed(sample, bam_file, path_given, debug):
     bed_file = os.path.join(path_given, HCGB_files.get_file_name(bam_file) + ".bed") ## create a name
     bed_file_tmp = bed_file + '_tmp' 
     
-    filename_stamp = path_given + '/.convert_bam2bed_success'
-    if os.path.isfile(filename_stamp):
-        if HCGB_files.is_non_zero_file(bed_file):
-            stamp = HCGB_time.read_time_stamp(filename_stamp)
-            print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, sample, 'convert_bam2bed'), 'yellow'))
-            return (bed_file)
+    ## check if previously done with same BAM file
+    (cached, step_info) = step_cache.check_step(path_given, 'convert_bam2bed', sample, [bam_file], "groupby: sum", prog='bedtools', 
+                                                legacy_stamp=path_given + '/.convert_bam2bed_success', Debug=debug)
+    if cached:
+        return (bed_file)
     
     ## execute conversion and count reads mapping in exact coordinates
     ## bedtools bamtobed -i bam_file > bed_file 
-    ## bedtools sort -chrThenSizeA -i bed_file > bed_sort.file
-    ## bedtools groupby -i bed_sort.file -o count -g 1,2,3 -c 4 > counts.bed 
+    ## sort -k1,1 -k2,2n -k3,3n bed_file > bed_sort.file
+    ## bedtools groupby -i bed_sort.file -o sum -g 1,2,3 -c 4 > counts.bed 
     
     ## Create call in two separate calls to reduce RAM requirement
     bedtools_exe = set_config.get_exe("bedtools", debug)
+    ## BAM files could be unsorted: alignments of the same coordinates are not consecutive, so 
+    ## counts of the first groupby are partial and summed once sorted
     cmd_bedtools = "%s bamtobed -i %s | %s groupby -o count -g 1,2,3 -c 4 > %s" %(bedtools_exe, bam_file, bedtools_exe, bed_file_tmp)
-    bed_code = HCGB_sys.system_call(cmd_bedtools, False, True)
+
+    ## alignments of unique sequences: sum the reads represented by each one, count in read name (see collapse_reads)
+    if collapse_reads.is_weighted(bam_file):
+        weight_awk = "awk 'BEGIN{OFS=\"\\t\"} {w=1; if (match($4, /_x[0-9]+$/)) w=substr($4, RSTART+2); print $1,$2,$3,w}'"
+        cmd_bedtools = "%s bamtobed -i %s | %s | %s groupby -o sum -g 1,2,3 -c 4 > %s" %(bedtools_exe, bam_file, weight_awk, 
+                                                                                     bedtools_exe, bed_file_tmp)
+
+    bed_code = exec_trace.system_call(cmd_bedtools, 'bedtools', sample, 'bedtools_bamtobed', inputs=[bam_file], outputs=[bed_file_tmp])
 
     if bed_code:
-        cmd_bedtools2 = "%s sort -chrThenSizeA -i %s | %s groupby -o count -g 1,2,3 -c 4 > %s" %(bedtools_exe, bed_file_tmp, 
-                                                                                                                bedtools_exe, bed_file)
-        bed_code2 = HCGB_sys.system_call(cmd_bedtools2, False, True)
+        ## sort by all coordinates: same intervals must be consecutive
+        cmd_bedtools2 = "LC_ALL=C sort -k1,1 -k2,2n -k3,3n -T %s %s | %s groupby -o sum -g 1,2,3 -c 4 > %s" %(path_given, bed_file_tmp, 
+                                                                                                          bedtools_exe, bed_file)
+        bed_code2 = exec_trace.system_call(cmd_bedtools2, 'bedtools', sample, 'bedtools_sort', inputs=[bed_file_tmp], outputs=[bed_file])
     
     ## -----------------------------------------------
     ## Pybedtools
@@ -105,12 +114,12 @@ def convert_bam2bed(sample, bam_file, path_given, debug):
         print ("** ERROR: Some error occurred during conversion from BAM to BED... **")
         exit()
     
-    ## print time stamp
-    HCGB_time.print_time_stamp(filename_stamp)
-
     ## remove tmp files
     os.remove(bed_file_tmp)
 
+    ## save results generated
+    step_cache.save_step(step_info, [bed_file])
+
     return (bed_file)
 
 ## -----------------------------------------------------------
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Maps reads using bowtie (version 1), a short read aligner with low memory requirements.
+
+The index of the human genome requires ~3 Gb, instead of ~30 Gb for STAR, and it is
+memory mapped (--mm), so samples mapped at the same time share a single copy. Results
+are equivalent to those of STAR_caller.mapReads: BAM file (unsorted or sorted on request)
+and mapping statistics in Log.final.out format, so downstream analysis (featureCounts,
+RNAbiotype.parse_featureCount, MultiQC) does not depend on the aligner.
+'''
+## useful imports
+import time
+import os
+import re
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+from termcolor import colored
+
+from HCGB.functions import files_functions
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+from XICRA.config import set_config
+from XICRA.scripts import resource_manager, exec_trace, collapse_reads, step_cache, STAR_caller
+
+## bowtie index files: small (ebwt) or large (ebwtl) genomes
+index_suffixes = ['.1.ebwt', '.2.ebwt', '.3.ebwt', '.4.ebwt', '.rev.1.ebwt', '.rev.2.ebwt']
+
+## mapping statistics reported by bowtie (stderr) and equivalent in Log.final.out
+bowtie_stats = { 'reads processed': 'Number of input reads',
+                 'reads with at least one reported alignment': 'Uniquely mapped reads number',
+                 'reads that failed to align': 'Number of reads unmapped: other',
+                 'reads with alignments suppressed due to -m': 'Number of reads mapped to too many loci' }
+
+############################################################
+def index_files(index):
+    """Returns the files of the bowtie index provided (prefix), small or large index."""
+    files = [ index + s for s in index_suffixes ]
+    if not os.path.isfile(files[0]) and os.path.isfile(files[0] + 'l'):
+        files = [ f + 'l' for f in files ]
+    return (files)
+
+############################################################
+def index_memory(index):
+    """Returns the memory (bytes) required to load the bowtie index: size of its files."""
+    return (sum([ os.path.getsize(f) for f in index_files(index) if os.path.isfile(f) ]))
+
+############################################################
+def create_index(folder, bowtie_build_exe, num_threads, fasta_file, cache_dir=None, Debug=False):
+    """Create the bowtie index or reuse a compatible index built previously.
+
+    Indexes are stored in the folder shared across projects with STAR genomeDirs (see
+    STAR_caller.index_cache_dir) and identified by the content of the fasta file and
+    the bowtie version. As for STAR_caller.create_genomeDir, the index is built in a
+    temporary folder and renamed when finished.
+
+    :param folder: folder to store the logs of the index generation
+    :param bowtie_build_exe: Executable path for bowtie-build binary
+    :param num_threads: number of threads to do the computation
+    :param fasta_file: path to the genome fasta file
+    :param cache_dir: folder to store the genome indexes. See STAR_caller.index_cache_dir.
+    :param Debug: show extra information of the process
+
+    :type folder: string
+    :type bowtie_build_exe: string
+    :type num_threads: int
+    :type fasta_file: string
+    :type cache_dir: string
+    :type Debug: boolean
+
+    :returns: bowtie index (prefix of the index files)
+    """
+    info = { 'fasta': step_cache.file_hash(fasta_file),
+             'bowtie': step_cache.tool_version('bowtie', Debug=Debug) }
+    key = 'bowtie_' + hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest()[:24]
+
+    cache_folder = STAR_caller.index_cache_dir(cache_dir)
+    os.makedirs(cache_folder, exist_ok=True)
+    index_dir = os.path.join(cache_folder, key)
+    info_file = os.path.join(index_dir, 'XICRA_index.json')
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("bowtie index key: %s" %key, "yellow")
+        HCGB_aes.debug_message("bowtie index information: %s" %info, "yellow")
+
+    ## only a process builds each index: others wait and reuse it
+    with open(os.path.join(cache_folder, key + '.lock'), 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(info_file):
+                print ('\t+ Reusing bowtie index available: %s' %index_dir)
+                return (os.path.join(index_dir, 'genome'))
+
+            tmp_index_dir = os.path.join(cache_folder, '.' + key + '.tmp' + str(os.getpid()))
+            shutil.rmtree(tmp_index_dir, ignore_errors=True)
+            os.makedirs(tmp_index_dir)
+
+            logfile = os.path.join(folder, 'bowtie_index.log')
+            cmd_create = "%s --threads %s %s %s > %s 2>&1" %(bowtie_build_exe, num_threads, fasta_file,
+                                                            os.path.join(tmp_index_dir, 'genome'), logfile)
+
+            print ('\t+ Index generation for bowtie mapping')
+            create_code = exec_trace.system_call(cmd_create, 'bowtie-build', step='bowtie_build', threads=num_threads,
+                                                 inputs=[fasta_file], outputs=[tmp_index_dir])
+            if not create_code:
+                shutil.rmtree(tmp_index_dir, ignore_errors=True)
+                print ("** ERROR: Some error occurred during bowtie index creation... **")
+                exit()
+
+            ## information of the index: written last, marks it as complete
+            info['fasta_file'] = os.path.abspath(fasta_file)
+            info['date'] = time.strftime("%Y-%m-%d %H:%M:%S")
+            with open(os.path.join(tmp_index_dir, 'XICRA_index.json'), 'w') as fh:
+                json.dump(info, fh, indent=1)
+            shutil.rmtree(index_dir, ignore_errors=True)
+            os.rename(tmp_index_dir, index_dir)
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    print ('\t+ bowtie index available for later usage: %s' %index_dir)
+    return (os.path.join(index_dir, 'genome'))
+
+############################################################
+def plan_mapping(threads, n_samples, index, limitRAM_option, Debug=False, sorted_bam=False):
+    """Sets threads, number of samples to map at the same time and RAM for sorting BAM files.
+
+    The index is memory mapped and shared by all jobs. As for STAR_caller.plan_mapping,
+    additional memory per job is only required if sorted BAM files are requested.
+
+    :param threads: Total number of CPUs available.
+    :param n_samples: Number of samples to map.
+    :param index: bowtie index (prefix of the index files).
+    :param limitRAM_option: maximum RAM (bytes) for sorting BAM files per job, as provided by the user.
+    :param Debug: Show additional information.
+    :param sorted_bam: BAM files sorted by coordinate are requested.
+
+    :returns: (threads_job, max_workers, limitRAM_job, memory_job, memory_index)
+    """
+    memory_index = index_memory(index)
+    memory_free = resource_manager.available_memory() - memory_index
+    (threads_job, workers_cpu) = resource_manager.plan_jobs('bowtie', threads, n_samples, memory_job=1, Debug=False)
+
+    ## reduce RAM for sorting if not enough memory
+    limitRAM_job = int(limitRAM_option) if sorted_bam else 0
+    if sorted_bam and memory_free // (limitRAM_job + STAR_caller.overhead_job) < workers_cpu:
+        limitRAM_job = max(STAR_caller.min_BAMsortRAM, int(memory_free // workers_cpu) - STAR_caller.overhead_job)
+        limitRAM_job = min(limitRAM_job, int(limitRAM_option))
+
+    memory_job = limitRAM_job + STAR_caller.overhead_job
+    (threads_job, max_workers) = resource_manager.plan_jobs('bowtie', threads, n_samples, memory_job=memory_job,
+                                                            memory_shared=memory_index, Debug=Debug)
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("bowtie index: %.1f Gb" %(memory_index/resource_manager.GB), "yellow")
+        HCGB_aes.debug_message("RAM for sorting BAM per job: %s" %limitRAM_job, "yellow")
+
+    return (threads_job, max_workers, limitRAM_job, memory_job, memory_index)
+
+############################################################
+def smallRNA_options():
+    """Returns the bowtie options set for small RNA Seq, equivalent to STAR_caller.smallRNA_options:
+    up to 1 mismatch, best alignments and reads mapping to multiple loci discarded."""
+    return ("-v 1 --best --strata -m 1 ")
+
+############################################################
+def read_stats(err_file):
+    """Returns mapping statistics reported by bowtie as a dictionary with labels of Log.final.out (see bowtie_stats).
+
+    :returns: Dictionary or None if bowtie did not finish (statistics not available).
+    """
+    counts = dict([ (label, 0) for label, label_perc in STAR_caller.log_counts ])
+    finished = False
+    with open(err_file) as fh:
+        for line in fh:
+            match = re.search(r'^# (.+): (\d+)', line)
+            if match and match.group(1) in bowtie_stats:
+                counts[bowtie_stats[match.group(1)]] = int(match.group(2))
+                finished = True
+    if not finished:
+        return (None)
+    return (counts)
+
+############################################################
+def write_stats(counts, out_file):
+    """Writes mapping statistics in the format of STAR (Log.final.out), see STAR_caller.write_log."""
+    total = counts.get('Number of input reads', 0)
+    def line(label, value):
+        return ("%s |\t%s\n" %(label.rjust(48), value))
+
+    with open(out_file, 'w') as fh:
+        fh.write(line('Started job on', time.strftime("%b %d %H:%M:%S")))
+        fh.write(line('Number of input reads', total))
+        for section, pairs in (('UNIQUE READS:', STAR_caller.log_counts[:1]), ('MULTI-MAPPING READS:', STAR_caller.log_counts[1:3]),
+                               ('UNMAPPED READS:', STAR_caller.log_counts[3:])):
+            fh.write(section.rjust(50) + '\n')
+            for label, label_perc in pairs:
+                fh.write(line(label, counts.get(label, 0)))
+                fh.write(line(label_perc, "%.2f%%" %(100.0 * counts.get(label, 0) / total if total else 0)))
+
+############################################################
+def mapReads(reads, folder, name, bowtie_exe, index, limitRAM_option, num_threads, Debug, collapsed=False, sorted_bam=False):
+    """
+    Map reads using bowtie. Some parameters are set for small RNA Seq (see smallRNA_options).
+
+    Alignments are converted on the fly into BAM format using samtools (Aligned.out.bam or
+    Aligned.sortedByCoord.out.bam if sorted_bam, see STAR_caller.sort_bam) and statistics
+    reported by bowtie are stored in Log.final.out, as generated by STAR. Unique sequences
+    are mapped if collapsed, see STAR_caller.mapReads.
+
+    :param reads: List containing absolute path to reads (SE or PE)
+    :param folder: Path for output results
+    :param name: Sample name
+    :param bowtie_exe: Executable path for bowtie binary
+    :param index: bowtie index (prefix of the index files)
+    :param limitRAM_option: maximum available RAM (bytes) for sorting the alignments, if sorted_bam.
+    :param num_threads: number of threads to do the computation
+    :param Debug: show extra information of the process
+    :param collapsed: map each unique sequence once
+    :param sorted_bam: sort and index the BAM file by coordinate
+
+    :type reads: list
+    :type folder: string
+    :type name: string
+    :type bowtie_exe: string
+    :type index: string
+    :type limitRAM_option: int
+    :type num_threads: int
+    :type Debug: boolean
+    :type collapsed: boolean
+    :type sorted_bam: boolean
+
+    :returns: mapping_code
+    """
+    print("\t+ Mapping sample %s using bowtie" %name)
+
+    if not os.path.isdir(folder):
+        folder = files_functions.create_folder(folder)
+    bam_file_name = os.path.join(folder, STAR_caller.bam_unsorted)
+    samtools_exe = set_config.get_exe('samtools', Debug=Debug)
+    logfile = os.path.join(folder, 'bowtie.log')
+
+    ## unique sequences: unmapped sequences are kept for weighting statistics
+    collapsed_file = collapse_reads.get_collapsed(reads, name, Debug, folder=folder) if collapsed else None
+    filter_unmapped = "" if collapsed_file else "-F 4 "
+
+    with collapse_reads.fastq_input(reads, folder, name, Debug, unique=bool(collapsed_file)) as fastq:
+        if len(fastq) == 2:
+            input_reads = "-1 %s -2 %s" %(fastq[0], fastq[1])
+        else:
+            input_reads = fastq[0]
+
+        cmd = "%s -p %s --mm -q -S %s%s %s 2> %s" %(bowtie_exe, num_threads, smallRNA_options(), index, input_reads, logfile)
+        cmd = cmd + " | %s view -b %s-o %s -" %(samtools_exe, filter_unmapped, bam_file_name)
+        mapping_code = exec_trace.system_call(cmd, 'bowtie', name, threads=num_threads, inputs=reads, outputs=[bam_file_name])
+
+    ## mapping statistics: bowtie errors are not reported by the pipe
+    counts = read_stats(logfile) if mapping_code else None
+    if not counts:
+        print (colored("** ERROR: bowtie failed for sample %s. See %s" %(name, logfile), 'red'))
+        return (False)
+    write_stats(counts, os.path.join(folder, 'Log.final.out'))
+    if Debug:
+        HCGB_aes.debug_message("bowtie mapping statistics: %s" %counts, "yellow")
+
+    ## sort on request: unsorted BAM file is not kept
+    if sorted_bam:
+        sorted_file = STAR_caller.sort_bam(bam_file_name, name, num_threads, limitRAM_option, Debug)
+        if not sorted_file:
+            return (False)
+        os.remove(bam_file_name)
+        bam_file_name = sorted_file
+
+    STAR_caller.clean_bam(folder, bam_file_name)
+    STAR_caller.weight_mapping(folder, bam_file_name, collapsed_file, Debug)
+    return (True)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Collapses the reads of each sample into unique sequences and counts.
+
+Small RNA libraries are highly redundant, so each sample is collapsed once after
+trimming and joining the reads. The collapsed file (<name>.collapsed.tsv.gz)
+contains a sequence and its count per line, sorted by count. An index
+(<name>.collapsed.json) summarizes the total number of reads, the unique
+sequences and the reads of each length.
+
+Software able to read counts uses the collapsed file directly. For software
+requiring FASTQ, reads are expanded on the fly into a named pipe, so no
+additional FASTQ file is written. Software must read the pipe only once: set
+XICRA_COLLAPSE_FIFO=0 to expand reads into a temporary file instead.
+
+Mappers could also receive each unique sequence once (unique=True), named as
+<name>_<rank>_x<count>. Alignments generated (BAM files) are then weighted: the
+count of each read is retrieved from its name (see read_weight) by the software
+counting alignments. Weighted BAM files are flagged by a file next to them (see
+set_weighted).
+'''
+## useful imports
+import os
+import re
+import sys
+import gzip
+import select
+import json
+import itertools
+import threading
+import contextlib
+import collections
+from termcolor import colored
+
+## import my modules
+from XICRA.scripts import step_cache
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## settings
+collapse_settings = { 'fifo': os.environ.get('XICRA_COLLAPSE_FIFO', '1') not in ('0', 'false', 'False') }
+
+## a lock for each collapsed file: several software could request it at the same time
+_locks = collections.defaultdict(threading.Lock)
+_lock = threading.Lock()
+
+## count of each unique sequence in the read name: <name>_<rank>_x<count>
+weight_regex = re.compile(r'_x(\d+)$')
+
+############################
+def collapsed_files(folder, name):
+    """Returns the collapsed file and its index for the sample provided."""
+    return (os.path.join(folder, name + '.collapsed.tsv.gz'), os.path.join(folder, name + '.collapsed.json'))
+
+############################
+def get_collapsed(reads, name, Debug, folder=None):
+    """Returns the collapsed file for the reads provided. It is generated if not available.
+
+    The collapsed file is stored next to the reads, or in the folder provided
+    if the reads folder is not writable.
+
+    :param reads: List containing the fastq file of the sample.
+    :param name: Sample name.
+    :param Debug: show extra information of the process.
+    :param folder: Alternative folder to store the collapsed file.
+
+    :returns: Collapsed file. None if reads could not be collapsed, e.g. paired-end reads.
+    """
+    if len(reads) != 1:
+        return (None)
+
+    reads_folder = os.path.dirname(os.path.abspath(reads[0]))
+    if folder and not os.access(reads_folder, os.W_OK):
+        reads_folder = os.path.abspath(folder)
+
+    if not collapse_caller(reads, reads_folder, name, Debug):
+        return (None)
+
+    return (collapsed_files(reads_folder, name)[0])
+
+############################
+def collapse_caller(reads, folder, name, Debug):
+    """Collapses the reads of the sample, unless previously generated with the same reads.
+
+    :param reads: List containing the fastq file of the sample.
+    :param folder: Folder to store the collapsed file and its index.
+    :param name: Sample name.
+    :param Debug: show extra information of the process.
+
+    :returns: True/False
+    """
+    (collapsed_file, index_file) = collapsed_files(folder, name)
+    with _lock:
+        file_lock = _locks[collapsed_file]
+
+    with file_lock:
+        return (collapse_sample(reads, collapsed_file, index_file, folder, name, Debug))
+
+############################
+def collapse_sample(reads, collapsed_file, index_file, folder, name, Debug):
+    """Collapses the reads of the sample if not available. See collapse_caller()."""
+    (cached, step_info) = step_cache.check_step(folder, 'collapse_' + name, name, reads, "", Debug=Debug)
+    if cached:
+        return (True)
+
+    print ("+ Collapsing reads for sample %s..." %name)
+    try:
+        index_info = collapse(reads[0], collapsed_file, index_file)
+    except (OSError, EOFError) as exc:
+        print (colored("** ERROR: reads could not be collapsed for sample %s: %s" %(name, exc), 'red'))
+        return (False)
+
+    if Debug:
+        HCGB_aes.debug_message("collapsed: %s reads into %s unique sequences" %(index_info['total_reads'], index_info['unique']), "yellow")
+
+    step_cache.save_step(step_info, [collapsed_file, index_file])
+    return (True)
+
+############################
+def open_file(path, mode='rb'):
+    """Opens the file provided, compressed or not."""
+    if path.endswith('.gz'):
+        return (gzip.open(path, mode))
+    return (open(path, mode))
+
+############################
+def collapse(fastq_file, collapsed_file, index_file):
+    """Counts the unique sequences of the fastq file and writes the collapsed file and its index.
+
+    :param fastq_file: Reads in fastq format, compressed or not.
+    :param collapsed_file: Output file: sequence and count, sorted by count.
+    :param index_file: Output index in JSON format.
+
+    :returns: Dictionary with the information of the index.
+    """
+    ## sequence is the second line of each read
+    with open_file(fastq_file) as fh:
+        counts = collections.Counter(map(bytes.rstrip, itertools.islice(fh, 1, None, 4)))
+
+    lengths = collections.Counter()
+    tmp_file = collapsed_file + '.tmp'
+    with gzip.open(tmp_file, 'wb', compresslevel=6) as out_fh:
+        for seq, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            out_fh.write(b'%s\t%d\n' %(seq, count))
+            lengths[len(seq)] += count
+    os.replace(tmp_file, collapsed_file)
+
+    index_info = { 'source': os.path.abspath(fastq_file),
+                   'total_reads': sum(counts.values()),
+                   'unique': len(counts),
+                   'lengths': { str(l): lengths[l] for l in sorted(lengths) } }
+    with open(index_file, 'w') as fh:
+        json.dump(index_info, fh, indent=2)
+
+    return (index_info)
+
+############################
+def read_index(collapsed_file):
+    """Returns the index information of the collapsed file provided."""
+    with open(collapsed_file.replace('.collapsed.tsv.gz', '.collapsed.json')) as fh:
+        return (json.load(fh))
+
+############################
+def read_collapsed(collapsed_file):
+    """Yields each sequence and count of the collapsed file."""
+    with gzip.open(collapsed_file, 'rb') as fh:
+        for line in fh:
+            (seq, count) = line.rstrip().split(b'\t')
+            yield (seq, int(count))
+
+############################
+def write_tabular(collapsed_file, tabular_file):
+    """Writes sequences and counts as plain text, as required by miraligner or sRNAbench (read count format)."""
+    with gzip.open(collapsed_file, 'rb') as in_fh, open(tabular_file, 'wb') as out_fh:
+        for chunk in iter(lambda: in_fh.read(1024*1024), b''):
+            out_fh.write(chunk)
+
+############################
+def write_fastq(collapsed_file, name, out_fh):
+    """Writes a read for each count of each sequence in fastq format.
+
+    Copies of the same sequence share the same identifier: <name>_<rank>_x<count>.
+    """
+    for rank, (seq, count) in enumerate(read_collapsed(collapsed_file), 1):
+        record = b'@%s_%d_x%d\n%s\n+\n%s\n' %(name.encode(), rank, count, seq, b'I'*len(seq))
+        ## write large copy numbers in blocks
+        while count > 0:
+            block = min(count, 10000)
+            out_fh.write(record * block)
+            count -= block
+
+############################
+def write_unique_fastq(collapsed_file, name, out_fh):
+    """Writes a read for each sequence in fastq format, named as <name>_<rank>_x<count>."""
+    for rank, (seq, count) in enumerate(read_collapsed(collapsed_file), 1):
+        out_fh.write(b'@%s_%d_x%d\n%s\n+\n%s\n' %(name.encode(), rank, count, seq, b'I'*len(seq)))
+
+############################
+def read_weight(read_name):
+    """Returns the number of reads represented by the read provided: count in its name or 1."""
+    match = weight_regex.search(read_name)
+    if match:
+        return (int(match.group(1)))
+    return (1)
+
+############################
+def weighted_file(bam_file):
+    """Returns the file flagging a BAM file generated using unique sequences."""
+    return (bam_file + '.collapsed.json')
+
+############################
+def set_weighted(bam_file, collapsed_file=None):
+    """Flags the BAM file as weighted (collapsed_file provided) or not."""
+    flag_file = weighted_file(bam_file)
+    if not collapsed_file:
+        if os.path.isfile(flag_file):
+            os.remove(flag_file)
+        return ()
+
+    info = read_index(collapsed_file)
+    info['collapsed_file'] = os.path.abspath(collapsed_file)
+    with open(flag_file, 'w') as fh:
+        json.dump(info, fh, indent=2)
+
+############################
+def is_weighted(bam_file):
+    """Returns True if alignments were generated using unique sequences and must be weighted."""
+    return (os.path.isfile(weighted_file(bam_file)))
+
+############################
+@contextlib.contextmanager
+def expanded_fastq(collapsed_file, folder, name, unique=False):
+    """Provides a fastq file containing the reads of the collapsed file.
+
+    Reads are written through a named pipe while the software reads them, so
+    the software must read the file once and sequentially. If named pipes are
+    disabled, a temporary fastq file is written and removed afterwards.
+
+    :param collapsed_file: Collapsed file of the sample.
+    :param folder: Folder to create the named pipe or temporary file.
+    :param name: Sample name.
+    :param unique: Write each sequence once instead of a read for each count (see write_unique_fastq).
+
+    :returns: Path to the fastq file.
+    """
+    fastq = os.path.join(os.path.abspath(folder), name + '.expanded.fastq')
+    writer = write_unique_fastq if unique else write_fastq
+    if os.path.exists(fastq):
+        os.remove(fastq)
+
+    if not collapse_settings['fifo']:
+        with open(fastq, 'wb') as fh:
+            writer(collapsed_file, name, fh)
+        try:
+            yield (fastq)
+        finally:
+            os.remove(fastq)
+        return
+
+    os.mkfifo(fastq)
+    stop = threading.Event()
+
+    def serve():
+        ## blocks until the software opens the pipe
+        fh = open(fastq, 'wb')
+        if stop.is_set():
+            fh.close()
+            return
+        try:
+            writer(collapsed_file, name, fh)
+            fh.close()
+        except BrokenPipeError:
+            ## software finished before all reads were written: discard buffered data
+            try:
+                fh.close()
+            except BrokenPipeError:
+                pass
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    try:
+        yield (fastq)
+    finally:
+        stop.set()
+        ## unblock the server if the software never opened the pipe and
+        ## discard any reads not consumed by the software
+        fd = os.open(fastq, os.O_RDONLY | os.O_NONBLOCK)
+        while server.is_alive():
+            if select.select([fd], [], [], 0.1)[0]:
+                os.read(fd, 1024*1024)
+        os.close(fd)
+        os.remove(fastq)
+
+############################
+@contextlib.contextmanager
+def fastq_input(reads, folder, name, Debug, unique=False):
+    """Provides the reads of the sample in fastq format, expanded from its collapsed file.
+
+    Reads that could not be collapsed (e.g. paired-end reads) are provided as they are.
+
+    :param reads: List containing the fastq files of the sample.
+    :param folder: Folder for the named pipe (see expanded_fastq()) or the collapsed file, if necessary.
+    :param name: Sample name.
+    :param Debug: show extra information of the process.
+    :param unique: Provide each sequence once, named with its count (see write_unique_fastq).
+
+    :returns: List of fastq files.
+    """
+    collapsed_file = get_collapsed(reads, name, Debug, folder=folder)
+    if not collapsed_file:
+        yield (reads)
+        return
+
+    with expanded_fastq(collapsed_file, folder, name, unique) as fastq:
+        yield ([fastq])
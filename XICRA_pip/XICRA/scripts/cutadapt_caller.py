@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from HCGB import functions
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace
 
 #############################################
 def caller(list_reads, sample_folder, name, threads, min_read_len, Debug, adapters, extra):
@@ -40,22 +41,32 @@ def caller(list_reads, sample_folder, name, threads, min_read_len, Debug, adapte
     :type extra: string
     
 
-    :returns: None
+    :returns: True/False
     """
     
-    ## check if previously trimmed and succeeded
-    filename_stamp = sample_folder + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'cutadapt'), 'yellow'))
+    ## output files
+    if (len(list_reads) == 2):
+        outputs = [ os.path.join(sample_folder, name + '_trim_R1.fastq'), os.path.join(sample_folder, name + '_trim_R2.fastq') ]
     else:
+        outputs = [ os.path.join(sample_folder, name + '_trim.fastq') ]
+    outputs.append(os.path.join(sample_folder, name + '.cutadapt.log'))
+
+    ## check if previously trimmed and succeeded with same inputs and parameters
+    params = "-m %s adapters: %s extra: %s" %(min_read_len, sorted(adapters.items()), extra)
+    (cached, step_info) = step_cache.check_step(sample_folder, 'cutadapt', name, list_reads, params, prog='cutadapt',
+                                                legacy_stamp=sample_folder + '/.success', Debug=Debug, 
+                                                outputs=outputs, by_name=True)
+    if not cached:
         # Call cutadapt
         cutadapt_exe = set_config.get_exe('cutadapt')
         code_returned = cutadapt(cutadapt_exe, list_reads, sample_folder, name, threads, min_read_len, Debug, adapters, extra)
         if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info, outputs)
         else:
             print ('** Sample %s failed...' %name)
+            return (False)
+    
+    return (True)
 
 
 #############################################
@@ -123,7 +134,7 @@ def cutadapt(cutadapt_exe, reads, path, sample_name, num_threads, min_len_given,
         return(False)
 
     ##
-    code = functions.system_call_functions.system_call(cmd)
+    code = exec_trace.system_call(cmd, 'cutadapt', sample_name, threads=num_threads, inputs=reads, outputs=[path])
 
     ## if additional options, run a second cutadapt command
     ## to ensure this options take effect.
@@ -152,7 +163,7 @@ def cutadapt(cutadapt_exe, reads, path, sample_name, num_threads, min_len_given,
                                                                    adapters['adapter_a'], 
                                                                    o_param2, o_param, logfile)    
         
-        code2 = functions.system_call_functions.system_call(extra_cmd)
+        code2 = exec_trace.system_call(extra_cmd, 'cutadapt', sample_name, 'cutadapt_extra', num_threads, inputs=reads, outputs=[path])
         
         ## remove: o_param p_param
         if (len(reads) == 2):        
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Normalizes expression matrices and tests differential expression between samples.
+
+Counts of each feature (isomiR, miRNA, tRF...) are modeled with a negative binomial
+generalized linear model, following DESeq2 (Love et al. 2014):
+
+- size factors: median of ratios (DESeq2), TMM (edgeR) or library size (CPM)
+- dispersions: gene-wise estimates (Cox-Reid adjusted likelihood) shrunk towards a
+  parametric trend on the mean (maximum a posteriori)
+- tests: Wald test of each contrast or likelihood ratio test (LRT) against the model
+  without the factor of the contrast
+
+All features are fitted at once using arrays (features x samples) and all contrasts
+are tested together, so no R session is required. Results contain the same columns
+as DESeq2: baseMean, log2FoldChange, lfcSE, stat, pvalue and padj.
+'''
+## useful imports
+import numpy as np
+import pandas as pd
+from termcolor import colored
+
+## normalization methods available
+normalization_methods = ['median_ratio', 'TMM', 'CPM']
+
+## tests available
+tests_available = ['Wald', 'LRT']
+
+## settings: same defaults as DESeq2
+min_dispersion = 1e-8
+min_mu = 0.5
+ridge = 1e-6
+max_iter = 100
+outlier_sd = 2
+
+############################
+def size_factors(counts, method='median_ratio'):
+    """Returns the size factor of each sample, scaled to a geometric mean of 1.
+
+    :param counts: Array of counts (features x samples).
+    :param method: median_ratio (DESeq2), TMM (edgeR) or CPM (library size).
+
+    :returns: Array of size factors.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    if method == 'median_ratio':
+        ## ratio to the geometric mean of each feature: features with zeros are not used
+        with np.errstate(divide='ignore'):
+            log_counts = np.log(counts)
+        log_means = log_counts.mean(axis=1)
+        use = np.isfinite(log_means)
+        if not use.any():
+            raise ValueError("Every feature contains at least one zero: median of ratios size factors are not available. Use TMM or CPM.")
+        factors = np.exp(np.median(log_counts[use] - log_means[use, None], axis=0))
+
+    elif method == 'TMM':
+        factors = counts.sum(axis=0) * tmm_factors(counts)
+
+    elif method == 'CPM':
+        factors = counts.sum(axis=0)
+
+    else:
+        raise ValueError("Normalization method %s not available. Options: %s" %(method, ", ".join(normalization_methods)))
+
+    return (factors / np.exp(np.mean(np.log(factors))))
+
+############################
+def tmm_factors(counts, logratio_trim=0.3, sum_trim=0.05):
+    """Returns the trimmed mean of M-values (TMM) normalization factor of each sample, as edgeR.
+
+    The reference is the sample with the upper quartile closest to the mean upper quartile.
+    """
+    from scipy.stats import rankdata
+
+    libs = counts.sum(axis=0)
+    upper = np.quantile(counts / libs, 0.75, axis=0)
+    ref = np.argmin(np.abs(upper - upper.mean()))
+
+    factors = np.ones(counts.shape[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for sample in range(counts.shape[1]):
+            obs = counts[:, sample] / libs[sample]
+            ref_values = counts[:, ref] / libs[ref]
+            log_ratio = np.log2(obs / ref_values)
+            abs_expr = (np.log2(obs) + np.log2(ref_values)) / 2
+            variance = (1 - obs) / counts[:, sample] + (1 - ref_values) / counts[:, ref]
+
+            use = np.isfinite(log_ratio) & np.isfinite(abs_expr)
+            if not use.any() or np.abs(log_ratio[use]).max() < 1e-6:
+                continue
+
+            n = use.sum()
+            (low_ratio, low_sum) = (np.floor(n * logratio_trim) + 1, np.floor(n * sum_trim) + 1)
+            ratio_rank = rankdata(log_ratio[use])
+            sum_rank = rankdata(abs_expr[use])
+            keep = ((ratio_rank >= low_ratio) & (ratio_rank <= n + 1 - low_ratio) &
+                    (sum_rank >= low_sum) & (sum_rank <= n + 1 - low_sum))
+
+            weights = 1 / variance[use][keep]
+            factors[sample] = 2 ** (np.sum(log_ratio[use][keep] * weights) / np.sum(weights))
+
+    return (factors / np.exp(np.mean(np.log(factors))))
+
+############################
+def design_matrix(sample_sheet, design, reference=None):
+    """Returns the design matrix for the factors provided.
+
+    Factors (text columns) are coded as indicator columns for each level, except
+    the reference level (first level sorted, unless provided). Numeric columns are
+    used as they are.
+
+    :param sample_sheet: Dataframe with samples as index and factors as columns.
+    :param design: List of columns of the sample sheet to use, e.g. ['batch', 'condition'].
+    :param reference: Dictionary with the reference level of each factor.
+
+    :returns: Dataframe (samples x coefficients) and dictionary with the coefficients of each factor.
+    """
+    reference = reference or {}
+    columns = { 'Intercept': np.ones(len(sample_sheet)) }
+    terms = {}
+    for factor in design:
+        values = sample_sheet[factor]
+        if pd.api.types.is_numeric_dtype(values):
+            columns[factor] = values.to_numpy(dtype=np.float64)
+            terms[factor] = [factor]
+            continue
+
+        values = values.astype(str)
+        levels = sorted(values.unique())
+        ref = str(reference.get(factor, levels[0]))
+        if ref not in levels:
+            raise ValueError("Reference level %s not available for factor %s" %(ref, factor))
+
+        terms[factor] = []
+        for level in levels:
+            if level == ref:
+                continue
+            name = '%s_%s' %(factor, level)
+            columns[name] = (values == level).to_numpy(dtype=np.float64)
+            terms[factor].append(name)
+
+    design_df = pd.DataFrame(columns, index=sample_sheet.index)
+    if np.linalg.matrix_rank(design_df.to_numpy()) < design_df.shape[1]:
+        raise ValueError("Design matrix is not full rank: some factors are confounded.")
+
+    return (design_df, terms)
+
+############################
+def contrast_vector(design_df, factor, numerator, denominator):
+    """Returns the vector of coefficients for the comparison numerator vs denominator of the factor provided."""
+    vector = np.zeros(design_df.shape[1])
+    for (level, sign) in ((numerator, 1), (denominator, -1)):
+        name = '%s_%s' %(factor, level)
+        ## reference level has no coefficient
+        if name in design_df.columns:
+            vector[design_df.columns.get_loc(name)] += sign
+    return (vector)
+
+############################
+def nbinom_loglik(counts, mu, dispersion):
+    """Returns the negative binomial log-likelihood of each feature.
+
+    :param counts: Array of counts (features x samples).
+    :param mu: Array of expected counts (features x samples).
+    :param dispersion: Dispersion of each feature.
+
+    :returns: Array of log-likelihoods.
+    """
+    from scipy.special import gammaln
+    size = 1 / np.asarray(dispersion, dtype=np.float64)[:, None]
+    return ((gammaln(counts + size) - gammaln(size) - gammaln(counts + 1) +
+             size * np.log(size / (size + mu)) + counts * np.log(mu / (size + mu))).sum(axis=1))
+
+############################
+def fit_glm(counts, design, factors, dispersion, tol=1e-8):
+    """Fits a negative binomial GLM for each feature by iteratively reweighted least squares.
+
+    All features are fitted at once. Features converged are not updated again.
+
+    :param counts: Array of counts (features x samples).
+    :param design: Design matrix (samples x coefficients).
+    :param factors: Size factor of each sample.
+    :param dispersion: Dispersion of each feature.
+    :param tol: Relative change of the deviance to stop iterating.
+
+    :returns: Dictionary with beta (natural log scale), mu, covariance of beta, log-likelihood and converged mask.
+    """
+    (n_features, n_samples) = counts.shape
+    n_coef = design.shape[1]
+    offset = np.log(factors)
+    penalty = ridge * np.eye(n_coef)
+
+    ## initial values: linear model on log normalized counts
+    beta = np.linalg.lstsq(design, np.log(counts / factors + 0.1).T, rcond=None)[0].T
+    mu = np.maximum(np.exp(beta @ design.T + offset), min_mu)
+    deviance = -2 * nbinom_loglik(counts, mu, dispersion)
+    active = np.ones(n_features, dtype=bool)
+
+    for iteration in range(max_iter):
+        idx = np.flatnonzero(active)
+        if not len(idx):
+            break
+
+        (y, m, disp) = (counts[idx], mu[idx], dispersion[idx])
+        weights = m / (1 + disp[:, None] * m)
+        working = np.log(m) - offset + (y - m) / m
+        xtwx = np.einsum('gn,np,nq->gpq', weights, design, design) + penalty
+        xtwz = (weights * working) @ design
+        beta[idx] = np.linalg.solve(xtwx, xtwz[:, :, None])[:, :, 0]
+
+        mu[idx] = np.maximum(np.exp(np.clip(beta[idx] @ design.T + offset, -30, 30)), min_mu)
+        new_deviance = -2 * nbinom_loglik(y, mu[idx], disp)
+        active[idx] = np.abs(new_deviance - deviance[idx]) / (np.abs(new_deviance) + 0.1) >= tol
+        deviance[idx] = new_deviance
+
+    ## covariance of the coefficients
+    weights = mu / (1 + dispersion[:, None] * mu)
+    xtwx = np.einsum('gn,np,nq->gpq', weights, design, design) + penalty
+    return ({ 'beta': beta, 'mu': mu, 'covariance': np.linalg.inv(xtwx),
+              'loglik': -deviance / 2, 'converged': ~active })
+
+############################
+def dispersion_objective(counts, mu, design, log_dispersion, prior_mean=None, prior_var=None):
+    """Returns the Cox-Reid adjusted log-likelihood of the dispersions provided, plus the log prior if provided."""
+    dispersion = np.exp(log_dispersion)
+    weights = 1 / (1 / mu + dispersion[:, None])
+    cox_reid = -0.5 * np.linalg.slogdet(np.einsum('gn,np,nq->gpq', weights, design, design))[1]
+    objective = nbinom_loglik(counts, mu, dispersion) + cox_reid
+    if prior_mean is not None:
+        objective -= (log_dispersion - prior_mean) ** 2 / (2 * prior_var)
+    return (objective)
+
+############################
+def optimize_dispersion(counts, mu, design, max_dispersion, prior_mean=None, prior_var=None):
+    """Returns the dispersion of each feature maximizing the objective (see dispersion_objective).
+
+    A grid of dispersions (log scale) is evaluated for all features at once and
+    refined twice around the best value of each feature.
+    """
+    n_features = counts.shape[0]
+    (low, high) = (np.log(min_dispersion), np.log(max_dispersion))
+    grid = np.linspace(low, high, 30)
+    step = grid[1] - grid[0]
+    centers = np.zeros(n_features)
+    offsets = grid
+
+    for refine in range(3):
+        if refine:
+            offsets = np.linspace(-step, step, 21)
+            step = offsets[1] - offsets[0]
+        candidates = np.clip(centers[:, None] + offsets[None, :], low, high) if refine else np.tile(grid, (n_features, 1))
+        scores = np.column_stack([ dispersion_objective(counts, mu, design, candidates[:, i], prior_mean, prior_var)
+                                   for i in range(candidates.shape[1]) ])
+        scores[~np.isfinite(scores)] = -np.inf
+        centers = candidates[np.arange(n_features), np.argmax(scores, axis=1)]
+
+    return (np.exp(centers))
+
+############################
+def fit_dispersion_trend(base_mean, dispersion):
+    """Fits the parametric trend of the dispersions on the mean: asymptotic dispersion + extra Poisson / mean.
+
+    Fitted with a gamma-family GLM (identity link), iteratively discarding outliers as DESeq2.
+
+    :returns: Coefficients (asymptotic, extra Poisson) or None if the fit fails.
+    """
+    use = (dispersion >= 100 * min_dispersion) & (base_mean > 0)
+    if use.sum() < 3:
+        return (None)
+
+    predictors = np.column_stack([ np.ones(use.sum()), 1 / base_mean[use] ])
+    values = dispersion[use]
+    coefs = np.array([0.1, 1.0])
+    for iteration in range(10):
+        fitted = predictors @ coefs
+        residuals = values / fitted
+        good = (residuals > 1e-4) & (residuals < 15)
+        if good.sum() < 3:
+            return (None)
+
+        ## gamma GLM, identity link: weighted least squares with weights 1/fitted^2
+        new_coefs = coefs
+        for inner in range(25):
+            weights = 1 / np.maximum(predictors[good] @ new_coefs, 1e-10) ** 2
+            sqrt_w = np.sqrt(weights)
+            new_coefs = np.linalg.lstsq(predictors[good] * sqrt_w[:, None], values[good] * sqrt_w, rcond=None)[0]
+            if (new_coefs <= 0).any():
+                return (None)
+
+        converged = np.sum(np.log(new_coefs / coefs) ** 2) < 1e-6
+        coefs = new_coefs
+        if converged:
+            break
+
+    return (coefs)
+
+############################
+def estimate_dispersions(counts, design, factors, Debug=False):
+    """Estimates the dispersion of each feature: gene-wise estimates shrunk towards the trend on the mean.
+
+    :param counts: Array of counts (features x samples), without features with all counts zero.
+    :param design: Design matrix (samples x coefficients).
+    :param factors: Size factor of each sample.
+    :param Debug: display complete log
+
+    :returns: Dataframe with columns baseMean, dispGeneEst, dispFit, dispersion and dispOutlier.
+    """
+    (n_features, n_samples) = counts.shape
+    n_coef = design.shape[1]
+    if n_samples <= n_coef:
+        raise ValueError("The number of samples must be larger than the number of coefficients to estimate dispersions.")
+
+    normalized = counts / factors
+    base_mean = normalized.mean(axis=1)
+    max_dispersion = max(10, n_samples)
+
+    ## rough estimate from moments, then gene-wise estimates
+    base_var = normalized.var(axis=1, ddof=1)
+    rough = np.clip((base_var - np.mean(1 / factors) * base_mean) / base_mean ** 2, min_dispersion, max_dispersion)
+    fit = fit_glm(counts, design, factors, rough)
+    gene_est = optimize_dispersion(counts, fit['mu'], design, max_dispersion)
+
+    ## trend on the mean: the mean of the gene-wise estimates if not available
+    coefs = fit_dispersion_trend(base_mean, gene_est)
+    if coefs is None:
+        print (colored("** WARNING: Dispersion trend could not be fitted. Using the mean of gene-wise estimates.", 'yellow'))
+        use = gene_est >= 100 * min_dispersion
+        trend = np.full(n_features, np.mean(gene_est[use]) if use.any() else np.mean(gene_est))
+    else:
+        trend = coefs[0] + coefs[1] / np.maximum(base_mean, 1e-8)
+
+    if Debug:
+        print (colored("**DEBUG: dispersion trend coefficients (asymptotic, extra Poisson): %s" %str(coefs), 'yellow'))
+
+    ## prior variance of the log dispersions: observed spread minus sampling variance
+    from scipy.special import polygamma
+    use = gene_est >= 100 * min_dispersion
+    residuals = np.log(gene_est[use]) - np.log(trend[use])
+    var_log_disp = (1.4826 * np.median(np.abs(residuals - np.median(residuals)))) ** 2 if use.any() else 0
+    prior_var = max(var_log_disp - polygamma(1, (n_samples - n_coef) / 2), 0.25)
+
+    ## maximum a posteriori
+    final = optimize_dispersion(counts, fit['mu'], design, max_dispersion, prior_mean=np.log(trend), prior_var=prior_var)
+
+    ## outliers keep the gene-wise estimate
+    outlier = np.log(gene_est) > np.log(trend) + outlier_sd * np.sqrt(var_log_disp)
+    final[outlier] = gene_est[outlier]
+
+    return (pd.DataFrame({ 'baseMean': base_mean, 'dispGeneEst': gene_est, 'dispFit': trend,
+                           'dispersion': final, 'dispOutlier': outlier }))
+
+############################
+def p_adjust(pvalues):
+    """Returns the p-values adjusted by Benjamini-Hochberg for each column. Missing values are ignored."""
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    adjusted = np.full(pvalues.shape, np.nan)
+    for col in range(pvalues.shape[1]):
+        idx = np.flatnonzero(~np.isnan(pvalues[:, col]))
+        if not len(idx):
+            continue
+        order = idx[np.argsort(pvalues[idx, col])]
+        values = pvalues[order, col] * len(idx) / np.arange(1, len(idx) + 1)
+        adjusted[order, col] = np.minimum(np.minimum.accumulate(values[::-1])[::-1], 1)
+    return (adjusted)
+
+############################
+def parse_contrast(contrast):
+    """Returns factor, numerator and denominator of a contrast provided as factor,numerator,denominator."""
+    items = [ item.strip() for item in contrast.split(',') ]
+    if len(items) != 3:
+        raise ValueError("Contrast %s not valid: provide factor,numerator,denominator (e.g. condition,case,control)" %contrast)
+    return (tuple(items))
+
+############################
+def default_contrasts(sample_sheet, design, reference=None):
+    """Returns the comparisons of each level vs the reference level of the last factor of the design."""
+    reference = reference or {}
+    factor = design[-1]
+    levels = sorted(sample_sheet[factor].astype(str).unique())
+    ref = str(reference.get(factor, levels[0]))
+    return ([ (factor, level, ref) for level in levels if level != ref ])
+
+############################
+def DE_analysis(counts_df, sample_sheet, design, contrasts=None, method='median_ratio', test='Wald', reference=None, min_counts=1, Debug=False):
+    """Normalizes counts and tests differential expression of all features for all contrasts.
+
+    :param counts_df: Dataframe with features as index and samples as columns.
+    :param sample_sheet: Dataframe with samples as index and factors as columns.
+    :param design: List of columns of the sample sheet for the model, e.g. ['batch', 'condition'].
+    :param contrasts: List of (factor, numerator, denominator). Default: each level vs reference of the last factor.
+    :param method: Normalization: median_ratio, TMM or CPM.
+    :param test: Wald or LRT.
+    :param reference: Dictionary with the reference level of each factor.
+    :param min_counts: Minimum total counts for a feature to be tested.
+    :param Debug: display complete log
+
+    :returns: Dictionary with size factors, normalized counts, dispersions and results (dictionary contrast name: dataframe).
+    """
+    ## samples in both tables
+    samples = [ s for s in counts_df.columns if s in sample_sheet.index ]
+    missing = [ str(s) for s in sample_sheet.index if s not in counts_df.columns ]
+    if missing:
+        print (colored("** WARNING: Samples not available in the expression matrix: %s" %", ".join(missing), 'yellow'))
+    sample_sheet = sample_sheet.loc[samples]
+    counts = np.nan_to_num(counts_df[samples].to_numpy(dtype=np.float64))
+    if (np.round(counts) != counts).any():
+        print (colored("** WARNING: Counts are not integers: they are rounded.", 'yellow'))
+        counts = np.round(counts)
+
+    ## model
+    (design_df, terms) = design_matrix(sample_sheet, design, reference)
+    contrasts = [ parse_contrast(c) if isinstance(c, str) else tuple(c) for c in (contrasts or default_contrasts(sample_sheet, design, reference)) ]
+    for (factor, numerator, denominator) in contrasts:
+        if factor not in terms or pd.api.types.is_numeric_dtype(sample_sheet[factor]):
+            raise ValueError("Factor %s of the contrast is not a factor of the design: %s" %(factor, ", ".join(design)))
+        levels = set(sample_sheet[factor].astype(str))
+        if numerator not in levels or denominator not in levels:
+            raise ValueError("Levels %s and %s must be available for factor %s: %s" %(numerator, denominator, factor, ", ".join(sorted(levels))))
+    matrix = np.column_stack([ contrast_vector(design_df, *c) for c in contrasts ])
+    names = [ '%s_%s_vs_%s' %c for c in contrasts ]
+
+    ## features tested
+    tested = counts.sum(axis=1) >= max(min_counts, 1)
+    print ("+ Testing %s features (%s discarded with less than %s counts) in %s samples for %s contrasts..."
+           %(tested.sum(), (~tested).sum(), max(min_counts, 1), len(samples), len(contrasts)))
+
+    ## normalization
+    factors = size_factors(counts[tested], method)
+    normalized = pd.DataFrame(counts / factors, index=counts_df.index, columns=samples)
+
+    ## dispersions and full model
+    X = design_df.to_numpy()
+    dispersions = estimate_dispersions(counts[tested], X, factors, Debug=Debug)
+    fit = fit_glm(counts[tested], X, factors, dispersions['dispersion'].to_numpy())
+    if not fit['converged'].all():
+        print (colored("** WARNING: %s features did not converge." %(~fit['converged']).sum(), 'yellow'))
+
+    ## Wald: all contrasts at once
+    from scipy import stats
+    log2fc = fit['beta'] @ matrix / np.log(2)
+    lfc_se = np.sqrt(np.einsum('pk,gpq,qk->gk', matrix, fit['covariance'], matrix)) / np.log(2)
+    if test == 'Wald':
+        stat = log2fc / lfc_se
+        pvalues = 2 * stats.norm.sf(np.abs(stat))
+
+    ## LRT: reduced model without the factor of each contrast, fitted once per factor
+    elif test == 'LRT':
+        stat = np.zeros(log2fc.shape)
+        pvalues = np.zeros(log2fc.shape)
+        for factor in set([ c[0] for c in contrasts ]):
+            keep = [ col for col in design_df.columns if col not in terms[factor] ]
+            reduced = fit_glm(counts[tested], design_df[keep].to_numpy(), factors, dispersions['dispersion'].to_numpy())
+            chi2 = np.maximum(2 * (fit['loglik'] - reduced['loglik']), 0)
+            for i in [ i for i, c in enumerate(contrasts) if c[0] == factor ]:
+                stat[:, i] = chi2
+                pvalues[:, i] = stats.chi2.sf(chi2, len(terms[factor]))
+    else:
+        raise ValueError("Test %s not available. Options: %s" %(test, ", ".join(tests_available)))
+
+    padj = p_adjust(pvalues)
+
+    ## results of each contrast: features not tested are missing
+    base_mean = normalized.mean(axis=1)
+    results = {}
+    for i, name in enumerate(names):
+        table = pd.DataFrame(np.nan, index=counts_df.index, columns=['log2FoldChange', 'lfcSE', 'stat', 'pvalue', 'padj'])
+        table.loc[tested] = np.column_stack([ log2fc[:, i], lfc_se[:, i], stat[:, i], pvalues[:, i], padj[:, i] ])
+        table.insert(0, 'baseMean', base_mean)
+        results[name] = table
+
+    dispersions.index = counts_df.index[tested]
+    return ({ 'size_factors': pd.Series(factors, index=samples, name='size_factor'),
+              'normalized': normalized, 'dispersions': dispersions, 'design': design_df, 'results': results })
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Execution trace for each external software call.
+
+Every command is executed using system_call() and a record is appended to a
+trace file in JSON lines format: sample, step, software, start and wall time,
+CPU time (user + system), peak memory (RSS) of the process and its children,
+and bytes of the input and output files.
+
+The trace file is set using set_trace() or the XICRA_TRACE environment variable.
+It could be converted into a timeline compatible with Chrome tracing
+(chrome://tracing) or Perfetto (https://ui.perfetto.dev) using export_chrome_trace().
+'''
+## useful imports
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import collections
+from termcolor import colored
+
+## import my modules
+from XICRA.scripts import resource_manager
+
+## settings
+trace_settings = { 'trace_file': os.environ.get('XICRA_TRACE') }
+
+_lock = threading.Lock()
+
+############################
+def set_trace(trace_file):
+    """Sets the file to append records for each call. If XICRA_TRACE is set, it is kept instead."""
+    if not os.environ.get('XICRA_TRACE'):
+        trace_settings['trace_file'] = os.path.abspath(trace_file)
+    os.makedirs(os.path.dirname(trace_settings['trace_file']), exist_ok=True)
+    return (trace_settings['trace_file'])
+
+############################
+def size_files(list_files):
+    """Returns the total size (bytes) of the files or folders provided."""
+    size = 0
+    for f in list_files:
+        if os.path.isfile(f):
+            size += os.path.getsize(f)
+        elif os.path.isdir(f):
+            for root, dirs, files in os.walk(f):
+                size += sum([ os.path.getsize(os.path.join(root, i)) for i in files
+                              if os.path.isfile(os.path.join(root, i)) ])
+    return (size)
+
+############################
+def system_call(cmd, tool, sample="", step="", threads=1, inputs=(), outputs=(), message=True):
+    """Generates a system call and records the resources used.
+
+    Equivalent to HCGB.functions.system_call_functions.system_call(). The
+    resources used by the process and its children are retrieved using
+    os.wait4(). Peak memory is also saved for the software profile (see
+    resource_manager.record_usage).
+
+    :param cmd: Command to execute.
+    :param tool: Software name, e.g. STAR.
+    :param sample: Sample name.
+    :param step: Step of the analysis, e.g. miRTop_counts. Default: tool.
+    :param threads: Threads used by the command.
+    :param inputs: List of input files or folders.
+    :param outputs: List of output files or folders.
+    :param message: Print the command.
+
+    :type inputs: list
+    :type outputs: list
+
+    :returns: True/False
+    """
+    if (message):
+        print (colored("[** System: %s **]" % cmd, 'magenta'))
+
+    bytes_in = size_files(inputs)
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    wall_time = time.time() - start
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    ## ru_maxrss: kilobytes on linux, bytes on macOS
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+    record = collections.OrderedDict()
+    record['sample'] = sample
+    record['step'] = step if step else tool
+    record['tool'] = tool
+    record['start'] = round(start, 3)
+    record['wall_time'] = round(wall_time, 3)
+    record['cpu_time'] = round(rusage.ru_utime + rusage.ru_stime, 3)
+    record['max_rss'] = max_rss
+    record['threads'] = threads
+    record['bytes_in'] = bytes_in
+    record['bytes_out'] = size_files(outputs)
+    record['read_blocks'] = rusage.ru_inblock
+    record['write_blocks'] = rusage.ru_oublock
+    record['returncode'] = proc.returncode
+    record['thread'] = threading.current_thread().name
+    record['cmd'] = cmd
+    write_record(record)
+
+    if proc.returncode != 0:
+        if (message):
+            print (colored("** ERROR **", 'red'))
+            print (colored(output, 'red'))
+            print (colored("** ERROR **", 'red'))
+        return (False)
+
+    resource_manager.record_usage(tool, threads, max_rss, wall_time)
+    return (True)
+
+############################
+def write_record(record):
+    """Appends the record to the trace file, if any."""
+    if not trace_settings['trace_file']:
+        return ()
+    with _lock:
+        with open(trace_settings['trace_file'], 'a') as fh:
+            fh.write(json.dumps(record) + '\n')
+
+############################
+def read_trace(trace_file):
+    """Returns the list of records in the trace file provided."""
+    records = []
+    with open(trace_file) as fh:
+        for line in fh:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return (records)
+
+############################
+def export_chrome_trace(trace_file, out_file):
+    """Converts the trace file into a timeline in Chrome tracing format (JSON).
+
+    Each worker thread is shown as a separate row and each call as a slice
+    named by step and sample.
+
+    :param trace_file: Trace file in JSON lines format.
+    :param out_file: Output file to open using chrome://tracing or https://ui.perfetto.dev
+
+    :returns: out_file
+    """
+    records = read_trace(trace_file)
+    if not records:
+        return (None)
+
+    start = min([ r['start'] for r in records ])
+    threads_ids = {}
+    events = []
+    for r in records:
+        tid = threads_ids.setdefault(r['thread'], len(threads_ids) + 1)
+        events.append({ 'name': "%s [%s]" %(r['step'], r['sample']) if r['sample'] else r['step'],
+                        'cat': r['tool'],
+                        'ph': 'X',
+                        'ts': int((r['start'] - start) * 1e6),
+                        'dur': int(r['wall_time'] * 1e6),
+                        'pid': 1,
+                        'tid': tid,
+                        'args': { k: r[k] for k in ('sample', 'cpu_time', 'max_rss', 'threads',
+                                                    'bytes_in', 'bytes_out', 'returncode', 'cmd') } })
+
+    ## name for each row
+    for thread_name, tid in threads_ids.items():
+        events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': { 'name': thread_name } })
+    events.append({ 'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': { 'name': 'XICRA' } })
+
+    with open(out_file, 'w') as fh:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, fh)
+    return (out_file)
+
+############################
+def summary_trace(trace_file):
+    """Prints wall time, CPU time and peak memory for each step in the trace file."""
+    records = read_trace(trace_file)
+    steps = collections.OrderedDict()
+    for r in records:
+        info = steps.setdefault(r['step'], { 'calls': 0, 'wall_time': 0, 'cpu_time': 0, 'max_rss': 0 })
+        info['calls'] += 1
+        info['wall_time'] += r['wall_time']
+        info['cpu_time'] += r['cpu_time']
+        info['max_rss'] = max(info['max_rss'], r['max_rss'])
+
+    print ("\t%-20s %8s %12s %12s %12s" %("step", "calls", "wall (s)", "cpu (s)", "max RSS (Mb)"))
+    for step, info in steps.items():
+        print ("\t%-20s %8s %12.1f %12.1f %12.1f" %(step, info['calls'], info['wall_time'],
+                                                    info['cpu_time'], info['max_rss']/1024**2))
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Writes and reads expression matrices in sparse formats.
+
+Expression matrices (features x samples) are mostly zeros, so instead of a dense
+CSV they could be stored as the non-zero values (feature, sample, count) plus the
+information of features (rows) and samples (columns):
+
+- mtx: MatrixMarket coordinate file (<prefix>.mtx), <prefix>.features.tsv and <prefix>.samples.tsv
+- parquet: <prefix>.parquet (non-zero values), <prefix>.features.parquet and <prefix>.samples.parquet
+- hdf5: <prefix>.h5 containing tables counts, features and samples
+
+Non-zero values are sorted by sample, so a subset of samples can be read without
+loading the whole matrix (parquet and hdf5). Parquet requires pyarrow and hdf5
+requires tables (PyTables).
+'''
+## useful imports
+import os
+import sys
+import shutil
+import numpy as np
+import pandas as pd
+from termcolor import colored
+
+## formats available
+matrix_formats = ['csv', 'mtx', 'parquet', 'hdf5']
+
+## optional modules required for each format
+format_modules = { 'mtx': 'scipy', 'parquet': 'pyarrow', 'hdf5': 'tables' }
+
+## number of values for each parquet row group
+row_group_size = 1000000
+
+############################
+def check_format(out_format):
+    """Checks the format is available and the module required is installed.
+
+    :param out_format: Output format: csv, mtx, parquet or hdf5.
+
+    :returns: True/False
+    """
+    if out_format not in matrix_formats:
+        print (colored("** ERROR: Format %s not available. Options: %s" %(out_format, ", ".join(matrix_formats)), 'red'))
+        return (False)
+
+    if out_format in format_modules:
+        try:
+            __import__(format_modules[out_format])
+        except ImportError:
+            print (colored("** ERROR: Python module %s is required to write %s files. Please install it." %(format_modules[out_format], out_format), 'red'))
+            return (False)
+
+    return (True)
+
+############################
+def matrix_files(prefix, out_format):
+    """Returns the files for the matrix with the prefix and format provided."""
+    if out_format == 'mtx':
+        return ({ 'counts': prefix + '.mtx', 'features': prefix + '.features.tsv', 'samples': prefix + '.samples.tsv' })
+    elif out_format == 'parquet':
+        return ({ 'counts': prefix + '.parquet', 'features': prefix + '.features.parquet', 'samples': prefix + '.samples.parquet' })
+    elif out_format == 'hdf5':
+        return ({ 'counts': prefix + '.h5', 'features': prefix + '.h5', 'samples': prefix + '.h5' })
+    else:
+        return ({ 'counts': prefix + '.csv' })
+
+############################
+def feature_info(index, type_res="miRNA"):
+    """Returns the information of each feature: ID and its name, variant and UID.
+
+    :param index: Feature IDs (name&variant&UID), e.g. hsa-let-7a-2-3p&NA&qNkjr6Ov2
+    :param type_res: Name of the column for the feature name: miRNA, tRF-amb, etc.
+
+    :returns: Dataframe with columns ID, type_res, variant and UID.
+    """
+    features = pd.DataFrame({'ID': pd.Index(index).astype(str)})
+    tmp = features['ID'].str.split('&', n=2, expand=True).reindex(columns=[0, 1, 2])
+    features[type_res] = tmp[0]
+    features['variant'] = tmp[1]
+    features['UID'] = tmp[2]
+    return (features)
+
+############################
+def dataframe2coo(df_data):
+    """Returns the non-zero values of the dataframe, sorted by sample (column).
+
+    :returns: Dataframe with columns feature, sample (0-based positions) and count.
+    """
+    values = np.nan_to_num(df_data.to_numpy(dtype=np.float64))
+    (sample, feature) = np.nonzero(values.T)
+    return (pd.DataFrame({ 'feature': feature.astype(np.int64),
+                           'sample': sample.astype(np.int64),
+                           'count': values[feature, sample] }))
+
+############################
+def write_matrix(df_data, prefix, out_format, type_res="miRNA"):
+    """Writes the expression matrix (features x samples) in the format provided.
+
+    :param df_data: Dataframe with features (ID) as index and samples as columns.
+    :param prefix: Path and name for the output files.
+    :param out_format: Output format: mtx, parquet or hdf5. See matrix_formats.
+    :param type_res: Name of the column for the feature name: miRNA, tRF-amb, etc.
+
+    :returns: List of files generated.
+    """
+    return (write_coo(dataframe2coo(df_data), feature_info(df_data.index, type_res),
+                      [ str(s) for s in df_data.columns ], prefix, out_format))
+
+############################
+def write_coo(coo, features, samples, prefix, out_format):
+    """Writes the non-zero values and the information of features and samples.
+
+    :param coo: Dataframe with columns feature, sample (positions) and count, sorted by sample.
+    :param features: Dataframe with the information of each feature (ID, name, variant, UID).
+    :param samples: List of sample names.
+    :param prefix: Path and name for the output files.
+    :param out_format: Output format: mtx, parquet or hdf5.
+
+    :returns: List of files generated.
+    """
+    writer = open_writer(prefix, out_format)
+    append_values(writer, coo)
+    return (close_writer(writer, features, samples))
+
+############################
+def open_writer(prefix, out_format):
+    """Starts writing a matrix. Values are appended using append_values(), so the matrix
+    is never completely in memory. See close_writer().
+
+    :param prefix: Path and name for the output files.
+    :param out_format: Output format: mtx, parquet or hdf5.
+
+    :returns: Dictionary with the information of the writer.
+    """
+    files = matrix_files(prefix, out_format)
+    writer = { 'format': out_format, 'files': files, 'values': 0, 'sample_values': {}, 'fh': None }
+
+    if out_format == 'mtx':
+        ## values are written after the header, once the number of values is known
+        writer['fh'] = open(files['counts'] + '.tmp', 'w')
+
+    elif out_format == 'hdf5':
+        if os.path.exists(files['counts']):
+            os.remove(files['counts'])
+        writer['fh'] = pd.HDFStore(files['counts'], mode='w', complevel=5, complib='blosc')
+
+    return (writer)
+
+############################
+def append_values(writer, coo):
+    """Appends non-zero values to the matrix. Values must be sorted by sample and samples
+    must be appended in order.
+
+    :param writer: Writer returned by open_writer().
+    :param coo: Dataframe with columns feature, sample (positions) and count.
+    """
+    if not len(coo):
+        return
+
+    coo = coo[['feature', 'sample', 'count']].astype({ 'feature': np.int64, 'sample': np.int64, 'count': np.float64 })
+    for sample, n in coo['sample'].value_counts(sort=False).items():
+        writer['sample_values'][sample] = writer['sample_values'].get(sample, 0) + n
+    writer['values'] += len(coo)
+
+    if writer['format'] == 'mtx':
+        ## 1-based coordinates
+        np.savetxt(writer['fh'], np.column_stack([ coo['feature'] + 1, coo['sample'] + 1, coo['count'] ]),
+                   fmt=['%d', '%d', '%.17g'])
+
+    elif writer['format'] == 'parquet':
+        import pyarrow, pyarrow.parquet
+        table = pyarrow.Table.from_pandas(coo, preserve_index=False)
+        if not writer['fh']:
+            writer['fh'] = pyarrow.parquet.ParquetWriter(writer['files']['counts'], table.schema)
+        writer['fh'].write_table(table, row_group_size=row_group_size)
+
+    elif writer['format'] == 'hdf5':
+        writer['fh'].append('counts', coo, format='table', index=False)
+
+############################
+def close_writer(writer, features, samples):
+    """Finishes the matrix: writes the information of features and samples.
+
+    :param writer: Writer returned by open_writer().
+    :param features: Dataframe with the information of each feature (ID, name, variant, UID).
+    :param samples: List of sample names.
+
+    :returns: List of files generated.
+    """
+    files = writer['files']
+
+    ## position of the values of each sample: read a subset of samples
+    positions = np.concatenate([[0], np.cumsum([ writer['sample_values'].get(i, 0) for i in range(len(samples)) ])]).astype(np.int64)
+    samples_df = pd.DataFrame({ 'sample': samples, 'start': positions[:-1], 'stop': positions[1:] })
+
+    if writer['format'] == 'mtx':
+        writer['fh'].close()
+        with open(files['counts'], 'w') as out_fh, open(files['counts'] + '.tmp') as in_fh:
+            out_fh.write('%%MatrixMarket matrix coordinate real general\n')
+            out_fh.write('%XICRA expression matrix: features x samples\n')
+            out_fh.write('%d %d %d\n' %(len(features), len(samples), writer['values']))
+            shutil.copyfileobj(in_fh, out_fh)
+        os.remove(files['counts'] + '.tmp')
+        features.to_csv(files['features'], sep='\t', index=False)
+        samples_df.to_csv(files['samples'], sep='\t', index=False)
+
+    elif writer['format'] == 'parquet':
+        if writer['fh']:
+            writer['fh'].close()
+        else:
+            pd.DataFrame({ 'feature': np.array([], dtype=np.int64), 'sample': np.array([], dtype=np.int64),
+                           'count': np.array([], dtype=np.float64) }).to_parquet(files['counts'], index=False)
+        features.to_parquet(files['features'], index=False)
+        samples_df.to_parquet(files['samples'], index=False)
+
+    elif writer['format'] == 'hdf5':
+        store = writer['fh']
+        ## empty tables are not stored using table format
+        if not writer['values']:
+            store.put('counts', pd.DataFrame({ 'feature': np.array([], dtype=np.int64), 'sample': np.array([], dtype=np.int64),
+                                               'count': np.array([], dtype=np.float64) }), format='fixed')
+        store.put('features', features, format='fixed')
+        store.put('samples', samples_df, format='fixed')
+        store.close()
+
+    return (sorted(set(files.values())))
+
+############################
+def write_table(df_data, prefix, out_format):
+    """Writes a table (e.g. sequence of each UID) in the format provided, as tsv for mtx."""
+    if out_format == 'parquet':
+        df_data.to_parquet(prefix + '.parquet')
+        return (prefix + '.parquet')
+    elif out_format == 'hdf5':
+        df_data.to_hdf(prefix + '.h5', key='data', mode='w', format='fixed')
+        return (prefix + '.h5')
+    else:
+        df_data.to_csv(prefix + '.tsv', sep='\t')
+        return (prefix + '.tsv')
+
+############################
+def read_features(prefix, out_format):
+    """Returns the information of the features of the matrix."""
+    files = matrix_files(prefix, out_format)
+    if out_format == 'mtx':
+        return (pd.read_csv(files['features'], sep='\t', dtype=str, keep_default_na=False))
+    elif out_format == 'parquet':
+        return (pd.read_parquet(files['features']))
+    elif out_format == 'hdf5':
+        return (pd.read_hdf(files['features'], key='features'))
+
+############################
+def read_samples(prefix, out_format):
+    """Returns the samples of the matrix and the position of their values."""
+    files = matrix_files(prefix, out_format)
+    if out_format == 'mtx':
+        return (pd.read_csv(files['samples'], sep='\t', dtype={'sample': str}))
+    elif out_format == 'parquet':
+        return (pd.read_parquet(files['samples']))
+    elif out_format == 'hdf5':
+        return (pd.read_hdf(files['samples'], key='samples'))
+
+############################
+def read_matrix(prefix, out_format, samples=None, features=None):
+    """Reads the expression matrix, or a subset of samples and features.
+
+    Only values of the samples requested are read for parquet and hdf5 files.
+    MatrixMarket files are read completely.
+
+    :param prefix: Path and name of the matrix files.
+    :param out_format: Format of the matrix: mtx, parquet or hdf5.
+    :param samples: List of samples to read. Default: all samples.
+    :param features: List of feature IDs to read. Default: all features.
+
+    :returns: Dataframe with features (ID) as index and samples as columns. Missing values are zero.
+    """
+    features_df = read_features(prefix, out_format)
+    samples_df = read_samples(prefix, out_format)
+
+    ## positions of the samples and features requested
+    sample_pos = np.arange(len(samples_df))
+    if samples is not None:
+        sample_pos = pd.Index(samples_df['sample']).get_indexer([ str(s) for s in samples ])
+        if (sample_pos < 0).any():
+            missing = [ s for s, p in zip(samples, sample_pos) if p < 0 ]
+            raise KeyError("Samples not available in %s: %s" %(prefix, ", ".join(map(str, missing))))
+
+    feature_pos = np.arange(len(features_df))
+    if features is not None:
+        feature_pos = pd.Index(features_df['ID']).get_indexer(list(features))
+        feature_pos = feature_pos[feature_pos >= 0]
+
+    ## read values
+    files = matrix_files(prefix, out_format)
+    if out_format == 'mtx':
+        from scipy import io
+        matrix = io.mmread(files['counts']).tocsc()[:, sample_pos][feature_pos, :]
+        values = matrix.toarray()
+    else:
+        if out_format == 'parquet':
+            coo = pd.read_parquet(files['counts'], filters=[('sample', 'in', [ int(p) for p in sample_pos ])])
+        else:
+            ## values of each sample are contiguous
+            coo = pd.concat([ pd.read_hdf(files['counts'], key='counts', start=int(samples_df['start'][p]), stop=int(samples_df['stop'][p]))
+                              for p in sample_pos ] or [ pd.DataFrame(columns=['feature', 'sample', 'count']) ])
+
+        values = np.zeros((len(feature_pos), len(sample_pos)))
+        row = pd.Index(feature_pos).get_indexer(coo['feature'].to_numpy())
+        col = pd.Index(sample_pos).get_indexer(coo['sample'].to_numpy())
+        keep = row >= 0
+        values[row[keep], col[keep]] = coo['count'].to_numpy()[keep]
+
+    df_data = pd.DataFrame(values, index=features_df['ID'].to_numpy()[feature_pos],
+                           columns=samples_df['sample'].to_numpy()[sample_pos])
+    df_data.index.name = "ID"
+    return (df_data)
+
+############################
+def iter_matrix(prefix, out_format, chunk_size=100, features=None):
+    """Reads the expression matrix in chunks of samples.
+
+    :param prefix: Path and name of the matrix files.
+    :param out_format: Format of the matrix: mtx, parquet or hdf5.
+    :param chunk_size: Number of samples for each chunk.
+    :param features: List of feature IDs to read. Default: all features.
+
+    :returns: Yields a dataframe for each chunk of samples. See read_matrix().
+    """
+    samples = read_samples(prefix, out_format)['sample'].to_list()
+    for i in range(0, len(samples), chunk_size):
+        yield (read_matrix(prefix, out_format, samples=samples[i:i + chunk_size], features=features))
+
+############################
+def read_matrix_file(matrix_file):
+    """Reads the expression matrix provided: a csv file or the counts file of a sparse matrix (.mtx, .parquet or .h5).
+
+    :returns: Dataframe with features (ID) as index and samples as columns. Missing values are zero.
+    """
+    extensions = { '.mtx': 'mtx', '.parquet': 'parquet', '.h5': 'hdf5' }
+    (prefix, ext) = os.path.splitext(matrix_file)
+    if ext in extensions:
+        return (read_matrix(prefix, extensions[ext]))
+
+    df_data = pd.read_csv(matrix_file, index_col=0).fillna(0)
+    df_data.index.name = "ID"
+    return (df_data)
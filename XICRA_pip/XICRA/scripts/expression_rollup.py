@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Rolls up expression matrices of isomiRs or tRFs into higher levels.
+
+Each feature (name&variant&UID) is assigned to a group of each level requested:
+
+- miRNA analysis:
+    - miRNA: counts of all isomiRs of each miRNA
+    - variant_type: counts of each type of isomiR (5p, 3p, add, snp or combinations, e.g. 3p+add) for all miRNAs
+    - miRNA_variant_type: counts of each type of isomiR of each miRNA
+- tRNA analysis (tRNA, tRF-amb, tRF-exc):
+    - tRNA: counts of all tRFs of each tRNA family (e.g. GluCTC)
+    - tRF_type: counts of each type of tRF (e.g. 5'-tRF, i-tRF)
+
+Groups of all levels are stacked into a single sparse indicator matrix (groups x
+features), so all roll-ups are obtained with a single product with the expression
+matrix. Roll-ups are stored as <prefix>_<level> in the same format as the matrix.
+'''
+## useful imports
+import csv
+import numpy as np
+import pandas as pd
+from termcolor import colored
+
+## import my modules
+from XICRA.scripts import expression_matrix
+
+## levels available for each type of analysis
+rollup_levels = { 'miRNA': ['miRNA', 'variant_type', 'miRNA_variant_type'],
+                  'tRNA': ['tRNA', 'tRF_type'] }
+
+## all levels
+levels_available = ['miRNA', 'variant_type', 'miRNA_variant_type', 'tRNA', 'tRF_type']
+
+## isomiR types: name and prefixes of the miRTop variants
+variant_types = [ ('5p', ('iso_5p',)), ('3p', ('iso_3p',)), ('add', ('iso_add',)), ('snp', ('iso_snv', 'iso_snp')) ]
+
+############################
+def analysis_levels(type_analysis):
+    """Returns the levels available for the type of analysis provided."""
+    if type_analysis == 'miRNA':
+        return (rollup_levels['miRNA'])
+    elif 'tRF' in type_analysis or type_analysis == 'tRNA':
+        return (rollup_levels['tRNA'])
+    return ([])
+
+############################
+def check_levels(levels, type_analysis):
+    """Returns the levels requested available for the type of analysis provided.
+
+    :param levels: List of levels requested. See levels_available.
+    :param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+
+    :returns: List of levels.
+    """
+    if not levels:
+        return ([])
+
+    available = analysis_levels(type_analysis)
+    discarded = [ level for level in levels if level not in available ]
+    if discarded:
+        print (colored("** WARNING: Levels not available for %s analysis: %s" %(type_analysis, ", ".join(discarded)), 'yellow'))
+
+    levels = [ level for level in available if level in levels ]
+    if levels:
+        try:
+            __import__('scipy.sparse')
+        except ImportError:
+            print (colored("** ERROR: Python module scipy is required to roll up expression matrices. Please install it.", 'red'))
+            return ([])
+
+    return (levels)
+
+############################
+def variant_type(variant):
+    """Returns the type of the isomiR variant provided, e.g. iso_3p:-1,iso_add3p:+2 is 3p+add.
+
+    Variants not available (NA) are Canonical and others not recognized are other.
+    """
+    if variant in ('NA', 'nan', 'None', ''):
+        return ('Canonical')
+
+    prefixes = [ item.split(':')[0] for item in variant.split(',') ]
+    found = [ name for (name, names) in variant_types if any(prefix.startswith(names) for prefix in prefixes) ]
+    if not found:
+        return ('other')
+    return ('+'.join(found))
+
+############################
+def group_keys(feature_levels, level):
+    """Returns the group of the level provided for each feature.
+
+    :param feature_levels: Multi-index with the name, variant and UID of each feature (see generate_DE.split_ids).
+    :param level: Level. See levels_available.
+
+    :returns: Dataframe with the information of each feature group: ID and a column for each key.
+    """
+    names = pd.Index(feature_levels.get_level_values(0)).astype(str)
+    variants = pd.Index(feature_levels.get_level_values('variant')).astype(str)
+
+    if level in ('miRNA', 'tRNA'):
+        keys = pd.DataFrame({ 'ID': names, level: names })
+    elif level == 'tRF_type':
+        keys = pd.DataFrame({ 'ID': variants, level: variants })
+    else:
+        ## classify each different variant once
+        (codes, uniques) = pd.factorize(variants)
+        types = pd.Index(uniques.map(variant_type)).take(codes)
+        if level == 'variant_type':
+            keys = pd.DataFrame({ 'ID': types, level: types })
+        elif level == 'miRNA_variant_type':
+            keys = pd.DataFrame({ 'ID': names + '&' + types, 'miRNA': names, 'variant_type': types })
+
+    return (keys)
+
+############################
+def group_matrix(feature_levels, levels):
+    """Returns the indicator matrix of the groups of all levels provided.
+
+    :param feature_levels: Multi-index with the name, variant and UID of each feature (see generate_DE.split_ids).
+    :param levels: List of levels. See levels_available.
+
+    :returns: Sparse matrix (groups x features) and a list with the level, rows and information (see group_keys) of its groups.
+    """
+    import scipy.sparse
+
+    n_features = len(feature_levels)
+    rows = []
+    groups = []
+    offset = 0
+    for level in levels:
+        keys = group_keys(feature_levels, level)
+        (codes, uniques) = pd.factorize(keys['ID'], sort=True)
+        info = keys.drop_duplicates('ID').set_index('ID').reindex(pd.Index(uniques, name='ID')).reset_index()
+
+        rows.append(offset + codes)
+        groups.append((level, slice(offset, offset + len(uniques)), info))
+        offset += len(uniques)
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    columns = np.tile(np.arange(n_features), len(levels))
+    indicator = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(offset, n_features))
+    return (indicator, groups)
+
+############################
+def rollup(indicator, values):
+    """Returns the counts of each group: sum of the counts of its features.
+
+    :param indicator: Indicator matrix of the groups (see group_matrix).
+    :param values: Counts (features x samples) as an array or sparse matrix.
+
+    :returns: Sparse matrix (groups x samples).
+    """
+    import scipy.sparse
+    if not scipy.sparse.issparse(values):
+        values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    return (scipy.sparse.csr_matrix(indicator @ values))
+
+############################
+def write_rollups(counts, groups, samples, prefix, out_format):
+    """Writes the matrix of each level as <prefix>_<level> in the format provided.
+
+    :param counts: Sparse matrix with the counts of all groups (see rollup).
+    :param groups: Level, rows and information of the groups of each level (see group_matrix).
+    :param samples: List of sample names.
+    :param prefix: Path and name of the expression matrix.
+    :param out_format: Output format: csv, mtx, parquet or hdf5.
+
+    :returns: List of files generated.
+    """
+    files = []
+    for (level, rows, info) in groups:
+        level_counts = counts[rows]
+        level_prefix = prefix + '_' + level
+
+        if out_format == 'csv':
+            df_data = pd.DataFrame(level_counts.toarray(), index=pd.Index(info['ID'], name='ID'), columns=samples)
+            df_data.to_csv(level_prefix + '.csv', quoting=csv.QUOTE_NONNUMERIC)
+            files.append(level_prefix + '.csv')
+            continue
+
+        ## non-zero values sorted by sample
+        level_counts = level_counts.tocsc()
+        level_counts.sort_indices()
+        level_counts = level_counts.tocoo()
+        coo = pd.DataFrame({ 'feature': level_counts.row.astype(np.int64),
+                             'sample': level_counts.col.astype(np.int64),
+                             'count': level_counts.data })
+        coo = coo[coo['count'] != 0]
+        files.extend(expression_matrix.write_coo(coo, info, [ str(s) for s in samples ], level_prefix, out_format))
+
+    return (files)
+
+############################
+def rollup_coo(indicator, coo, n_samples):
+    """Returns the counts of each group for the non-zero values provided.
+
+    :param indicator: Indicator matrix of the groups (see group_matrix).
+    :param coo: Dataframe with columns feature, sample (positions) and count.
+    :param n_samples: Total number of samples.
+
+    :returns: Sparse matrix (groups x samples).
+    """
+    import scipy.sparse
+    values = scipy.sparse.csr_matrix((coo['count'].to_numpy(dtype=np.float64), (coo['feature'].to_numpy(), coo['sample'].to_numpy())),
+                                     shape=(indicator.shape[1], n_samples))
+    return (rollup(indicator, values))
+
+############################
+def rollup_files(prefix, levels, out_format):
+    """Returns the files of the matrix of each level provided (see write_rollups)."""
+    return ([ f for level in levels for f in expression_matrix.matrix_files(prefix + '_' + level, out_format).values() ])
@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from HCGB import functions
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace
 
 ############
 def call_fastqc(path, files, sample, fastqc_bin, threads):    
@@ -32,7 +33,7 @@ def call_fastqc(path, files, sample, fastqc_bin, threads):
     
     ##print ("+ Calling fastqc for samples...")    
     cmd_fastqc = '%s --extract -t %s -o %s %s > %s 2> %s' %(fastqc_bin, threads, path, files_string, logFile, logFile)
-    fastq_code = functions.system_call_functions.system_call( cmd_fastqc )
+    fastq_code = exec_trace.system_call(cmd_fastqc, 'fastqc', sample, threads=threads, inputs=files, outputs=[path])
     
     if not fastq_code:
         print ('** Sample %s failed...' %sample)
@@ -44,17 +45,15 @@ def call_fastqc(path, files, sample, fastqc_bin, threads):
 def run_module_fastqc(path, files, sample, threads):    
     ## Arguments provided via ARGVs
 
-    ## check if previously done and succeeded
-    filename_stamp = path + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, sample, 'fastqc'), 'yellow'))
-    else:
+    ## check if previously done and succeeded with same files
+    (cached, step_info) = step_cache.check_step(path, 'fastqc', sample, files, "--extract", prog='fastqc',
+                                                legacy_stamp=path + '/.success', by_name=True)
+    if not cached:
         ## call fastqc
         fastqc_bin = set_config.get_exe('fastqc')
         codeReturn = call_fastqc(path, files, sample, fastqc_bin, threads)
 
         if codeReturn:
-            functions.time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info)
         
         return ()
@@ -10,31 +10,66 @@ import re
 import sys
 from io import open
 from sys import argv
+import numpy as np
 import pandas as pd
+import shutil
+import json
 import csv
 from termcolor import colored
 
 from HCGB import functions
 import HCGB.functions.aesthetics_functions as HCGB_aes
+from XICRA.scripts import expression_matrix, expression_rollup, step_cache, table_loader
 
 ####################
-def generate_DE(dataframe_results, Debug, outfolder, type_analysis='miRNA'):
+def generate_DE(dataframe_results, Debug, outfolder, type_analysis='miRNA', out_format='csv', memory_budget=None, incremental=False, threads=1, rollup=None):
 	"""Builds final expression matrices comparing all samples.
 	
-		Generates three .csv for each software used:
+		Generates four .csv for each software used:
 		miRNA_expression-soft_name_dup.csv: counts with duplicated reads for each sample
+		miRNA_expression-soft_name_dup_summary.csv: summary of ids sharing each duplicated UID
 		miRNA_expression-soft_name.csv: final matrix, counts of each isomiR (with miRNA and variant info) without duplicated reads 
 		miRNA_expression-soft_name_seq.csv: table with the miRTop identifier and the corresponding DNA sequence
 		
 		miRNA is the default analysis but other can be provided such as tRNA, piRNA, etc
 		
+		Matrices could be stored as sparse matrices (mtx, parquet or hdf5) instead of csv. 
+		See expression_matrix for details.
+		
+		If a memory budget is provided, samples are read in batches and matrices are merged 
+		from disk (see stream_matrix), so memory does not depend on the number of samples.
+		
+		In incremental mode, counts are kept in a store and only new or changed samples 
+		are read (see incremental_matrix).
+		
+		Matrices rolled up to the levels requested (e.g. miRNA or variant_type) are generated 
+		from the final matrix as soft_name_level (see expression_rollup).
+		
 		:param dataframe_results: dataframe with the paths of the outputs of each sample and software
 		:param Debug: display complete log
 		:param outfolder: output folder
+		:param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+		:param out_format: format for the matrices: csv, mtx, parquet or hdf5
+		:param memory_budget: memory (GB) available to read samples. Default: all samples are read at once
+		:param incremental: update the matrices reading only new or changed samples
+		:param threads: number of processes to read samples
+		:param rollup: list of levels to roll up the final matrix. See expression_rollup.levels_available
 		
 	    :returns: None
 	"""
 	
+	## check format and modules required
+	if not expression_matrix.check_format(out_format):
+		return
+	
+	## levels to roll up
+	rollup = expression_rollup.check_levels(rollup, type_analysis)
+	
+	## streaming and incremental modes generate sparse matrices
+	if (memory_budget or incremental) and out_format == 'csv':
+		print (colored("** WARNING: Dense csv matrices are not available using a memory budget or incremental mode. Using mtx format...", 'yellow'))
+		out_format = 'mtx'
+	
 	## get results dictionary for each software employed 
 	soft_list = dataframe_results.soft.unique()
 	
@@ -62,177 +97,164 @@ def generate_DE(dataframe_results, Debug, outfolder, type_analysis='miRNA'):
 			print ("dict_files")
 			print (dict_files)
 
+		csv_outfile = os.path.join(outfolder, type_analysis + '_expression-' + soft_name)
+		
+		## update store with new or changed samples
+		if incremental:
+			incremental_matrix(dict_files, soft_name.lower(), csv_outfile, out_format, Debug, type_analysis=type_analysis, threads=threads, rollup=rollup)
+			continue
+		
+		## read samples in batches and merge from disk
+		if memory_budget:
+			stream_matrix(dict_files, soft_name.lower(), csv_outfile, out_format, memory_budget, Debug, type_analysis=type_analysis, threads=threads, rollup=rollup)
+			continue
+		
 		## get data and discard duplicate UIDs if any
-		(all_data, all_seqs) = generate_matrix(dict_files, soft_name.lower(), Debug, type_analysis=type_analysis)
-		all_data_filtered, all_data_duplicated = discard_UID_duplicated(all_data, type_res=type_analysis)
+		(all_data, all_seqs) = generate_matrix(dict_files, soft_name.lower(), Debug, type_analysis=type_analysis, threads=threads)
+		all_data_filtered, all_data_duplicated, summary_duplicated = discard_UID_duplicated(all_data, type_res=type_analysis)
 			
 		
 		## dump data in folder provided
-		csv_outfile = os.path.join(outfolder, type_analysis + '_expression-' + soft_name)
-		all_data_filtered.to_csv(csv_outfile + ".csv", quoting=csv.QUOTE_NONNUMERIC)
-		all_data_duplicated.to_csv(csv_outfile + '_dup.csv', quoting=csv.QUOTE_NONNUMERIC)
-		all_seqs.to_csv(csv_outfile + '_seq.csv', quoting=csv.QUOTE_NONNUMERIC)
+		if out_format == 'csv':
+			all_data_filtered.to_csv(csv_outfile + ".csv", quoting=csv.QUOTE_NONNUMERIC)
+			all_data_duplicated.to_csv(csv_outfile + '_dup.csv', quoting=csv.QUOTE_NONNUMERIC)
+			summary_duplicated.to_csv(csv_outfile + '_dup_summary.csv', quoting=csv.QUOTE_NONNUMERIC)
+			all_seqs.to_csv(csv_outfile + '_seq.csv', quoting=csv.QUOTE_NONNUMERIC)
+		else:
+			expression_matrix.write_matrix(all_data_filtered, csv_outfile, out_format, type_res=type_analysis)
+			expression_matrix.write_matrix(all_data_duplicated, csv_outfile + '_dup', out_format, type_res=type_analysis)
+			expression_matrix.write_table(summary_duplicated, csv_outfile + '_dup_summary', out_format)
+			expression_matrix.write_table(all_seqs, csv_outfile + '_seq', out_format)
+		
+		## roll up final matrix: a single sum for all levels
+		if rollup:
+			(indicator, groups) = expression_rollup.group_matrix(split_ids(all_data_filtered.index, type_analysis), rollup)
+			rollup_counts = expression_rollup.rollup(indicator, all_data_filtered.to_numpy())
+			expression_rollup.write_rollups(rollup_counts, groups, list(all_data_filtered.columns), csv_outfile, out_format)
 
 ####################
 def discard_UID_duplicated(df_data, type_res="miRNA"):
-	"""
-	"""
+	"""Splits the expression matrix into features with a unique UID and features sharing the UID.
 	
-	## get data index
-	df_data['ID'] = df_data.index
-	new_data = df_data.filter(['ID'], axis=1)	
-
-	# split ID (hsa-let-7a-2-3p&NA&qNkjr6Ov2) into miRNA, variant and UID
-	tmp = new_data['ID'].str.split('&', expand = True)
+		Several ids share the same UID when bases are added at both ends, so it cannot be 
+		differentiated if they are 3p:+1;5p:+2 or 3p:+2;5p:+1. They are discarded from the 
+		final matrix (they typically have very few counts).
+		
+		Ids are split once into levels (see split_ids) and duplicates are found with a single 
+		pass over the UIDs. The matrix provided is not modified.
+		
+		:param df_data: expression matrix with ids (e.g. hsa-let-7a-2-3p&NA&qNkjr6Ov2) as index and samples as columns
+		:param type_res: name for the feature level: miRNA, tRF-amb, etc.
+		
+		:returns: matrix without duplicated UIDs, matrix with duplicated UIDs and summary of duplicated UIDs (see summary_UID_duplicated)
+	"""
+	(levels, duplicated) = duplicated_UID(df_data.index, type_res)
 	
-	new_data[type_res]  = tmp[0]
-	new_data['variant']  = tmp[1]
-	new_data['UID']  = tmp[2]
+	## expression of each group
+	clean_data_expression = df_data.loc[~duplicated]
+	clean_data_expression.index.name = "ID"
+	duplicates_expression = df_data.loc[duplicated]
+	duplicates_expression.index.name = "ID"
 	
-	## count 
-	count_groups = new_data.groupby('UID').count()
-	## print to file?
+	## summary
+	summary = summary_UID_duplicated(levels[duplicated], duplicates_expression.sum(axis=1).to_numpy(), type_res)
 	
-	## get duplicated
-	bigger1count = count_groups[ count_groups['ID'] > 1 ]
-	## print counts to file?
+	return (clean_data_expression, duplicates_expression, summary)
+
+####################
+def split_ids(ids, type_res="miRNA"):
+	"""Returns the ids (name&variant&UID) split into a multi-index with levels type_res, variant and UID."""
+	ids = pd.Index(ids, dtype=object).astype(str)
+	if not len(ids):
+		return (pd.MultiIndex.from_arrays([[], [], []], names=[type_res, 'variant', 'UID']))
 	
-	## get list of UIDs duplicate
-	bigger1count_list = bigger1count.index.to_list()
-	duplicates = new_data[new_data['UID'].isin(bigger1count_list)]
-	## print duplicate to file?
+	levels = ids.str.split('&', n=2, expand=True)
+	if levels.nlevels < 3:
+		levels = pd.MultiIndex.from_arrays([ levels.get_level_values(i) if i < levels.nlevels else [None]*len(ids) for i in range(3) ])
+	levels.names = [type_res, 'variant', 'UID']
+	return (levels)
 
-	## get duplicated data
-	duplicates_indes_list = duplicates.index.to_list()
-	duplicates_expression = df_data[df_data.index.isin(duplicates_indes_list)]
-	#duplicates_expression['UID'] = duplicates_expression['ID'].str.split('&', expand = True)[2]
-	duplicates_expression = duplicates_expression.drop(['ID'], axis=1)
-	duplicates_expression.index.name = "ID"
+####################
+def duplicated_UID(ids, type_res="miRNA"):
+	"""Returns the ids split into levels (see split_ids) and a mask for the ids sharing their UID with other ids."""
+	levels = split_ids(ids, type_res)
+	duplicated = levels.get_level_values('UID').duplicated(keep=False)
+	return (levels, duplicated)
+
+####################
+def summary_UID_duplicated(levels, totals, type_res="miRNA"):
+	"""Returns a table summarizing the duplicated UIDs.
 	
-	## get clean data
-	clean_data_expression = df_data[~df_data.index.isin(duplicates_indes_list)]
-	#clean_data_expression['UID'] = clean_data_expression['ID'].str.split('&', expand = True)[2]
-	clean_data_expression =	clean_data_expression.drop(['ID'], axis=1)
-	clean_data_expression.index.name = "ID"
-	## Fix this error
-	## A value is trying to be set on a copy of a slice from a DataFrame.
-	## Try using .loc[row_indexer,col_indexer] = value instead
-	## 
-	## See the caveats in the documentation: http://pandas.pydata.org/pandas-docs/stable/indexing.html#indexing-view-versus-copy
-	##   clean_data_expression['UID'] = clean_data_expression['ID'].str.split('&', expand = True)[2]
+		:param levels: ids with duplicated UIDs, split into levels (see split_ids)
+		:param totals: total counts of each id
+		:param type_res: name for the feature level: miRNA, tRF-amb, etc.
+		
+		:returns: dataframe with UID as index and columns: number of ids, names and variants (separated by ';'), total counts and ids
+	"""
+	data = pd.DataFrame({ type_res: levels.get_level_values(type_res).astype(str), 
+						  'variant': levels.get_level_values('variant').astype(str), 
+						  'UID': levels.get_level_values('UID').astype(str), 
+						  'total': np.asarray(totals, dtype=np.float64) })
+	data['ID'] = data[type_res] + '&' + data['variant'] + '&' + data['UID']
 	
-	return (clean_data_expression, duplicates_expression)
+	join = lambda values: ';'.join(pd.unique(values))
+	summary = data.groupby('UID', sort=True).agg(ids=('ID', 'size'), name=(type_res, join), variant=('variant', join), 
+												  total=('total', 'sum'), ID=('ID', ';'.join))
+	return (summary.rename(columns={'name': type_res}))
 
 ####################
-def generate_matrix(dict_files, soft_name, Debug, type_analysis="miRNA"):
-	"""
-	"""
-	######################################################
-	### For a list of files, generates a count matrix with a unique index id by merging:
-	### information provided within each file: name, variant and UID by '&'
-	### e.g. AlaAGC&3'-tRF&tRF-16-KSP185D
-	### e.g. hsa-let-7a-2-3p&NA&qNkjr6Ov2
-	### 
-	### It returns a dataframe containing for each index generated
-	### count values for each sample (sample_name) in columns
-	###
-	#########################################################
-	all_data = pd.DataFrame()
-	seq_all_data = pd.DataFrame()
-	for sample, this_file in dict_files.items():
+def generate_matrix(dict_files, soft_name, Debug, type_analysis="miRNA", threads=1):
+	"""Generates a count matrix for all samples provided.
+	
+		Each feature is identified with a unique index id by merging the information 
+		provided within each file: name, variant and UID by '&'
+		e.g. AlaAGC&3'-tRF&tRF-16-KSP185D
+		e.g. hsa-let-7a-2-3p&NA&qNkjr6Ov2
 		
-		new_data=pd.DataFrame()
+		Counts of each sample are retrieved as a column and all samples are merged
+		at once, so time and memory are linear in the number of samples. Samples are 
+		read in parallel (see table_loader).
 		
-		print ('+ Reading information from sample: ', sample)	
+		:param dict_files: dictionary with the results file for each sample
+		:param soft_name: software used to generate the results (lowercase)
+		:param Debug: display complete log
+		:param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+		:param threads: number of processes to read samples
 		
-		## 
-		if functions.files_functions.is_non_zero_file(this_file):
-			data = pd.read_csv(this_file, sep='\t')
-		else:
-			print ('\t - Information not available for sample: ', sample)	
-			continue
-		##
-		if (data.size == 0):
-			print ('\t - Information not available for sample: ', sample)  
+		:returns: dataframe containing count values for each sample (sample_name) in columns and
+		dataframe with the sequence (Read) of each UID
+	"""
+	sample_counts = []
+	seq_dict = {}
+	for sample_data in table_loader.parallel_map(read_sample_counts, sample_args(dict_files, soft_name, type_analysis, Debug), threads):
+		if sample_data is None:
 			continue
 
-		####
-		if type_analysis=="miRNA":
-			
-			## ------------------------------------------ ##
-			## Create matrix for miRNA results
-			## ------------------------------------------ ##
-			
-			## get info, generate unique name and merge for samples
-			## header of tsv files: 
-			## UID	Read	miRNA	Variant	iso_5p	iso_3p	iso_add3p	iso_snp	sRNAbench
-	
-			data['Variant'].fillna('NA', inplace=True)
-			data['unique_id'] = data.apply(lambda data: data['miRNA'] + '&' + data['Variant'] + '&' + data['UID'], axis=1)
-	
-			## parse according to software
-			if (soft_name == 'srnabench'):
-				## sRNAbench mirtop creates a column id with sRNAbench instead of sample name
-				new_data = data.filter(['unique_id', 'sRNAbench'], axis=1)
-				new_data = new_data.set_index('unique_id')
-				new_data = new_data.rename(columns={'sRNAbench': sample})
-	
-			if (soft_name == 'optimir'):
-				## OptimiR mirtop creates a column containing sample name and other tags (trim, joined, fastq...)
-				regex=re.compile(sample + '.*')
-				search_list = list(filter(regex.match, data.columns.values.tolist()))
-				new_data = data.filter(['unique_id', search_list[0]], axis=1)
-				new_data = new_data.set_index('unique_id')
-				new_data = new_data.rename(columns={search_list[0]: sample})
-	
-			if (soft_name == 'miraligner'):
-				## miraligner mirtop creates a column containing sample name and other tags (trim, joined, fastq...)
-				new_data = data.filter(['unique_id', sample], axis=1)
-				new_data = new_data.set_index('unique_id')
-		
-		####
-		elif "tRF" in type_analysis: ## tRF-amb; tRF-exc, tRF
-
-			if Debug:
-				HCGB_aes.debug_message(type_analysis + " analysis: ", color)
-
-			## ------------------------------------------ ##
-			## Create matrix for tRNA results
-			## ------------------------------------------ ##
-			## UID	Read	tRNA	variant	ident	expression	soft\n'
-			
-			data['variant'].fillna('NA', inplace=True)
-			
-			## parse according to software
-			if (soft_name == 'mintmap'):
-				data['unique_id'] = data.apply(lambda data: data['tRNA'] + '&' + data['variant'] + '&' + data['UID'], axis=1)
-				new_data = data.filter(['unique_id', 'expression'], axis=1)
-				new_data = new_data.set_index('unique_id')
-				new_data = new_data.rename(columns={'expression': sample})
-			
-			## TODO
-			#else:
-			#	data['unique_id'] = data.apply(lambda data: data['tRNA'] + '&' + data['variant'] + '&' + data['UID'], axis=1)
-			#	new_data = data.filter(['unique_id', 'XXXX'], axis=1) ## TODO
-			#	new_data = new_data.set_index('unique_id')			  ## TODO
-			#	new_data = new_data.rename(columns={'XXXX': sample})  ## TODO
-				
-		else:
-			print()
-			## add new
+		## get counts for this sample
+		(sample, new_data, seq_data) = sample_data
+		sample_counts.append(new_data)
 		
-		## sequence information
-		seq_data = data.filter(['UID', 'Read'], axis=1)	
-		seq_data = seq_data.set_index('UID')
-		seq_all_data = seq_all_data.append(seq_data, sort=True).drop_duplicates('Read')
+		## sequence information: keep first sequence for each new UID
+		for uid, seq in zip(seq_data['UID'].values, seq_data['Read'].values):
+			if uid not in seq_dict:
+				seq_dict[uid] = seq
 
 		## debugging messages
 		if Debug:
 			print ("*** DEBUG: data for sample ***")
 			print (new_data)
 		
-		all_data = pd.concat([all_data, new_data], axis=1, sort=True)
-
+	## merge all samples at once
+	if sample_counts:
+		all_data = pd.concat(sample_counts, axis=1, join='outer', sort=True)
+	else:
+		all_data = pd.DataFrame()
+	
+	## sequences: discard duplicated sequences as before
+	seq_all_data = pd.DataFrame({'Read': pd.Series(seq_dict, dtype=object)})
+	seq_all_data.index.name = 'UID'
+	seq_all_data = seq_all_data.drop_duplicates('Read').sort_index()
+	
 	##
 	## debugging messages
 	if Debug:
@@ -243,6 +265,473 @@ def generate_matrix(dict_files, soft_name, Debug, type_analysis="miRNA"):
 	
 	return (all_data, seq_all_data)	
 
+####################
+def read_sample(this_file, sample, usecols=None):
+	"""Returns the results of the sample as a dataframe or None if not available.
+	
+		:param this_file: results file of the sample
+		:param sample: sample name
+		:param usecols: columns to read. Default: all columns. See sample_columns().
+	"""
+	print ('+ Reading information from sample: ', sample)	
+	
+	## 
+	if functions.files_functions.is_non_zero_file(this_file):
+		data = table_loader.read_table(this_file, usecols=usecols)
+	else:
+		print ('\t - Information not available for sample: ', sample)	
+		return (None)
+	##
+	if (data.size == 0):
+		print ('\t - Information not available for sample: ', sample)  
+		return (None)
+	
+	return (data)
+
+####################
+def stream_matrix(dict_files, soft_name, outfile, out_format, memory_budget, Debug, type_analysis="miRNA", threads=1, rollup=None):
+	"""Generates the sparse count matrices for all samples provided with bounded memory.
+	
+		Samples are read in batches up to a quarter of the memory budget. The counts of 
+		each batch (partial) are saved in a temporary folder. Once all samples are read, 
+		partials are merged into the final matrices (see merge_partials). Only a batch 
+		of samples is in memory at once, plus the ids and sequences of all features.
+		
+		:param dict_files: dictionary with the results file for each sample
+		:param soft_name: software used to generate the results (lowercase)
+		:param outfile: path and name for the matrices
+		:param out_format: format for the matrices: mtx, parquet or hdf5
+		:param memory_budget: memory (GB) available to read samples
+		:param Debug: display complete log
+		:param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+		:param threads: number of processes to read samples
+		:param rollup: list of levels to roll up the final matrix
+		
+		:returns: True/False
+	"""
+	tmp_folder = outfile + '_partials'
+	shutil.rmtree(tmp_folder, ignore_errors=True)
+	os.makedirs(tmp_folder)
+	
+	## sorting and merging a batch require copies of the data
+	batch_limit = memory_budget * 1024**3 / 4
+	
+	partials = []
+	batch = []
+	batch_memory = 0
+	for sample_data in table_loader.parallel_map(read_sample_counts, sample_args(dict_files, soft_name, type_analysis, Debug), threads):
+		if sample_data is None:
+			continue
+		
+		batch.append(sample_data)
+		batch_memory += sample_data[1].memory_usage(deep=True) + sample_data[2].memory_usage(deep=True).sum()
+		
+		if batch_memory > batch_limit:
+			partials.append(os.path.join(tmp_folder, 'partial_%s' %len(partials)))
+			save_partial(partials[-1], *batch2partial(batch), Debug=Debug)
+			batch = []
+			batch_memory = 0
+	
+	if batch:
+		partials.append(os.path.join(tmp_folder, 'partial_%s' %len(partials)))
+		save_partial(partials[-1], *batch2partial(batch), Debug=Debug)
+		batch = []
+	
+	merge_partials(partials, outfile, out_format, Debug, type_analysis=type_analysis, rollup=rollup)
+	shutil.rmtree(tmp_folder)
+	return (True)
+
+####################
+def incremental_matrix(dict_files, soft_name, outfile, out_format, Debug, type_analysis="miRNA", threads=1, shard_size=100, rollup=None):
+	"""Updates the sparse count matrices reading only new or changed samples.
+	
+		Counts of all samples are kept in a store (outfile_store) split into shards of 
+		samples. A manifest records the results file (SHA256) of each sample and its shard. 
+		Only samples new or with a different results file are read, and only the shards 
+		containing them are rewritten. Samples not provided anymore are removed. Matrices 
+		are merged from the shards (see merge_partials) only if any shard changed or they 
+		are not available in the format requested.
+		
+		:param dict_files: dictionary with the results file for each sample
+		:param soft_name: software used to generate the results (lowercase)
+		:param outfile: path and name for the matrices
+		:param out_format: format for the matrices: mtx, parquet or hdf5
+		:param Debug: display complete log
+		:param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+		:param threads: number of processes to read samples
+		:param shard_size: maximum number of samples for each shard
+		:param rollup: list of levels to roll up the final matrix
+		
+		:returns: True/False
+	"""
+	store_folder = outfile + '_store'
+	manifest_file = os.path.join(store_folder, 'manifest.json')
+	manifest = read_manifest(manifest_file, soft_name, type_analysis)
+	
+	## samples to read: new or changed
+	to_read = {}
+	for sample, this_file in dict_files.items():
+		if not os.path.isfile(this_file):
+			continue
+		sha256 = step_cache.file_hash(this_file)
+		info = manifest['samples'].get(sample)
+		if not info or info['sha256'] != sha256:
+			to_read[sample] = (this_file, sha256)
+	
+	## shards to update: remove samples changed or not available
+	affected = {}
+	for sample, info in manifest['samples'].items():
+		if sample in to_read or sample not in dict_files or not os.path.isfile(dict_files[sample]):
+			affected.setdefault(info['shard'], { 'remove': [], 'add': [] })['remove'].append(sample)
+	
+	## changed samples are kept in their shard, new samples fill the last shard
+	shard_samples = {}
+	for sample, info in manifest['samples'].items():
+		shard_samples.setdefault(info['shard'], []).append(sample)
+	for shard in affected:
+		shard_samples[shard] = [ s for s in shard_samples[shard] if s not in affected[shard]['remove'] ]
+	for sample in to_read:
+		shard = manifest['samples'][sample]['shard'] if sample in manifest['samples'] else None
+		if shard is None:
+			shard = max(shard_samples) if shard_samples else 0
+			if len(shard_samples.get(shard, [])) >= shard_size:
+				shard += 1
+		shard_samples.setdefault(shard, []).append(sample)
+		affected.setdefault(shard, { 'remove': [], 'add': [] })['add'].append(sample)
+	
+	print ('+ Store %s: %s samples, %s to update (%s shards)' %(os.path.basename(store_folder), len(manifest['samples']), len(to_read), len(affected)))
+	
+	## update shards
+	os.makedirs(store_folder, exist_ok=True)
+	for shard in sorted(affected):
+		partial = os.path.join(store_folder, 'shard_%s' %shard)
+		if os.path.isfile(partial + '.pkl'):
+			(samples, counts, seqs) = read_partial(partial)
+		else:
+			(samples, counts, seqs) = ([], None, None)
+		
+		## remove samples, then add samples read
+		for sample in affected[shard]['remove']:
+			del manifest['samples'][sample]
+		samples = [ s for s in samples if s not in affected[shard]['remove'] ]
+		batch = []
+		shard_files = dict([ (sample, to_read[sample][0]) for sample in affected[shard]['add'] ])
+		for sample_data in table_loader.parallel_map(read_sample_counts, sample_args(shard_files, soft_name, type_analysis, Debug), threads):
+			if sample_data is None:
+				continue
+			batch.append(sample_data)
+			(this_file, sha256) = to_read[sample_data[0]]
+			manifest['samples'][sample_data[0]] = { 'file': os.path.abspath(this_file), 'sha256': sha256, 'shard': shard }
+		
+		(new_samples, new_counts, new_seqs) = batch2partial(batch)
+		if counts is not None:
+			new_counts = pd.concat([ counts[ counts['sample'].isin(samples) ], new_counts ])
+			new_seqs = pd.concat([ seqs[ seqs['sample'].isin(samples) ], new_seqs ])
+		
+		if samples or new_samples:
+			save_partial(partial, samples + new_samples, new_counts, new_seqs, Debug=Debug)
+		else:
+			for f in (partial + '.pkl', partial + '.ids.pkl'):
+				if os.path.isfile(f):
+					os.remove(f)
+	
+	## merge matrices if changed or not available
+	outputs = list(expression_matrix.matrix_files(outfile, out_format).values()) + expression_rollup.rollup_files(outfile, rollup, out_format)
+	if affected or manifest.get('format') != out_format or not all(os.path.isfile(f) for f in outputs):
+		shards = sorted(set([ info['shard'] for info in manifest['samples'].values() ]))
+		merge_partials([ os.path.join(store_folder, 'shard_%s' %shard) for shard in shards ], outfile, out_format, Debug, type_analysis=type_analysis, rollup=rollup)
+	else:
+		print ('+ Matrices are up to date...')
+	
+	## save manifest
+	manifest['format'] = out_format
+	with open(manifest_file + '.tmp', 'w') as fh:
+		json.dump(manifest, fh, indent=2)
+	os.replace(manifest_file + '.tmp', manifest_file)
+	return (True)
+
+####################
+def read_manifest(manifest_file, soft_name, type_analysis):
+	"""Returns the manifest of the store or a new one if not available or not matching."""
+	manifest = { 'soft': soft_name, 'type': type_analysis, 'format': None, 'samples': {} }
+	if os.path.isfile(manifest_file):
+		with open(manifest_file) as fh:
+			stored = json.load(fh)
+		if stored.get('soft') == soft_name and stored.get('type') == type_analysis:
+			manifest = stored
+		else:
+			print (colored("** WARNING: Store %s does not match. Creating a new store..." %manifest_file, 'yellow'))
+	return (manifest)
+
+####################
+def read_sample_counts(this_file, sample, soft_name, type_analysis, Debug):
+	"""Returns the sample name, counts (series) and sequences (dataframe) or None if not available."""
+	data = read_sample(this_file, sample, usecols=sample_columns(sample, soft_name, type_analysis))
+	if data is None:
+		return (None)
+	new_data = get_sample_counts(data, sample, soft_name, type_analysis, Debug)
+	if new_data is None:
+		print ('\t - Information not available for sample: ', sample)  
+		return (None)
+	
+	## sequence information
+	if 'Read' in data.columns:
+		seq_data = data.filter(['UID', 'Read'], axis=1).drop_duplicates('UID')
+	else:
+		seq_data = pd.DataFrame(columns=['UID', 'Read'])
+	
+	return ((sample, new_data, seq_data))
+
+####################
+def sample_args(dict_files, soft_name, type_analysis, Debug):
+	"""Returns the arguments of read_sample_counts() for each sample."""
+	return ([ (this_file, sample, soft_name, type_analysis, Debug) for sample, this_file in dict_files.items() ])
+
+####################
+def sample_columns(sample, soft_name, type_analysis):
+	"""Returns a function to select the columns required for the sample, software and analysis. See get_sample_counts()."""
+	if type_analysis == "miRNA":
+		columns = ['UID', 'Read', 'miRNA', 'Variant', 'sRNAbench', sample]
+	elif type_analysis == "piRNA":
+		columns = ['UID', 'Read', 'piRNA', 'variant', 'expression']
+	else:
+		columns = ['UID', 'Read', 'tRNA', 'variant', 'expression']
+	
+	## OptimiR column contains sample name and other tags
+	regex = re.compile(sample + '.*') if soft_name == 'optimir' else None
+	return (lambda col: col in columns or bool(regex and regex.match(col)))
+
+####################
+def batch2partial(batch):
+	"""Returns the samples, counts and sequences of a batch of samples.
+	
+		:param batch: list of sample name, counts (series) and sequences (dataframe)
+		
+		:returns: list of samples, dataframe with columns ID, sample and count, and dataframe with columns UID, Read and sample
+	"""
+	samples = [ sample for (sample, data, seqs) in batch ]
+	counts = pd.DataFrame({ 'ID': np.concatenate([ data.index.to_numpy(dtype=object) for (sample, data, seqs) in batch ] or [[]]).astype(object),
+							'sample': np.concatenate([ np.full(len(data), sample, dtype=object) for (sample, data, seqs) in batch ] or [[]]).astype(object),
+							'count': np.concatenate([ data.to_numpy(dtype=np.float64) for (sample, data, seqs) in batch ] or [[]]).astype(np.float64) })
+	seqs = pd.concat([ seqs.assign(sample=sample) for (sample, data, seqs) in batch ] or [ pd.DataFrame(columns=['UID', 'Read', 'sample']) ])
+	return (samples, counts, seqs)
+
+####################
+def save_partial(partial, samples, counts, seqs, Debug=False):
+	"""Saves the counts and sequences of a group of samples (partial). See merge_partials().
+	
+		Partials are saved as partial.pkl (samples, counts and sequences) and 
+		partial.ids.pkl (samples and ids of all features).
+		
+		:param partial: path and name of the partial matrix
+		:param samples: list of samples
+		:param counts: dataframe with columns ID, sample (name) and count
+		:param seqs: dataframe with columns UID, Read and sample (name)
+		:param Debug: display complete log
+	"""
+	## ids of all features: zero counts are kept, as features are reported even if zero
+	ids = np.unique(counts['ID'].to_numpy(dtype=object))
+	counts = counts.assign(count=counts['count'].fillna(0), sample=pd.Categorical(counts['sample'], categories=samples))
+	seqs = seqs.assign(sample=pd.Categorical(seqs['sample'], categories=samples))
+	
+	for (f, content) in ((partial + '.pkl', (samples, counts, seqs)), (partial + '.ids.pkl', (samples, ids))):
+		pd.to_pickle(content, f + '.tmp')
+		os.replace(f + '.tmp', f)
+	
+	if Debug:
+		print ("*** DEBUG: partial matrix %s: %s samples, %s values ***" %(partial, len(samples), len(counts)))
+
+####################
+def read_partial(partial):
+	"""Returns samples, counts and sequences of the partial. See save_partial()."""
+	return (pd.read_pickle(partial + '.pkl'))
+
+####################
+def merge_partials(partials, outfile, out_format, Debug, type_analysis="miRNA", rollup=None):
+	"""Generates the sparse count matrices by merging partial matrices.
+	
+		Ids of all partials are merged, duplicated UIDs are detected and each partial 
+		is appended to the final matrices (see expression_matrix.open_writer). Generates 
+		the same matrices as generate_DE: outfile, outfile_dup, outfile_dup_summary and outfile_seq.
+		Roll-ups are summed as each partial is appended (see expression_rollup).
+		
+		:param partials: list of partial matrices. See save_partial().
+		:param outfile: path and name for the matrices
+		:param out_format: format for the matrices: mtx, parquet or hdf5
+		:param Debug: display complete log
+		:param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+		:param rollup: list of levels to roll up the final matrix
+	"""
+	## samples and ids of all features, sorted
+	samples = []
+	offsets = []
+	ids = np.array([], dtype=object)
+	for partial in partials:
+		(partial_samples, partial_ids) = pd.read_pickle(partial + '.ids.pkl')
+		offsets.append(len(samples))
+		samples.extend(partial_samples)
+		ids = np.union1d(ids, partial_ids)
+	
+	print ('+ Merging %s samples from %s partial matrices...' %(len(samples), len(partials)))
+	
+	## discard duplicate UIDs: several ids for the same UID
+	(levels, duplicated) = duplicated_UID(ids, type_analysis)
+	clean_map = np.full(len(ids), -1, dtype=np.int64)
+	clean_map[~duplicated] = np.arange((~duplicated).sum())
+	dup_map = np.full(len(ids), -1, dtype=np.int64)
+	dup_map[duplicated] = np.arange(duplicated.sum())
+	
+	## append each partial: samples are in order
+	writers = [ (expression_matrix.open_writer(outfile, out_format), clean_map), 
+				(expression_matrix.open_writer(outfile + '_dup', out_format), dup_map) ]
+	seq_dict = {}
+	totals = np.zeros(len(ids))
+	
+	## groups of the levels to roll up
+	if rollup:
+		(indicator, groups) = expression_rollup.group_matrix(levels[~duplicated], rollup)
+		rollup_counts = None
+	
+	for (partial, offset) in zip(partials, offsets):
+		(partial_samples, counts, seqs) = read_partial(partial)
+		position = np.searchsorted(ids, counts['ID'].to_numpy(dtype=object))
+		sample = offset + counts['sample'].cat.codes.to_numpy().astype(np.int64)
+		totals += np.bincount(position, weights=counts['count'].to_numpy(), minlength=len(ids))
+		for (writer, id_map) in writers:
+			feature = id_map[position]
+			keep = (feature >= 0) & (counts['count'].to_numpy() != 0)
+			coo = pd.DataFrame({ 'feature': feature[keep], 'sample': sample[keep], 
+								 'count': counts['count'].to_numpy()[keep] }).sort_values(['sample', 'feature'])
+			expression_matrix.append_values(writer, coo)
+			
+			if rollup and id_map is clean_map:
+				partial_rollup = expression_rollup.rollup_coo(indicator, coo, len(samples))
+				rollup_counts = partial_rollup if rollup_counts is None else rollup_counts + partial_rollup
+		
+		## keep first sequence for each new UID
+		for uid, seq in zip(seqs['UID'].values, seqs['Read'].values):
+			if uid not in seq_dict:
+				seq_dict[uid] = seq
+		del counts, seqs
+	
+	expression_matrix.close_writer(writers[0][0], expression_matrix.feature_info(ids[~duplicated], type_analysis), samples)
+	expression_matrix.close_writer(writers[1][0], expression_matrix.feature_info(ids[duplicated], type_analysis), samples)
+	expression_matrix.write_table(summary_UID_duplicated(levels[duplicated], totals[duplicated], type_analysis), outfile + '_dup_summary', out_format)
+	if rollup:
+		if rollup_counts is None:
+			rollup_counts = expression_rollup.rollup_coo(indicator, pd.DataFrame({ 'feature': [], 'sample': [], 'count': [] }, dtype=np.int64), len(samples))
+		expression_rollup.write_rollups(rollup_counts, groups, samples, outfile, out_format)
+	
+	## sequences: discard duplicated sequences as generate_matrix
+	seq_all_data = pd.DataFrame({'Read': pd.Series(seq_dict, dtype=object)})
+	seq_all_data.index.name = 'UID'
+	seq_all_data = seq_all_data.drop_duplicates('Read').sort_index()
+	expression_matrix.write_table(seq_all_data, outfile + '_seq', out_format)
+	
+	## debugging messages
+	if Debug:
+		print ("*** DEBUG: features and samples ***")
+		print ("%s features (%s duplicated UIDs); %s samples" %(len(ids), duplicated.sum(), len(samples)))
+
+####################
+def unique_id(data, name_col, variant_col):
+	"""Returns the unique index id (name&variant&UID) for each row of the dataframe provided."""
+	return (data[name_col].astype(str) + '&' + data[variant_col].astype(object).fillna('NA').astype(str) + '&' + data['UID'].astype(str))
+
+####################
+def get_sample_counts(data, sample, soft_name, type_analysis, Debug):
+	"""Returns the counts of the sample as a series indexed by the unique index id.
+	
+		:param data: dataframe with the results of the sample
+		:param sample: sample name
+		:param soft_name: software used to generate the results (lowercase)
+		:param type_analysis: miRNA, tRF-amb, tRF-exc, tRNA or piRNA
+		:param Debug: display complete log
+		
+		:returns: pandas series named as the sample or None if not available
+	"""
+	new_data = None
+	
+	####
+	if type_analysis=="miRNA":
+		
+		## ------------------------------------------ ##
+		## Create matrix for miRNA results
+		## ------------------------------------------ ##
+		
+		## get info, generate unique name and merge for samples
+		## header of tsv files: 
+		## UID	Read	miRNA	Variant	iso_5p	iso_3p	iso_add3p	iso_snp	sRNAbench
+		index = unique_id(data, 'miRNA', 'Variant')
+		
+		## parse according to software
+		if (soft_name == 'srnabench'):
+			## sRNAbench mirtop creates a column id with sRNAbench instead of sample name
+			count_col = 'sRNAbench'
+
+		elif (soft_name == 'optimir'):
+			## OptimiR mirtop creates a column containing sample name and other tags (trim, joined, fastq...)
+			regex=re.compile(sample + '.*')
+			search_list = list(filter(regex.match, data.columns.values.tolist()))
+			count_col = search_list[0] if search_list else None
+	
+		elif (soft_name == 'miraligner' or soft_name == 'native'):
+			## miraligner mirtop creates a column containing sample name and other tags (trim, joined, fastq...)
+			count_col = sample
+
+		else:
+			count_col = None
+		
+	####
+	elif "tRF" in type_analysis or type_analysis == "tRNA": ## tRF-amb; tRF-exc, tRF
+
+		if Debug:
+			HCGB_aes.debug_message(type_analysis + " analysis: ", "yellow")
+
+		## ------------------------------------------ ##
+		## Create matrix for tRNA results
+		## ------------------------------------------ ##
+		## UID	Read	tRNA	variant	ident	expression	soft\n'
+		count_col = None
+		
+		## parse according to software
+		if (soft_name == 'mintmap'):
+			index = unique_id(data, 'tRNA', 'variant')
+			count_col = 'expression'
+		
+		## TODO: other software
+			
+	####
+	elif type_analysis == "piRNA":
+		
+		## ------------------------------------------ ##
+		## Create matrix for piRNA results
+		## ------------------------------------------ ##
+		## UID	Read	piRNA	variant	ident	expression	soft\n'
+		count_col = None
+		if all(col in data.columns for col in ('UID', 'piRNA', 'expression')):
+			if 'variant' not in data.columns:
+				data['variant'] = 'NA'
+			index = unique_id(data, 'piRNA', 'variant')
+			count_col = 'expression'
+	
+	else:
+		count_col = None
+		## add new
+	
+	if count_col not in data.columns:
+		return (None)
+	
+	new_data = pd.Series(data[count_col].values, index=index.values, name=sample)
+	new_data.index.name = 'unique_id'
+	
+	## same id several times: sum counts
+	if not new_data.index.is_unique:
+		new_data = new_data.groupby(level=0, sort=False).sum()
+		new_data.name = sample
+	
+	return (new_data)
+
 ######
 
 ######
@@ -263,13 +752,14 @@ def main():
     (all_data, all_seqs) = generate_matrix(dictionary_info, "miraligner", False)
 
     ## discard duplicate UIDs if any
-    all_data_filtered, all_data_duplicated = discard_UID_duplicated(all_data)
+    all_data_filtered, all_data_duplicated, summary_duplicated = discard_UID_duplicated(all_data)
 
     ## dump data in folder provided
     outfolder = "./"
     csv_outfile = os.path.join(outfolder, 'miRNA_expression')
     all_data_filtered.to_csv(csv_outfile + ".csv", quoting=csv.QUOTE_NONNUMERIC)
     all_data_duplicated.to_csv(csv_outfile + '_dup.csv', quoting=csv.QUOTE_NONNUMERIC)
+    summary_duplicated.to_csv(csv_outfile + '_dup_summary.csv', quoting=csv.QUOTE_NONNUMERIC)
     all_seqs.to_csv(csv_outfile + '_seq.csv', quoting=csv.QUOTE_NONNUMERIC)
 
 
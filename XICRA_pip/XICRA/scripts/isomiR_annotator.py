@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Native isomiR annotator to create miRNA profile.
+
+An index of all isomiRs allowed for each mature miRNA is created from the hairpin
+sequences and the miRBase GFF3 annotation, using the same limits as miraligner
+(-sub 1 -add 3 -trim 3):
+
+- templated variants: up to 3 nucleotides shifted at the 5' and 3' ends
+- non-templated additions: up to 3 nucleotides added at the 3' end
+- one nucleotide substitution
+
+Each unique sequence of the sample (see collapse_reads) is annotated by lookup in
+the index. Every sequence differing by one substitution from a templated variant
+is precomputed when the index is created, so substitutions are also annotated by
+a direct lookup, without comparing the sequence against candidates. Results are written in miraligner (seqbuster) format, so they are
+standardized using miRTop as for miraligner.
+
+The index is created only once per execution and shared by all samples.
+'''
+## useful imports
+import os
+import itertools
+import threading
+import numpy as np
+from termcolor import colored
+
+## import my modules
+from XICRA.scripts import step_cache, collapse_reads
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## limits: as miraligner -sub 1 -add 3 -trim 3
+max_trim = 3
+max_add = 3
+min_length = 16
+
+## sequences packed as integers: 2 bits per nucleotide and a leading bit for the length
+nt_code = { 'A': 0, 'C': 1, 'G': 2, 'T': 3 }
+nt_digits = str.maketrans('ACGT', '0123')
+max_packed = 31
+
+## unique sequences annotated at once
+batch_size = 100000
+
+## indexes already created
+_indexes = {}
+_lock = threading.Lock()
+
+###############
+def isomiR_annotator_caller(reads, sample_folder, name, threads, miRNA_gff, hairpinFasta, species, Debug):
+    """Passes the sample information to be analyzed by isomiR_annotator().
+
+    Checks if the computation has been performed before. If not, it calls
+    isomiR_annotator().
+
+    :param reads: file with sample reads
+    :param sample_folder: output folder
+    :param name: sample name
+    :param threads: selected threads (by defoult 2)
+    :param miRNA_gff: miRNA gff3 annotation file
+    :param hairpinFasta: hairpin fasta file
+    :param species: species tag ID. Default: hsa (Homo sapiens)
+    :param Debug: display complete log.
+
+    :returns: True/False
+    """
+    # check if previously generated and succeeded with same reads and annotation
+    (cached, step_info) = step_cache.check_step(sample_folder, 'native', name, reads + [hairpinFasta, miRNA_gff],
+                                                "-sub 1 -add %s -trim %s -s %s" %(max_add, max_trim, species), Debug=Debug, by_name=True)
+    if not cached:
+        code_returned = isomiR_annotator(reads, sample_folder, name, miRNA_gff, hairpinFasta, species, Debug)
+        if code_returned:
+            step_cache.save_step(step_info, [code_returned])
+        else:
+            print ('** Sample %s failed...' %name)
+            return(False)
+
+    return(True)
+
+###############
+def isomiR_annotator(reads, outpath, file_name, miRNA_gff, hairpinFasta, species, Debug):
+    """Annotates the unique sequences of the sample using the isomiR index.
+
+    :param reads: file with sample reads
+    :param outpath: output folder
+    :param file_name: sample name
+    :param miRNA_gff: miRNA gff3 annotation file
+    :param hairpinFasta: hairpin fasta file
+    :param species: species tag ID. Default: hsa (Homo sapiens)
+    :param Debug: display complete log.
+
+    :returns: File with the results in miraligner format or False if failed.
+    """
+    if (len(reads) > 1):
+        print (colored("** ERROR: Only 1 fastq file is allowed please joined reads before...", 'red'))
+        exit()
+
+    collapsed_file = collapse_reads.get_collapsed(reads, file_name, Debug, folder=outpath)
+    if not collapsed_file:
+        return (False)
+
+    index = get_index(hairpinFasta, miRNA_gff, species, Debug)
+    if not index['variants']:
+        print (colored("** ERROR: No miRNA available for species %s in %s" %(species, miRNA_gff), 'red'))
+        return (False)
+
+    ## name of the file is used by miRTop as sample name
+    mirna_file = os.path.join(outpath, file_name + '.mirna')
+    reads_annotated = 0
+    reads_total = 0
+    with open(mirna_file + '.tmp', 'w') as out_fh:
+        out_fh.write('seq\tname\tfreq\tmir\tstart\tend\tmism\tadd\tt5\tt3\ts5\ts3\tDB\tprecursor\tambiguity\n')
+        ## sequences are annotated in batches: substitutions are searched at once
+        rank = 0
+        unique_seqs = collapse_reads.read_collapsed(collapsed_file)
+        for batch in iter(lambda: list(itertools.islice(unique_seqs, batch_size)), []):
+            batch = [ (seq.decode(), count) for (seq, count) in batch ]
+            hits_batch = annotate_batch([ seq for (seq, count) in batch ], index)
+            for ((seq, count), hits) in zip(batch, hits_batch):
+                rank += 1
+                reads_total += count
+                if not hits:
+                    continue
+
+                reads_annotated += count
+                read_name = 'seq_%s_x%s' %(rank, count)
+                for hit in hits:
+                    out_fh.write(format_hit(seq, read_name, count, hit, index, len(hits)) + '\n')
+
+    os.replace(mirna_file + '.tmp', mirna_file)
+    print ("\t+ Sample %s: %s reads annotated out of %s" %(file_name, reads_annotated, reads_total))
+    return (mirna_file)
+
+###############
+def get_index(hairpinFasta, miRNA_gff, species, Debug):
+    """Returns the isomiR index for the annotation provided. It is only created once per execution."""
+    key = (os.path.abspath(hairpinFasta), os.path.abspath(miRNA_gff), species)
+    with _lock:
+        if key not in _indexes:
+            print ("+ Creating isomiR index for species %s..." %species)
+            _indexes[key] = create_index(read_hairpins(hairpinFasta, species), read_matures(miRNA_gff), Debug)
+        return (_indexes[key])
+
+###############
+def read_hairpins(hairpinFasta, species):
+    """Returns a dictionary with the DNA sequence of each hairpin of the species provided."""
+    hairpins = {}
+    hairpin_name = ""
+    with open(hairpinFasta) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                hairpin_name = line[1:].split()[0]
+                if hairpin_name.startswith(species + '-'):
+                    hairpins[hairpin_name] = []
+                else:
+                    hairpin_name = ""
+            elif hairpin_name:
+                hairpins[hairpin_name].append(line.upper().replace('U', 'T'))
+
+    return ({ h: "".join(seq) for h, seq in hairpins.items() })
+
+###############
+def read_matures(miRNA_gff):
+    """Returns the mature miRNAs of each precursor and their position (0-based, end excluded) in the precursor.
+
+    :param miRNA_gff: miRBase gff3 annotation file.
+
+    :returns: dictionary: precursor name -> list of (mature name, start, end)
+    """
+    precursors = {}
+    matures = []
+    with open(miRNA_gff) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) < 9:
+                continue
+            attributes = dict([ attr.split('=', 1) for attr in cols[8].split(';') if '=' in attr ])
+            if cols[2] == 'miRNA_primary_transcript':
+                precursors[attributes['ID']] = (attributes['Name'], int(cols[3]), int(cols[4]), cols[6])
+            elif cols[2] == 'miRNA':
+                matures.append((attributes['Name'], attributes['Derives_from'], int(cols[3]), int(cols[4])))
+
+    mature_dict = {}
+    for (mature, derives_from, start, end) in matures:
+        if derives_from not in precursors:
+            continue
+        (precursor, prec_start, prec_end, strand) = precursors[derives_from]
+        if strand == '-':
+            position = (mature, prec_end - end, prec_end - start + 1)
+        else:
+            position = (mature, start - prec_start, end - prec_start + 1)
+        ## precursors at several loci: keep one copy
+        if position not in mature_dict.setdefault(precursor, []):
+            mature_dict[precursor].append(position)
+
+    return (mature_dict)
+
+###############
+def create_index(hairpins, mature_dict, Debug):
+    """Creates the index of templated isomiRs.
+
+    Each variant is identified by the precursor, the mature miRNA and its position
+    in the precursor. Variants are indexed by their exact sequence. Sequences with
+    one substitution of each variant are stored packed as integers in a sorted array
+    (see pack()), along with the variant and position of the substitution: ~130 Mb for
+    the ~8 million sequences of human miRNAs, instead of ~1 Gb as a Python dictionary.
+
+    :returns: dictionary with variants, exact and substitution indexes.
+    """
+    index = { 'hairpins': hairpins, 'variants': [], 'exact': {}, 'mismatch_long': {} }
+    packed = []
+    for precursor, positions in mature_dict.items():
+        if precursor not in hairpins:
+            continue
+        hairpin = hairpins[precursor]
+        for (mature, start, end) in positions:
+            for shift5 in range(-max_trim, max_trim + 1):
+                for shift3 in range(-max_trim, max_trim + 1):
+                    (var_start, var_end) = (start + shift5, end + shift3)
+                    if var_start < 0 or var_end > len(hairpin) or var_end - var_start < min_length:
+                        continue
+
+                    variant_id = len(index['variants'])
+                    index['variants'].append((precursor, mature, start, end, var_start, var_end))
+                    var_seq = hairpin[var_start:var_end]
+                    index['exact'].setdefault(var_seq, []).append(variant_id)
+
+                    key = pack(var_seq)
+                    if key is not None:
+                        packed.append((key, len(var_seq), variant_id))
+                        continue
+                    ## too long to be packed or unknown nucleotides
+                    for position, nt in enumerate(var_seq):
+                        for nt_sub in nt_code:
+                            if nt_sub != nt:
+                                seq_sub = var_seq[:position] + nt_sub + var_seq[position+1:]
+                                index['mismatch_long'].setdefault(seq_sub, []).append((variant_id, position))
+
+    ## every substitution of each variant: flip the 2 bits of the position
+    keys = np.array([ p[0] for p in packed ], dtype=np.uint64)
+    lengths = np.array([ p[1] for p in packed ], dtype=np.int64)
+    variant_ids = np.array([ p[2] for p in packed ], dtype=np.int64)
+    keys_sub = [ np.zeros(0, dtype=np.uint64) ]
+    codes_sub = [ np.zeros(0, dtype=np.int64) ]
+    for position in range(int(lengths.max()) if len(packed) else 0):
+        mask = lengths > position
+        shift = (2 * (lengths[mask] - 1 - position)).astype(np.uint64)
+        for change in (1, 2, 3):
+            keys_sub.append(keys[mask] ^ (np.uint64(change) << shift))
+            codes_sub.append(variant_ids[mask] * 64 + position)
+
+    keys_sub = np.concatenate(keys_sub)
+    order = np.argsort(keys_sub, kind='stable')
+    index['mismatch_keys'] = keys_sub[order]
+    index['mismatch_codes'] = np.concatenate(codes_sub)[order]
+
+    if Debug:
+        HCGB_aes.debug_message("isomiR index: %s variants; %s sequences; %s sequences with one substitution" %(
+            len(index['variants']), len(index['exact']), len(index['mismatch_keys']) + len(index['mismatch_long'])), "yellow")
+
+    return (index)
+
+###############
+def pack(seq):
+    """Returns the sequence packed as an integer or None if it contains other than A, C, G, T or is too long."""
+    if len(seq) > max_packed:
+        return (None)
+    try:
+        return (int('1' + seq.translate(nt_digits), 4))
+    except ValueError:
+        return (None)
+
+###############
+def annotate(seq, index):
+    """Returns the hits with less changes for the sequence provided (see annotate_batch()).
+
+    :returns: list of (variant_id, addition, substitution position)
+    """
+    return (annotate_batch([seq], index)[0])
+
+###############
+def annotate_batch(seqs, index):
+    """Returns the hits with less changes for each sequence provided.
+
+    Search order: exact templated variant, non-templated addition, one substitution
+    and one substitution with addition. Substitutions are searched at once for all
+    sequences without exact hits, in the sorted array of the index.
+
+    :returns: list of hits for each sequence: (variant_id, addition, substitution position)
+    """
+    hits_list = [ [] for seq in seqs ]
+
+    ## exact templated variants and additions
+    for i, seq in enumerate(seqs):
+        for add in range(0, min(max_add, len(seq) - min_length) + 1):
+            variants = index['exact'].get(seq[:len(seq) - add])
+            if variants:
+                hits_list[i] = filter_additions([ (v, seq[len(seq) - add:], None) for v in variants ], index)
+                if hits_list[i]:
+                    break
+
+    ## one substitution: packed sequence without the nucleotides added is a shift of the bits
+    keys = index['mismatch_keys']
+    pending = [ (i, pack(seqs[i])) for i, hits in enumerate(hits_list) if not hits ]
+    for add in range(0, max_add + 1):
+        batch = []
+        for (i, key) in pending:
+            if len(seqs[i]) - add < min_length:
+                continue
+            core = seqs[i][:len(seqs[i]) - add]
+            core_key = pack(core) if key is None else key >> (2 * add)
+            if core_key is None:
+                hits_list[i] = substitutions_unpacked(core, index)
+            else:
+                hits_list[i] = list(index['mismatch_long'].get(core, []))
+                batch.append((i, core_key))
+
+        ## lookup all sequences at once: only those found are retrieved
+        packed = np.array([ b[1] for b in batch ], dtype=np.uint64)
+        left = keys.searchsorted(packed, side='left')
+        matched = np.flatnonzero(keys[np.minimum(left, len(keys) - 1)] == packed) if len(keys) else []
+        right = keys.searchsorted(packed[matched], side='right')
+        for (j, end) in zip(matched, right):
+            i = batch[j][0]
+            codes = index['mismatch_codes'][left[j]:end]
+            hits_list[i] = sorted(hits_list[i] + [ (int(code) // 64, int(code) % 64) for code in codes ])
+
+        ## additions
+        for (i, key) in pending:
+            if hits_list[i]:
+                addition = seqs[i][len(seqs[i]) - add:] if add else ''
+                hits_list[i] = filter_additions([ (v, addition, position) for (v, position) in hits_list[i] ], index)
+        pending = [ (i, key) for (i, key) in pending if not hits_list[i] ]
+
+    return (hits_list)
+
+###############
+def filter_additions(hits, index):
+    """Discards hits with additions matching the precursor: non-templated, first nucleotide added differs from precursor."""
+    return ([ h for h in hits if not h[1] or not is_templated(h[0], h[1], index) ])
+
+###############
+def substitutions_unpacked(core, index):
+    """Returns the variants (variant_id, position) differing by one substitution, not available in the packed array.
+
+    :param core: Sequence.
+    :param index: isomiR index.
+    """
+    hits = list(index['mismatch_long'].get(core, []))
+
+    ## unknown nucleotide (e.g. N): it is the substitution
+    unknown = [ i for i, nt in enumerate(core) if nt not in nt_code ]
+    if len(unknown) == 1:
+        position = unknown[0]
+        hits.extend([ (v, position) for nt in nt_code for v in index['exact'].get(core[:position] + nt + core[position+1:], []) ])
+    return (sorted(hits))
+
+###############
+def variant_seq(variant_id, index):
+    """Returns the sequence of the templated variant."""
+    (precursor, mature, start, end, var_start, var_end) = index['variants'][variant_id]
+    return (index['hairpins'][precursor][var_start:var_end])
+
+###############
+def is_templated(variant_id, addition, index):
+    """Checks if the first nucleotide added matches the precursor."""
+    (precursor, mature, start, end, var_start, var_end) = index['variants'][variant_id]
+    hairpin = index['hairpins'][precursor]
+    return (var_end < len(hairpin) and hairpin[var_end] == addition[0])
+
+###############
+def format_hit(seq, read_name, count, hit, index, ambiguity):
+    """Returns the line for the hit in miraligner format.
+
+    Changes at the ends are shown as miraligner: nucleotides missing in lowercase
+    and nucleotides extra in uppercase.
+    """
+    (variant_id, addition, sub_position) = hit
+    (precursor, mature, start, end, var_start, var_end) = index['variants'][variant_id]
+    hairpin = index['hairpins'][precursor]
+
+    ## 5' and 3' changes
+    if var_start < start:
+        t5 = hairpin[var_start:start]
+    elif var_start > start:
+        t5 = hairpin[start:var_start].lower()
+    else:
+        t5 = '0'
+    if var_end > end:
+        t3 = hairpin[end:var_end]
+    elif var_end < end:
+        t3 = hairpin[var_end:end].lower()
+    else:
+        t3 = '0'
+
+    ## substitution: position in read, nucleotide in read and in precursor
+    mism = '0'
+    if sub_position is not None:
+        mism = '%s%s%s' %(sub_position + 1, seq[sub_position], hairpin[var_start + sub_position])
+
+    return ('\t'.join([ seq, read_name, str(count), mature, str(var_start + 1), str(var_start + len(seq)), mism,
+                        addition if addition else '0', t5, t3, hairpin[var_start:var_start+2], hairpin[var_end-2:var_end],
+                        'miRNA', precursor, str(ambiguity) ]))
@@ -20,6 +20,7 @@ from termcolor import colored
 from HCGB.functions import fasta_functions
 from HCGB import functions
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace, collapse_reads
 
 ###############       
 def miraligner_caller(reads, sample_folder, name, threads, database, species, Debug):
@@ -39,16 +40,15 @@ def miraligner_caller(reads, sample_folder, name, threads, database, species, De
 
     :returns: True/False
     """
-    # check if previously generated and succeeded
-    filename_stamp = sample_folder + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'miraligner'), 'yellow'))
-    else:
+    # check if previously generated and succeeded with same reads, database and parameters
+    (cached, step_info) = step_cache.check_step(sample_folder, 'miraligner', name, reads, 
+                                                "-db %s -sub 1 -add 3 -trim 3 -s %s" %(os.path.abspath(database), species), prog='miraligner', 
+                                                legacy_stamp=sample_folder + '/.success', Debug=Debug, by_name=True)
+    if not cached:
         # Call miralinger
         code_returned = miraligner(reads, sample_folder, name, database, species, Debug)
         if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info)
         else:
             print ('** Sample %s failed...' %name)
             return(False)
@@ -81,13 +81,17 @@ def miraligner (reads, outpath, file_name, database, species, Debug):
         print (colored("** ERROR: Only 1 fastq file is allowed please joined reads before...", 'red'))
         exit()
     
-    ## create tabular information of reads
+    ## create tabular information of reads: use collapsed reads of the sample
     tabular_info = os.path.join(outpath, file_name + '-tab.freq.txt')
-    fasta_functions.reads2tabular(reads[0], tabular_info)
+    collapsed_file = collapse_reads.get_collapsed(reads, file_name, Debug, folder=outpath)
+    if collapsed_file:
+        collapse_reads.write_tabular(collapsed_file, tabular_info)
+    else:
+        fasta_functions.reads2tabular(reads[0], tabular_info)
     
     ## create command 
     java_exe = set_config.get_exe('java', Debug=Debug)
     cmd = '%s -jar %s -db %s -sub 1 -add 3 -trim 3 -s %s -i %s -o %s 2> %s' %(
         java_exe, miraligner_exe, database, species, tabular_info, outpath_file, logfile)
     
-    return(functions.system_call_functions.system_call(cmd))
+    return(exec_trace.system_call(cmd, 'miraligner', file_name, inputs=[tabular_info], outputs=[outpath]))
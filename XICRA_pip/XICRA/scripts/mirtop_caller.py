@@ -5,25 +5,47 @@
 ##########################################################
 '''
 Calls mirtop to accommodate results
+
+By default, miRTop is executed using its python API in a pool of worker processes:
+hairpin and GFF annotation are loaded only once per worker and shared by all samples.
+GFF lines are parsed once and counts and export tables are written in a single pass,
+with the same columns as miRTop command line (only for the versions in api_versions).
+Set XICRA_MIRTOP_MODE=cli to execute miRTop command line instead. The command
+line is also used if the python API is not available or fails.
 '''
 ## useful imports
-import time
-import io
 import os
-import re
-import sys
-from sys import argv
-from io import open
+import copy
+import argparse
+import threading
+import concurrent.futures
 from termcolor import colored
 
 ## import my modules
 from HCGB import functions
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## settings
+mirtop_settings = { 'mode': os.environ.get('XICRA_MIRTOP_MODE', 'api') }
+
+## miRTop versions tested for the python API. Columns of counts and export tables
+## are generated here, so any other version uses the command line.
+api_versions = ('0.4.23',)
+
+## pools of workers for the python API: one per annotation
+_pools = {}
+_lock = threading.Lock()
+
+## annotation loaded in each worker
+_worker = {}
 
 ###############
 def miRTop_caller(results_folder, mirtop_folder, name, threads, miRNA_gff, hairpinFasta, format, species, Debug):
-    """Checks if the computation has already been performed. If not, it calls
-    miRTop()
+    """Creates miRTop folders and calls miRTop(). Each miRTop step is only 
+    executed if inputs, parameters or miRTop version changed.
+
     :param results_folder: file with the output of the sample from each software 
     :param folder: output miRTop folder
     :param name: sample name
@@ -36,25 +58,16 @@ def miRTop_caller(results_folder, mirtop_folder, name, threads, miRNA_gff, hairp
     :returns: True/False
     """
     # check if previously generated and succeeded
-    mirtop_folder_gff = functions.files_functions.create_subfolder('gff', mirtop_folder)
-    mirtop_folder_stats = functions.files_functions.create_subfolder('stats', mirtop_folder)
-    mirtop_folder_counts = functions.files_functions.create_subfolder('counts', mirtop_folder)
-    mirtop_folder_counts = functions.files_functions.create_subfolder('export', mirtop_folder)
-
-    filename_stamp = mirtop_folder_counts + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'miRTop'), 'yellow'))
-    else:
-        # Call miRTop
-        code_returned = miRTop(results_folder, mirtop_folder, name, threads, format.lower(), miRNA_gff, hairpinFasta, species, Debug)
-        if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
-        else:
-            print ('** Sample %s failed...' %name)
-            return(False)
+    for subfolder in ('gff', 'stats', 'counts', 'export'):
+        functions.files_functions.create_subfolder(subfolder, mirtop_folder)
+
+    # Call miRTop
+    code_returned = miRTop(results_folder, mirtop_folder, name, threads, format.lower(), miRNA_gff, hairpinFasta, species, Debug)
+    if not code_returned:
+        print ('** Sample %s failed...' %name)
+        return(False)
         
-        return(True)
+    return(True)
 
 ###############
 def miRTop(results_folder, sample_folder, name, threads, format, miRNA_gff, hairpinFasta, species,Debug):
@@ -80,7 +93,6 @@ def miRTop(results_folder, sample_folder, name, threads, format, miRNA_gff, hair
     
     ## folders
     mirtop_folder_gff = os.path.join(sample_folder, 'gff')
-    mirtop_folder_stats = os.path.join(sample_folder, 'stats')
     mirtop_folder_counts = os.path.join(sample_folder, 'counts')
     mirtop_folder_export = os.path.join(sample_folder, 'export')
     
@@ -115,26 +127,32 @@ def miRTop(results_folder, sample_folder, name, threads, format, miRNA_gff, hair
             return (False)
     
         
+    ## miRTop python API
+    if mirtop_settings['mode'] == 'api':
+        outdir_tsv = miRTop_api(results_folder, sample_folder, name, threads, format, miRNA_gff, hairpinFasta, species, Debug)
+        if outdir_tsv:
+            return (outdir_tsv)
+        print (colored("\t** miRTop python API failed for sample %s: using command line" %name, 'yellow'))
+    
     ## miRTop analysis gff
-    filename_stamp_gff = mirtop_folder_gff + '/.success'
-    if os.path.isfile(filename_stamp_gff):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp_gff)
-        print (colored("\tA previous command generated results on: %s [%s -- %s - gff]" %(stamp, name, 'miRTop'), 'yellow'))
-    else:
+    mirtop_folder_gff_file = os.path.join(mirtop_folder_gff, 'mirtop.gff')
+    (cached, step_info) = step_cache.check_step(mirtop_folder_gff, 'miRTop_gff', name, [results_folder, hairpinFasta, miRNA_gff], 
+                                                "--sps %s --format %s" %(species, format), prog='miRTop',
+                                                legacy_stamp=mirtop_folder_gff + '/.success', Debug=Debug, by_name=True)
+    if not cached:
         print ('Creating isomiRs gtf file for sample %s' %name)
         cmd = miRTop_exe + ' gff --sps %s --hairpin %s --gtf %s --format %s -o %s %s 2> %s' %(
                                                     species, hairpinFasta, miRNA_gff, format,
                                                     mirtop_folder_gff, results_folder, logfile)
         
         ## execute
-        code_miRTop = functions.system_call_functions.system_call(cmd)
+        code_miRTop = exec_trace.system_call(cmd, 'miRTop', name, 'miRTop_gff', inputs=[results_folder], outputs=[mirtop_folder_gff])
         if code_miRTop:
-            functions.time_functions.print_time_stamp(filename_stamp_gff)
+            step_cache.save_step(step_info, [mirtop_folder_gff_file])
         else:
             return(False)
         
     ## miRTop stats
-    mirtop_folder_gff_file = os.path.join(mirtop_folder_gff, 'mirtop.gff')
 
     #filename_stamp_stats = mirtop_folder_stats + '/.success'
     #if os.path.isfile(filename_stamp_stats):
@@ -150,34 +168,32 @@ def miRTop(results_folder, sample_folder, name, threads, format, miRNA_gff, hair
     #        return(False)
             
     ## miRTop counts
-    filename_stamp_counts = mirtop_folder_counts + '/.success'
-    if os.path.isfile(filename_stamp_counts):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp_counts)
-        print (colored("\tA previous command generated results on: %s [%s -- %s - counts]" %(stamp, name, 'miRTop'), 'yellow'))
-    else:
+    (cached, step_info) = step_cache.check_step(mirtop_folder_counts, 'miRTop_counts', name, [mirtop_folder_gff_file, hairpinFasta, miRNA_gff], 
+                                                "--sps %s" %species, prog='miRTop', 
+                                                legacy_stamp=mirtop_folder_counts + '/.success', Debug=Debug, by_name=True)
+    if not cached:
         print ('Creating isomiRs counts for sample %s' %name)
         ## if both succeeded
         cmd_stats = miRTop_exe + ' counts -o %s --gff %s --hairpin %s --gtf %s --sps %s 2>> %s' %(mirtop_folder_counts, mirtop_folder_gff_file, hairpinFasta, miRNA_gff, species, logfile)
-        code_miRTop_counts = functions.system_call_functions.system_call(cmd_stats)
+        code_miRTop_counts = exec_trace.system_call(cmd_stats, 'miRTop', name, 'miRTop_counts', inputs=[mirtop_folder_gff_file], outputs=[mirtop_folder_counts])
         
         if code_miRTop_counts:
-            functions.time_functions.print_time_stamp(filename_stamp_counts)
+            step_cache.save_step(step_info)
         else:
             return(False)
     
     ## miRTop export
-    filename_stamp_export = mirtop_folder_export + '/.success'
-    if os.path.isfile(filename_stamp_export):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp_export)
-        print (colored("\tA previous command generated results on: %s [%s -- %s - export]" %(stamp, name, 'miRTop'), 'yellow'))
-    else:
+    (cached, step_info) = step_cache.check_step(mirtop_folder_export, 'miRTop_export', name, [mirtop_folder_gff_file, hairpinFasta, miRNA_gff], 
+                                                "--sps %s --format isomir" %species, prog='miRTop', 
+                                                legacy_stamp=mirtop_folder_export + '/.success', Debug=Debug, by_name=True)
+    if not cached:
         print ('Creating isomiRs export information for sample %s' %name)
         ## if both succeeded
         cmd_export = miRTop_exe + ' export -o %s --hairpin %s --gtf %s --sps %s --format isomir %s 2> %s' %(mirtop_folder_export, hairpinFasta, miRNA_gff, species, mirtop_folder_gff_file, logfile)
-        code_miRTop_export = functions.system_call_functions.system_call(cmd_export)
+        code_miRTop_export = exec_trace.system_call(cmd_export, 'miRTop', name, 'miRTop_export', inputs=[mirtop_folder_gff_file], outputs=[mirtop_folder_export])
         
         if code_miRTop_export:
-            functions.time_functions.print_time_stamp(filename_stamp_export)
+            step_cache.save_step(step_info)
         else:
             return(False)
     
@@ -188,3 +204,285 @@ def miRTop(results_folder, sample_folder, name, threads, format, miRNA_gff, hair
     ## if any command failed
     #return(False)
     
+
+###############
+def api_version(Debug=False):
+    """Returns the version of miRTop if its python API can be used, otherwise None.
+
+    Counts and export tables are generated by XICRA, so only versions tested (api_versions)
+    are used. See dependencies.csv.
+    """
+    try:
+        import mirtop
+    except ImportError as exc:
+        if Debug:
+            HCGB_aes.debug_message("miRTop python API not available: %s" %exc, "yellow")
+        return (None)
+
+    if mirtop.__version__ not in api_versions:
+        if Debug:
+            HCGB_aes.debug_message("miRTop python API not tested for version %s" %mirtop.__version__, "yellow")
+        return (None)
+
+    return (mirtop.__version__)
+
+###############
+def api_pool(hairpinFasta, miRNA_gff, species, threads):
+    """Returns the pool of workers for the annotation provided. 
+
+    Pool is created only once per execution and each worker loads the annotation 
+    only once (see init_worker()), so samples do not compete for the GIL.
+
+    :param hairpinFasta: hairpin fasta file
+    :param miRNA_gff: miRNA gff3 annotation file
+    :param species: species tag ID
+    :param threads: maximum number of workers
+
+    :returns: concurrent.futures.ProcessPoolExecutor
+    """
+    key = (os.path.abspath(hairpinFasta), os.path.abspath(miRNA_gff), species)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, int(threads)), 
+                                                                 initializer=init_worker, initargs=key)
+        return (_pools[key])
+
+###############
+def init_worker(hairpinFasta, miRNA_gff, species):
+    """Loads the annotation in the worker. See load_annotation()."""
+    _worker['annotation'] = load_annotation(hairpinFasta, miRNA_gff, species)
+
+###############
+def load_annotation(hairpinFasta, miRNA_gff, species):
+    """Loads hairpin and GFF annotation using miRTop python API.
+
+    :returns: arguments required by miRTop python API, including the annotation.
+    """
+    from mirtop.mirna import fasta, mapper
+    
+    args = argparse.Namespace(hairpin=hairpinFasta, gtf=miRNA_gff, sps=species, keep_name=False, add_extra=False, 
+                              out_format='gff', out_genomic=False, genomic=False, low_memory=False, 
+                              database=None, format=None, files=[], out=None)
+    args.database = mapper.guess_database(args)
+    args.precursors = fasta.read_precursor(hairpinFasta, species)
+    args.matures = mapper.read_gtf_to_precursor(miRNA_gff)
+    return (args)
+
+###############
+def miRTop_api(results_file, sample_folder, name, threads, format, miRNA_gff, hairpinFasta, species, Debug):
+    """Executes miRTop gff, counts and export using miRTop python API in a pool of workers.
+
+    Each step is only executed if inputs, parameters or miRTop version changed, as
+    for the command line. See miRTop().
+
+    :returns: counts file or False if failed.
+    """
+    version = api_version(Debug)
+    if not version:
+        return (False)
+    
+    ## outputs
+    mirtop_folder_gff_file = os.path.join(sample_folder, 'gff', 'mirtop.gff')
+    mirtop_counts_file = os.path.join(sample_folder, 'counts', 'mirtop.tsv')
+    mirtop_export_file = os.path.join(sample_folder, 'export', 'mirtop_rawData.tsv')
+    
+    ## miRTop version is part of the parameters: no executable required
+    def check(output_file, step, inputs, params):
+        return (step_cache.check_step(os.path.dirname(output_file), step, name, inputs, 
+                                      params + " --miRTop %s" %version, Debug=Debug, by_name=True))
+    
+    try:
+        ## miRTop analysis gff
+        (cached_gff, step_info_gff) = check(mirtop_folder_gff_file, 'miRTop_gff', [results_file, hairpinFasta, miRNA_gff], 
+                                            "--sps %s --format %s" %(species, format))
+        steps = {}
+        if not cached_gff:
+            steps['gff'] = mirtop_folder_gff_file
+            steps['counts'] = mirtop_counts_file
+            steps['export'] = mirtop_export_file
+        else:
+            (cached_counts, step_info_counts) = check(mirtop_counts_file, 'miRTop_counts', [mirtop_folder_gff_file, hairpinFasta, miRNA_gff], 
+                                                      "--sps %s" %species)
+            (cached_export, step_info_export) = check(mirtop_export_file, 'miRTop_export', [mirtop_folder_gff_file, hairpinFasta, miRNA_gff], 
+                                                      "--sps %s --format isomir" %species)
+            if not cached_counts:
+                steps['counts'] = mirtop_counts_file
+            if not cached_export:
+                steps['export'] = mirtop_export_file
+        
+        if not steps:
+            return (mirtop_counts_file)
+        
+        print ('Creating isomiRs %s for sample %s' %(', '.join(steps), name))
+        future = api_pool(hairpinFasta, miRNA_gff, species, threads).submit(api_sample, results_file, format, mirtop_folder_gff_file, steps)
+        future.result()
+        
+        ## save steps: counts and export depend on the gff just generated
+        if 'gff' in steps:
+            step_cache.save_step(step_info_gff, [mirtop_folder_gff_file])
+            (cached_counts, step_info_counts) = check(mirtop_counts_file, 'miRTop_counts', [mirtop_folder_gff_file, hairpinFasta, miRNA_gff], 
+                                                      "--sps %s" %species)
+            (cached_export, step_info_export) = check(mirtop_export_file, 'miRTop_export', [mirtop_folder_gff_file, hairpinFasta, miRNA_gff], 
+                                                      "--sps %s --format isomir" %species)
+        if 'counts' in steps and not cached_counts:
+            step_cache.save_step(step_info_counts, [mirtop_counts_file])
+        if 'export' in steps and not cached_export:
+            step_cache.save_step(step_info_export, [mirtop_export_file])
+    
+    except Exception as exc:
+        print (colored("** ERROR: miRTop failed for sample %s: %s" %(name, exc), 'red'))
+        return (False)
+    
+    return (mirtop_counts_file)
+
+###############
+def api_sample(results_file, format, gff_file, steps):
+    """Executes in the worker the miRTop steps provided for a sample.
+
+    GFF lines are only parsed once: either generated from the results of the software
+    or read from the GFF file, and then counts and export tables are written in a single pass.
+
+    :param results_file: file (or folder for sRNAbench) with the results of the software
+    :param format: 'srnabench', 'optimir' or 'seqbuster'
+    :param gff_file: GFF file generated by miRTop
+    :param steps: dictionary with the output file of each step to execute: 'gff', 'counts' and/or 'export'
+
+    :returns: True
+    """
+    annotation = _worker['annotation']
+    if 'gff' in steps:
+        (gff_lines, samples) = api_gff(results_file, format, annotation, steps['gff'])
+    else:
+        (gff_lines, samples) = read_gff(gff_file)
+    
+    api_tables(gff_lines, samples, annotation, steps.get('counts'), steps.get('export'))
+    return (True)
+
+###############
+def api_gff(results_file, format, annotation, gff_file):
+    """Creates the GFF file for the results of the software. Equivalent to miRTop gff.
+
+    :param results_file: file (or folder for sRNAbench) with the results of the software
+    :param format: 'srnabench', 'optimir' or 'seqbuster'
+    :param annotation: arguments returned by load_annotation()
+    :param gff_file: output GFF file
+
+    :returns: (lines of the GFF file, sample names)
+    """
+    from mirtop.importer import seqbuster, srnabench, optimir
+    from mirtop.mirna.annotate import annotate
+    from mirtop.gff import body, header, merge
+
+    args = copy.copy(annotation)
+    args.format = format
+    args.out = os.path.dirname(gff_file)
+    
+    results_file = os.path.normpath(results_file)
+    sample = os.path.splitext(os.path.basename(results_file))[0]
+    if format == "seqbuster":
+        reads = seqbuster.read_file(results_file, args)
+        lines = body.create(annotate(reads, args.matures, args.precursors), args.database, sample, args)
+    elif format == "srnabench":
+        lines = srnabench.read_file(results_file, args)
+    elif format == "optimir":
+        lines = optimir.read_file(results_file, args)
+    else:
+        raise ValueError("format %s not supported" %format)
+    
+    merged = merge.merge({ results_file: lines }, [sample])
+    gff_lines = [ hit[4] for m in merged for s in sorted(merged[m].keys()) for hit in merged[m][s] ]
+    
+    with open(gff_file, 'w') as out_fh:
+        out_fh.write(header.create([sample], args.database, header.make_tools([format])) + '\n')
+        for line in gff_lines:
+            out_fh.write(line + '\n')
+    
+    return (gff_lines, [sample])
+
+###############
+def read_gff(gff_file):
+    """Returns the lines and sample names of a GFF file generated by miRTop."""
+    samples = []
+    gff_lines = []
+    with open(gff_file) as in_fh:
+        for line in in_fh:
+            if line.startswith("## COLDATA:"):
+                samples = line.strip().split("COLDATA:")[1].strip().split(",")
+            elif not line.startswith("#") and line.strip():
+                gff_lines.append(line.rstrip('\n'))
+    return (gff_lines, samples)
+
+###############
+def variant_dict(variant):
+    """Returns the isomiR types and the number of single nucleotide variants of a Variant attribute."""
+    isomir = {}
+    snv = 0
+    for v in variant.split(","):
+        if v.find(":") > 0:
+            isomir[v.split(":")[0]] = v.split(":")[1]
+        elif v.find("snv") > 0:
+            snv += 1
+    return (isomir, snv)
+
+###############
+def counts_columns(variant):
+    """Columns iso_5p, iso_3p, iso_add3p and iso_snp of miRTop counts for the Variant attribute."""
+    (isomir, snv) = variant_dict(variant)
+    return ([ str(isomir.get(i, 0)) for i in ('iso_5p', 'iso_3p', 'iso_add3p') ] + [ str(snv) ])
+
+###############
+def export_columns(variant_nt):
+    """Columns mism, add, t5 and t3 of miRTop export --format isomir for the Variant with nucleotides."""
+    (isomir, snv) = variant_dict(variant_nt)
+    return ([ str(isomir.get(i, 0)) for i in ('iso_snv', 'iso_add3p', 'iso_5p', 'iso_3p') ])
+
+###############
+def api_tables(gff_lines, samples, annotation, counts_file=None, export_file=None):
+    """Creates counts and isomiRs export tables in a single pass over the GFF lines. Equivalent 
+    to miRTop counts and miRTop export --format isomir.
+
+    :param gff_lines: lines of the GFF file
+    :param samples: sample names
+    :param annotation: arguments returned by load_annotation()
+    :param counts_file: output counts file or None
+    :param export_file: output isomiRs export file or None
+    """
+    from mirtop.gff.classgff import feature
+    from mirtop.gff.body import variant_with_nt
+    from mirtop.mirna.realign import read_id
+    
+    sep = "\t"
+    counts_fh = open(counts_file, 'w') if counts_file else None
+    export_fh = open(export_file, 'w') if export_file else None
+    try:
+        if counts_fh:
+            counts_fh.write(sep.join(['UID', 'Read', 'miRNA', 'Variant', 'iso_5p', 'iso_3p', 'iso_add3p', 'iso_snp'] + samples) + '\n')
+        if export_fh:
+            export_fh.write(sep.join(['seq', 'mir', 'mism', 'add', 't5', 't3'] + samples) + '\n')
+        
+        for line in gff_lines:
+            attr = feature(line).attributes
+            try:
+                read = read_id(attr["UID"])
+            except KeyError:
+                continue
+            
+            expression = attr["Expression"].strip().split(",")
+            mirna = attr["Name"]
+            if counts_fh:
+                counts_fh.write(sep.join([attr["UID"], attr["Read"], mirna, attr["Variant"]] + 
+                                         counts_columns(attr["Variant"]) + expression) + '\n')
+            
+            ## isomiRs export: variants with nucleotides
+            if export_fh:
+                parent = attr["Parent"]
+                if parent not in annotation.precursors or mirna not in annotation.matures[parent]:
+                    continue
+                extra = variant_with_nt(line, annotation.precursors, annotation.matures)
+                if extra == "Invalid":
+                    continue
+                export_fh.write(sep.join([read, mirna] + export_columns(extra) + expression) + '\n')
+    finally:
+        for fh in (counts_fh, export_fh):
+            if fh:
+                fh.close()
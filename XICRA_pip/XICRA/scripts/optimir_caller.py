@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from HCGB import functions
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace, collapse_reads
 
 ###############       
 def optimir (reads, outpath, file_name, num_threads, matureFasta, hairpinFasta, miRNA_gff, Debug):
@@ -47,10 +48,12 @@ def optimir (reads, outpath, file_name, num_threads, matureFasta, hairpinFasta,
         print (colored("** ERROR: Only 1 fastq file is allowed please joined reads before...", 'red'))
         exit()
  
-    ## create command  
-    cmd = "%s process --fq %s --gff_out -o %s --maturesFasta %s --hairpinsFasta %s --gff3 %s > %s 2> %s" %(
-        optimir_exe, reads[0], outpath, matureFasta, hairpinFasta, miRNA_gff, logfile, errfile)
-    return(functions.system_call_functions.system_call(cmd))
+    ## use collapsed reads of the sample, expanded on the fly
+    with collapse_reads.fastq_input(reads, outpath, file_name, Debug) as fastq:
+        ## create command  
+        cmd = "%s process --fq %s --gff_out -o %s --maturesFasta %s --hairpinsFasta %s --gff3 %s > %s 2> %s" %(
+            optimir_exe, fastq[0], outpath, matureFasta, hairpinFasta, miRNA_gff, logfile, errfile)
+        return(exec_trace.system_call(cmd, 'optimir', file_name, inputs=reads, outputs=[outpath]))
 
 
 ###############       
@@ -73,17 +76,15 @@ def optimir_caller(reads, sample_folder, name, threads, matureFasta, hairpinFast
 
     :returns: True/False
     """
-    # check if previously generated and succeeded
-    filename_stamp = sample_folder + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'OptimiR'), 'yellow'))
-    else:
-        # Call sRNAbench
-    ## no species option for OptimiR
+    # check if previously generated and succeeded with same reads and annotation
+    (cached, step_info) = step_cache.check_step(sample_folder, 'OptimiR', name, reads + [matureFasta, hairpinFasta, miRNA_gff], 
+                                                "--gff_out", prog='optimir', legacy_stamp=sample_folder + '/.success', Debug=Debug, by_name=True)
+    if not cached:
+        # Call OptimiR
+        ## no species option for OptimiR
         code_returned = optimir(reads, sample_folder, name, threads, matureFasta, hairpinFasta, miRNA_gff,  Debug)
         if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info)
         else:
             print ('** Sample %s failed...' %name)
             return(False)
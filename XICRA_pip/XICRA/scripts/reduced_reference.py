@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Builds a reduced reference with the small RNA loci of the genome.
+
+Loci of small RNA biotypes (miRNA, tRNA, snoRNA, snRNA, piRNA, rRNA...) are
+retrieved from the GTF annotation, extended with flanking sequence and merged.
+Additional loci (e.g. piRNA clusters) could be provided in BED format. Each
+region is a sequence of the reduced reference named as chr:start-end (1-based),
+so alignments are translated back into genome coordinates (see lift_sam).
+
+Reads are mapped against the reduced reference first and only reads not mapped
+exactly are mapped against the whole genome (see STAR_caller.mapReads_reduced). The
+reduced reference is usually two orders of magnitude smaller than the genome.
+'''
+## useful imports
+import os
+import re
+import numpy as np
+import pandas as pd
+from termcolor import colored
+
+## import my modules
+from XICRA.scripts import step_cache
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## biotypes included in the reduced reference (Ensembl/GENCODE gene_biotype or gene_type)
+smallRNA_biotypes = ['miRNA', 'tRNA', 'Mt_tRNA', 'snoRNA', 'scaRNA', 'snRNA', 'piRNA',
+                     'rRNA', 'Mt_rRNA', 'rRNA_pseudogene', 'misc_RNA', 'vault_RNA', 'Y_RNA']
+
+## default flanking sequence (bp) on each side of the loci
+default_flank = 50
+
+## complement of nucleotides, to restore reads aligned on the reverse strand
+complement = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+## attributes containing the biotype of each feature
+biotype_regex = r'(?:gene_biotype|gene_type|transcript_biotype|transcript_type) "([^"]+)"'
+
+############################
+def GTF_loci(gtf_file, biotypes=None, chunksize=1000000):
+    """Returns the loci of the small RNA biotypes annotated in the GTF file.
+
+    Gene features are used if available, otherwise all features of the biotypes.
+
+    :param gtf_file: Reference genome annotation in GTF format.
+    :param biotypes: List of biotypes to include. Default: smallRNA_biotypes.
+    :param chunksize: Lines of the GTF read at once.
+
+    :returns: Dataframe with columns chrom, start, end (0-based, half-open).
+    """
+    if not biotypes:
+        biotypes = smallRNA_biotypes
+
+    loci = []
+    genes = False
+    reader = pd.read_csv(gtf_file, sep='\t', comment='#', header=None, usecols=[0, 2, 3, 4, 8],
+                         names=['chrom', 'feature', 'start', 'end', 'attributes'],
+                         dtype={ 'chrom': str, 'feature': str }, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk.assign(biotype=chunk['attributes'].str.extract(biotype_regex, expand=False))
+        chunk = chunk[chunk['biotype'].isin(biotypes)]
+        if chunk.empty:
+            continue
+
+        ## use gene features once found
+        is_gene = chunk['feature'] == 'gene'
+        if is_gene.any():
+            if not genes:
+                loci = []
+                genes = True
+            chunk = chunk[is_gene]
+        elif genes:
+            continue
+
+        loci.append(pd.DataFrame({ 'chrom': chunk['chrom'].to_numpy(),
+                                   'start': chunk['start'].to_numpy(dtype=np.int64) - 1,
+                                   'end': chunk['end'].to_numpy(dtype=np.int64) }))
+
+    if not loci:
+        return (pd.DataFrame(columns=['chrom', 'start', 'end']))
+    return (pd.concat(loci, ignore_index=True))
+
+############################
+def BED_loci(bed_file):
+    """Returns the loci provided in BED format: chrom, start, end (0-based, half-open)."""
+    loci = pd.read_csv(bed_file, sep='\t', comment='#', header=None, usecols=[0, 1, 2],
+                       names=['chrom', 'start', 'end'], dtype={ 'chrom': str, 'start': np.int64, 'end': np.int64 })
+    return (loci[~loci['chrom'].str.startswith(('track', 'browser'))])
+
+############################
+def merge_loci(loci, flank=default_flank):
+    """Extends loci with flanking sequence and merges those overlapping.
+
+    :param loci: Dataframe with columns chrom, start, end (0-based, half-open).
+    :param flank: Bases to add on each side of each locus.
+
+    :returns: Dataframe with the merged regions sorted by chrom and start.
+    """
+    if loci.empty:
+        return (loci)
+
+    loci = pd.DataFrame({ 'chrom': loci['chrom'].astype(str),
+                          'start': np.maximum(loci['start'].to_numpy(dtype=np.int64) - flank, 0),
+                          'end': loci['end'].to_numpy(dtype=np.int64) + flank })
+    loci = loci.sort_values(['chrom', 'start'], ignore_index=True)
+
+    ## a new region starts if it does not overlap the maximum end of the previous loci of the chromosome
+    max_end = loci.groupby('chrom', sort=False)['end'].cummax()
+    previous_end = max_end.groupby(loci['chrom'], sort=False).shift(1)
+    new_region = previous_end.isna() | (loci['start'] > previous_end)
+    region = new_region.cumsum()
+
+    merged = loci.groupby(region, sort=False).agg(chrom=('chrom', 'first'), start=('start', 'min'), end=('end', 'max'))
+    return (merged.reset_index(drop=True))
+
+############################
+def region_name(chrom, start, end):
+    """Returns the name of the region in the reduced reference: chr:start-end (1-based, inclusive)."""
+    return ("%s:%s-%s" %(chrom, start + 1, end))
+
+############################
+def parse_region(name):
+    """Returns chromosome and offset (0-based start) of the region provided (see region_name)."""
+    (chrom, coordinates) = name.rsplit(':', 1)
+    return (chrom, int(coordinates.split('-')[0]) - 1)
+
+############################
+def extract_regions(fasta_file, regions, out_fasta, line_length=60):
+    """Writes the sequence of the regions provided into a fasta file.
+
+    Chromosomes are read one at a time, so memory required is the size of the
+    largest chromosome.
+
+    :param fasta_file: Genome sequence in fasta format.
+    :param regions: Dataframe with columns chrom, start, end (see merge_loci).
+    :param out_fasta: Output fasta file.
+
+    :returns: Total length of the regions written.
+    """
+    from Bio import SeqIO
+
+    by_chrom = { chrom: df for chrom, df in regions.groupby('chrom', sort=False) }
+    total = 0
+    with open(out_fasta, 'w') as out_fh:
+        for record in SeqIO.parse(fasta_file, 'fasta'):
+            if record.id not in by_chrom:
+                continue
+
+            sequence = str(record.seq)
+            for start, end in zip(by_chrom[record.id]['start'], by_chrom[record.id]['end']):
+                end = min(end, len(sequence))
+                if start >= end:
+                    continue
+                out_fh.write('>' + region_name(record.id, start, end) + '\n')
+                for i in range(start, end, line_length):
+                    out_fh.write(sequence[i:min(i + line_length, end)] + '\n')
+                total += end - start
+
+    return (total)
+
+############################
+def build_reduced_fasta(fasta_file, gtf_file, folder, flank=default_flank, bed_file=None, Debug=False):
+    """Generates the fasta file of the reduced reference with the small RNA loci of the genome.
+
+    Results are reused if the genome, annotation and parameters did not change.
+
+    :param fasta_file: Genome sequence in fasta format.
+    :param gtf_file: Reference genome annotation in GTF format.
+    :param folder: Folder to store the reduced reference.
+    :param flank: Bases to add on each side of each locus.
+    :param bed_file: Additional loci in BED format, e.g. piRNA clusters.
+    :param Debug: show extra information of the process.
+
+    :returns: Fasta file of the reduced reference. None if no loci were found.
+    """
+    out_fasta = os.path.join(folder, 'reduced_reference.fa')
+    inputs = [fasta_file, gtf_file] + ([bed_file] if bed_file else [])
+    params = "flank:%s biotypes:%s" %(flank, ",".join(smallRNA_biotypes))
+    (cached, step_info) = step_cache.check_step(folder, 'reduced_reference', 'genome', inputs, params, Debug=Debug)
+    if cached and os.path.isfile(out_fasta):
+        return (out_fasta)
+
+    print ('\t+ Retrieving small RNA loci from annotation: %s' %gtf_file)
+    loci = GTF_loci(gtf_file)
+    if bed_file:
+        loci = pd.concat([loci, BED_loci(bed_file)], ignore_index=True)
+
+    if loci.empty:
+        print (colored("** WARNING: No small RNA loci found in the annotation provided.", 'yellow'))
+        return (None)
+
+    regions = merge_loci(loci, flank)
+    total = extract_regions(fasta_file, regions, out_fasta)
+    print ('\t+ Reduced reference: %s regions, %.1f Mb' %(len(regions), total/1e6))
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("loci: %s" %len(loci), "yellow")
+        HCGB_aes.debug_message("regions:", "yellow")
+        print (regions)
+
+    step_cache.save_step(step_info, [out_fasta])
+    return (out_fasta)
+
+############################
+def lift_sam(sam_file, out_fh, mate_fhs=None):
+    """Writes the alignments of the reduced reference in genome coordinates.
+
+    Reference names (chr:start-end) are replaced by the chromosome and positions
+    are shifted by the start of the region. Header lines are skipped.
+
+    If mate_fhs is provided, only exact alignments are written (see is_exact): no alignment 
+    in the genome could have a better score. Reads with any other alignment (mismatches, 
+    indels or soft-clipped bases) might align better, or also, outside the small RNA loci, 
+    so they are written in fastq format to be mapped against the whole genome (all mates 
+    of paired-end reads).
+
+    :param sam_file: SAM file with alignments against the reduced reference.
+    :param out_fh: Open file to write the alignments.
+    :param mate_fhs: List of open files to write the reads not exact (one per mate).
+
+    :returns: Number of alignments written and number of reads written in fastq format.
+    """
+    regions = {}
+    def lift(name):
+        if name not in regions:
+            regions[name] = parse_region(name)
+        return (regions[name])
+
+    def write(read):
+        nonlocal n, n_fastq
+        if mate_fhs is not None and not all([ is_exact(fields) for fields in read ]):
+            for fields in read:
+                mate_fhs[1 if int(fields[1]) & 0x80 else 0].write(fastq_record(fields))
+            n_fastq += 1
+            return
+        
+        for fields in read:
+            if fields[2] != '*':
+                (chrom, offset) = lift(fields[2])
+                fields[7] = str(int(fields[7]) + offset) if fields[6] == '=' else fields[7]
+                fields[2] = chrom
+                fields[3] = str(int(fields[3]) + offset)
+            if fields[6] not in ('*', '='):
+                (chrom, offset) = lift(fields[6])
+                fields[6] = chrom
+                fields[7] = str(int(fields[7]) + offset)
+            out_fh.write('\t'.join(fields))
+            n += 1
+
+    ## alignments of each read are consecutive
+    (n, n_fastq) = (0, 0)
+    read = []
+    with open(sam_file) as in_fh:
+        for line in in_fh:
+            if line.startswith('@'):
+                continue
+            fields = line.split('\t')
+            if read and read[0][0] != fields[0]:
+                write(read)
+                read = []
+            read.append(fields)
+    if read:
+        write(read)
+    return (n, n_fastq)
+
+############################
+def is_exact(fields):
+    """Returns True if the SAM alignment provided (fields) is end-to-end without mismatches."""
+    if int(fields[1]) & 0x4 or not re.fullmatch(r'\d+M', fields[5]):
+        return (False)
+    mismatches = [ tag for tag in fields[11:] if tag.startswith(('nM:i:', 'NM:i:')) ]
+    return (bool(mismatches) and all([ int(tag[5:]) == 0 for tag in mismatches ]))
+
+############################
+def fastq_record(fields):
+    """Returns the read of the SAM alignment provided (fields) in fastq format, as sequenced."""
+    (seq, qual) = (fields[9], fields[10].rstrip('\n'))
+    if int(fields[1]) & 0x10:
+        seq = seq.translate(complement)[::-1]
+        qual = qual[::-1]
+    return ('@%s\n%s\n+\n%s\n' %(fields[0], seq, qual))
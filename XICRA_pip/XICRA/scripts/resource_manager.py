@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+CPU and memory profiles of the software employed and planning of jobs.
+
+Each software has a profile: the maximum number of threads it can use and the
+memory (bytes) required per job. Profiles could be declared by each caller and
+are updated with the peak memory (RSS) measured in previous executions, stored
+in ~/.XICRA/resource_usage.json (or XICRA_RESOURCE_FILE).
+
+The number of jobs to run at the same time is set by both the CPUs and the memory
+available, so jobs are packed in the node without running out of memory. Memory
+available is retrieved from the system or set using XICRA_MAX_MEMORY (Gb).
+'''
+## useful imports
+import os
+import json
+import time
+import fcntl
+import threading
+from termcolor import colored
+
+## import my modules
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## 1 Gb
+GB = 1024**3
+
+## default profiles: maximum threads and memory per job
+tool_profiles = {
+    'fastqc':        { 'max_threads': 4,  'memory': 1*GB },
+    'cutadapt':      { 'max_threads': 8,  'memory': 1*GB },
+    'fastqjoin':     { 'max_threads': 1,  'memory': 1*GB },
+    'collapse':      { 'max_threads': 1,  'memory': 2*GB },
+    'STAR':          { 'max_threads': 16, 'memory': 32*GB },
+    'bowtie':        { 'max_threads': 8,  'memory': 4*GB },
+    'featureCounts': { 'max_threads': 8,  'memory': 2*GB },
+    'bedtools':      { 'max_threads': 1,  'memory': 2*GB },
+    'sRNAbench':     { 'max_threads': 1,  'memory': 8*GB },
+    'miraligner':    { 'max_threads': 1,  'memory': 4*GB },
+    'native':        { 'max_threads': 1,  'memory': 1*GB },
+    'optimir':       { 'max_threads': 1,  'memory': 2*GB },
+    'miRTop':        { 'max_threads': 1,  'memory': 2*GB },
+    'MINTmap':       { 'max_threads': 1,  'memory': 4*GB },
+    'Rscript':       { 'max_threads': 1,  'memory': 2*GB },
+}
+
+## number of executions to keep for each software
+history_size = 20
+
+## margin over the peak memory observed
+memory_margin = 1.2
+
+_lock = threading.Lock()
+
+############################
+def declare_profile(tool, max_threads=None, memory=None):
+    """Declares or updates the CPU and memory profile for a software.
+
+    :param tool: Software name, e.g. STAR.
+    :param max_threads: Maximum number of threads the software can take advantage of.
+    :param memory: Memory (bytes) required per job.
+
+    :type tool: string
+    :type max_threads: int
+    :type memory: int
+    """
+    with _lock:
+        profile = tool_profiles.setdefault(tool, { 'max_threads': 1, 'memory': 1*GB })
+        if max_threads:
+            profile['max_threads'] = int(max_threads)
+        if memory:
+            profile['memory'] = int(memory)
+
+############################
+def usage_file():
+    """Returns the file containing memory usage from previous executions."""
+    if os.environ.get('XICRA_RESOURCE_FILE'):
+        return (os.path.abspath(os.environ['XICRA_RESOURCE_FILE']))
+    return (os.path.join(os.path.expanduser("~"), ".XICRA", "resource_usage.json"))
+
+############################
+def read_usage():
+    """Returns a dictionary with memory usage from previous executions."""
+    file_usage = usage_file()
+    if not os.path.isfile(file_usage):
+        return ({})
+    try:
+        with open(file_usage) as fh:
+            return (json.load(fh))
+    except ValueError:
+        return ({})
+
+############################
+def record_usage(tool, threads, max_rss, wall_time=0):
+    """Saves the peak memory (bytes) used by an execution of the software.
+
+    :param tool: Software name, e.g. STAR.
+    :param threads: Threads used.
+    :param max_rss: Peak resident memory (bytes).
+    :param wall_time: Seconds elapsed.
+    """
+    if not tool:
+        return ()
+
+    ## lock across processes: several executions could share the same file
+    file_usage = usage_file()
+    with _lock:
+        try:
+            os.makedirs(os.path.dirname(file_usage), exist_ok=True)
+            with open(file_usage + '.lock', 'w') as lock_fh:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+                try:
+                    usage = read_usage()
+                    records = usage.setdefault(tool, [])
+                    records.append({ 'threads': threads, 'max_rss': int(max_rss), 'wall_time': round(wall_time, 2),
+                                     'date': time.strftime("%Y-%m-%d %H:%M:%S") })
+                    usage[tool] = records[-history_size:]
+
+                    ## write atomically
+                    tmp_file = file_usage + '.tmp' + str(os.getpid())
+                    with open(tmp_file, 'w') as fh:
+                        json.dump(usage, fh, indent=1)
+                    os.replace(tmp_file, file_usage)
+                finally:
+                    fcntl.flock(lock_fh, fcntl.LOCK_UN)
+        except OSError as exc:
+            print (colored("** WARNING: Resource usage could not be saved: %s" %exc, 'yellow'))
+
+############################
+def get_profile(tool):
+    """Returns the profile for the software: maximum threads and memory per job (bytes).
+
+    If previous executions were recorded, memory is set to the peak observed plus a
+    margin, instead of the default declared.
+    """
+    with _lock:
+        profile = dict(tool_profiles.get(tool, { 'max_threads': 1, 'memory': 1*GB }))
+
+    records = read_usage().get(tool)
+    if records:
+        profile['memory'] = int(max([ r['max_rss'] for r in records ]) * memory_margin)
+    return (profile)
+
+############################
+def available_memory(memory_loaded=0):
+    """Returns the memory (bytes) available in the system, or the value set by XICRA_MAX_MEMORY (Gb).
+
+    :param memory_loaded: Memory (bytes) already allocated in shared memory by this execution, 
+      e.g. STAR genome index (see STAR_caller.shared_genome). SysV shared memory is not included 
+      in the memory available in the system (MemAvailable), so it is only subtracted from XICRA_MAX_MEMORY.
+    """
+    if os.environ.get('XICRA_MAX_MEMORY'):
+        return (int(float(os.environ['XICRA_MAX_MEMORY']) * GB) - memory_loaded)
+
+    ## linux
+    if os.path.isfile('/proc/meminfo'):
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return (int(line.split()[1]) * 1024)
+
+    ## other systems: total memory
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (ValueError, OSError):
+        return (16*GB)
+
+############################
+def plan_jobs(tools, threads, n_jobs, memory_job=None, memory_shared=0, Debug=False, memory_loaded=0):
+    """Returns the threads per job and the number of jobs to run at the same time.
+
+    Replaces HCGB.functions.main_functions.optimize_threads(), taking into account
+    the memory available and the profile of the software employed. Jobs running at
+    the same time never require more memory than available. If the software can not
+    use additional threads, more jobs are sent so CPUs are not left idle.
+
+    :param tools: Software name or list of software names executed in each job.
+    :param threads: Total number of CPUs available.
+    :param n_jobs: Number of jobs to execute, e.g. samples.
+    :param memory_job: Memory (bytes) per job. Default: retrieved from the profile.
+    :param memory_shared: Memory (bytes) shared by all jobs, e.g. a genome index loaded once.
+    :param Debug: Show additional information.
+    :param memory_loaded: Memory (bytes) shared by all jobs and already loaded. See available_memory().
+
+    :returns: (threads_job, max_workers)
+    """
+    if isinstance(tools, str):
+        tools = [tools]
+
+    ## a job executing several software requires the maximum of them
+    profiles = [ get_profile(t) for t in tools ]
+    max_threads = max([ p['max_threads'] for p in profiles ])
+    if not memory_job:
+        memory_job = max([ p['memory'] for p in profiles ])
+
+    threads = max(1, int(threads))
+    n_jobs = max(1, int(n_jobs))
+    memory = available_memory(memory_loaded) - memory_shared
+
+    ## jobs fitting in memory
+    workers_mem = max(1, int(memory // memory_job))
+
+    ## split CPUs among jobs, and send more jobs if the software does not use them
+    workers = min(n_jobs, threads, workers_mem)
+    threads_job = max(1, min(max_threads, threads // workers))
+    workers = max(1, min(n_jobs, workers_mem, threads // threads_job))
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("plan_jobs: %s" %",".join(tools), "yellow")
+        HCGB_aes.debug_message("memory available: %.1f Gb; memory per job: %.1f Gb" %(memory/GB, memory_job/GB), "yellow")
+        HCGB_aes.debug_message("threads_job: %s; max_workers: %s" %(threads_job, workers), "yellow")
+
+    return (threads_job, workers)
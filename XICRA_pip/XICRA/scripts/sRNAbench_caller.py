@@ -19,6 +19,7 @@ from termcolor import colored
 ## import my modules
 from HCGB import functions
 from XICRA.config import set_config
+from XICRA.scripts import step_cache, exec_trace, collapse_reads
 
 
 ###############
@@ -38,16 +39,14 @@ def sRNAbench_caller(reads, sample_folder, name, threads, species, Debug):
 
     :returns: True/False
     """
-    # check if previously generated and succeeded
-    filename_stamp = sample_folder + '/.success'
-    if os.path.isfile(filename_stamp):
-        stamp = functions.time_functions.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, 'sRNAbench'), 'yellow'))
-    else:
+    # check if previously generated and succeeded with same reads and parameters
+    (cached, step_info) = step_cache.check_step(sample_folder, 'sRNAbench', name, reads, "microRNA=%s" %species, 
+                                                prog='sRNAbench', legacy_stamp=sample_folder + '/.success', Debug=Debug, by_name=True)
+    if not cached:
         # Call sRNAbench
         code_returned = sRNAbench(reads, sample_folder, name, threads, species, Debug)
         if code_returned:
-            functions.time_functions.print_time_stamp(filename_stamp)
+            step_cache.save_step(step_info)
         else:
             print ('** Sample %s failed...' %name)
             return(False)
@@ -85,11 +84,24 @@ def sRNAbench (reads, outpath, file_name, num_threads, species, Debug):
         print (colored("** ERROR: Only 1 fastq file is allowed please joined reads before...", 'red'))
         exit()
     
+    ## use collapsed reads of the sample: read count format (sequence and count)
+    input_file = reads[0]
+    collapsed_file = collapse_reads.get_collapsed(reads, file_name, Debug, folder=outpath)
+    if collapsed_file:
+        input_file = os.path.join(outpath, file_name + '.rc')
+        collapse_reads.write_tabular(collapsed_file, input_file)
+    
     ## create command    
     java_exe = set_config.get_exe('java', Debug=Debug)
-    cmd = '%s -jar %s dbPath=%s input=%s output=%s' %(java_exe, sRNAbench_exe, sRNAbench_db, reads[0], outpath)  
+    cmd = '%s -jar %s dbPath=%s input=%s output=%s' %(java_exe, sRNAbench_exe, sRNAbench_db, input_file, outpath)  
     cmd = cmd + ' microRNA=%s isoMiR=true plotLibs=true graphics=true' %species 
     cmd = cmd + ' plotMiR=true bedGraphMode=true writeGenomeDist=true'
     cmd = cmd + ' chromosomeLevel=true chrMappingByLength=true > ' + logfile 
     
-    return(functions.system_call_functions.system_call(cmd))
+    code_returned = exec_trace.system_call(cmd, 'sRNAbench', file_name, threads=num_threads, inputs=[input_file], outputs=[outpath])
+    
+    ## remove read count file: collapsed reads are kept
+    if collapsed_file:
+        os.remove(input_file)
+    
+    return(code_returned)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Content-addressed cache for each step of the analysis.
+
+Each step is identified by a key: a hash of its input files, the parameters used
+to build the command line and the version of the software employed. A step is
+skipped only if a previous execution generated the same key and all its outputs
+are still available. If any input, parameter or software version changes, the
+step is executed again.
+
+Input files are identified by size and modification time. If content hashing is
+enabled (XICRA_CACHE_HASH=1), the SHA256 of each input is used instead.
+
+If a shared cache folder is provided (XICRA_CACHE_DIR), outputs of each step are
+also stored there and reused by any other project. The shared key is always
+computed from the content of the inputs, the parameters and the software
+version: it does not depend on the location of the files nor on the sample name,
+unless the outputs report the sample name (by_name). Steps generating more than
+XICRA_CACHE_MAX_SIZE Gb (default: 5) are not stored.
+'''
+## useful imports
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from termcolor import colored
+
+## import my modules
+from XICRA.config import set_config
+import HCGB.functions.aesthetics_functions as HCGB_aes
+import HCGB.functions.time_functions as HCGB_time
+
+## settings
+cache_settings = { 'cache_dir': os.environ.get('XICRA_CACHE_DIR'),
+                   'content_hash': os.environ.get('XICRA_CACHE_HASH', '') in ('1', 'true', 'True'),
+                   'max_size': float(os.environ.get('XICRA_CACHE_MAX_SIZE', 5)) }
+
+## software versions and content hashes already computed
+_versions = {}
+_hashes = {}
+_lock = threading.Lock()
+
+############################
+def set_cache(cache_dir=None, content_hash=False, max_size=None):
+    """Sets the shared cache folder and the hashing mode for the inputs.
+
+    :param cache_dir: Folder to store outputs shared across projects.
+    :param content_hash: Use the SHA256 of the input files instead of size and modification time.
+    :param max_size: Maximum size (Gb) of the outputs of a step stored in the shared cache folder.
+    """
+    if cache_dir:
+        cache_settings['cache_dir'] = os.path.abspath(cache_dir)
+    if content_hash:
+        cache_settings['content_hash'] = True
+    if max_size:
+        cache_settings['max_size'] = float(max_size)
+
+############################
+def tool_version(prog, Debug=False):
+    """Returns the version of the software as reported by set_config.get_exe().
+
+    Each software is checked only once per execution.
+    """
+    if not prog:
+        return ('')
+
+    with _lock:
+        if prog in _versions:
+            return (_versions[prog])
+
+    (exe, version) = set_config.get_exe(prog, Debug=Debug, Return_Version=True)
+    with _lock:
+        _versions[prog] = version
+    return (version)
+
+############################
+def file_hash(path):
+    """Returns the SHA256 of the file provided. Computed only once per file and modification time."""
+    stat_info = os.stat(path)
+    id_file = (os.path.realpath(path), stat_info.st_size, stat_info.st_mtime_ns)
+    with _lock:
+        if id_file in _hashes:
+            return (_hashes[id_file])
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024*1024), b''):
+            sha256.update(chunk)
+
+    with _lock:
+        _hashes[id_file] = sha256.hexdigest()
+    return (_hashes[id_file])
+
+############################
+def list_files(path):
+    """Returns all files for the path provided. Hidden files and folders are skipped."""
+    if os.path.isfile(path):
+        return ([path])
+
+    list_files_path = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted([ d for d in dirs if not d.startswith('.') ])
+        for f in sorted(files):
+            if not f.startswith('.'):
+                list_files_path.append(os.path.join(root, f))
+    return (list_files_path)
+
+############################
+def file_signature(path, content_hash):
+    """Returns a list identifying the file or folder provided, independent of its location."""
+    if not os.path.exists(path):
+        return ({ 'missing': os.path.basename(path) })
+
+    signature = []
+    for f in list_files(path):
+        stat_info = os.stat(f)
+        if content_hash:
+            signature.append({ 'size': stat_info.st_size, 'sha256': file_hash(f) })
+        else:
+            signature.append({ 'size': stat_info.st_size, 'mtime': stat_info.st_mtime_ns })
+    return (signature)
+
+############################
+def step_key(info):
+    """Returns the key for the information of the step provided."""
+    return (hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest())
+
+############################
+def record_file(folder, step):
+    """Returns the file containing the cache record for the step provided."""
+    return (os.path.join(folder, '.cache_' + step + '.json'))
+
+############################
+def check_step(folder, step, name, inputs, params, prog=None, legacy_stamp=None, Debug=False, outputs=None, by_name=False):
+    """Checks if the step was previously generated with the same inputs, parameters and software version.
+
+    :param folder: Output folder for the step.
+    :param step: Name of the step, e.g. cutadapt.
+    :param name: Sample name.
+    :param inputs: List of input files or folders.
+    :param params: String with any parameter that modifies the results (excluding output paths).
+    :param prog: Software name to retrieve its version, as in set_config.get_exe().
+    :param legacy_stamp: Timestamp file created by previous versions. If available, results are adopted.
+    :param Debug: Show additional information.
+    :param outputs: Output files required to adopt results of previous versions. By default, any file within the output folder.
+    :param by_name: The sample name is reported within the outputs: results are only shared with samples of the same name.
+
+    :type inputs: list
+    :type params: string
+    :type outputs: list
+    :type by_name: boolean
+
+    :returns: (True/False, step_info). Provide step_info to save_step() once the step succeeds.
+    """
+    content_hash = cache_settings['content_hash']
+    version = tool_version(prog, Debug)
+    info = { 'step': step,
+             'name': name,
+             'params': params,
+             'version': version,
+             'inputs': [ file_signature(f, content_hash) for f in inputs ] }
+    step_info = { 'folder': os.path.abspath(folder), 'key': step_key(info), 'info': info, 'shared_key': None }
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("Cache key for %s [%s]: %s" %(step, name, step_info['key']), "yellow")
+
+    ## local record
+    record = read_record(folder, step)
+    if record and record['key'] == step_info['key'] and outputs_available(folder, record['outputs']):
+        print (colored("\tA previous command generated results on: %s [%s -- %s]" %(record['date'], name, step), 'yellow'))
+        return (True, step_info)
+
+    ## adopt results generated by previous versions, only if its outputs are available
+    if not record and legacy_stamp and os.path.isfile(legacy_stamp):
+        legacy_outputs = list_files(folder) if outputs is None else outputs
+        if all([ os.path.isfile(f) for f in legacy_outputs ]) and sum([ os.path.getsize(f) for f in legacy_outputs ]) > 0:
+            stamp = HCGB_time.read_time_stamp(legacy_stamp)
+            print (colored("\tA previous command generated results on: %s [%s -- %s]" %(stamp, name, step), 'yellow'))
+            save_step(step_info, legacy_outputs, store=False)
+            return (True, step_info)
+
+    ## shared cache: key on the content of the inputs, parameters and version
+    if not cache_settings['cache_dir']:
+        return (False, step_info)
+
+    shared_info = { 'step': step,
+                    'params': params,
+                    'version': version,
+                    'inputs': [ file_signature(f, True) for f in inputs ] }
+    if by_name:
+        shared_info['name'] = name
+    step_info['shared_key'] = step_key(shared_info)
+
+    if restore_shared(step_info, Debug):
+        print (colored("\tResults retrieved from shared cache [%s -- %s]" %(name, step), 'yellow'))
+        return (True, step_info)
+
+    return (False, step_info)
+
+############################
+def save_step(step_info, outputs=None, store=True):
+    """Saves the record for a step succeeded and stores its outputs in the shared cache, if any.
+
+    :param step_info: Information returned by check_step().
+    :param outputs: List of output files. By default, all files within the output folder.
+    :param store: Copy outputs into shared cache folder.
+    """
+    folder = step_info['folder']
+    if outputs is None:
+        outputs = list_files(folder)
+
+    outputs_dict = {}
+    for f in outputs:
+        if os.path.isfile(f):
+            outputs_dict[os.path.relpath(os.path.abspath(f), folder)] = os.path.getsize(f)
+
+    record = { 'key': step_info['key'],
+               'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+               'outputs': outputs_dict }
+    record.update(step_info['info'])
+
+    ## write record atomically
+    tmp_file = record_file(folder, step_info['info']['step']) + '.tmp' + str(threading.get_ident())
+    with open(tmp_file, 'w') as fh:
+        json.dump(record, fh, indent=1)
+    os.replace(tmp_file, record_file(folder, step_info['info']['step']))
+
+    if store and step_info['shared_key']:
+        store_shared(step_info, outputs_dict)
+
+############################
+def read_record(folder, step):
+    """Returns the cache record for the step or None."""
+    file_record = record_file(folder, step)
+    if not os.path.isfile(file_record):
+        return (None)
+    try:
+        with open(file_record) as fh:
+            return (json.load(fh))
+    except ValueError:
+        return (None)
+
+############################
+def outputs_available(folder, outputs_dict):
+    """Checks all outputs recorded exist and have the same size."""
+    for f, size in outputs_dict.items():
+        file_path = os.path.join(folder, f)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != size:
+            return (False)
+    return (True)
+
+############################
+def copy_file(src, dest):
+    """Copies file src into dest.
+
+    Files are never hard linked: outputs are rewritten in place by later executions
+    (e.g. shell redirections), which would modify the copy stored in the shared cache.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_file = dest + '.tmp' + str(threading.get_ident())
+    shutil.copy2(src, tmp_file)
+    os.replace(tmp_file, dest)
+
+############################
+def shared_folder(key):
+    """Returns the folder in the shared cache for the key provided."""
+    return (os.path.join(cache_settings['cache_dir'], key[:2], key))
+
+############################
+def store_shared(step_info, outputs_dict):
+    """Stores outputs of the step into the shared cache folder, unless larger than XICRA_CACHE_MAX_SIZE Gb."""
+    final_folder = shared_folder(step_info['shared_key'])
+    if os.path.isdir(final_folder):
+        return ()
+
+    ## size guard
+    size_outputs = sum(outputs_dict.values())
+    if size_outputs > cache_settings['max_size'] * 1024**3:
+        print (colored("** WARNING: Results of %s [%s] not stored in shared cache: %.2f Gb > %s Gb (XICRA_CACHE_MAX_SIZE)" %(
+            step_info['info']['step'], step_info['info']['name'], size_outputs / 1024**3, cache_settings['max_size']), 'yellow'))
+        return ()
+
+    ## build in a temporary folder and rename: other processes never see partial results
+    tmp_folder = final_folder + '.tmp.%s.%s' %(os.getpid(), threading.get_ident())
+    try:
+        for f in outputs_dict:
+            copy_file(os.path.join(step_info['folder'], f), os.path.join(tmp_folder, 'files', f))
+        with open(os.path.join(tmp_folder, 'manifest.json'), 'w') as fh:
+            json.dump({ 'key': step_info['shared_key'], 'name': step_info['info']['name'], 
+                        'outputs': outputs_dict, 'info': step_info['info'] }, fh, indent=1)
+        os.rename(tmp_folder, final_folder)
+    except OSError as exc:
+        print (colored("** WARNING: Results could not be stored in shared cache: %s" %exc, 'yellow'))
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+############################
+def rename_output(relpath, name_stored, name):
+    """Returns the path of an output stored for sample name_stored, named after the sample provided."""
+    if name_stored == name:
+        return (relpath)
+    return (os.path.join(os.path.dirname(relpath), os.path.basename(relpath).replace(name_stored, name)))
+
+############################
+def restore_shared(step_info, Debug):
+    """Retrieves outputs of the step from the shared cache folder, if available."""
+    folder_key = shared_folder(step_info['shared_key'])
+    manifest_file = os.path.join(folder_key, 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        return (False)
+
+    with open(manifest_file) as fh:
+        manifest = json.load(fh)
+
+    if not outputs_available(os.path.join(folder_key, 'files'), manifest['outputs']):
+        return (False)
+
+    ## debug messages
+    if Debug:
+        HCGB_aes.debug_message("Retrieve from shared cache: " + folder_key, "yellow")
+
+    ## outputs named after the sample are renamed
+    outputs = []
+    for f in manifest['outputs']:
+        outputs.append(os.path.join(step_info['folder'], rename_output(f, manifest['name'], step_info['info']['name'])))
+        copy_file(os.path.join(folder_key, 'files', f), outputs[-1])
+
+    save_step(step_info, outputs, store=False)
+    return (True)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Loads the results tables of each sample with compact types and in parallel.
+
+Tables are read with only the columns required and with fixed types:
+
+- categorical: names and variants (miRNA, Variant, tRNA, variant, piRNA, RNAbiotypes)
+- string: identifiers and sequences (UID, Read). Stored as arrow strings (a single buffer 
+  per column) if pyarrow is available, or as python strings otherwise. Fixed-width bytes 
+  are not used: pandas stores them as python objects.
+- int32: counts, if all values are integers (float64 otherwise). Other columns are kept as read.
+
+Tables of several samples are read using a pool of processes. Results are returned
+in the same order as provided and only a few tables are read ahead, so memory does
+not depend on the number of samples.
+'''
+## useful imports
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+## column types
+category_columns = ['miRNA', 'Variant', 'tRNA', 'variant', 'piRNA', 'RNAbiotypes']
+string_columns = ['UID', 'Read']
+try:
+    string_dtype = pd.StringDtype('pyarrow')
+    pd.array([''], dtype=string_dtype)
+except ImportError:
+    string_dtype = str
+
+## tables read ahead by each process
+read_ahead = 2
+
+############################
+def read_table(this_file, usecols=None, header='infer', names=None):
+    """Reads the tab-separated table provided with compact types.
+
+    :param this_file: Table to read.
+    :param usecols: List of columns or function to select the columns to read. Default: all columns.
+    :param header: Row containing the column names. See pandas.read_csv().
+    :param names: Column names, if not included in the table.
+
+    :returns: Dataframe.
+    """
+    dtypes = dict([ (col, 'category') for col in category_columns ] + [ (col, string_dtype) for col in string_columns ])
+    data = pd.read_csv(this_file, sep='\t', usecols=usecols, header=header, names=names, dtype=dtypes)
+
+    ## counts
+    for col in data.columns:
+        if col not in dtypes:
+            data[col] = compact_counts(data[col])
+
+    return (data)
+
+############################
+def compact_counts(values):
+    """Returns the counts as int32 if all values are integers, or as float64 otherwise.
+
+    Only columns parsed as numeric by pandas are converted. Any other column (e.g. text 
+    or a sample column containing a string) is returned unchanged, instead of losing values.
+    """
+    if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return (values)
+    if not values.isna().any():
+        numbers = values.to_numpy()
+        if (numbers == np.round(numbers)).all() and (len(numbers) == 0 or np.abs(numbers).max() < 2**31):
+            return (values.astype(np.int32))
+    return (values.astype(np.float64))
+
+############################
+def parallel_map(function, args_list, threads):
+    """Calls the function for each set of arguments using a pool of processes.
+
+    Results are yielded in the same order as the arguments. Only a few calls per
+    process are submitted ahead, so results not yet consumed are bounded.
+
+    :param function: Function to call. It must be defined at module level.
+    :param args_list: List of tuples of arguments.
+    :param threads: Number of processes. If 1, calls are done in this process.
+
+    :returns: Yields the result of each call.
+    """
+    if threads <= 1 or len(args_list) <= 1:
+        for args in args_list:
+            yield (function(*args))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        futures = []
+        pending = iter(args_list)
+        for args in pending:
+            futures.append(executor.submit(function, *args))
+            if len(futures) >= threads * read_ahead:
+                break
+
+        while futures:
+            result = futures.pop(0).result()
+            for args in pending:
+                futures.append(executor.submit(function, *args))
+                break
+            yield (result)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy           ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain ##
+##########################################################
+'''
+Executes a directed acyclic graph (DAG) of tasks.
+
+Each task is a function call that depends on zero or more previous tasks. A task
+is sent to the pool of workers as soon as all its dependencies are finished, so
+different samples can be at different stages of the pipeline at the same time
+(e.g. sample A is being mapped while sample B is still being trimmed).
+
+Each task could declare the threads and memory it requires. Tasks are only sent
+if they fit into the CPUs and memory still available, so the pool never takes more
+resources than those provided (see XICRA.scripts.resource_manager).
+
+A task fails if it raises an exception or returns False. Tasks depending on a
+failed task are skipped.
+'''
+## useful imports
+import collections
+import concurrent.futures
+from termcolor import colored
+
+## import my modules
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+############################
+def add_task(graph, task_id, function, args=(), depends=(), sample="", step="", exclusive=None, threads=1, memory=0):
+    """Adds a task into the graph provided.
+
+    :param graph: Dictionary containing tasks, as generated by previous calls.
+    :param task_id: Unique identifier for the task, e.g. sample1_trim.
+    :param function: Function to call.
+    :param args: Arguments to pass to the function.
+    :param depends: List of task identifiers that must finish before this task starts.
+    :param sample: Sample name, for reporting purposes.
+    :param step: Step of the pipeline, for reporting purposes.
+    :param exclusive: Name of a group of tasks that can not run at the same time.
+    :param threads: Number of threads used by the task.
+    :param memory: Memory (bytes) required by the task.
+
+    :type graph: dict
+    :type task_id: string
+    :type args: list
+    :type depends: list
+    :type sample: string
+    :type step: string
+    :type exclusive: string
+    :type threads: int
+    :type memory: int
+
+    :returns: Dictionary updated.
+    """
+    if task_id in graph:
+        print (colored("** ERROR: Task %s is already included in the graph" %task_id, 'red'))
+        exit()
+
+    graph[task_id] = { 'function': function,
+                       'args': list(args),
+                       'depends': list(depends),
+                       'sample': sample,
+                       'step': step,
+                       'exclusive': exclusive,
+                       'threads': threads,
+                       'memory': memory }
+    return (graph)
+
+############################
+def check_graph(graph):
+    """Checks all dependencies exist and there are no cycles in the graph.
+
+    It uses Kahn's algorithm to get a topological order of the tasks.
+
+    :param graph: Dictionary containing tasks generated using add_task().
+
+    :returns: List of task identifiers sorted in topological order.
+    """
+    ## check dependencies
+    for task_id, task in graph.items():
+        for dep in task['depends']:
+            if dep not in graph:
+                print (colored("** ERROR: Task %s depends on missing task %s" %(task_id, dep), 'red'))
+                exit()
+
+    ## Kahn's algorithm
+    dependents = get_dependents(graph)
+    pending = { task_id: len(task['depends']) for task_id, task in graph.items() }
+    ready = collections.deque([ task_id for task_id, n in pending.items() if n == 0 ])
+    order = []
+    while ready:
+        task_id = ready.popleft()
+        order.append(task_id)
+        for child in dependents[task_id]:
+            pending[child] -= 1
+            if pending[child] == 0:
+                ready.append(child)
+
+    if len(order) != len(graph):
+        print (colored("** ERROR: The graph of tasks contains a cycle", 'red'))
+        exit()
+
+    return (order)
+
+############################
+def get_dependents(graph):
+    """Returns a dictionary with the tasks that depend on each task."""
+    dependents = { task_id: [] for task_id in graph }
+    for task_id, task in graph.items():
+        for dep in task['depends']:
+            dependents[dep].append(task_id)
+    return (dependents)
+
+############################
+def run_graph(graph, max_workers, Debug, threads=None, memory=None):
+    """Executes all the tasks in the graph using a pool of workers.
+
+    Tasks are submitted in insertion order as soon as their dependencies are
+    satisfied and there are enough threads and memory available. If the next
+    task does not fit, later tasks requiring less resources are sent instead.
+    When a task fails, all tasks depending on it are skipped but the rest of
+    the graph continues.
+
+    :param graph: Dictionary containing tasks generated using add_task().
+    :param max_workers: Maximum number of tasks to run at the same time.
+    :param Debug: Show additional information.
+    :param threads: Total number of threads available. Default: no limit.
+    :param memory: Total memory (bytes) available. Default: no limit.
+
+    :type graph: dict
+    :type max_workers: int
+    :type Debug: bool
+    :type threads: int
+    :type memory: int
+
+    :returns: Dictionary with the status of each task: done, failed or skipped.
+    """
+    order = check_graph(graph)
+    position = { task_id: i for i, task_id in enumerate(graph) }
+    dependents = get_dependents(graph)
+
+    ##
+    status = {}
+    pending = { task_id: len(task['depends']) for task_id, task in graph.items() }
+    ready = [ task_id for task_id in graph if pending[task_id] == 0 ]
+    running = {}
+    busy_groups = set()
+    used = { 'threads': 0, 'memory': 0 }
+
+    if Debug:
+        HCGB_aes.debug_message("Tasks in graph: " + str(len(graph)), "yellow")
+        HCGB_aes.debug_message("Topological order: ", "yellow")
+        print (order)
+
+    ## skip all tasks depending on a failed task
+    def skip_dependents(task_id):
+        stack = list(dependents[task_id])
+        while stack:
+            child = stack.pop()
+            if child in status:
+                continue
+            status[child] = 'skipped'
+            print (colored("** Task %s is skipped: a previous step failed" %child, 'yellow'))
+            stack.extend(dependents[child])
+
+    ## enough resources for the task: if nothing is running, send it anyway
+    def task_fits(task):
+        if not running:
+            return (True)
+        if threads and used['threads'] + task['threads'] > threads:
+            return (False)
+        if memory and used['memory'] + task['memory'] > memory:
+            return (False)
+        return (True)
+
+    ## task finished
+    def task_finished(task_id, result):
+        if result is False:
+            status[task_id] = 'failed'
+            print (colored("** Task %s failed" %task_id, 'red'))
+            skip_dependents(task_id)
+        else:
+            status[task_id] = 'done'
+            for child in dependents[task_id]:
+                pending[child] -= 1
+                if pending[child] == 0 and child not in status:
+                    ready.append(child)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            ## submit tasks ready, keep insertion order
+            ready.sort(key=lambda x: position[x])
+            waiting = []
+            for task_id in ready:
+                if task_id in status:
+                    continue
+                task = graph[task_id]
+                if len(running) >= max_workers or (task['exclusive'] and task['exclusive'] in busy_groups):
+                    waiting.append(task_id)
+                    continue
+                if not task_fits(task):
+                    waiting.append(task_id)
+                    continue
+
+                if Debug:
+                    HCGB_aes.debug_message("Submit task: " + task_id, "yellow")
+
+                if task['exclusive']:
+                    busy_groups.add(task['exclusive'])
+                used['threads'] += task['threads']
+                used['memory'] += task['memory']
+                running[executor.submit(task['function'], *task['args'])] = task_id
+            ready[:] = waiting
+
+            if not running:
+                break
+
+            ## wait for any task to finish
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                task_id = running.pop(fut)
+                if graph[task_id]['exclusive']:
+                    busy_groups.discard(graph[task_id]['exclusive'])
+                used['threads'] -= graph[task_id]['threads']
+                used['memory'] -= graph[task_id]['memory']
+                try:
+                    result = fut.result()
+                except (Exception, SystemExit) as exc:
+                    ## some callers exit() when a command fails
+                    print ('***ERROR:')
+                    print('%r generated an exception: %s' % (task_id, exc))
+                    result = False
+                task_finished(task_id, result)
+
+    return (status)
+
+############################
+def summary_graph(graph, status):
+    """Prints the number of tasks done, failed or skipped per step."""
+    steps = collections.OrderedDict()
+    for task_id, task in graph.items():
+        steps.setdefault(task['step'], collections.Counter())[status.get(task_id, 'skipped')] += 1
+
+    for step, counts in steps.items():
+        print ("\t%s: %s done, %s failed, %s skipped" %(step, counts['done'], counts['failed'], counts['skipped']))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez, Marta Lopez & Lauro Sumoy             ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Performance benchmark for XICRA modules.
+
+It generates synthetic small RNA libraries offline using the isomiR sequences from
+the simulation example (BMC_bioinformatics_paper/simulation), runs each XICRA module
+and reports wall time, CPU time, reads/second, peak memory and disk I/O per stage.
+Results are stored as JSON and could be compared against a baseline to flag
+regressions.
+
+    python benchmark.py generate --out lib_1M --reads 1000000 --samples 2 --mode PE
+    python benchmark.py run --reads_dir lib_1M --out run_1M --stages prep trim join miRNA \\
+                            --software miraligner --database db -t 8
+    python benchmark.py compare --results run_1M/benchmark.json --baseline baselines/1M_PE.json
+"""
+## import useful modules
+import os
+import sys
+import time
+import json
+import gzip
+import shutil
+import socket
+import platform
+import argparse
+import subprocess
+import numpy as np
+
+## folder of this script
+benchmark_folder = os.path.dirname(os.path.abspath(__file__))
+default_fasta = os.path.join(benchmark_folder, '..', '..', '..', 'BMC_bioinformatics_paper', 'simulation',
+                             'example', 'isomiR_simulations', 'rep_1.freqs.isomiRs.fasta')
+
+## Illumina TruSeq small RNA adapters: 3' adapter in R1, reverse complement of 5' adapter in R2
+adapter_R1 = 'TGGAATTCTCGGGTGCCAAGG'
+adapter_R2 = 'GATCGTCGGACTGTAGAACTCTGAAC'
+
+## stages available, in order
+stages_available = ['prep', 'QC', 'trim', 'join', 'miRNA', 'tRNA', 'biotype']
+
+## metrics compared: True if higher is better
+metrics_compared = { 'wall_time': False, 'cpu_time': False, 'max_rss': False,
+                     'write_bytes': False, 'reads_per_sec': True }
+
+#########################################################
+def read_fasta(fasta_file):
+    """Returns the list of sequences in the fasta file (DNA alphabet)."""
+    seqs = []
+    seq = []
+    with open(fasta_file) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                if seq:
+                    seqs.append("".join(seq))
+                seq = []
+            elif line:
+                seq.append(line.upper().replace('U', 'T'))
+    if seq:
+        seqs.append("".join(seq))
+    return (seqs)
+
+#########################################################
+def rev_comp(seq):
+    """Returns the reverse complement of a DNA sequence."""
+    return (seq.translate(str.maketrans('ACGTN', 'TGCAN'))[::-1])
+
+#########################################################
+def templates(seqs, read_len, pair):
+    """Returns arrays (sequences x read_len) with the read expected for each isomiR (R1 and R2)."""
+    filler = 'A' * read_len
+    T1 = np.array([ list((s + adapter_R1 + filler)[:read_len].encode()) for s in seqs ], dtype=np.uint8)
+    T2 = None
+    if pair:
+        T2 = np.array([ list((rev_comp(s) + adapter_R2 + filler)[:read_len].encode()) for s in seqs ], dtype=np.uint8)
+    return (T1, T2)
+
+#########################################################
+def add_errors(chunk, error_rate, rng):
+    """Introduces random substitutions in the reads at the rate provided."""
+    if error_rate <= 0:
+        return (chunk)
+    mask = rng.random(chunk.shape) < error_rate
+    chunk[mask] = rng.choice(np.frombuffer(b'ACGT', dtype=np.uint8), int(mask.sum()))
+    return (chunk)
+
+#########################################################
+def write_chunk(fh, chunk, name, start, read_tag, quality):
+    """Writes a chunk of reads in FASTQ format."""
+    read_len = chunk.shape[1]
+    buf = chunk.tobytes()
+    name = name.encode()
+    records = [ b"@%s_%d/%s\n%s\n+\n%s\n" %(name, start + i, read_tag, buf[i*read_len:(i+1)*read_len], quality)
+                for i in range(chunk.shape[0]) ]
+    fh.write(b"".join(records))
+
+#########################################################
+def generate_library(args):
+    """Generates synthetic small RNA libraries with the number of reads provided for each sample."""
+    fasta = os.path.abspath(args.fasta)
+    out = os.path.abspath(args.out)
+    os.makedirs(out, exist_ok=True)
+    pair = (args.mode == 'PE')
+
+    print ("+ Generate synthetic libraries")
+    print ("+ isomiR sequences: " + fasta)
+    seqs = read_fasta(fasta)
+    (T1, T2) = templates(seqs, args.read_len, pair)
+    print ("+ Sequences: %s; Reads/sample: %s; Samples: %s; Mode: %s" %(len(seqs), args.reads, args.samples, args.mode))
+
+    ## quality: decreasing along the read
+    quality = bytes([ max(53, 73 - int(20 * i / args.read_len)) for i in range(args.read_len) ])
+
+    rng = np.random.default_rng(args.seed)
+    start_time = time.time()
+    for s in range(args.samples):
+        name = "sample%s" %(s + 1)
+        files = [ gzip.open(os.path.join(out, name + '_R1.fastq.gz'), 'wb', compresslevel=1) ]
+        if pair:
+            files.append(gzip.open(os.path.join(out, name + '_R2.fastq.gz'), 'wb', compresslevel=1))
+
+        done = 0
+        while done < args.reads:
+            n = min(args.chunk, args.reads - done)
+            idx = rng.integers(0, len(seqs), size=n)
+            write_chunk(files[0], add_errors(T1[idx], args.error_rate, rng), name, done, b'1', quality)
+            if pair:
+                write_chunk(files[1], add_errors(T2[idx], args.error_rate, rng), name, done, b'2', quality)
+            done += n
+
+        for fh in files:
+            fh.close()
+        print ("\t+ Sample %s generated" %name)
+
+    ## information of the library
+    info = { 'fasta': fasta, 'reads': args.reads, 'samples': args.samples, 'mode': args.mode,
+             'read_len': args.read_len, 'error_rate': args.error_rate, 'seed': args.seed,
+             'adapter_R1': adapter_R1, 'adapter_R2': adapter_R2 }
+    with open(os.path.join(out, 'library.json'), 'w') as fh:
+        json.dump(info, fh, indent=1)
+
+    print ("+ Libraries generated in %.1f seconds: %s" %(time.time() - start_time, out))
+    return (info)
+
+#########################################################
+def stage_command(stage, args, reads_dir, project, pair):
+    """Returns the XICRA command line for the stage provided."""
+    cmd = [ args.XICRA, stage, '-i', project, '-t', str(args.threads) ]
+    if not pair:
+        cmd.append('--single_end')
+
+    if stage == 'prep':
+        cmd[3] = reads_dir
+        cmd += ['-o', project]
+    elif stage == 'QC':
+        cmd += ['--skip_report']
+    elif stage == 'trim':
+        cmd += ['--adapters_a', adapter_R1, '--skip_report']
+        if pair:
+            cmd += ['--adapters_A', adapter_R2]
+    elif stage == 'miRNA':
+        cmd += ['--software'] + args.software
+    elif stage == 'tRNA':
+        cmd += ['--software', 'mintmap']
+    elif stage == 'biotype':
+        cmd += ['--annotation', args.annotation, '--skip_report']
+        if args.genomeDir:
+            cmd += ['--genomeDir', args.genomeDir]
+        else:
+            cmd += ['--fasta', args.fasta_genome]
+
+    ## use raw reads if not trimmed
+    if 'trim' not in args.stages and stage in ('join', 'miRNA', 'tRNA', 'biotype'):
+        cmd.append('--noTrim')
+
+    if args.database and stage in ('miRNA', 'tRNA', 'biotype'):
+        cmd += ['--database', args.database]
+    return (cmd)
+
+#########################################################
+def folder_size(folder):
+    """Returns the size (bytes) of all files within the folder."""
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            file_path = os.path.join(root, f)
+            if os.path.isfile(file_path) and not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return (size)
+
+#########################################################
+def trace_summary(trace_file):
+    """Returns wall time, CPU time and peak memory for each software in the XICRA trace file."""
+    tools = {}
+    if not os.path.isfile(trace_file):
+        return (tools)
+    with open(trace_file) as fh:
+        for line in fh:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            info = tools.setdefault(r['step'], { 'calls': 0, 'wall_time': 0, 'cpu_time': 0, 'max_rss': 0 })
+            info['calls'] += 1
+            info['wall_time'] = round(info['wall_time'] + r['wall_time'], 3)
+            info['cpu_time'] = round(info['cpu_time'] + r['cpu_time'], 3)
+            info['max_rss'] = max(info['max_rss'], r['max_rss'])
+    return (tools)
+
+#########################################################
+def run_stage(cmd, log_file, trace_file):
+    """Executes the command and returns resources used by the process and all its children."""
+    env = dict(os.environ)
+    env['XICRA_TRACE'] = trace_file
+
+    start = time.time()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        (pid, status, rusage) = os.wait4(proc.pid, 0)
+    wall_time = time.time() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    ## ru_maxrss: kilobytes on linux, bytes on macOS
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return ({ 'returncode': proc.returncode,
+              'wall_time': round(wall_time, 3),
+              'cpu_time': round(rusage.ru_utime + rusage.ru_stime, 3),
+              'max_rss': max_rss,
+              'read_bytes': rusage.ru_inblock * 512,
+              'write_bytes': rusage.ru_oublock * 512 })
+
+#########################################################
+def environment_info(args):
+    """Returns information of the system and XICRA version employed."""
+    version = ""
+    version_file = os.path.join(benchmark_folder, '..', '..', 'VERSION')
+    if os.path.isfile(version_file):
+        version = open(version_file).read().strip()
+
+    commit = ""
+    try:
+        commit = subprocess.check_output(['git', '-C', benchmark_folder, 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return ({ 'date': time.strftime("%Y-%m-%d %H:%M:%S"), 'host': socket.gethostname(),
+              'platform': platform.platform(), 'python': platform.python_version(),
+              'cpus': os.cpu_count(), 'threads': args.threads, 'XICRA_version': version, 'commit': commit })
+
+#########################################################
+def run_benchmark(args):
+    """Executes each stage selected and saves resources used in JSON format."""
+    reads_dir = os.path.abspath(args.reads_dir)
+    out = os.path.abspath(args.out)
+    project = os.path.join(out, 'project')
+    logs = os.path.join(out, 'logs')
+    if os.path.isdir(project) and not args.keep:
+        shutil.rmtree(project)
+    os.makedirs(logs, exist_ok=True)
+
+    with open(os.path.join(reads_dir, 'library.json')) as fh:
+        library = json.load(fh)
+    pair = (library['mode'] == 'PE')
+    total_reads = library['reads'] * library['samples']
+
+    ## keep order of the stages
+    stages = [ s for s in stages_available if s in args.stages ]
+    if not pair and 'join' in stages:
+        stages.remove('join')
+
+    results = { 'name': args.name, 'library': library, 'environment': environment_info(args), 'stages': {} }
+    for stage in stages:
+        cmd = stage_command(stage, args, reads_dir, project, pair)
+        print ("+ Stage %s: %s" %(stage, " ".join(cmd)))
+
+        size_before = folder_size(project) if os.path.isdir(project) else 0
+        info = run_stage(cmd, os.path.join(logs, stage + '.log'), os.path.join(logs, stage + '.trace.jsonl'))
+        info['disk_bytes'] = (folder_size(project) if os.path.isdir(project) else 0) - size_before
+        info['reads_per_sec'] = round(total_reads / info['wall_time'], 1) if info['wall_time'] else 0
+        info['tools'] = trace_summary(os.path.join(logs, stage + '.trace.jsonl'))
+        results['stages'][stage] = info
+
+        print ("\t%.1f s; %.1f reads/s; %.1f Mb peak memory; exit code %s" %(
+            info['wall_time'], info['reads_per_sec'], info['max_rss']/1024**2, info['returncode']))
+        if info['returncode'] != 0:
+            print ("** ERROR: Stage %s failed. See %s" %(stage, os.path.join(logs, stage + '.log')))
+            break
+
+    results_file = os.path.join(out, 'benchmark.json')
+    with open(results_file, 'w') as fh:
+        json.dump(results, fh, indent=1)
+    print ("+ Results: " + results_file)
+
+    if args.save_baseline:
+        baseline_file = os.path.join(benchmark_folder, 'baselines', args.name + '.json')
+        os.makedirs(os.path.dirname(baseline_file), exist_ok=True)
+        shutil.copy(results_file, baseline_file)
+        print ("+ Baseline saved: " + baseline_file)
+
+    return (results)
+
+#########################################################
+def compare_results(args):
+    """Compares results against a baseline. Returns the number of regressions found."""
+    with open(args.results) as fh:
+        results = json.load(fh)
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+
+    if results['library']['reads'] != baseline['library']['reads'] or results['library']['mode'] != baseline['library']['mode']:
+        print ("** WARNING: libraries differ between results and baseline")
+
+    regressions = 0
+    print ("%-10s %-15s %15s %15s %9s" %("stage", "metric", "baseline", "current", "change"))
+    for stage, info_base in baseline['stages'].items():
+        info = results['stages'].get(stage)
+        if not info:
+            print ("%-10s not available in results" %stage)
+            continue
+
+        for metric, higher_better in metrics_compared.items():
+            base_value = info_base.get(metric, 0)
+            value = info.get(metric, 0)
+            if not base_value:
+                continue
+            change = (value - base_value) / base_value
+            worse = (change < -args.tolerance) if higher_better else (change > args.tolerance)
+            flag = "  REGRESSION" if worse else ""
+            regressions += int(worse)
+            print ("%-10s %-15s %15.1f %15.1f %+8.1f%%%s" %(stage, metric, base_value, value, change*100, flag))
+
+    print ("\n+ Regressions found: %s (tolerance: %.0f%%)" %(regressions, args.tolerance*100))
+    return (regressions)
+
+#####################################################
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Performance benchmark for XICRA modules.')
+    subparsers = parser.add_subparsers(title='commands', dest='command')
+
+    ## generate
+    parser_generate = subparsers.add_parser('generate', help='Generate synthetic small RNA libraries.')
+    parser_generate.add_argument('--out', required=True, help='Folder to store reads.')
+    parser_generate.add_argument('--fasta', default=default_fasta, help='isomiR sequences to simulate [Default: simulation example].')
+    parser_generate.add_argument('--reads', type=int, default=1000000, help='Reads for each sample [Default: 1000000].')
+    parser_generate.add_argument('--samples', type=int, default=2, help='Number of samples [Default: 2].')
+    parser_generate.add_argument('--mode', choices=['PE', 'SE'], default='PE', help='Paired-end or single-end reads [Default: PE].')
+    parser_generate.add_argument('--read_len', type=int, default=50, help='Read length [Default: 50].')
+    parser_generate.add_argument('--error_rate', type=float, default=0.001, help='Substitution rate per base [Default: 0.001].')
+    parser_generate.add_argument('--seed', type=int, default=123456789, help='Random seed.')
+    parser_generate.add_argument('--chunk', type=int, default=200000, help='Reads generated at once.')
+
+    ## run
+    parser_run = subparsers.add_parser('run', help='Run XICRA modules and measure resources.')
+    parser_run.add_argument('--reads_dir', required=True, help='Folder with reads generated.')
+    parser_run.add_argument('--out', required=True, help='Folder to store XICRA project and results.')
+    parser_run.add_argument('--name', default='benchmark', help='Name for the results and baseline.')
+    parser_run.add_argument('--stages', nargs='*', choices=stages_available, default=['prep', 'trim', 'join'])
+    parser_run.add_argument('-t', '--threads', type=int, default=2)
+    parser_run.add_argument('--XICRA', default='XICRA', help='XICRA executable [Default: XICRA].')
+    parser_run.add_argument('--software', nargs='*', default=['miraligner'], choices=['sRNAbench','optimir', 'miraligner'])
+    parser_run.add_argument('--database', help='XICRA database folder.')
+    parser_run.add_argument('--annotation', help='GTF annotation for biotype stage.')
+    parser_run.add_argument('--genomeDir', help='STAR genomeDir for biotype stage.')
+    parser_run.add_argument('--fasta_genome', help='Reference genome for biotype stage.')
+    parser_run.add_argument('--keep', action='store_true', help='Keep a previous project: steps already done are reused.')
+    parser_run.add_argument('--save_baseline', action='store_true', help='Save results as baseline: baselines/<name>.json')
+
+    ## compare
+    parser_compare = subparsers.add_parser('compare', help='Compare results against a baseline.')
+    parser_compare.add_argument('--results', required=True)
+    parser_compare.add_argument('--baseline', required=True)
+    parser_compare.add_argument('--tolerance', type=float, default=0.1, help='Relative change allowed [Default: 0.1].')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate_library(args)
+    elif args.command == 'run':
+        if 'biotype' in args.stages and (not args.annotation or not (args.genomeDir or args.fasta_genome)):
+            parser.error("biotype stage requires --annotation and --genomeDir or --fasta_genome")
+        run_benchmark(args)
+    elif args.command == 'compare':
+        if compare_results(args):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+######
+if __name__== "__main__":
+    main()
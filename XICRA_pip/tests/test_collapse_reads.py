@@ -0,0 +1,81 @@
+'''
+Tests XICRA.scripts.collapse_reads: collapsed files are expanded back into the
+same reads through the named pipe (or a temporary file) and unique sequences are
+named with their counts (<name>_<rank>_x<count>).
+'''
+import collections
+import gzip
+
+import pytest
+
+from XICRA.scripts import collapse_reads
+
+## reads of the sample: sequence and number of copies
+reads = { b'TGAGGTAGTAGGTTGTATAGTT': 5, b'TAGCTTATCAGACTGATGTTGA': 3, b'AACCCGTAGATCCGAACTTGTG': 1 }
+
+############################
+@pytest.fixture
+def collapsed(tmp_path):
+    """Returns the collapsed file of a fastq file containing the reads."""
+    fastq_file = tmp_path / 'sample.fastq.gz'
+    with gzip.open(str(fastq_file), 'wb') as fh:
+        n = 0
+        ## copies are not consecutive
+        for copy in range(max(reads.values())):
+            for seq, count in reads.items():
+                if copy < count:
+                    n += 1
+                    fh.write(b'@read%d\n%s\n+\n%s\n' %(n, seq, b'F' * len(seq)))
+
+    (collapsed_file, index_file) = collapse_reads.collapsed_files(str(tmp_path), 'sample')
+    index_info = collapse_reads.collapse(str(fastq_file), collapsed_file, index_file)
+    assert index_info['total_reads'] == sum(reads.values())
+    assert index_info['unique'] == len(reads)
+    return (collapsed_file)
+
+############################
+def read_fastq(fastq):
+    """Returns names and sequences of the fastq file, read once and sequentially as a mapper does."""
+    with open(fastq, 'rb') as fh:
+        lines = fh.read().splitlines()
+    return (lines[0::4], lines[1::4])
+
+############################
+@pytest.mark.parametrize('fifo', [True, False])
+def test_expanded_round_trip(collapsed, tmp_path, monkeypatch, fifo):
+    monkeypatch.setitem(collapse_reads.collapse_settings, 'fifo', fifo)
+    with collapse_reads.expanded_fastq(collapsed, str(tmp_path), 'sample') as fastq:
+        (names, seqs) = read_fastq(fastq)
+
+    ## same reads as the original fastq file and the pipe is removed
+    assert collections.Counter(seqs) == collections.Counter(reads)
+    assert not (tmp_path / 'sample.expanded.fastq').exists()
+
+    ## copies of a sequence share its identifier
+    for name, seq in zip(names, seqs):
+        assert collapse_reads.read_weight(name.decode()) == reads[seq]
+
+############################
+@pytest.mark.parametrize('fifo', [True, False])
+def test_unique_names(collapsed, tmp_path, monkeypatch, fifo):
+    monkeypatch.setitem(collapse_reads.collapse_settings, 'fifo', fifo)
+    with collapse_reads.expanded_fastq(collapsed, str(tmp_path), 'sample', unique=True) as fastq:
+        (names, seqs) = read_fastq(fastq)
+
+    ## each sequence once, sorted by count and named <name>_<rank>_x<count>
+    assert seqs == sorted(reads, key=lambda seq: -reads[seq])
+    assert [ name.decode() for name in names ] == [ '@sample_%d_x%d' %(rank, reads[seq]) for rank, seq in enumerate(seqs, 1) ]
+    assert sum([ collapse_reads.read_weight(name.decode()) for name in names ]) == sum(reads.values())
+
+############################
+def test_pipe_not_read(collapsed, tmp_path, monkeypatch):
+    """Software failing before opening the pipe does not block."""
+    monkeypatch.setitem(collapse_reads.collapse_settings, 'fifo', True)
+    with collapse_reads.expanded_fastq(collapsed, str(tmp_path), 'sample'):
+        pass
+    assert not (tmp_path / 'sample.expanded.fastq').exists()
+
+############################
+def test_read_weight():
+    assert collapse_reads.read_weight('sample_1_x25') == 25
+    assert collapse_reads.read_weight('read_without_count') == 1
@@ -0,0 +1,85 @@
+'''
+Tests XICRA.scripts.diff_expression with counts simulated from a negative binomial:
+false positive rate under the null and recovery of the log2 fold changes.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from XICRA.scripts import diff_expression
+
+## simulation
+n_features = 2000
+n_samples = 6
+fraction_DE = 0.1
+
+############################
+def simulate(seed=1):
+    """Returns counts, sample sheet, true log2 fold changes and true size factors."""
+    rng = np.random.default_rng(seed)
+    base_mean = np.exp(rng.uniform(np.log(20), np.log(5000), n_features))
+    dispersion = 0.05 + 1 / base_mean
+
+    log2fc = np.zeros(n_features)
+    n_DE = int(n_features * fraction_DE)
+    log2fc[:n_DE] = rng.choice([-1.5, 1.5], n_DE)
+
+    condition = np.array(['control'] * n_samples + ['case'] * n_samples)
+    factors = np.exp(rng.normal(0, 0.3, 2 * n_samples))
+    mu = base_mean[:, None] * factors[None, :] * np.where(condition == 'case', 2 ** log2fc[:, None], 1)
+
+    ## negative binomial: variance mu + dispersion * mu^2
+    size = 1 / dispersion[:, None]
+    counts = rng.negative_binomial(size, size / (size + mu))
+
+    samples = [ 'S%s' %i for i in range(2 * n_samples) ]
+    features = [ 'feature_%s' %i for i in range(n_features) ]
+    counts_df = pd.DataFrame(counts, index=features, columns=samples)
+    sample_sheet = pd.DataFrame({ 'condition': condition }, index=samples)
+    return (counts_df, sample_sheet, pd.Series(log2fc, index=features), pd.Series(factors, index=samples))
+
+############################
+@pytest.fixture(scope='module')
+def simulation():
+    return (simulate())
+
+############################
+@pytest.mark.parametrize('test', diff_expression.tests_available)
+def test_false_positive_rate(simulation, test):
+    (counts_df, sample_sheet, log2fc, factors) = simulation
+    results = diff_expression.DE_analysis(counts_df, sample_sheet, ['condition'], contrasts=['condition,case,control'], test=test)
+    table = results['results']['condition_case_vs_control']
+
+    null = (log2fc == 0).to_numpy()
+    pvalues = table['pvalue'].to_numpy()[null]
+    pvalues = pvalues[~np.isnan(pvalues)]
+    assert 0.02 < (pvalues < 0.05).mean() < 0.08
+
+    ## features called with padj < 0.05: few false discoveries and most true ones
+    called = (table['padj'] < 0.05).to_numpy()
+    assert (called & null).sum() / max(called.sum(), 1) < 0.1
+    assert (called & ~null).sum() / (~null).sum() > 0.8
+
+############################
+def test_log2_fold_change_recovery(simulation):
+    (counts_df, sample_sheet, log2fc, factors) = simulation
+    results = diff_expression.DE_analysis(counts_df, sample_sheet, ['condition'], contrasts=['condition,case,control'])
+    table = results['results']['condition_case_vs_control']
+
+    DE = (log2fc != 0).to_numpy()
+    estimated = table['log2FoldChange'].to_numpy()
+    assert np.median(np.abs(estimated[DE] - log2fc[DE])) < 0.2
+    assert abs(np.mean(estimated[~DE])) < 0.02
+    assert np.corrcoef(estimated, log2fc)[0, 1] > 0.9
+
+    ## errors within the standard errors: median absolute z-score of a normal is 0.674
+    z = (estimated - log2fc.to_numpy()) / table['lfcSE'].to_numpy()
+    assert 0.55 < np.median(np.abs(z)) < 0.8
+
+############################
+@pytest.mark.parametrize('method', diff_expression.normalization_methods)
+def test_size_factors(simulation, method):
+    (counts_df, sample_sheet, log2fc, factors) = simulation
+    estimated = diff_expression.size_factors(counts_df.to_numpy(dtype=np.float64), method)
+    expected = factors / np.exp(np.mean(np.log(factors)))
+    assert np.allclose(estimated / np.exp(np.mean(np.log(estimated))), expected, rtol=0.1)
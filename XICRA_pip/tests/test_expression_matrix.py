@@ -0,0 +1,90 @@
+'''
+Tests the expression matrices generated by XICRA.scripts.generate_DE: dense csv,
+sparse (mtx, parquet), reading samples in batches (memory budget) and updating
+the store with new samples (incremental) must generate the same matrices.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from XICRA.scripts import generate_DE, expression_matrix
+
+## samples simulated
+n_samples = 6
+n_features = 300
+
+############################
+def write_samples(folder, samples, seed=1):
+    """Writes the miRTop counts table of each sample and returns the dataframe of results (name, soft, filename)."""
+    rng = np.random.default_rng(seed)
+    uids = [ 'iso-22-%08X' %i for i in range(n_features) ]
+    reads = [ ''.join(rng.choice(list('ACGT'), 22)) for i in range(n_features) ]
+    rows = []
+    for sample in samples:
+        ## each sample contains a subset of features; a few UIDs are shared by two miRNAs
+        keep = np.flatnonzero(rng.random(n_features) < 0.6)
+        table = pd.DataFrame({ 'UID': [ uids[i] for i in keep ], 'Read': [ reads[i] for i in keep ],
+                               'miRNA': [ 'hsa-miR-%s' %(i % 40) for i in keep ],
+                               'Variant': [ 'iso_3p:-1' if i % 3 else 'NA' for i in keep ],
+                               'iso_5p': 0, 'iso_3p': 0, 'iso_add3p': 0, 'iso_snp': 0,
+                               sample: rng.integers(1, 1000, len(keep)) })
+        shared = table[table['UID'].isin(uids[:5])].assign(miRNA='hsa-miR-dup')
+        table = pd.concat([table, shared])
+        filename = os.path.join(folder, sample + '.tsv')
+        table.to_csv(filename, sep='\t', index=False)
+        rows.append({ 'name': sample, 'soft': 'native', 'filename': filename })
+    return (pd.DataFrame(rows))
+
+############################
+def read_result(prefix, out_format):
+    """Returns the matrix stored with features and samples sorted and missing values as zero."""
+    if out_format == 'csv':
+        data = pd.read_csv(prefix + '.csv', index_col=0).fillna(0)
+    else:
+        data = expression_matrix.read_matrix(prefix, out_format)
+    data.index = data.index.astype(str)
+    data.columns = data.columns.astype(str)
+    return (data.sort_index().sort_index(axis=1).astype(np.float64))
+
+############################
+@pytest.fixture(scope='module')
+def expected(tmp_path_factory):
+    """Dense csv matrices: all samples read at once."""
+    folder = tmp_path_factory.mktemp('csv')
+    results = write_samples(str(folder), [ 'S%s' %i for i in range(n_samples) ])
+    generate_DE.generate_DE(results, False, str(folder), out_format='csv')
+    prefix = os.path.join(str(folder), 'miRNA_expression-native')
+    return ({ name: read_result(prefix + name, 'csv') for name in ('', '_dup') })
+
+############################
+def check(expected, folder, out_format):
+    prefix = os.path.join(folder, 'miRNA_expression-native')
+    for name, matrix in expected.items():
+        assert not matrix.empty
+        pd.testing.assert_frame_equal(read_result(prefix + name, out_format), matrix, check_names=False)
+
+############################
+@pytest.mark.parametrize('out_format', ['mtx', 'parquet'])
+def test_sparse(expected, tmp_path, out_format):
+    if out_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    results = write_samples(str(tmp_path), [ 'S%s' %i for i in range(n_samples) ])
+    generate_DE.generate_DE(results, False, str(tmp_path), out_format=out_format)
+    check(expected, str(tmp_path), out_format)
+
+############################
+def test_memory_budget(expected, tmp_path):
+    ## a budget below a sample: a batch for each sample
+    results = write_samples(str(tmp_path), [ 'S%s' %i for i in range(n_samples) ])
+    generate_DE.generate_DE(results, False, str(tmp_path), out_format='mtx', memory_budget=1e-9)
+    check(expected, str(tmp_path), 'mtx')
+
+############################
+def test_incremental(expected, tmp_path):
+    ## first execution with some samples, then the rest are added
+    results = write_samples(str(tmp_path), [ 'S%s' %i for i in range(n_samples) ])
+    generate_DE.generate_DE(results.iloc[:n_samples // 2], False, str(tmp_path), out_format='mtx', incremental=True)
+    generate_DE.generate_DE(results, False, str(tmp_path), out_format='mtx', incremental=True)
+    check(expected, str(tmp_path), 'mtx')
@@ -0,0 +1,55 @@
+'''
+Tests XICRA.scripts.reduced_reference.lift_sam: exact alignments of the reduced reference
+are kept in genome coordinates and any other read is provided to be mapped against the genome.
+'''
+import io
+
+from XICRA.scripts import reduced_reference
+
+## reads of 20 nt aligned against region chr1:1001-1200
+seq = 'ACGTACGTAACCGGTTACGT'
+qual = 'ABCDEFGHIJKLMNOPQRST'
+sam = [
+    '@HD\tVN:1.4',
+    '@SQ\tSN:chr1:1001-1200\tLN:200',
+    '\t'.join(['exact', '0', 'chr1:1001-1200', '11', '255', '20M', '*', '0', '0', seq, qual, 'NH:i:1', 'nM:i:0']),
+    '\t'.join(['mismatch', '16', 'chr1:1001-1200', '31', '255', '20M', '*', '0', '0', seq, qual, 'NH:i:1', 'nM:i:1']),
+    '\t'.join(['clipped', '0', 'chr1:1001-1200', '51', '255', '2S18M', '*', '0', '0', seq, qual, 'NH:i:1', 'nM:i:0']),
+    '\t'.join(['pair', '99', 'chr1:1001-1200', '71', '255', '20M', '=', '91', '40', seq, qual, 'NH:i:1', 'nM:i:0']),
+    '\t'.join(['pair', '147', 'chr1:1001-1200', '91', '255', '20M', '=', '71', '-40', seq, qual, 'NH:i:1', 'nM:i:0']),
+    '\t'.join(['pair_mm', '99', 'chr1:1001-1200', '111', '255', '20M', '=', '131', '40', seq, qual, 'NH:i:1', 'nM:i:1']),
+    '\t'.join(['pair_mm', '147', 'chr1:1001-1200', '131', '255', '20M', '=', '111', '-40', seq, qual, 'NH:i:1', 'nM:i:1']),
+]
+
+############################
+def lift(tmp_path, mate_fhs):
+    sam_file = tmp_path / 'Aligned.out.sam'
+    sam_file.write_text('\n'.join(sam) + '\n')
+    out_fh = io.StringIO()
+    (n, n_fastq) = reduced_reference.lift_sam(str(sam_file), out_fh, mate_fhs)
+    alignments = [ line.split('\t') for line in out_fh.getvalue().splitlines() ]
+    return (n, n_fastq, alignments)
+
+############################
+def test_lift_all(tmp_path):
+    (n, n_fastq, alignments) = lift(tmp_path, None)
+    assert (n, n_fastq) == (7, 0)
+    assert [ (a[2], a[3]) for a in alignments ][:3] == [('chr1', '1011'), ('chr1', '1031'), ('chr1', '1051')]
+    assert (alignments[3][6], alignments[3][7]) == ('=', '1091')
+
+############################
+def test_lift_exact(tmp_path):
+    mate_fhs = [ io.StringIO(), io.StringIO() ]
+    (n, n_fastq, alignments) = lift(tmp_path, mate_fhs)
+
+    ## exact reads kept: single-end and both mates of the pair
+    assert (n, n_fastq) == (3, 3)
+    assert [ (a[0], a[2], a[3]) for a in alignments ] == [('exact', 'chr1', '1011'), ('pair', 'chr1', '1071'), ('pair', 'chr1', '1091')]
+
+    ## other reads as sequenced: reverse strand is restored
+    mate1 = mate_fhs[0].getvalue().splitlines()
+    mate2 = mate_fhs[1].getvalue().splitlines()
+    assert mate1[0::4] == ['@mismatch', '@clipped', '@pair_mm']
+    assert mate1[1] == 'ACGTAACCGGTTACGTACGT' and mate1[3] == qual[::-1]
+    assert mate1[5] == seq and mate1[7] == qual
+    assert mate2 == ['@pair_mm', 'ACGTAACCGGTTACGTACGT', '+', qual[::-1]]